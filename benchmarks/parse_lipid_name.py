@@ -0,0 +1,81 @@
+"""
+benchmarks/parse_lipid_name.py
+Dylan Ross (dylan.ross@pnnl.gov)
+
+    Throughput benchmark for lipid name parsing. Builds a corpus of lipid names with a
+    skewed (Zipf-like) repeat distribution, similar to what is encountered in lipid
+    annotation where the same sum composition and chain-level names show up across many
+    features, then compares parsing with the full regex (uncached) against the cached
+    parser with the fast path for simple names
+
+    usage: python benchmarks/parse_lipid_name.py [n_names]
+"""
+
+
+import sys
+import time
+
+import numpy as np
+
+from lipidimea._lipidlib.lipids import lmaps_sum_comp_names
+from lipidimea._lipidlib.parser import (
+    _parse_lipid_name_regex, parse_lipid_name, parse_lipid_name_info
+)
+
+
+# (LMAPS ID prefix, class abbreviation, number of chains) for the corpus
+_CLASSES = [
+    ("LMGP0101", "PC", 2),
+    ("LMGP0201", "PE", 2),
+    ("LMGP0301", "PS", 2),
+    ("LMGP0401", "PG", 2),
+    ("LMGP0601", "PI", 2),
+    ("LMGP0105", "LPC", 1),
+    ("LMGP0205", "LPE", 1),
+    ("LMGL0301", "TG", 3),
+    ("LMGL0201", "DG", 2),
+]
+
+
+def _build_unique_names(rng: np.random.Generator) -> list[str]:
+    """ sum composition names, chain-level names and a few names that require the full regex """
+    names = []
+    fa_cs = np.arange(12, 25)
+    fa_us = np.arange(0, 7)
+    for lmid_prefix, abbrev, n_chains in _CLASSES:
+        cs, us = np.meshgrid(fa_cs * n_chains, fa_us, indexing="ij")
+        names += lmaps_sum_comp_names(lmid_prefix, cs.ravel(), us.ravel())
+        for _ in range(500):
+            chains = [f"{rng.choice(fa_cs)}:{rng.choice(fa_us)}" for _ in range(n_chains)]
+            names.append(f"{abbrev} {'_'.join(chains)}")
+    # names that do not have a simple shape
+    for c in fa_cs:
+        names += [f"PC O-{2 * c}:1", f"PE P-{2 * c}:1", f"Cer {c + 18}:1;O2", f"PC {c}:0/18:1"]
+    return sorted(set(names))
+
+
+def main(n_names: int = 1_000_000) -> None:
+    rng = np.random.default_rng(420)
+    unique = _build_unique_names(rng)
+    # skewed repeat distribution
+    weights = 1. / np.arange(1, len(unique) + 1)
+    weights /= weights.sum()
+    corpus = [unique[i] for i in rng.choice(len(unique), size=n_names, p=weights)]
+    print(f"corpus: {n_names} names ({len(unique)} unique)")
+    for label, func in [
+        ("regex (uncached)", _parse_lipid_name_regex),
+        ("parse_lipid_name", parse_lipid_name),
+        ("parse_lipid_name_info", parse_lipid_name_info),
+    ]:
+        parse_lipid_name_info.cache_clear()
+        t0 = time.perf_counter()
+        for name in corpus:
+            func(name)
+        dt = time.perf_counter() - t0
+        print(f"{label:>24s}: {dt:7.2f} s ({n_names / dt:12,.0f} names/s)")
+    print(parse_lipid_name_info.cache_info())
+
+
+if __name__ == "__main__":
+    main(*[int(_) for _ in sys.argv[1:2]])
+
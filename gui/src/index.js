@@ -347,25 +347,61 @@ ipcMain.on('fetch-database-table', (event, filePath) => {
 });
 
 
-function fetchRawBlob(featId, rawType, callback) {
-  // Open the database using the global dbPath.
-  const db = new sqlite3.Database(dbPath);
-  const query = `
-    SELECT raw_data 
+// Max number of points to load for plotting a piece of raw data (XIC, ATD, spectrum). If the
+// results database has downsampled versions of the raw data (RawDownsampled table, from 
+// `LipidIMEA utility downsample_raw`) the largest one that fits is loaded instead of the full data.
+const RAW_POINT_BUDGET = 4096;
+
+function rawBlobQuery(featIdType, downsampled) {
+  const rawData = downsampled ? `
+      COALESCE(
+        (SELECT d.raw_data 
+         FROM RawDownsampled d 
+         WHERE d.raw_id = Raw.raw_id 
+           AND Raw.raw_n > ${RAW_POINT_BUDGET} 
+           AND d.raw_n <= ${RAW_POINT_BUDGET}
+         ORDER BY d.raw_n DESC 
+         LIMIT 1),
+        raw_data
+      ) AS raw_data` : 'raw_data';
+  return `
+    SELECT ${rawData}
     FROM Raw 
-    WHERE feat_id_type = 'dia_pre_id' 
+    WHERE feat_id_type = '${featIdType}' 
       AND feat_id = ? 
       AND raw_type = ?
   `;
-  db.get(query, [featId, rawType], (error, row) => {
+}
+
+// Fetch a raw data blob for a feature (downsampled if available), passes the blob (or null if 
+// not found) to the callback.
+function fetchRawBlobForFeature(featIdType, featId, rawType, callback) {
+  // Open the database using the global dbPath.
+  const db = new sqlite3.Database(dbPath);
+  db.get(rawBlobQuery(featIdType, true), [featId, rawType], (error, row) => {
+    if (error && error.message.includes('no such table')) {
+      // results database created before downsampled raw data were added
+      db.get(rawBlobQuery(featIdType, false), [featId, rawType], (error2, row2) => {
+        callback(error2, row2 ? row2.raw_data : null);
+        db.close();
+      });
+      return;
+    }
+    callback(error, row ? row.raw_data : null);
+    db.close();
+  });
+}
+
+
+function fetchRawBlob(featId, rawType, callback) {
+  fetchRawBlobForFeature('dia_pre_id', featId, rawType, (error, blob) => {
     if (error) {
       console.error(`Error fetching ${rawType} blob for feature ${featId}:`, error);
       callback(error);
     } else {
       // Return the blob data (or null if not found)
-      callback(null, row ? row.raw_data : null);
+      callback(null, blob);
     }
-    db.close();
   });
 }
 
@@ -395,12 +431,39 @@ ipcMain.on('fetch-raw-blob', (event, { featId, rawType }) => {
   });
 });
 
+// Annotations that passed the RT range and CCS trend filters (FilteredLipids view), falling back
+// to the Lipids table for results databases created before filtering only flagged annotations
+function fetchFilteredLipids(db, callback) {
+  db.all('SELECT * FROM FilteredLipids', (error, rows) => {
+    if (error && error.message.includes('no such table')) {
+      db.all('SELECT * FROM Lipids', callback);
+      return;
+    }
+    callback(error, rows);
+  });
+}
+
+// Delete raw data for a set of features along with their downsampled versions (RawDownsampled),
+// which would otherwise get picked up by new raw data that reuse the same raw_id values. Results
+// databases created before downsampled raw data were added do not have the RawDownsampled table.
+function deleteRaw(db, featIdType, featIds, callback) {
+  const placeholders = featIds.map(() => '?').join(',');
+  const params = [featIdType, ...featIds];
+  db.run(`DELETE FROM RawDownsampled WHERE raw_id IN (SELECT raw_id FROM Raw WHERE feat_id_type = ? AND feat_id IN (${placeholders}))`, params, (error) => {
+    if (error && !error.message.includes('no such table')) {
+      callback(error);
+      return;
+    }
+    db.run(`DELETE FROM Raw WHERE feat_id_type = ? AND feat_id IN (${placeholders})`, params, callback);
+  });
+}
+
 // Run SQL Query to get annotation table
 ipcMain.on('fetch-annotation-table', (event, filePath) => {
   const db = new sqlite3.Database(filePath);
   console.log("LOG: index.js: Fetch data in 'fetch-annotation-table' function");
 
-  db.all('SELECT * FROM Lipids', (error, data) => {
+  fetchFilteredLipids(db, (error, data) => {
     if (error) {
       console.error('Error fetching data from the database:', error);
       event.reply('database-annotation-data', data, false, error.message, filePath);
@@ -545,22 +608,13 @@ ipcMain.on('fetch-dda-features', (event, { diaMz, tolerance }) => {
 
 
 function fetchDDABlob(featId, blobType, callback) {
-  const db = new sqlite3.Database(dbPath);
-  const query = `
-    SELECT raw_data
-    FROM Raw
-    WHERE feat_id_type = 'dda_pre_id'
-      AND feat_id = ?
-      AND raw_type = ?
-  `;
-  db.get(query, [featId, blobType], (error, row) => {
+  fetchRawBlobForFeature('dda_pre_id', featId, blobType, (error, blob) => {
     if (error) {
       console.error(`Error fetching ${blobType} blob for DDA feature ${featId}:`, error);
       callback(error);
     } else {
-      callback(null, row ? row.raw_data : null);
+      callback(null, blob);
     }
-    db.close();
   });
 }
 
@@ -646,22 +700,13 @@ ipcMain.on('fetch-decon-fragments', (event, dia_pre_id) => {
 
 // ---------- Fetch blob for decon fragments (feat_id_type 'dia_frag_id') ----------
 function fetchRawBlobDecon(featId, rawType, callback) {
-  const db = new sqlite3.Database(dbPath);
-  const query = `
-    SELECT raw_data 
-    FROM Raw 
-    WHERE feat_id_type = 'dia_frag_id'
-      AND feat_id = ?
-      AND raw_type = ?
-  `;
-  db.get(query, [featId, rawType], (error, row) => {
+  fetchRawBlobForFeature('dia_frag_id', featId, rawType, (error, blob) => {
     if (error) {
       console.error(`Error fetching ${rawType} blob for decon feature ${featId}:`, error);
       callback(error);
     } else {
-      callback(null, row ? row.raw_data : null);
+      callback(null, blob);
     }
-    db.close();
   });
 }
 
@@ -746,7 +791,7 @@ ipcMain.on('delete-diaprecursor-rows', (event, rowsArray) => {
                 return;
               }
               // 6. Delete from Raw for precursor data.
-              db.run(`DELETE FROM Raw WHERE feat_id_type = 'dia_pre_id' AND feat_id IN (${prePlaceholders})`, rowsArray, function(err6) {
+              deleteRaw(db, 'dia_pre_id', rowsArray, function(err6) {
                 if (err6) {
                   db.run("ROLLBACK");
                   event.reply('delete-diaprecursor-rows-result', { success: false, error: err6.message });
@@ -762,7 +807,7 @@ ipcMain.on('delete-diaprecursor-rows', (event, rowsArray) => {
                         callback(err7);
                         return;
                       }
-                      db.run(`DELETE FROM Raw WHERE feat_id_type = 'dia_frag_id' AND feat_id IN (${fragPlaceholders})`, fragIds, function(err8) {
+                      deleteRaw(db, 'dia_frag_id', fragIds, function(err8) {
                         callback(err8);
                       });
                     });
@@ -886,8 +931,8 @@ ipcMain.on('delete-annotated-feature-rows', (event, lipidIds) => {
               db.close();
               return;
             }
-            // After successful commit, re-query the Lipids table so the renderer can update its annotation table.
-            db.all('SELECT * FROM Lipids', (errFetch, rows) => {
+            // After successful commit, re-query the (filtered) annotations so the renderer can update its annotation table.
+            fetchFilteredLipids(db, (errFetch, rows) => {
               if (errFetch) {
                 event.reply('delete-annotated-feature-rows-result', { success: true, error: errFetch.message });
               } else {
@@ -43,7 +43,7 @@ __version__ = '0.13.3'
 #       types and the docstring should provide explanation. See example below:
 #
 #       def export_results_table(results_db: ResultsDbPath,
-#                                out_csv: str,
+#                                out_file: str,
 #                                tolerances: Tuple[float, float, float],
 #                                select_data_files: Optional[Union[List[int], List[str]]],
 #                                include_unknowns: bool = False,
@@ -64,7 +64,7 @@ __version__ = '0.13.3'
 #           ----------
 #           results_db
 #               results database with annotated DIA features
-#           out_csv
+#           out_file
 #               output results file (.csv)
 #           tolerances
 #               tuple of tolerances (m/z, RT, arrival time) for combining DIA precursors
@@ -10,7 +10,7 @@ import argparse
 
 from lipidimea.params import AnnotationParams
 from lipidimea.annotation import (
-    annotate_lipids
+    annotate_lipids, refilter_lipid_annotations
 )
 
 
@@ -29,12 +29,41 @@ def setup_annotate_subparser(parser: argparse.ArgumentParser):
         "RESULTS_DB",
         help="results database file (.db)"
     )
+    parser.add_argument(
+        "--n-proc",
+        default=1,
+        type=int,
+        help="set >1 to parallelize parts of the annotation (default=1)"
+    )
+    parser.add_argument(
+        "--refilter",
+        action="store_true",
+        help="only re-apply the RT range and CCS trend filters to existing annotations"
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only annotate DIA features that have not already been annotated with the same "
+             "parameters (e.g., after adding data files), ignored with --refilter"
+    )
+    parser.add_argument(
+        "--frag-library",
+        default=None,
+        metavar="FRAG_LIB",
+        help="theoretical fragment library file (.npz), built and saved there if it does not exist yet"
+    )
 
 
 def annotate_run(args: argparse.Namespace):
     """ perform lipid annotation """
     # load the parameters
     params = AnnotationParams.from_config(args.PARAMS_CONFIG)
-    # annotate lipids
-    _ = annotate_lipids(args.RESULTS_DB, params, debug_flag="text")
+    if args.refilter:
+        # re-filter existing lipid annotations
+        _ = refilter_lipid_annotations(args.RESULTS_DB, params, debug_flag="text", n_proc=args.n_proc, 
+                                       frag_library=args.frag_library)
+    else:
+        # annotate lipids
+        _ = annotate_lipids(args.RESULTS_DB, params, debug_flag="text", n_proc=args.n_proc, 
+                            incremental=args.incremental, frag_library=args.frag_library)
 
@@ -7,11 +7,11 @@ Dylan Ross (dylan.ross@pnnl.gov)
 
 
 import argparse
-import sqlite3
 import os
 import errno
 
 from lipidimea.params import DiaParams
+from lipidimea.util import connect_results_db
 from lipidimea.msms.dia import (
     extract_dia_features,
     extract_dia_features_multiproc,
@@ -49,6 +49,13 @@ def _setup_process_subparser(parser: argparse.ArgumentParser):
         type=int,
         help="set >1 to processes multiple data files in parallel (default=1)"
     )
+    parser.add_argument(
+        "--shards",
+        action="store_true",
+        default=False,
+        help="with --n-proc >1, process each data file into a separate shard database then merge them "
+             "into the results database"
+    )
 
 
 def _process_run(args: argparse.Namespace):
@@ -58,7 +65,8 @@ def _process_run(args: argparse.Namespace):
     # extract the DDA features
     if args.n_proc > 1:
         _ = extract_dia_features_multiproc(
-            args.DIA_MZA, args.RESULTS_DB, params, n_proc=args.n_proc, debug_flag="text_pid"
+            args.DIA_MZA, args.RESULTS_DB, params, n_proc=args.n_proc, debug_flag="text_pid",
+            shards=args.shards
         )
     else:
         for dia_data_file in args.DIA_MZA:
@@ -81,7 +89,8 @@ def _setup_list_subparser(parser: argparse.ArgumentParser):
     parser.add_argument(
         "list_choice",
         choices=[
-            "file_ids"
+            "file_ids",
+            "file_summary"
         ],
         help="which information to fetch"
     )
@@ -101,7 +110,24 @@ _QUERIES = {
             JOIN DataFiles USING(dfile_id)
         ORDER BY
             dfile_name
-    --endsql"""
+    --endsql""",
+    "file_summary": """--beginsql
+        SELECT
+            dfile_id,
+            dfile_name,
+            n_dia_precursors,
+            n_dia_fragments,
+            n_dia_decon_fragments,
+            n_dia_annotated,
+            n_dia_annotations
+        FROM 
+            DataFileSummary
+            JOIN DataFiles USING(dfile_id)
+        WHERE
+            n_dia_precursors > 0
+        ORDER BY
+            dfile_name
+    --endsql""",
 }
 
 
@@ -113,7 +139,7 @@ def _list_run(args: argparse.Namespace):
                                 os.strerror(errno.ENOENT), 
                                 args.RESULTS_DB)
     # connect to database
-    con = sqlite3.connect(args.RESULTS_DB)
+    con = connect_results_db(args.RESULTS_DB, profile="read")
     cur = con.cursor()
     # fetch requested information
     match args.list_choice:
@@ -121,6 +147,15 @@ def _list_run(args: argparse.Namespace):
             print("dfile_id\tdfile_name")
             for dfid, dfname in cur.execute(_QUERIES["file_id"]).fetchall():
                 print(f"{dfid}\t{dfname}")
+        case "file_summary":
+            has_summary = cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='DataFileSummary'").fetchone()[0] > 0
+            if not has_summary:
+                con.close()
+                raise RuntimeError("results database does not have summary tables yet, "
+                                   "upgrade it first (lipidimea utility upgrade_db)")
+            print("dfile_id\tdfile_name\tprecursors\tfragments\tdeconvoluted_fragments\tannotated\tannotations")
+            for row in cur.execute(_QUERIES["file_summary"]).fetchall():
+                print("\t".join(map(str, row)))
     # clean up
     con.close()
 
@@ -9,7 +9,11 @@ Dylan Ross (dylan.ross@pnnl.gov)
 import argparse
 
 from lipidimea.params import DdaParams, DiaParams, AnnotationParams
-from lipidimea.util import create_results_db, export_results_table
+from lipidimea.util import (
+    create_results_db, upgrade_results_db, merge_results_db_shards, refresh_summary_tables, 
+    export_results_table
+)
+from lipidimea.results import RAW_DOWNSAMPLE_LEVELS, DOWNSAMPLE_METHODS, build_raw_downsampled
 
 
 #------------------------------------------------------------------------------
@@ -79,12 +83,140 @@ def _setup_create_db_subparser(parser: argparse.ArgumentParser):
     )
 
 
+#------------------------------------------------------------------------------
+# utility upgrade_db subcommand
+
+
+_UPGRADE_DB_DESCRIPTION = """
+    Upgrade a results database created with an older version of LipidIMEA to the current schema 
+    version in place, and create indexes
+"""
+
+
+def _setup_upgrade_db_subparser(parser: argparse.ArgumentParser):
+    """ setup subparser for utility upgrade_db subcommand """
+    parser.add_argument(
+        "RESULTS_DB",
+        help="results database file (.db)"
+    )
+    parser.add_argument(
+        "--no-indexes",
+        action="store_true",
+        default=False,
+        help="only upgrade the schema, do not create indexes"
+    )
+
+
+def _upgrade_db_run(args: argparse.Namespace):
+    """ run function for utility upgrade_db subcommand """
+    old_version, new_version = upgrade_results_db(args.RESULTS_DB, create_indexes=not args.no_indexes)
+    print(f"results database schema version: {old_version} -> {new_version}")
+
+
+#------------------------------------------------------------------------------
+# utility merge_shards subcommand
+
+
+_MERGE_SHARDS_DESCRIPTION = """
+    Merge shard databases with DIA features (e.g. processed on separate compute nodes) into a 
+    results database
+"""
+
+
+def _setup_merge_shards_subparser(parser: argparse.ArgumentParser):
+    """ setup subparser for utility merge_shards subcommand """
+    parser.add_argument(
+        "RESULTS_DB",
+        help="results database file (.db)"
+    )
+    parser.add_argument(
+        "SHARD_DB",
+        nargs="+",
+        help="shard database files to merge into the results database, in order"
+    )
+    parser.add_argument(
+        "--remove",
+        action="store_true",
+        default=False,
+        help="delete the shard database files after merging"
+    )
+
+
+def _merge_shards_run(args: argparse.Namespace):
+    """ run function for utility merge_shards subcommand """
+    n = merge_results_db_shards(args.RESULTS_DB, args.SHARD_DB, remove_shards=args.remove)
+    print(f"merged {n} DIA features from {len(args.SHARD_DB)} shards")
+
+
+#------------------------------------------------------------------------------
+# utility refresh_summaries subcommand
+
+
+_REFRESH_SUMMARIES_DESCRIPTION = """
+    Rebuild the summary tables (feature counts per data file, fragment and annotation summaries 
+    per DIA feature), only needed if the results database was modified outside of the analysis 
+    steps (e.g. features deleted using the GUI)
+"""
+
+
+def _setup_refresh_summaries_subparser(parser: argparse.ArgumentParser):
+    """ setup subparser for utility refresh_summaries subcommand """
+    parser.add_argument(
+        "RESULTS_DB",
+        help="results database file (.db)"
+    )
+
+
+#------------------------------------------------------------------------------
+# utility downsample_raw subcommand
+
+
+_DOWNSAMPLE_RAW_DESCRIPTION = """
+    Store downsampled versions of the raw data (XICs, ATDs, spectra) at multiple resolutions, for 
+    faster plotting
+"""
+
+
+def _setup_downsample_raw_subparser(parser: argparse.ArgumentParser):
+    """ setup subparser for utility downsample_raw subcommand """
+    parser.add_argument(
+        "RESULTS_DB",
+        help="results database file (.db)"
+    )
+    parser.add_argument(
+        "--levels",
+        nargs="+",
+        type=int,
+        default=RAW_DOWNSAMPLE_LEVELS,
+        help=f"max number of points for each downsampled version (default={RAW_DOWNSAMPLE_LEVELS})"
+    )
+    parser.add_argument(
+        "--method",
+        choices=DOWNSAMPLE_METHODS,
+        default="minmax",
+        help="downsampling method, min/max decimation or Largest-Triangle-Three-Buckets (default=minmax)"
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        default=False,
+        help="replace existing downsampled versions of the raw data"
+    )
+
+
+def _downsample_raw_run(args: argparse.Namespace):
+    """ run function for utility downsample_raw subcommand """
+    n = build_raw_downsampled(args.RESULTS_DB, levels=args.levels, method=args.method, overwrite=args.overwrite)
+    print(f"downsampled {n} pieces of raw data")
+
+
 #------------------------------------------------------------------------------
 # utility export subcommand
 
 
 _EXPORT_DESCRIPTION = """
-    Export analysis results to CSV
+    Export analysis results to CSV, Parquet, or Arrow IPC (format determined from the output 
+    file extension)
 """
 
 
@@ -95,8 +227,8 @@ def _setup_export_subparser(parser: argparse.ArgumentParser):
         help="results database file (.db)"
     )
     parser.add_argument(
-        "OUT_CSV",
-        help="export to file name (.csv)"
+        "OUT_FILE",
+        help="export to file name (.csv, .parquet, or .arrow)"
     )
     parser.add_argument(
         "--mz-tol", 
@@ -132,6 +264,34 @@ def _setup_export_subparser(parser: argparse.ArgumentParser):
         default="union",
         help="strategy for combining annotations among grouped features (default='union')"
     )
+    parser.add_argument(
+        "--alignment",
+        choices=[
+            "first_match", "connected_components"
+        ],
+        default="first_match",
+        help="strategy for aligning features across data files (default='first_match')"
+    )
+    parser.add_argument(
+        "--compression",
+        default=None,
+        help="compression for Parquet (default='zstd') or Arrow IPC (default='uncompressed') output"
+    )
+    parser.add_argument(
+        "--db-chunk-size",
+        type=int,
+        default=None,
+        help="process DIA features from the database in chunks of this many (in order of m/z) to limit "
+             "memory use for very large results databases"
+    )
+    parser.add_argument(
+        "--reuse-alignment",
+        action="store_true",
+        default=False,
+        help="reuse the alignment of DIA features across data files stored in the results database "
+             "by a previous export (with this option) with the same parameters, NOTE: this writes into "
+             "the results database, storing the alignment if there is not already a matching one"
+    )
     parser.add_argument(
         "--max-precursor-ppm",
         type=float,
@@ -156,14 +316,18 @@ def _export_run(args: argparse.Namespace):
     """ run function for utility export subcommand """
     _ = export_results_table(
         args.RESULTS_DB, 
-        args.OUT_CSV, 
+        args.OUT_FILE, 
         (args.mz_tol, args.rt_tol, args.at_tol), 
         select_data_files=args.DFILE_ID, 
         # it's dt_height or dt_area, add the dt_ to the front
         abundance_value="dt_" + args.abundance, 
         include_unknowns=args.include_unknowns, 
         limit_precursor_mz_ppm=args.max_precursor_ppm, 
-        annotation_combine_strategy=args.annotation_combine_strategy
+        annotation_combine_strategy=args.annotation_combine_strategy,
+        alignment=args.alignment,
+        compression=args.compression,
+        db_chunk_size=args.db_chunk_size,
+        reuse_alignment=args.reuse_alignment
     )
 
 
@@ -199,11 +363,43 @@ def setup_utility_subparser(parser: argparse.ArgumentParser):
             description=_CREATE_DB_DESCRIPTION
         )
     )
+    # set up upgrade_db subparser
+    _setup_upgrade_db_subparser(
+            _subparsers.add_parser(
+            "upgrade_db", 
+            help="upgrade results database",
+            description=_UPGRADE_DB_DESCRIPTION
+        )
+    )
+    # set up merge_shards subparser
+    _setup_merge_shards_subparser(
+            _subparsers.add_parser(
+            "merge_shards", 
+            help="merge shard databases into results database",
+            description=_MERGE_SHARDS_DESCRIPTION
+        )
+    )
+    # set up refresh_summaries subparser
+    _setup_refresh_summaries_subparser(
+            _subparsers.add_parser(
+            "refresh_summaries", 
+            help="rebuild summary tables",
+            description=_REFRESH_SUMMARIES_DESCRIPTION
+        )
+    )
+    # set up downsample_raw subparser
+    _setup_downsample_raw_subparser(
+            _subparsers.add_parser(
+            "downsample_raw", 
+            help="downsample raw data for plotting",
+            description=_DOWNSAMPLE_RAW_DESCRIPTION
+        )
+    )
     # set up export subparser
     _setup_export_subparser(
             _subparsers.add_parser(
             "export", 
-            help="export results to CSV",
+            help="export results to CSV, Parquet, or Arrow IPC",
             description=_EXPORT_DESCRIPTION
         )
     )
@@ -217,5 +413,14 @@ def utility_run(args: argparse.Namespace):
         case "create_db":
             # no need for separate "run" function
             create_results_db(args.RESULTS_DB, overwrite=args.overwrite)
+        case "upgrade_db":
+            _upgrade_db_run(args)
+        case "merge_shards":
+            _merge_shards_run(args)
+        case "refresh_summaries":
+            # no need for separate "run" function
+            refresh_summary_tables(args.RESULTS_DB)
+        case "downsample_raw":
+            _downsample_raw_run(args)
         case "export":
             _export_run(args)
\ No newline at end of file
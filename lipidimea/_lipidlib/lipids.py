@@ -9,10 +9,13 @@ Dylan Ross (dylan.ross@pnnl.gov)
 import os
 from itertools import product
 from functools import total_ordering
-from typing import Generator, Tuple, List, Optional, Callable
+from typing import Generator, Tuple, List, Optional, Callable, Dict, Union
 import enum
 
 import yaml
+import numpy as np
+import numpy.typing as npt
+from mzapy.isotopes import _ELEMENT_MONOISO_MASS, _HEAVY_ISOTOPE_MASS, _ADDUCT_FORMULAS, _ADDUCT_CHARGES
 
 from lipidimea.util import INCLUDE_DIR
 
@@ -24,6 +27,179 @@ with open(_LMAPS_YAML, "r") as _yf:
     LMAPS = yaml.safe_load(_yf)
 
 
+def _compile_formula(formula: Dict[str, Union[int, str]]
+                     ) -> Tuple[Tuple[str, ...], npt.NDArray[np.int64]] :
+    """
+    compile a LMAPS formula template (element counts as ints or expressions in c and u) into
+    integer coefficients such that count = a + b * c + d * u for each element
+
+    Raises a ValueError if any of the count expressions is not linear in c and u
+
+    Parameters
+    ----------
+    formula : ``dict(str:(int or str))``
+        formula template from LMAPS
+
+    Returns
+    -------
+    elements : ``tuple(str)``
+        elements in the formula (same order as the template)
+    coefs : ``numpy.ndarray(int)``
+        array with shape (n_elements, 3) containing the (a, b, d) coefficients for each element
+    """
+    elements = tuple(formula.keys())
+    coefs = np.zeros((len(elements), 3), dtype=np.int64)
+    for i, count in enumerate(formula.values()):
+        if type(count) is int:
+            coefs[i, 0] = count
+        else:
+            f = eval("lambda c, u: " + count)
+            a = f(0, 0)
+            coefs[i] = a, f(1, 0) - a, f(0, 1) - a
+            # make sure the expression is actually linear
+            for c, u in [(2, 3), (17, 5), (40, 12)]:
+                if f(c, u) != coefs[i, 0] + coefs[i, 1] * c + coefs[i, 2] * u:
+                    msg = "_compile_formula: count expression ('{}') is not linear in c and u"
+                    raise ValueError(msg.format(count))
+    return elements, coefs
+
+
+# compile the formula templates once, at load time
+# keys: LMID prefix
+# values: (elements, coefs) from _compile_formula
+_LMAPS_FORMULAS = {lmid_prefix: _compile_formula(info["formula"]) for lmid_prefix, info in LMAPS.items()}
+
+
+def lmaps_formula_counts(lmid_prefix: str, 
+                         fa_carbon: npt.ArrayLike, 
+                         fa_unsat: npt.ArrayLike
+                         ) -> Tuple[Tuple[str, ...], npt.NDArray[np.int64]] :
+    """
+    compute element counts for a lipid class across many sum compositions at once using
+    the compiled LMAPS formula templates
+
+    Parameters
+    ----------
+    lmid_prefix : ``str``
+        Lipid MAPS ID prefix denoting lipid classification
+    fa_carbon : ``int`` or array of ``int``
+        fatty acid carbon count(s) (all acyl chains)
+    fa_unsat : ``int`` or array of ``int``
+        fatty acid unsaturation count(s) (all acyl chains)
+
+    Returns
+    -------
+    elements : ``tuple(str)``
+        elements in the formula
+    counts : ``numpy.ndarray(int)``
+        element counts with shape (n_compositions, n_elements), or (n_elements,) if fa_carbon 
+        and fa_unsat are scalars
+    """
+    if (compiled := _LMAPS_FORMULAS.get(lmid_prefix)) is None:
+        msg = "lmaps_formula_counts: unrecognized LMID prefix: {}"
+        raise ValueError(msg.format(lmid_prefix))
+    elements, coefs = compiled
+    c = np.asarray(fa_carbon, dtype=np.int64)
+    u = np.asarray(fa_unsat, dtype=np.int64)
+    counts = coefs[:, 0] + np.multiply.outer(c, coefs[:, 1]) + np.multiply.outer(u, coefs[:, 2])
+    return elements, counts
+
+
+def _element_mass(element: str
+                  ) -> float :
+    """ monoisotopic mass of an element (or heavy isotope) """
+    if element in _ELEMENT_MONOISO_MASS:
+        return _ELEMENT_MONOISO_MASS[element]
+    elif element in _HEAVY_ISOTOPE_MASS:
+        return _HEAVY_ISOTOPE_MASS[element]
+    msg = "_element_mass: element \"{}\" not recognized"
+    raise ValueError(msg.format(element))
+
+
+def _formula_masses(counts: npt.NDArray[np.int64], 
+                    element_masses: npt.NDArray[np.float64]
+                    ) -> npt.NDArray[np.float64] :
+    """ 
+    monoisotopic masses from element counts (last axis), accumulated one element at a time in 
+    the same order as ``mzapy.isotopes.monoiso_mass`` so the results are identical
+    """
+    masses = np.zeros(counts.shape[:-1])
+    for i, element_mass in enumerate(element_masses):
+        masses = masses + element_mass * counts[..., i]
+    # NOTE: numpy.round does not always agree with the builtin round in the last digit
+    return np.array([round(m, 6) for m in masses.ravel().tolist()]).reshape(masses.shape)
+
+
+def lmaps_class_masses(lmid_prefix: str, 
+                       fa_carbon: npt.ArrayLike, 
+                       fa_unsat: npt.ArrayLike,
+                       adducts: Optional[List[str]] = None
+                       ) -> Tuple[npt.NDArray[np.float64], Dict[str, npt.NDArray[np.float64]]] :
+    """
+    compute monoisotopic masses and adduct m/zs for a lipid class across many sum compositions
+    at once, using element count matrices from the compiled LMAPS formula templates combined with
+    a vector of element masses
+
+    Results are the same as computing ``mzapy.isotopes.monoiso_mass`` or ``mzapy.isotopes.ms_adduct_mz``
+    on ``Lipid(lmid_prefix, c, u).formula`` for each sum composition
+
+    Parameters
+    ----------
+    lmid_prefix : ``str``
+        Lipid MAPS ID prefix denoting lipid classification
+    fa_carbon : array of ``int``
+        fatty acid carbon counts (all acyl chains)
+    fa_unsat : array of ``int``
+        fatty acid unsaturation counts (all acyl chains)
+    adducts : ``list(str)``, optional
+        MS adducts to compute m/zs for
+
+    Returns
+    -------
+    masses : ``numpy.ndarray(float)``
+        neutral monoisotopic masses
+    adduct_mzs : ``dict(str:numpy.ndarray(float))``
+        m/zs for each of the specified adducts
+    """
+    elements, counts = lmaps_formula_counts(lmid_prefix, fa_carbon, fa_unsat)
+    adducts = adducts if adducts is not None else []
+    for adduct in adducts:
+        if adduct not in _ADDUCT_FORMULAS:
+            msg = "lmaps_class_masses: MS adduct \"{}\" not recognized"
+            raise ValueError(msg.format(adduct))
+    # add columns for any elements that only show up in the adducts
+    all_elements = list(elements)
+    for adduct in adducts:
+        all_elements += [e for e in _ADDUCT_FORMULAS[adduct] if e not in all_elements]
+    element_masses = np.array([_element_mass(e) for e in all_elements])
+    counts = np.concatenate([counts, np.zeros(counts.shape[:-1] + (len(all_elements) - len(elements),), dtype=np.int64)], 
+                            axis=-1)
+    masses = _formula_masses(counts, element_masses)
+    adduct_mzs = {}
+    for adduct in adducts:
+        adduct_counts = np.array([_ADDUCT_FORMULAS[adduct].get(e, 0) for e in all_elements])
+        adduct_mzs[adduct] = _formula_masses(counts + adduct_counts, element_masses) / _ADDUCT_CHARGES[adduct]
+    return masses, adduct_mzs
+
+
+def lmaps_sum_comp_names(lmid_prefix: str, 
+                         fa_carbon: npt.ArrayLike, 
+                         fa_unsat: npt.ArrayLike
+                         ) -> List[str] :
+    """
+    generate lipid names (same as ``str(Lipid(lmid_prefix, c, u))``) for a lipid class across many 
+    sum compositions at once
+    """
+    lipid_info = LMAPS[lmid_prefix]
+    oxy_suffix = lipid_info.get("oxy_suffix", "")
+    oxy_suffix = ";" + oxy_suffix if oxy_suffix != "" else ""
+    prefix = "{} {}".format(lipid_info["class_abbrev"], lipid_info.get("fa_mod", ""))
+    return [
+        f"{prefix}{c}:{u}{oxy_suffix}" 
+        for c, u in zip(np.asarray(fa_carbon).tolist(), np.asarray(fa_unsat).tolist())
+    ]
+
+
 # define ID levels
 # NOTE: The identification level scheme is taken from here: 
 #       https://www.jlr.org/article/S0022-2275(20)60017-7/fulltext
@@ -105,6 +281,12 @@ class Lipid():
         Identification level
     """
 
+    __slots__ = (
+        "lipid_class_abbrev", "fa_carbon", "fa_unsat", "fa_mod", "oxy_suffix", 
+        "lmaps_category", "lmaps_class", "lmaps_subclass", "lmaps_id_prefix", 
+        "formula", "n_chains", "n_chains_full"
+    )
+
     def __init__(self, 
                  lmid_prefix: str, 
                  fa_carbon: int, 
@@ -144,13 +326,12 @@ class Lipid():
         # fetch classification information using lipid class abbrev and fa modifier
         self.lmaps_category, self.lmaps_class, self.lmaps_subclass = lipid_info["classification"]
         self.lmaps_id_prefix = lmid_prefix
-        # construct the molecular formula using FA composition and rules lipid_info
-        self.formula = {}
-        for element, count in lipid_info["formula"].items():
-            if type(count) is int:
-                self.formula[element] = count
-            elif type(count) is str:
-                self.formula[element] = eval("lambda c, u: " + count)(self.fa_carbon, self.fa_unsat)
+        # construct the molecular formula using FA composition and the compiled formula template
+        elements, coefs = _LMAPS_FORMULAS[lmid_prefix]
+        self.formula = {
+            element: int(a + b * fa_carbon + d * fa_unsat) 
+            for element, (a, b, d) in zip(elements, coefs.tolist())
+        }
         # get number of acyl chains and ionization
         self.n_chains = lipid_info["n_chains"]
         # n_chains_full is present in some lipid classes to indicate lyso- species
@@ -226,6 +407,11 @@ class LipidWithChains(Lipid):
         Identification level
     """
 
+    __slots__ = (
+        "fa_carbon_chains", "fa_unsat_chains", "oxy_suffix_chains", 
+        "fa_unsat_pos", "fa_unsat_stereo", "sn_pos_is_known"
+    )
+
     def __init__(self, 
                  lmid_prefix: str, 
                  fa_carbon_chains: List[int], 
@@ -6,7 +6,8 @@ Dylan Ross (dylan.ross@pnnl.gov)
 """
 
 
-from typing import List, Optional, Tuple, Union, Dict, Any
+from typing import List, Optional, Tuple, Union, Dict, Any, NamedTuple
+from functools import cache, lru_cache
 import re
 
 from .lipids import LMAPS, Lipid, LipidWithChains
@@ -230,6 +231,7 @@ def _combined_oxy_suffix_from_oxy_suffix_chains(oxy_suffix_chains: List[str]) ->
             return None
 
 
+@cache
 def _get_lmid_prefix(lipid_class_abbrev: str, fa_mod: str, n_unsat: int, oxy_suffix: str) -> Optional[str]:
     """
     fetch specific lipid class info (using LMAPS ID prefix) based on
@@ -293,20 +295,122 @@ def _try_lipid(init_args: Tuple[Any], init_kwargs: Dict[Any, Any], with_chains:
         return None
 
 
-def parse_lipid_name(name: str) -> Optional[Union[Lipid, LipidWithChains]]:
+def _lipid_from_sum_comp(lipid_class_abbrev: str, fa_mod: str, fa_carbon: int, fa_unsat: int, oxy_suffix: str
+                         ) -> Optional[Union[Lipid, LipidWithChains]]:
     """
-    Parses a lipid name in standard format and returns a corresponding instance of a ``Lipid`` object (or subclass). 
-    If the name is not able to be parsed, returns ``None``
+    Create a Lipid (or LipidWithChains for monoacyl lipids) from parsed information when only 
+    one composition element was provided, returns None if that is not possible
+    """
+    # NOTE (Dylan Ross): This is a bad heuristic to use because a valid annotation like LPC 24:0 
+    #                    will cause an error due to the long chain length making the n_acyl chain
+    #                    guess 2 chains which does not make sense for LPC. Likewise for something
+    #                    like PC 24:0 if the chain guess threshold is reduced then this gets guessed 
+    #                    as 1 chain which again is not correct for PC. In any case this static
+    #                    logic for guessing number of chains is not suited to the task. It is better
+    #                    to map lipid class abbreviations to n_chains instead
+    # determine the most likely number of chains just based on FA carbon number
+    # 1-23 = 1, 24-47 = 2, 48-71 = 3, 72+ = 4
+    # which is just c // 24 + 1
+    #n_chains_guess = (fa_carbon) // 24 + 1
+    # this can be None, in which case this should return None
+    if (lmid_prefix := _get_lmid_prefix(lipid_class_abbrev, fa_mod, fa_unsat, oxy_suffix)) is not None:
+        if (lpd := _try_lipid((lmid_prefix, fa_carbon, fa_unsat),
+                              {},
+                              False)) is not None:
+            # check for monoacyl lipids which can be upgraded to LipidWithChains
+            if lpd is not None and lpd.n_chains == 1:
+                # add 0s to fill FA carbon/unsat chains
+                zero_pad = [0 for _ in range(lpd.n_chains_full - 1)]
+                return _try_lipid((lmid_prefix, [fa_carbon,] + zero_pad, [fa_unsat,] + zero_pad), 
+                                {},
+                                True)
+            else:
+                # FA1 is the sum composition, stay with Lipid
+                return lpd
+        else:
+            # could not initialize a Lipid
+            return None
+    else:
+        # could not find a corresponding LMID prefix
+        return None
 
-    Parameters
-    ----------
-    name : ``str``
-        lipid name in standard format
+
+def _lipid_from_chains(lipid_class_abbrev: str, fa_mod: str, fa_carbon_chains: List[int], fa_unsat_chains: List[int], 
+                       sn_is_known: bool, oxy_suffix_chains: List[str]
+                       ) -> Optional[LipidWithChains]:
+    """
+    Create a LipidWithChains from parsed information when individual FA chains were specified 
+    (without double bond positions), returns None if that is not possible
+    """
+    comb_oxy_suff = _combined_oxy_suffix_from_oxy_suffix_chains(oxy_suffix_chains)
+    if comb_oxy_suff is not None:
+        if (lmid_prefix := _get_lmid_prefix(lipid_class_abbrev, 
+                                            fa_mod, 
+                                            sum(fa_unsat_chains), 
+                                            comb_oxy_suff)) is not None:
+            # no positions or sterochem specified
+            return _try_lipid((lmid_prefix, fa_carbon_chains, fa_unsat_chains),  # type: ignore
+                              {"sn_pos_is_known": sn_is_known, "oxy_suffix_chains": oxy_suffix_chains},
+                              True)
+    return None
+
+
+def _is_class_abbrev(s: str) -> bool:
+    """ same as matching the lipid class abbreviation part of the full regex ([A-Za-z123]+) """
+    return s != "" and s.isascii() and all(ch.isalpha() or ch in "123" for ch in s)
+
+
+def _fast_tokenize(name: str) -> Optional[Tuple[str, List[int], List[int]]]:
+    """
+    Tokenize lipid names with the most common simple shapes ("CLS C:U" or "CLS C:U_C:U") without 
+    using the full regex. 
 
     Returns
     -------
-    lipid : ``LipidIMEA.lipids.Lipid`` or subclass
-        instance of Lipid (or subclass), or ``None`` if unable to parse
+    tokens : ``tuple(str, list(int), list(int))`` or ``None``
+        lipid class abbreviation, FA carbons and FA unsaturations for each chain, or None if the 
+        name does not have one of the simple shapes and needs to go through the full regex
+    """
+    lipid_class_abbrev, sep, rest = name.partition(" ")
+    if not sep or not _is_class_abbrev(lipid_class_abbrev):
+        return None
+    chains = rest.split("_")
+    if len(chains) > 2:
+        return None
+    fa_carbon_chains, fa_unsat_chains = [], []
+    for chain in chains:
+        c, sep, u = chain.partition(":")
+        if not (sep and c.isascii() and c.isdigit() and u.isascii() and u.isdigit()):
+            return None
+        fa_carbon_chains.append(int(c))
+        fa_unsat_chains.append(int(u))
+    return lipid_class_abbrev, fa_carbon_chains, fa_unsat_chains
+
+
+def _parse_lipid_name_fast(name: str) -> Tuple[bool, Optional[Union[Lipid, LipidWithChains]]]:
+    """
+    Fast path for parsing lipid names with simple shapes, see ``_fast_tokenize``
+
+    Returns
+    -------
+    handled : ``bool``
+        whether the name had a simple shape, if False the name needs to go through the full regex
+    lipid : ``Lipid`` or ``LipidWithChains`` or ``None``
+        parsed lipid, or None if unable to parse
+    """
+    if (tokens := _fast_tokenize(name)) is None:
+        return False, None
+    lipid_class_abbrev, fa_carbon_chains, fa_unsat_chains = tokens
+    if len(fa_carbon_chains) == 1:
+        return True, _lipid_from_sum_comp(lipid_class_abbrev, "", fa_carbon_chains[0], fa_unsat_chains[0], "")
+    return True, _lipid_from_chains(lipid_class_abbrev, "", fa_carbon_chains, fa_unsat_chains, 
+                                    False, ["" for _ in fa_carbon_chains])
+
+
+def _parse_lipid_name_regex(name: str) -> Optional[Union[Lipid, LipidWithChains]]:
+    """
+    Parses a lipid name in standard format using the full regex, returns a corresponding instance 
+    of a ``Lipid`` object (or subclass) or ``None`` if unable to parse
     """
     mat = re.search(_LIPID_NAME_REGEX, name)
     if mat is None:
@@ -323,38 +427,7 @@ def parse_lipid_name(name: str) -> Optional[Union[Lipid, LipidWithChains]]:
         # only one composition element was provided, could by monoacyl species or sum composition
         fa_carbon = int(parsed['fac_1']) 
         fa_unsat = int(parsed['fau_1'])
-        # NOTE (Dylan Ross): This is a bad heuristic to use because a valid annotation like LPC 24:0 
-        #                    will cause an error due to the long chain length making the n_acyl chain
-        #                    guess 2 chains which does not make sense for LPC. Likewise for something
-        #                    like PC 24:0 if the chain guess threshold is reduced then this gets guessed 
-        #                    as 1 chain which again is not correct for PC. In any case this static
-        #                    logic for guessing number of chains is not suited to the task. It is better
-        #                    to map lipid class abbreviations to n_chains instead
-        # determine the most likely number of chains just based on FA carbon number
-        # 1-23 = 1, 24-47 = 2, 48-71 = 3, 72+ = 4
-        # which is just c // 24 + 1
-        #n_chains_guess = (fa_carbon) // 24 + 1
-        # this can be None, in which case this should return None
-        if (lmid_prefix := _get_lmid_prefix(lipid_class_abbrev, fa_mod, fa_unsat, oxy_suffix)) is not None:
-            if (lpd := _try_lipid((lmid_prefix, fa_carbon, fa_unsat),
-                                  {},
-                                  False)) is not None:
-                # check for monoacyl lipids which can be upgraded to LipidWithChains
-                if lpd is not None and lpd.n_chains == 1:
-                    # add 0s to fill FA carbon/unsat chains
-                    zero_pad = [0 for _ in range(lpd.n_chains_full - 1)]
-                    return _try_lipid((lmid_prefix, [fa_carbon,] + zero_pad, [fa_unsat,] + zero_pad), 
-                                    {},
-                                    True)
-                else:
-                    # FA1 is the sum composition, stay with Lipid
-                    return lpd
-            else:
-                # could not initialize a Lipid
-                return None
-        else:
-            # could not find a corresponding LMID prefix
-            return None
+        return _lipid_from_sum_comp(lipid_class_abbrev, fa_mod, fa_carbon, fa_unsat, oxy_suffix)
     else:
         # individual FA chains were specified, use LipidWithChains
         sn_is_known = parsed['sn'] == '/'
@@ -376,19 +449,8 @@ def parse_lipid_name(name: str) -> Optional[Union[Lipid, LipidWithChains]]:
         # convert Nones into empty strings in oxy_suffix_chains
         oxy_suffix_chains = [_ if _ is not None else "" for _ in oxy_suffix_chains]
         if not pos_specified:
-            n_chains = len([_ for _ in fa_carbon_chains if _ > 0])
-            comb_oxy_suff = _combined_oxy_suffix_from_oxy_suffix_chains(oxy_suffix_chains)
-            if comb_oxy_suff is not None:
-                if (lmid_prefix := _get_lmid_prefix(lipid_class_abbrev, 
-                                                    fa_mod, 
-                                                    sum(fa_unsat_chains), 
-                                                    comb_oxy_suff)) is not None:
-                    # no positions or sterochem specified
-                    return _try_lipid((lmid_prefix, fa_carbon_chains, fa_unsat_chains),
-                                      {"sn_pos_is_known": sn_is_known, "oxy_suffix_chains": oxy_suffix_chains},
-                                      True)
-                else:
-                    return None
+            return _lipid_from_chains(lipid_class_abbrev, fa_mod, fa_carbon_chains, fa_unsat_chains, 
+                                      sn_is_known, oxy_suffix_chains)
         # better to not raise an error here, return None to signal failure to parse
         return None
         stereo_specified = False
@@ -415,3 +477,88 @@ def parse_lipid_name(name: str) -> Optional[Union[Lipid, LipidWithChains]]:
                                fa_unsat_pos=fa_unsat_pos, fa_unsat_stereo=fa_unsat_stereo, 
                                fa_mod=fa_mod, sn_pos_is_known=sn_is_known)
 
+
+class ParsedLipidName(NamedTuple):
+    """
+    Immutable information from a parsed lipid name (see ``parse_lipid_name_info``), field names are the 
+    same as the corresponding ``Lipid``/``LipidWithChains`` attributes. Chain-level fields are None if 
+    the name was parsed to a ``Lipid`` (sum composition only)
+    """
+    lmaps_id_prefix: str
+    fa_carbon: int
+    fa_unsat: int
+    n_chains: int
+    n_chains_full: int
+    fa_carbon_chains: Optional[Tuple[int, ...]] = None
+    fa_unsat_chains: Optional[Tuple[int, ...]] = None
+    sn_pos_is_known: bool = False
+    oxy_suffix_chains: Optional[Tuple[str, ...]] = None
+
+    @property
+    def with_chains(self) -> bool:
+        """ whether the parsed name corresponds to a LipidWithChains """
+        return self.fa_carbon_chains is not None
+
+
+# maximum number of parsed lipid names to keep in the cache (fixed when the module is imported)
+_PARSE_CACHE_SIZE: int = 2 ** 16
+
+
+@lru_cache(maxsize=_PARSE_CACHE_SIZE)
+def parse_lipid_name_info(name: str) -> Optional[ParsedLipidName]:
+    """
+    Parses a lipid name in standard format and returns the parsed information as an immutable
+    ``ParsedLipidName``, or ``None`` if the name is not able to be parsed. 
+    
+    Results are cached (least recently used names are dropped first once the cache is full), and names with the common simple shapes ("CLS C:U" or "CLS C:U_C:U") skip the full regex
+
+    Parameters
+    ----------
+    name : ``str``
+        lipid name in standard format
+
+    Returns
+    -------
+    parsed : ``ParsedLipidName``
+        parsed lipid name information, or ``None`` if unable to parse
+    """
+    handled, lipid = _parse_lipid_name_fast(name)
+    if not handled:
+        lipid = _parse_lipid_name_regex(name)
+    if lipid is None:
+        return None
+    if isinstance(lipid, LipidWithChains):
+        return ParsedLipidName(lipid.lmaps_id_prefix, lipid.fa_carbon, lipid.fa_unsat, 
+                               lipid.n_chains, lipid.n_chains_full, 
+                               tuple(lipid.fa_carbon_chains), tuple(lipid.fa_unsat_chains), 
+                               lipid.sn_pos_is_known, tuple(lipid.oxy_suffix_chains))
+    return ParsedLipidName(lipid.lmaps_id_prefix, lipid.fa_carbon, lipid.fa_unsat, 
+                           lipid.n_chains, lipid.n_chains_full)
+
+
+def parse_lipid_name(name: str) -> Optional[Union[Lipid, LipidWithChains]]:
+    """
+    Parses a lipid name in standard format and returns a corresponding instance of a ``Lipid`` object (or subclass). 
+    If the name is not able to be parsed, returns ``None``
+
+    Parsing goes through ``parse_lipid_name_info`` (cached) but a new instance is returned for each call
+
+    Parameters
+    ----------
+    name : ``str``
+        lipid name in standard format
+
+    Returns
+    -------
+    lipid : ``LipidIMEA.lipids.Lipid`` or subclass
+        instance of Lipid (or subclass), or ``None`` if unable to parse
+    """
+    if (parsed := parse_lipid_name_info(name)) is None:
+        return None
+    if parsed.with_chains:
+        return LipidWithChains(parsed.lmaps_id_prefix, 
+                               list(parsed.fa_carbon_chains),  # type: ignore
+                               list(parsed.fa_unsat_chains),  # type: ignore
+                               sn_pos_is_known=parsed.sn_pos_is_known, 
+                               oxy_suffix_chains=list(parsed.oxy_suffix_chains))  # type: ignore
+    return Lipid(parsed.lmaps_id_prefix, parsed.fa_carbon, parsed.fa_unsat)
@@ -9,29 +9,38 @@ Dylan Ross (dylan.ross@pnnl.gov)
 from os import path as op
 import os
 import errno
+import hashlib
+import json
+import multiprocessing
 from sqlite3 import connect
-from itertools import product
+from functools import cache
+from itertools import repeat
+from dataclasses import asdict
 from typing import (
     Generator, Tuple, List, Optional, Callable, Dict, Iterable, Any
 )
 
-from mzapy.isotopes import ms_adduct_mz
 from mzapy._util import _ppm_error
 import yaml
 import numpy as np
 import numpy.typing as npt
-from scipy.optimize import curve_fit
+import polars as pl
+from scipy.optimize import minimize_scalar
 
+from lipidimea import __version__
 from lipidimea.typing import (
-    ScdbLipidId, ResultsDbPath, ResultsDbCursor, YamlFilePath
+    ScdbLipidId, FragLibKey, ResultsDbPath, ResultsDbCursor, YamlFilePath
 )
 from lipidimea.util import (
-    debug_handler, INCLUDE_DIR, AnalysisStep, update_analysis_log, check_analysis_log
+    debug_handler, INCLUDE_DIR, AnalysisStep, update_analysis_log, check_analysis_log,
+    connect_results_db, _upgrade_results_db_schema, _create_results_db_indexes, _update_summary_tables
 )
 from lipidimea.msms._util import tol_from_ppm
 from lipidimea.params import AnnotationParams
-from lipidimea._lipidlib.lipids import LMAPS, get_c_u_combos, Lipid, LipidWithChains
-from lipidimea._lipidlib.parser import parse_lipid_name
+from lipidimea._lipidlib.lipids import (
+    LMAPS, get_c_u_combos, LipidWithChains, lmaps_class_masses, lmaps_sum_comp_names
+)
+from lipidimea._lipidlib.parser import parse_lipid_name_info
 from lipidimea._lipidlib._fragmentation_rules import load_rules
 
 
@@ -67,6 +76,40 @@ DEFAULT_LITERATURE_CCS_TREND_PARAMS: YamlFilePath = os.path.join(
 )
 
 
+# columns (and types) of the lipid annotation tables produced by the in-memory annotation functions,
+# these mirror the Lipids and LipidSumComp tables in the results database (with features referenced
+# by index instead of dia_pre_id)
+ANNOTATION_SCHEMA: Dict[str, Any] = {
+    "feature": pl.Int64,
+    "lmid_prefix": pl.String,
+    "lipid": pl.String,
+    "adduct": pl.String,
+    "mz_ppm_err": pl.Float64,
+    "ccs_rel_err": pl.Float64,
+    "ccs_lit_trend": pl.Int64,
+    "chains": pl.String,
+    "rt_pass": pl.Int64,
+    "ccs_pass": pl.Int64,
+    "sum_c": pl.Int64,
+    "sum_u": pl.Int64,
+    "n_chains": pl.Int64,
+}
+
+
+# columns (and types) of the fragment annotation tables produced by the in-memory annotation functions, 
+# these mirror the LipidFragments table in the results database (with annotations referenced by row 
+# index and fragments referenced by index within the feature's fragments, instead of IDs)
+FRAGMENT_SCHEMA: Dict[str, Any] = {
+    "annotation": pl.Int64,
+    "fragment": pl.Int64,
+    "frag_rule": pl.String,
+    "rule_mz": pl.Float64,
+    "ppm": pl.Float64,
+    "diagnostic": pl.Int64,
+    "supports_fa": pl.String,
+}
+
+
 class SumCompLipidDB():
     """
     creates an in-memory database with lipids at the level of sum composition for initial
@@ -158,17 +201,27 @@ class SumCompLipidDB():
                 max_u = self.max_u(n_c) if max_u is None else min(max_u, self.max_u(n_c))
                 for n_u in range(0, self.max_u(n_c) + 1):
                     fas.append((n_c, n_u))
-        # permute over acyl chains
-        sum_comp = set()
-        for combo in product(fas, repeat=n_chains):
-            c, u = 0, 0
-            for fac, fau in combo:
-                c += fac
-                u += fau
-            comp = (c, u)
-            if comp not in sum_comp:
-                sum_comp.add(comp)
-                yield comp
+        # build up the sum compositions one acyl chain at a time, only the unique sums from
+        # the previous step need to be combined with each FA (rather than all permutations)
+        # reachable[k] is the set of sum compositions from k acyl chains
+        reachable = [set(), set(fas)]
+        for _ in range(n_chains - 1):
+            reachable.append({(c + fac, u + fau) for c, u in reachable[-1] for fac, fau in fas})
+        @cache
+        def first_combo(comp, k):
+            # indices of the first combination of k FAs (iterating over permutations in order) 
+            # that produces comp
+            c, u = comp
+            for i, (fac, fau) in enumerate(fas):
+                if k == 1:
+                    if (fac, fau) == comp:
+                        return (i,)
+                elif (c - fac, u - fau) in reachable[k - 1]:
+                    return (i,) + first_combo((c - fac, u - fau), k - 1)
+        # yield in the same order the sum compositions would first be encountered while
+        # iterating over all permutations of FAs
+        for comp in sorted(reachable[n_chains], key=lambda comp: first_combo(comp, n_chains)):
+            yield comp
 
     def __init__(self
                  ) -> None :
@@ -222,12 +275,19 @@ class SumCompLipidDB():
             # adjust min unsaturation level for sphingolipids
             max_u = 2 if lmaps_prefix[:4] == 'LMSP' else None
             n_chains = LMAPS[lmaps_prefix]['n_chains']
-            for sumc, sumu in self.gen_sum_compositions(n_chains, min_c, max_c, odd_c, max_u=max_u):
-                lpd = Lipid(lmaps_prefix, sumc, sumu)
-                for adduct in adducts:
-                    mz = ms_adduct_mz(lpd.formula, adduct)
-                    qdata = (lpd.lmaps_id_prefix, sumc, sumu, n_chains, str(lpd), adduct, mz)
-                    self._cur.execute(insert_qry, qdata)
+            sum_comps = list(self.gen_sum_compositions(n_chains, min_c, max_c, odd_c, max_u=max_u))
+            if len(sum_comps) == 0:
+                continue
+            sumcs, sumus = np.array(sum_comps).T
+            # compute m/zs for all sum compositions and adducts of this lipid class at once
+            _, adduct_mzs = lmaps_class_masses(lmaps_prefix, sumcs, sumus, adducts)
+            names = lmaps_sum_comp_names(lmaps_prefix, sumcs, sumus)
+            self._cur.executemany(insert_qry, [
+                (lmaps_prefix, sumc, sumu, n_chains, name, adduct, mz)
+                for sumc, sumu, name, *mzs in zip(sumcs.tolist(), sumus.tolist(), names, 
+                                                  *[adduct_mzs[adduct].tolist() for adduct in adducts])
+                for adduct, mz in zip(adducts, mzs)
+            ])
             
     def get_sum_comp_lipid_ids(self, 
                                mz: float, 
@@ -258,6 +318,23 @@ class SumCompLipidDB():
         --endsql"""
         return [_ for _ in self._cur.execute(qry, (mz_min, mz_max)).fetchall()]
 
+    def get_all_sum_comp_lipid_ids(self
+                                   ) -> List[ScdbLipidId] :
+        """
+        fetch all of the lipids from the sum composition lipid ids database (in the order they 
+        were added)
+
+        Returns
+        -------
+        lipids
+            list of lipids, each is a tuple with the same format as in 
+            ``SumCompLipidDB.get_sum_comp_lipid_ids()``
+        """
+        qry = """--beginsql
+            SELECT lmid_prefix, name, sum_c, sum_u, n_chains, adduct, mz FROM SumCompLipids
+        --endsql"""
+        return self._cur.execute(qry).fetchall()
+
     def close(self
               ) -> None :
         """
@@ -266,6 +343,170 @@ class SumCompLipidDB():
         self._con.close()
 
 
+def _sum_comp_library_arrays(scdb: SumCompLipidDB
+                             ) -> Tuple[List[ScdbLipidId], npt.NDArray[np.float64], npt.NDArray[np.int64]] :
+    """
+    Get all lipids from a sum composition lipid DB along with their m/zs in sorted order (and the 
+    corresponding indices into the list of lipids) for searching by m/z without the database
+    """
+    lipids = scdb.get_all_sum_comp_lipid_ids()
+    mzs = np.array([_[6] for _ in lipids], dtype=np.float64)
+    order = np.argsort(mzs, kind="stable")
+    return lipids, mzs[order], order
+
+
+def _match_sum_comp_partition(library: Tuple[List[ScdbLipidId], npt.NDArray[np.float64], npt.NDArray[np.int64]],
+                              ppm: float,
+                              pre_mzs: List[float]
+                              ) -> List[List[Tuple[ScdbLipidId, float]]] :
+    """
+    Match precursor m/zs against all of the lipids from the sum composition lipid DB (from 
+    ``_sum_comp_library_arrays``), returns the matching lipids for each precursor along with 
+    the ppm error. The matches are the same as from ``SumCompLipidDB.get_sum_comp_lipid_ids()``
+    (including order) for each precursor.
+    """
+    lipids, sorted_mzs, order = library
+    matches = []
+    for mz in pre_mzs:
+        mz_tol = tol_from_ppm(mz, ppm)
+        lo = np.searchsorted(sorted_mzs, mz - mz_tol, side="left")
+        hi = np.searchsorted(sorted_mzs, mz + mz_tol, side="right")
+        matches.append([(lipids[i], _ppm_error(lipids[i][6], mz)) for i in sorted(order[lo:hi].tolist())])
+    return matches
+
+
+#------------------------------------------------------------------------------
+# parallel annotation helpers
+
+
+# read-only data shared with worker processes (set by _init_annotation_worker)
+_WORKER_SHARED: Dict[str, Any] = {}
+
+
+def _init_annotation_worker(shared: Dict[str, Any]
+                            ) -> None :
+    """ initializer for worker processes, stores the shared read-only data (e.g., sum composition library) """
+    _WORKER_SHARED.update(shared)
+
+
+def _run_with_shared(fn: Callable, args: List[Any], shared_args: List[str]
+                     ) -> Any :
+    """ call a function in a worker process with the shared read-only data as the first arguments """
+    return fn(*[_WORKER_SHARED[_] for _ in shared_args], *args)
+
+
+def _partition_dia_features(dfile_ids: npt.NDArray[np.int64], 
+                            mzs: npt.NDArray[np.float64], 
+                            n_parts: int
+                            ) -> List[npt.NDArray[np.int64]] :
+    """
+    Partition DIA features for parallel processing, by data file if there are at least ``n_parts`` 
+    different data files, otherwise by m/z range (ranges with roughly equal numbers of features)
+
+    Returns the (sorted) indices of the features in each partition
+    """
+    unique_dfile_ids = np.unique(dfile_ids)
+    if len(unique_dfile_ids) >= n_parts:
+        return [np.flatnonzero(dfile_ids == dfile_id) for dfile_id in unique_dfile_ids]
+    order = np.argsort(mzs, kind="stable")
+    return [np.sort(part) for part in np.array_split(order, n_parts) if len(part) > 0]
+
+
+def _map_partitions(fn: Callable, 
+                    data: List[Any], 
+                    partitions: List[npt.NDArray[np.int64]], 
+                    shared: Dict[str, Any], 
+                    n_proc: int
+                    ) -> List[Any] :
+    """
+    Apply ``fn(*shared.values(), data_partition)`` to each partition of ``data`` in a process pool 
+    then merge the per-item results (``fn`` must return one result per item) back into the original
+    order of ``data``. Each worker gets the ``shared`` read-only data once (at initialization).
+    """
+    args = [([data[i] for i in part],) for part in partitions]
+    args_for_starmap = zip(repeat(fn), args, repeat(list(shared.keys())))
+    with multiprocessing.Pool(processes=min(n_proc, len(partitions)), 
+                              initializer=_init_annotation_worker, 
+                              initargs=(shared,)) as p:
+        part_results = p.starmap(_run_with_shared, args_for_starmap)
+    results = [None for _ in data]
+    for part, part_result in zip(partitions, part_results):
+        for i, result in zip(part, part_result):
+            results[i] = result
+    return results
+
+
+def annotation_params_hash(params: AnnotationParams
+                           ) -> str :
+    """
+    Compute a hash that identifies a set of annotation parameters, including the contents of the 
+    config files that would be used (default config files if not specified) and the package version.
+    Parameters that only affect display (``display_name``) are not included.
+
+    Parameters
+    ----------
+    params
+        parameters for lipid annotation
+
+    Returns
+    -------
+    params_hash
+        hex digest of the hash
+    """
+    params_dict = asdict(params)
+    params_dict.pop("display_name", None)
+    h = hashlib.sha256()
+    h.update(__version__.encode())
+    h.update(json.dumps(params_dict, sort_keys=True, default=str).encode())
+    # contents of the config files that would be used
+    configs = [
+        params.sum_comp.config if params.sum_comp.config is not None 
+        else DEFAULT_SCDB_CONFIG.get(params.ionization or ""),
+        params.config_file['rt_range_config'] if params.config_file and params.config_file.get('rt_range_config') 
+        else DEFAULT_RP_RT_RANGE_CONFIG,
+        params.ccs_trends.config if params.ccs_trends.config is not None 
+        else DEFAULT_LITERATURE_CCS_TREND_PARAMS,
+    ]
+    for config in configs:
+        if config is not None and os.path.isfile(config):
+            with open(config, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def _scope_condition(cur: ResultsDbCursor, 
+                     ids: Optional[Iterable[int]],
+                     column: str = "dia_pre_id"
+                     ) -> str :
+    """
+    Set up restricting queries to a subset of DIA features (or a subset of any other entries, by 
+    ``column``). If ``ids`` is not None they get loaded into a temporary table (``_AnnotationScope`` 
+    for DIA features) and the returned condition (for use in a WHERE clause) selects only rows with 
+    those ``column`` values, otherwise the returned condition is always true.
+    """
+    if ids is None:
+        return "1"
+    table = "_AnnotationScope" if column == "dia_pre_id" else f"_AnnotationScope_{column}"
+    cur.execute(f"""--beginsql
+        CREATE TEMPORARY TABLE IF NOT EXISTS {table} ({column} INTEGER PRIMARY KEY)
+    --endsql""")
+    cur.execute(f"DELETE FROM {table}")
+    cur.executemany(f"INSERT INTO {table} VALUES (?)", [(int(_),) for _ in ids])
+    return f"{column} IN (SELECT {column} FROM {table})"
+
+
+def _scope_ids(cur: ResultsDbCursor,
+               ids: Optional[Iterable[int]]
+               ) -> Optional[List[int]] :
+    """ 
+    DIA features in scope (already loaded into ``_AnnotationScope`` by ``_scope_condition``), None if
+    all DIA features are in scope 
+    """
+    if ids is None:
+        return None
+    return [dia_pre_id for dia_pre_id, in cur.execute("SELECT dia_pre_id FROM _AnnotationScope")]
+
+
 def remove_lipid_annotations(results_db: ResultsDbPath
                              ) -> None :
     """
@@ -282,7 +523,7 @@ def remove_lipid_annotations(results_db: ResultsDbPath
                                 os.strerror(errno.ENOENT), 
                                 results_db)
     # connect to  results database
-    con = connect(results_db) 
+    con = connect_results_db(results_db) 
     cur = con.cursor()
     # drop any existing annotations
     cur.execute("DELETE FROM Lipids;")
@@ -290,6 +531,10 @@ def remove_lipid_annotations(results_db: ResultsDbPath
     cur.execute("DELETE FROM LipidSumComp;")
     # drop existing fragment annotations
     cur.execute("DELETE FROM LipidFragments;")
+    # no DIA features are annotated anymore
+    _upgrade_results_db_schema(cur)
+    cur.execute("DELETE FROM LipidAnnotatedFeatures;")
+    _update_summary_tables(cur, AnalysisStep.LIPID_ANN)
     # clean up
     con.commit()
     con.close()
@@ -310,7 +555,7 @@ def add_lmaps_ont(results_db: ResultsDbPath,
         path to LipidIMEA analysis results database
     """
     # connect to  results database
-    con = connect(results_db) 
+    con = connect_results_db(results_db) 
     cur = con.cursor()
     # drop any existing entries
     cur.execute("DELETE FROM _LipidMapsPrefixToLong;")
@@ -324,9 +569,92 @@ def add_lmaps_ont(results_db: ResultsDbPath,
     con.close()
 
 
+def _sum_comp_lipid_db(params: AnnotationParams
+                       ) -> SumCompLipidDB :
+    """ create the sum composition lipid DB from the annotation parameters """
+    # load the default config if no alternative was provided
+    assert params.ionization is not None, "ionization must be set (POS or NEG)"
+    sum_comp_config = (
+        params.sum_comp.config 
+        if params.sum_comp.config is not None 
+        else DEFAULT_SCDB_CONFIG[params.ionization]
+    )
+    scdb = SumCompLipidDB()
+    scdb.fill_db_from_config(sum_comp_config, 
+                             params.sum_comp.fa_cl.min, 
+                             params.sum_comp.fa_cl.max, 
+                             params.sum_comp.fa_odd_c)
+    return scdb
+
+
+def annotate_sum_composition(pre_mzs: npt.ArrayLike,
+                             params: AnnotationParams,
+                             dfile_ids: Optional[npt.ArrayLike] = None,
+                             n_proc: int = 1,
+                             scdb: Optional[SumCompLipidDB] = None
+                             ) -> pl.DataFrame :
+    """
+    annotate features (by precursor m/z) at the level of sum composition using a generated database 
+    of lipids, entirely in memory (without a results database)
+
+    Parameters
+    ----------
+    pre_mzs
+        precursor m/z for each feature
+    params
+        parameters for lipid annotation
+    [dfile_ids]
+        data file identifier for each feature, only used for partitioning features if n_proc > 1
+    [n_proc]
+        number of processes to use, set >1 to partition the features (by data file or m/z range) and 
+        match them against the sum composition lipid DB in parallel
+    [scdb]
+        sum composition lipid DB to use, None to generate one using ``params`` (if annotating many sets 
+        of features with the same parameters, it can be generated once and reused)
+
+    Returns
+    -------
+    annotations
+        one row per annotation with columns: feature (index into ``pre_mzs``), lmid_prefix, lipid, 
+        adduct, mz_ppm_err, sum_c, sum_u, n_chains, chains (acyl chain composition flag)
+    """
+    pre_mzs = np.asarray(pre_mzs, dtype=np.float64)
+    if scdb is None:
+        scdb = _sum_comp_lipid_db(params)
+        library = _sum_comp_library_arrays(scdb)
+        scdb.close()
+    else:
+        library = _sum_comp_library_arrays(scdb)
+    if n_proc > 1 and len(pre_mzs) > 1:
+        dfile_ids = np.zeros(len(pre_mzs), dtype=np.int64) if dfile_ids is None else np.asarray(dfile_ids)
+        partitions = _partition_dia_features(dfile_ids, pre_mzs, n_proc)
+        matches = _map_partitions(_match_sum_comp_partition, pre_mzs.tolist(), partitions, 
+                                  {"library": library, "ppm": params.sum_comp.mz_ppm}, n_proc)
+    else:
+        matches = _match_sum_comp_partition(library, params.sum_comp.mz_ppm, pre_mzs.tolist())
+    columns = {k: [] for k in ["feature", "lmid_prefix", "lipid", "adduct", "mz_ppm_err", 
+                               "sum_c", "sum_u", "n_chains", "chains"]}
+    for i, pre_matches in enumerate(matches):
+        for (clmidp, cname, csumc, csumu, cchains, cadduct, _), ppm in pre_matches:
+            columns["feature"].append(i)
+            columns["lmid_prefix"].append(clmidp)
+            columns["lipid"].append(cname)
+            columns["adduct"].append(cadduct)
+            columns["mz_ppm_err"].append(ppm)
+            columns["sum_c"].append(csumc)
+            columns["sum_u"].append(csumu)
+            columns["n_chains"].append(cchains)
+            # special case: lipids with single chains automatically have inferred acyl chain 
+            # composition instead of unknown
+            columns["chains"].append("inferred" if cchains == 1 else None)
+    return pl.DataFrame(columns, schema={k: ANNOTATION_SCHEMA[k] for k in columns})
+
+
 def annotate_lipids_sum_composition(results_db: ResultsDbPath, 
                                     params: AnnotationParams,
-                                    debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None
+                                    debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None,
+                                    n_proc: int = 1,
+                                    dia_pre_ids: Optional[Iterable[int]] = None
                                     ) -> Tuple[int, int] :
     """
     annotate features from a DDA-DIA data analysis using a generated database of lipids
@@ -343,6 +671,11 @@ def annotate_lipids_sum_composition(results_db: ResultsDbPath,
     [debug_cb]
         callback function that takes the debugging message as an argument, can be None if
         debug_flag is not set to 'textcb' or 'textcb_pid'
+    [n_proc]
+        number of processes to use, set >1 to partition the DIA features (by data file or m/z 
+        range) and match them against the sum composition lipid DB in parallel
+    [dia_pre_ids]
+        only annotate this subset of DIA features (by dia_pre_id), None to annotate all features
 
     Returns
     -------
@@ -359,61 +692,52 @@ def annotate_lipids_sum_composition(results_db: ResultsDbPath,
                                 results_db)
     debug_handler(debug_flag, debug_cb, 
                   "ANNOTATING LIPIDS AT SUM COMPOSITION LEVEL USING GENERATED LIPID DATABASE...")
-    # create the sum composition lipid database
-    # load the default config if no alternative was provided
-    assert params.ionization is not None, "ionization must be set (POS or NEG)"
-    sum_comp_config = (
-        params.sum_comp.config 
-        if params.sum_comp.config is not None 
-        else DEFAULT_SCDB_CONFIG[params.ionization]
-    )
-    scdb = SumCompLipidDB()
-    scdb.fill_db_from_config(sum_comp_config, 
-                             params.sum_comp.fa_cl.min, 
-                             params.sum_comp.fa_cl.max, 
-                             params.sum_comp.fa_odd_c)
     # connect to  results database
-    con = connect(results_db) 
+    con = connect_results_db(results_db) 
     cur = con.cursor()
     # check that DIA feature extraction has been completed first
     check_analysis_log(cur, AnalysisStep.DIA_EXT)
-    # iterate through DIA features and get putative annotations
-    qry_sel = """--beginsql
-        SELECT dia_pre_id, mz FROM DIAPrecursors
+    _upgrade_results_db_schema(cur)
+    # index the DIA features (already loaded) for the annotation steps
+    _create_results_db_indexes(cur, ["DIAPrecursors", "DIAFragments"])
+    # get putative annotations for all DIA features
+    qry_sel = f"""--beginsql
+        SELECT dia_pre_id, dfile_id, mz FROM DIAPrecursors WHERE {_scope_condition(cur, dia_pre_ids)}
     --endsql"""
     qry_ins = """--beginsql
-        INSERT INTO Lipids VALUES (?,?,?,?,?,?,?,?,?)
+        INSERT INTO Lipids VALUES (?,?,?,?,?,?,?,?,?,?,?)
     --endsql"""
     qry_ins2 = """--beginsql
         INSERT INTO LipidSumComp VALUES (?,?,?,?)
     --endsql"""
-    n_feats, n_feats_annotated, n_anns = 0, 0, 0
-    for dia_feat_id, mz, in cur.execute(qry_sel).fetchall():
-        n_feats += 1
-        annotated = False
-        # TODO: this ugly
-        for clmidp, cname, csumc, csumu, cchains, cadduct, cmz \
-        in scdb.get_sum_comp_lipid_ids(mz, params.sum_comp.mz_ppm):
-            annotated = True
-            # special case: lipids with single chains automatically have inferred acyl chain 
-            # composition instead of unknown
-            chains_flag = "inferred" if cchains == 1 else None
-            qdata = (
-                None, dia_feat_id, clmidp, cname, cadduct, _ppm_error(cmz, mz), 
-                # ccs_rel_err, ccs_lit_trend, chains 
-                None, None, chains_flag
-            )
-            # add the Lipids entry
-            cur.execute(qry_ins, qdata)
-            # add the LipidSumComp entry
-            cur.execute(qry_ins2, (cur.lastrowid, csumc, csumu, cchains))
-            n_anns += 1
-        if annotated:
-            n_feats_annotated += 1
+    pre_ids, pre_dfile_ids, pre_mzs = [], [], []
+    for dia_pre_id, dfile_id, mz in cur.execute(qry_sel).fetchall():
+        pre_ids.append(dia_pre_id)
+        pre_dfile_ids.append(-1 if dfile_id is None else dfile_id)
+        pre_mzs.append(mz)
+    anns = annotate_sum_composition(pre_mzs, params, dfile_ids=pre_dfile_ids, n_proc=n_proc)
+    # new lipid IDs are assigned sequentially after the current max
+    next_lipid_id = (cur.execute("SELECT MAX(lipid_id) FROM Lipids").fetchone()[0] or 0) + 1
+    lipid_ids = range(next_lipid_id, next_lipid_id + anns.height)
+    ann_pre_ids = [pre_ids[i] for i in anns["feature"].to_list()]
+    n_feats, n_feats_annotated, n_anns = len(pre_ids), anns["feature"].n_unique(), anns.height
+    lipid_rows = zip(
+        lipid_ids, ann_pre_ids, *[anns[k].to_list() for k in ["lmid_prefix", "lipid", "adduct", "mz_ppm_err"]], 
+        # ccs_rel_err, ccs_lit_trend
+        repeat(None), repeat(None), 
+        anns["chains"].to_list(),
+        # rt_pass, ccs_pass
+        repeat(None), repeat(None)
+    )
+    sum_comp_rows = zip(lipid_ids, *[anns[k].to_list() for k in ["sum_c", "sum_u", "n_chains"]])
+    # add the Lipids and LipidSumComp entries
+    cur.executemany(qry_ins, lipid_rows)
+    cur.executemany(qry_ins2, sum_comp_rows)
     # report how many features were annotated
     debug_handler(debug_flag, debug_cb, 
                   f"ANNOTATED: {n_feats_annotated} / {n_feats} DIA features ({n_anns} annotations total)")
-    # update analysis log
+    # update the summary tables and the analysis log
+    _update_summary_tables(cur, AnalysisStep.LIPID_ANN, dia_pre_ids=_scope_ids(cur, dia_pre_ids))
     update_analysis_log(
         cur, 
         AnalysisStep.LIPID_ANN,
@@ -424,21 +748,72 @@ def annotate_lipids_sum_composition(results_db: ResultsDbPath,
         }
     )
     # clean up
-    scdb.close()
     con.commit()
     con.close()
     # return the number of features annotated
     return n_feats_annotated, n_anns
 
 
+def _load_rt_ranges(params: AnnotationParams
+                    ) -> Dict[str, Tuple[float, float]] :
+    """ load the RT ranges config (or the default config if no alternative was provided) """
+    rt_range_config = (
+        params.config_file['rt_range_config']
+        if params.config_file['rt_range_config']
+        else DEFAULT_RP_RT_RANGE_CONFIG
+    )
+    with open(rt_range_config, 'r') as yf:
+        rt_ranges = yaml.safe_load(yf)
+    return {lmid_prefix: (rtmin, rtmax) for lmid_prefix, (rtmin, rtmax) in rt_ranges.items()}
+
+
+def rt_range_pass(lmid_prefixes: npt.ArrayLike,
+                  rts: npt.ArrayLike,
+                  rt_ranges: Dict[str, Tuple[float, float]]
+                  ) -> npt.NDArray[np.bool_] :
+    """
+    Check lipid annotations against expected retention time ranges by lipid class, annotations pass 
+    if the retention time is strictly within the range for the class, annotations for classes without 
+    a defined range do not pass
+
+    Parameters
+    ----------
+    lmid_prefixes
+        LipidMAPS ID prefix for each annotation
+    rts
+        retention time of the annotated feature for each annotation
+    rt_ranges
+        RT range (min, max) for each LipidMAPS ID prefix 
+
+    Returns
+    -------
+    rt_pass
+        flag for each annotation indicating whether it passed
+    """
+    lmid_prefixes = np.asarray(lmid_prefixes, dtype=np.str_)
+    rts = np.asarray(rts, dtype=np.float64)
+    uniq, inv = np.unique(lmid_prefixes, return_inverse=True)
+    bounds = np.array([rt_ranges.get(lmid_prefix, (np.nan, np.nan)) for lmid_prefix in uniq], 
+                      dtype=np.float64).reshape(-1, 2)
+    rt_min, rt_max = bounds[inv, 0], bounds[inv, 1]
+    # comparisons with NaN are always False
+    return (rts > rt_min) & (rts < rt_max)
+
+
 def filter_annotations_by_rt_range(results_db: ResultsDbPath, 
                                    params: AnnotationParams,
-                                   debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None
+                                   debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None,
+                                   dia_pre_ids: Optional[Iterable[int]] = None
                                    ) -> Tuple[int, int] :
     """
     filter lipid annotations based on their retention times vs. expected retention time ranges
     by lipid class for a specified chromatographic method
 
+    Annotations are not removed, instead the result is stored in the ``rt_pass`` flag of each 
+    annotation (annotations that did not pass are excluded from the ``FilteredLipids`` view). This
+    means that annotations can be re-filtered (e.g. using a different RT range config) without
+    needing to re-annotate everything.
+
     Parameters
     ----------
     results_db
@@ -450,6 +825,8 @@ def filter_annotations_by_rt_range(results_db: ResultsDbPath,
     [debug_cb]
         callback function that takes the debugging message as an argument, can be None if
         debug_flag is not set to 'textcb' or 'textcb_pid'
+    [dia_pre_ids]
+        only filter annotations for this subset of DIA features (by dia_pre_id), None to filter all
 
     Returns
     -------
@@ -464,53 +841,60 @@ def filter_annotations_by_rt_range(results_db: ResultsDbPath,
                                 results_db)
     debug_handler(debug_flag, debug_cb, 
                   "FILTERING LIPID ANNOTATIONS BASED ON LIPID CLASS RETENTION TIME RANGES ...")
-    # ann_rtr_only_keep_defined_classes
-    # load the default config if no alternative was provided
-
-    rt_range_config = (
-        params.config_file['rt_range_config']
-        if params.config_file['rt_range_config']
-        else DEFAULT_RP_RT_RANGE_CONFIG
-    )
-    print(rt_range_config)
-    with open(rt_range_config, 'r') as yf:
-        rt_ranges = yaml.safe_load(yf)
-    con = connect(results_db) 
+    rt_ranges = _load_rt_ranges(params)
+    con = connect_results_db(results_db) 
     cur = con.cursor()
     # check that initial lipid annotations have already been added
     check_analysis_log(cur, AnalysisStep.LIPID_ANN)
-    # iterate through annotations, check if the RT is within specified range 
-    anns_to_del = []  # track annotation IDs to delete
-    qry_sel = """--beginsql
+    _upgrade_results_db_schema(cur)
+    # load the RT ranges into a temporary table so that the filtering can be done in a single pass 
+    # (same as ``rt_range_pass``)
+    cur.execute("""--beginsql
+        CREATE TEMPORARY TABLE _RTRanges (
+            lmid_prefix TEXT PRIMARY KEY,
+            rt_min REAL NOT NULL,
+            rt_max REAL NOT NULL
+        )
+    --endsql""")
+    cur.executemany("INSERT INTO _RTRanges VALUES (?,?,?)", 
+                    [(lmid_prefix, rtmin, rtmax) for lmid_prefix, (rtmin, rtmax) in rt_ranges.items()])
+    scope = _scope_condition(cur, dia_pre_ids)
+    # flag annotations according to whether they are within the specified RT range, any annotations 
+    # for which no RT bounds exist automatically get filtered out, only annotations with a 
+    # corresponding precursor get filtered
+    qry_flag = f"""--beginsql
+        UPDATE Lipids 
+        SET 
+            rt_pass = EXISTS (
+                SELECT 
+                    1 
+                FROM 
+                    DIAPrecursors AS p 
+                    JOIN _RTRanges AS r ON r.lmid_prefix = Lipids.lmid_prefix 
+                WHERE 
+                    p.dia_pre_id = Lipids.dia_pre_id 
+                    AND p.rt > r.rt_min 
+                    AND p.rt < r.rt_max
+            )
+        WHERE 
+            dia_pre_id IN (SELECT dia_pre_id FROM DIAPrecursors) 
+            AND {scope}
+    --endsql"""
+    cur.execute(qry_flag)
+    qry_cnt = f"""--beginsql
         SELECT 
-            lipid_id, 
-            lmid_prefix, 
-            rt 
+            COALESCE(SUM(rt_pass), 0), 
+            COALESCE(SUM(1 - rt_pass), 0) 
         FROM 
             Lipids 
-            JOIN DIAPrecursors USING(dia_pre_id)
-    --endsql"""
-    # track annotations kept and filtered
-    n_kept, n_filt = 0, 0
-    for ann_id, lmid_prefix, rt in cur.execute(qry_sel).fetchall():
-        if lmid_prefix in rt_ranges:
-            rtmin, rtmax = rt_ranges[lmid_prefix]
-            if rt <= rtmin or rt >= rtmax:
-                anns_to_del.append(ann_id)
-                n_filt += 1
-            else: 
-                n_kept += 1
-        else:
-            # any annotations for which no RT bounds exist automatically get filtered out
-            anns_to_del.append(ann_id)
-            n_filt += 1
-    # delete any annotations not within specified RT range
-    qry_del = """--beginsql
-        DELETE FROM Lipids WHERE lipid_id=?
+            JOIN DIAPrecursors USING(dia_pre_id) 
+        WHERE 
+            {scope}
     --endsql"""
-    for ann_id in anns_to_del:
-        cur.execute(qry_del, (ann_id,))
-    # update analysis log
+    n_kept, n_filt = cur.execute(qry_cnt).fetchone()
+    cur.execute("DROP TABLE _RTRanges")
+    # update the summary tables and the analysis log
+    _update_summary_tables(cur, AnalysisStep.LIPID_ANN, dia_pre_ids=_scope_ids(cur, dia_pre_ids))
     update_analysis_log(
         cur,
         AnalysisStep.LIPID_ANN,
@@ -534,49 +918,278 @@ def _fpow(x, a, b, c):
     return a * x ** b + c
 
 
+def _fpow_linear_fit(mzs: npt.NDArray[np.float64], 
+                     ccss: npt.NDArray[np.float64], 
+                     b: float
+                     ) -> Tuple[float, float, float] :
+    """
+    with the exponent `b` fixed, `_fpow` is linear in `a` and `c` so they can be solved for directly 
+    (least squares, with `a` constrained to be >= 0)
+
+    Returns `a`, `c`, and the sum of squared residuals
+    """
+    xb = mzs ** b
+    xb_mean, ccs_mean = xb.mean(), ccss.mean()
+    dx = xb - xb_mean
+    sxx = dx @ dx
+    a = max((dx @ (ccss - ccs_mean)) / sxx, 0.) if sxx > 0 else 0.
+    c = ccs_mean - a * xb_mean
+    resid = ccss - (a * xb + c)
+    return a, c, resid @ resid
+
+
 def _fit_observed_trend(mzs: npt.ArrayLike, 
-                        ccss: npt.ArrayLike
+                        ccss: npt.ArrayLike,
+                        b0: Optional[float] = None
                         ) -> Tuple[Optional[Tuple[float, float, float]], Optional[Exception]] :
     """
     fit a m/z vs. CCS trend using `_fpow`
 
+    The linear parameters (`a`, `c`) are solved for directly for any given exponent `b` (see 
+    `_fpow_linear_fit`), so the fit reduces to a bounded 1-D search over `b` in [0, 1]: a coarse 
+    grid search (which also includes the starting exponent `b0` if provided, e.g. from a literature
+    trend for a related subclass/adduct) followed by a bounded refinement around the best grid point. 
+    The number of function evaluations is capped, so fitting time does not depend on how well 
+    conditioned the data is.
+
     Returns the fit parameters if fitting was successful, `None` otherwise. 
     """
     try:
-        opt, _ = curve_fit(_fpow, mzs, ccss, 
-                           maxfev=int(1e6), 
-                           p0=(10., 0.5, 0.), 
-                           bounds=([0, 0, -np.inf], [np.inf, 1., np.inf])) 
-        return opt, None
+        mzs, ccss = np.asarray(mzs, dtype=np.float64), np.asarray(ccss, dtype=np.float64)
+        if len(mzs) < 3 or not (np.all(np.isfinite(mzs)) and np.all(np.isfinite(ccss))):
+            raise ValueError("need at least 3 finite points to fit a trend")
+        bs = np.linspace(0., 1., 21)
+        if b0 is not None and 0. <= b0 <= 1.:
+            bs = np.append(bs, b0)
+        sses = [_fpow_linear_fit(mzs, ccss, b)[2] for b in bs]
+        best_b = bs[int(np.argmin(sses))]
+        # refine around the best exponent from the grid search
+        res = minimize_scalar(lambda b: _fpow_linear_fit(mzs, ccss, b)[2], 
+                              bounds=(max(best_b - 0.05, 0.), min(best_b + 0.05, 1.)),
+                              method="bounded",
+                              options={"xatol": 1e-9, "maxiter": 200})
+        if res.fun < min(sses):
+            best_b = float(res.x)
+        a, c, _ = _fpow_linear_fit(mzs, ccss, best_b)
+        return np.array([a, best_b, c]), None
     except Exception as e:
         return None, e
 
 
-def _point_in_trend(mz: float, 
-                    ccs: float, 
-                    trend_params: Tuple[float, float, float], 
-                    percent: float
-                    ) -> Optional[float] :
+def _trend_errors(mzs: npt.NDArray[np.float64], 
+                  ccss: npt.NDArray[np.float64], 
+                  trend_params: Tuple[float, float, float]
+                  ) -> npt.NDArray[np.float64] :
+    """
+    returns the percent errors of all points (`mzs`, `ccss`) from the trend defined by 
+    `trend_params`
     """
-    test if a point (`mz`, `ccs`) is within `percent` of a trend defined by `trend_params`
+    trend_ccss = _fpow(mzs, *trend_params)
+    return 100 * (ccss - trend_ccss) / trend_ccss
 
-    Returns the percent error from the trend if so, otherwise `None`
+
+def _load_lit_ccs_trends(params: AnnotationParams
+                         ) -> Dict[str, Dict[str, Tuple[float, float, float]]] :
+    """ load the literature CCS trends config (or the default config if no alternative was provided) """
+    ccs_trends_config = (
+        params.ccs_trends.config
+        if params.ccs_trends.config is not None 
+        else DEFAULT_LITERATURE_CCS_TREND_PARAMS
+    )
+    with open(ccs_trends_config, "r") as yf:
+        return yaml.safe_load(yf)
+
+
+def ccs_trend_filter(features: npt.ArrayLike,
+                     lm_subs: npt.ArrayLike,
+                     adducts: npt.ArrayLike,
+                     mzs: npt.ArrayLike,
+                     ccss: npt.ArrayLike,
+                     params: AnnotationParams,
+                     rt_pass: Optional[npt.ArrayLike] = None,
+                     in_scope: Optional[npt.ArrayLike] = None,
+                     debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None,
+                     n_proc: int = 1,
+                     lit_ccs_trends: Optional[Dict[str, Dict[str, Tuple[float, float, float]]]] = None
+                     ) -> Tuple[pl.DataFrame, Tuple[int, int, int, int]] :
     """
-    trend_ccs = _fpow(mz, *trend_params)
-    trend_err = 100 * (ccs - trend_ccs) / trend_ccs
-    if abs(trend_err) <= percent:
-        # point is within trend
-        return trend_err
-    else:
-        # point is outside of trend
-        return None
+    Check lipid annotations against CCS subclass trends
+
+    Lipid annotations are grouped by LipidMAPS subclass and adduct, then a m/z vs. CCS trend (based on 
+    literature CCS values) is fetched for that subclass and adduct and annotations pass according to 
+    whether the CCS is within `AnnotationParams.ccs_trends.percent` of the trend. If trend parameters 
+    are not available for a subclass and adduct, a trend is instead fit using the annotations themselves 
+    (only those that passed RT range filtering, counting each feature once) and outliers from this trend 
+    (using the same percent tolerance) do not pass. If there are too few annotations to fit a trend the
+    annotations are not checked, if the fit fails the annotations do not pass.
+
+    Parameters
+    ----------
+    features
+        feature identifier for each annotation
+    lm_subs
+        LipidMAPS subclass (short form, e.g. "GP0101") for each annotation
+    adducts
+        adduct for each annotation
+    mzs
+    ccss
+        m/z and CCS of the annotated feature for each annotation, annotations with NaN CCS are not checked
+    params
+        parameters for lipid annotation
+    [rt_pass]
+        flags indicating which annotations passed RT range filtering, only those are used for fitting 
+        observed trends and counted in the returned numbers of annotations kept/filtered, None for all
+    [in_scope]
+        flags indicating which annotations to check, observed trends are still fit using all annotations,
+        None to check all annotations
+    [debug_flag]
+        specifies how to dispatch debugging messages, None to do nothing
+    [debug_cb]
+        callback function that takes the debugging message as an argument, can be None if
+        debug_flag is not set to 'textcb' or 'textcb_pid'
+    [n_proc]
+        number of processes to use for fitting observed trends (for subclasses without literature
+        trends), set >1 to fit multiple subclasses in parallel
+    [lit_ccs_trends]
+        literature CCS trend parameters by subclass then adduct, None to load them using ``params``
 
+    Returns
+    -------
+    results
+        one row per annotation with columns: ccs_rel_err (percent error from the trend), ccs_lit_trend 
+        (whether a literature trend was used, 0 or 1), ccs_pass (0 or 1), all null if the annotation was
+        not checked
+    counts
+        numbers of annotations kept and filtered out based on literature CCS trends and based on observed
+        CCS trends: (n_kept_lit, n_filt_lit, n_kept_obs, n_filt_obs)
+    """
+    if lit_ccs_trends is None:
+        lit_ccs_trends = _load_lit_ccs_trends(params)
+    mzs = np.asarray(mzs, dtype=np.float64)
+    ccss = np.asarray(ccss, dtype=np.float64)
+    n = len(mzs)
+    # flags for annotations that passed RT range filtering (or were not RT filtered)
+    rt_ok = np.ones(n, dtype=np.bool_) if rt_pass is None else np.asarray(rt_pass, dtype=np.bool_)
+    # flags for annotations that are in scope for filtering (and have CCS values)
+    has_ccs = ~np.isnan(ccss)
+    in_scope = has_ccs if in_scope is None else np.asarray(in_scope, dtype=np.bool_) & has_ccs
+    # group the annotations by (subclass, adduct) 
+    # keys: (lm_sub, adduct) -> tuple(str, str)
+    # values: indices of annotations -> list(int)
+    # also flag the annotations used to fit observed trends: those that passed RT range filtering, 
+    # only counting each feature once per (subclass, adduct) (annotations updated with acyl chain 
+    # info can have multiple entries for the same feature)
+    for_fit = np.zeros(n, dtype=np.bool_)
+    groups, seen = {}, set()
+    for i, (feature, lm_sub, adduct) in enumerate(zip(np.asarray(features).tolist(), 
+                                                      np.asarray(lm_subs).tolist(), 
+                                                      np.asarray(adducts).tolist())):
+        if not has_ccs[i]:
+            continue
+        groups.setdefault((lm_sub, adduct), []).append(i)
+        if rt_ok[i] and (feature, lm_sub, adduct) not in seen:
+            seen.add((feature, lm_sub, adduct))
+            for_fit[i] = True
+    # only subclasses with annotations that are in scope need to be considered
+    groups = {k: np.array(v, dtype=np.int64) for k, v in groups.items() if in_scope[v].any()}
+    # fit observed trends for all of the subclasses that do not have literature trends up front
+    # (in parallel if n_proc > 1)
+    min_points = 5
+    lit_trend_params, to_fit = {}, []
+    for (lm_sub, adduct), idx in groups.items():
+        if (sub_params := lit_ccs_trends.get(lm_sub)) is not None \
+                and (trend_params := sub_params.get(adduct)) is not None:
+            lit_trend_params[(lm_sub, adduct)] = trend_params
+        elif for_fit[idx].sum() >= min_points:
+            to_fit.append((lm_sub, adduct))
+    # if there are literature trends for the same subclass (with other adducts), use those to get 
+    # a starting exponent for the fit
+    fit_args = []
+    for lm_sub, adduct in to_fit:
+        lit_bs = [trend_params[1] for trend_params in (lit_ccs_trends.get(lm_sub) or {}).values()]
+        b0 = float(np.median(lit_bs)) if lit_bs else None
+        idx = groups[(lm_sub, adduct)]
+        idx = idx[for_fit[idx]]
+        fit_args.append((mzs[idx], ccss[idx], b0))
+    if n_proc > 1 and len(fit_args) > 1:
+        with multiprocessing.Pool(processes=min(n_proc, len(fit_args))) as p:
+            obs_fits = dict(zip(to_fit, p.starmap(_fit_observed_trend, fit_args)))
+    else:
+        obs_fits = {key: _fit_observed_trend(*args) for key, args in zip(to_fit, fit_args)}
+    # trend errors, literature trend flags, and pass flags for all annotations (NaN/-1 for NULL)
+    errs = np.full(n, np.nan)
+    lit = np.full(n, -1, dtype=np.int64)
+    passed = np.full(n, -1, dtype=np.int64)
+    # track the number of annotations kept vs. filtered
+    n_kept_lit, n_filt_lit, n_kept_obs, n_filt_obs = 0, 0, 0, 0
+    # go through each lipid subclass from among the annotations
+    for (lm_sub, adduct), idx in groups.items():
+        idx = idx[in_scope[idx]]
+        if (trend_params := lit_trend_params.get((lm_sub, adduct))) is not None:
+            debug_handler(
+                debug_flag, debug_cb, 
+                f"literature CCS trend for subclass {lm_sub} and adduct {adduct} FOUND ({trend_params=})"
+            )
+            lit_trend = 1
+        else:
+            debug_handler(debug_flag, debug_cb, 
+                          f"literature CCS trend for subclass {lm_sub} and adduct {adduct} NOT FOUND")
+            # no trend parameters found for this subclass, use the observed trend
+            lit_trend = 0
+            if (lm_sub, adduct) not in obs_fits:
+                # move on to next subclass, annotations are not filtered
+                debug_handler(debug_flag, debug_cb, 
+                              "\t\ttoo few values to fit observed trend")
+                continue
+            trend_params, fit_err = obs_fits[(lm_sub, adduct)]
+            if trend_params is None:
+                # failure
+                debug_handler(debug_flag, debug_cb, 
+                              f"\t\tfailed to fit trend using observed values ({fit_err})")
+                # all associated annotations are filtered out
+                lit[idx] = 0
+                passed[idx] = 0
+                n_filt_obs += int(rt_ok[idx].sum())
+                continue
+            # success
+            debug_handler(debug_flag, debug_cb, 
+                          f"\t\tfit observed trend ({trend_params=})")
+        # filter all annotations based on whether the the m/z and CCS are within X % of the 
+        # lipid subclass trend
+        trend_errs = _trend_errors(mzs[idx], ccss[idx], trend_params)
+        in_trend = np.abs(trend_errs) <= params.ccs_trends.percent
+        errs[idx] = trend_errs
+        lit[idx] = lit_trend
+        passed[idx] = in_trend
+        # only count annotations that were not already filtered out by RT range
+        n_kept, n_filt = int((in_trend & rt_ok[idx]).sum()), int((~in_trend & rt_ok[idx]).sum())
+        if lit_trend:
+            n_kept_lit += n_kept
+            n_filt_lit += n_filt
+        else:
+            n_kept_obs += n_kept
+            n_filt_obs += n_filt
+        # report running total of filtering stats after each subclass
+        debug_handler(debug_flag, debug_cb, 
+                        f"\t\tkept:     {n_kept_lit + n_kept_obs} (lit: {n_kept_lit}, obs: {n_kept_obs})")
+        debug_handler(debug_flag, debug_cb, 
+                        f"\t\tfiltered: {n_filt_lit + n_filt_obs} (lit: {n_filt_lit}, obs: {n_filt_obs})")
+    results = pl.DataFrame(
+        {"ccs_rel_err": errs, "ccs_lit_trend": lit, "ccs_pass": passed}, 
+        schema={k: ANNOTATION_SCHEMA[k] for k in ["ccs_rel_err", "ccs_lit_trend", "ccs_pass"]}
+    ).with_columns(
+        pl.col("ccs_rel_err").fill_nan(None),
+        pl.when(pl.col("ccs_lit_trend") >= 0).then(pl.col("ccs_lit_trend")),
+        pl.when(pl.col("ccs_pass") >= 0).then(pl.col("ccs_pass")),
+    )
+    return results, (n_kept_lit, n_filt_lit, n_kept_obs, n_filt_obs)
 
-# TODO: This function is too big, should break it up for ease of interpretation and maintenance.
 
 def filter_annotations_by_ccs_subclass_trend(results_db: ResultsDbPath, 
                                              params: AnnotationParams,
-                                             debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None
+                                             debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None,
+                                             n_proc: int = 1,
+                                             dia_pre_ids: Optional[Iterable[int]] = None
                                              ) -> Tuple[int, int, int, int] :
     """
     filter lipid annotations based on their CCS values vs. overall subclass trends
@@ -585,7 +1198,18 @@ def filter_annotations_by_ccs_subclass_trend(results_db: ResultsDbPath,
     CCS values) is fetched for that subclass and the annotations are filtered according to whether the 
     CCS is within `AnnotationParams.ccs_trend_percent` of the trend. If trend parameters are not 
     already present for a lipid subclass, a trend is instead constructed based only on the annotations
-    themselves and outliers from this trend (using the same percent tolerance) are filtered out.
+    themselves and outliers from this trend (using the same percent tolerance) are filtered out 
+    (see ``ccs_trend_filter``).
+
+    Annotations are not removed, instead the trend errors and the result are stored in the 
+    ``ccs_rel_err`` and ``ccs_pass`` columns of each annotation (annotations that did not pass are 
+    excluded from the ``FilteredLipids`` view), so annotations can be re-filtered (e.g. using a 
+    different ``ccs_trends.percent``) without needing to re-annotate everything. Observed trends are
+    fit using only annotations that passed RT range filtering, with each DIA feature counted once per 
+    subclass and adduct, so this filter should be re-applied after re-filtering by RT range.
+
+    If only a subset of DIA features is specified (`dia_pre_ids`), only annotations of those features
+    get filtered, but observed trends are fit using all annotations in the subclass.
 
     Parameters
     ----------
@@ -598,6 +1222,11 @@ def filter_annotations_by_ccs_subclass_trend(results_db: ResultsDbPath,
     [debug_cb]
         callback function that takes the debugging message as an argument, can be None if
         debug_flag is not set to 'textcb' or 'textcb_pid'
+    [n_proc]
+        number of processes to use for fitting observed trends (for subclasses without literature
+        trends), set >1 to fit multiple subclasses in parallel
+    [dia_pre_ids]
+        only filter annotations for this subset of DIA features (by dia_pre_id), None to filter all
 
     Returns
     -------
@@ -615,126 +1244,43 @@ def filter_annotations_by_ccs_subclass_trend(results_db: ResultsDbPath,
                                 results_db)
     debug_handler(debug_flag, debug_cb, 
                   "FILTERING LIPID ANNOTATIONS BASED ON LIPID CLASS CCS TRENDS ...")
-    con = connect(results_db) 
+    # load the lipid subclass ccs trends 
+    lit_ccs_trends = _load_lit_ccs_trends(params)
+    con = connect_results_db(results_db) 
     cur = con.cursor()
     # make sure CCS calibration has been performed
     check_analysis_log(cur, AnalysisStep.CCS_CAL)
     # check that initial lipid annotations have already been added
     check_analysis_log(cur, AnalysisStep.LIPID_ANN)
-    # queries
-    lm_sub_qry = """--beginsql
-        SELECT DISTINCT
-            lm_sub, adduct 
-        FROM 
-            LipidMapsShort 
-            JOIN Lipids USING(lipid_id) 
-            JOIN DIAPrecursors USING(dia_pre_id)
-        WHERE 
-            ccs IS NOT NULL
-    --endsql"""
-    ann_qry = """--beginsql
+    _upgrade_results_db_schema(cur)
+    # load all of the annotations at once as columns
+    ann_qry = f"""--beginsql
         SELECT 
-            lipid_id, mz, ccs
+            lipid_id, dia_pre_id, lm_sub, adduct, mz, ccs, rt_pass IS NOT 0, {_scope_condition(cur, dia_pre_ids)}
         FROM 
             Lipids 
             JOIN LipidMapsShort USING(lipid_id) 
             JOIN DIAPrecursors USING(dia_pre_id)
         WHERE 
-            lm_sub=?
-            AND adduct=?
-            AND ccs IS NOT NULL
+            ccs IS NOT NULL
     --endsql"""
+    lids, pre_ids, lm_subs, adducts, mzs, ccss, rt_ok, in_scope = zip(*rows) if (rows := cur.execute(ann_qry).fetchall()) else [[]] * 8
+    results, counts = ccs_trend_filter(pre_ids, lm_subs, adducts, mzs, ccss, params, 
+                                       rt_pass=rt_ok, in_scope=in_scope, 
+                                       debug_flag=debug_flag, debug_cb=debug_cb, n_proc=n_proc, 
+                                       lit_ccs_trends=lit_ccs_trends)
+    n_kept_lit, n_filt_lit, n_kept_obs, n_filt_obs = counts
+    # update Lipids entries (that are in scope) with lipids subclass CCS trend errors and filtering 
+    # results, all at once
     update_qry = """--beginsql
-        UPDATE Lipids SET ccs_rel_err=?, ccs_lit_trend=? WHERE lipid_id=?
+        UPDATE Lipids SET ccs_rel_err=?, ccs_lit_trend=?, ccs_pass=? WHERE lipid_id=?
     --endsql"""
-    # load the lipid subclass ccs trends 
-    # load the default config if no alternative was provided
-    ccs_trends_config = (
-        params.ccs_trends.config
-        if params.ccs_trends.config is not None 
-        else DEFAULT_LITERATURE_CCS_TREND_PARAMS
-    )
-    with open(ccs_trends_config, "r") as yf:
-        lit_ccs_trends = yaml.safe_load(yf)
-    # track lipid annotation IDs to drop
-    drop_lids = []
-    # track the number of annotations kept vs. filtered
-    n_kept_lit, n_filt_lit, n_kept_obs, n_filt_obs = 0, 0, 0, 0
-    # iterate through each lipid subclass from among the annotations
-    for lm_sub, adduct in cur.execute(lm_sub_qry).fetchall():
-        # fetch the lipid IDs, m/zs, and CCS values from all annotations of this subclass
-        res = cur.execute(ann_qry, (lm_sub, adduct)).fetchall()
-        # fetch the CCS trend parameters for this subclass (if available)
-        if (sub_params := lit_ccs_trends.get(lm_sub)) is not None \
-                and (trend_params := sub_params.get(adduct)) is not None:
-            debug_handler(
-                debug_flag, debug_cb, 
-                f"literature CCS trend for subclass {lm_sub} and adduct {adduct} FOUND ({trend_params=})"
-            )
-            # filter each annotation based on whether the the m/z and CCS are within
-            # X % of the lipid subclass trend
-            for lid, mz, ccs in res:
-                if (trend_err := _point_in_trend(mz, ccs, 
-                                                trend_params, 
-                                                params.ccs_trends.percent)) is not None:
-                    # update Lipids entry with lipids subclass CCS trend error
-                    # ccs_lit_trend is 1 (True)
-                    cur.execute(update_qry, (trend_err, 1, lid))
-                    n_kept_lit += 1
-                else:
-                    # drop the Lipids entry
-                    drop_lids.append(lid)
-                    n_filt_lit += 1
-        else:
-            debug_handler(debug_flag, debug_cb, 
-                          f"literature CCS trend for subclass {lm_sub} and adduct {adduct} NOT FOUND")
-            # no trend parameters found for this subclass
-            # try to fit a new trend
-            min_points = 5
-            # only proceed if there were actual annotations returned in the last query
-            if len(res) < min_points:
-                # move on to next subclass
-                debug_handler(debug_flag, debug_cb, 
-                              "\t\ttoo few values to fit observed trend")
-                continue
-            mzs, ccss = np.array([_[1:] for _ in res]).T
-            trend_params, trend_err = _fit_observed_trend(mzs, ccss)
-            if trend_params is not None:
-                # success
-                debug_handler(debug_flag, debug_cb, 
-                              f"\t\tfit observed trend ({trend_params=})")
-                for lid, mz, ccs in res:
-                    if (trend_err := _point_in_trend(mz, ccs, 
-                                                    trend_params, 
-                                                    params.ccs_trends.percent)) is not None:
-                        # update Lipids entry with lipids class CCS trend error
-                        # ccs_lit_trend is 0 (False)
-                        cur.execute(update_qry, (trend_err, 0, lid))
-                        n_kept_obs += 1
-                    else:
-                        # drop the Lipids entry
-                        drop_lids.append(lid)
-                        n_filt_obs += 1
-            else:
-                # failure
-                debug_handler(debug_flag, debug_cb, 
-                              f"\t\tfailed to fit trend using observed values ({trend_err})")
-                # drop all associated Lipid IDs
-                to_drop = [_[0] for _ in res]
-                drop_lids += to_drop
-                n_filt_obs += len(to_drop)
-        # report running total of filtering stats after each subclass
-        debug_handler(debug_flag, debug_cb, 
-                        f"\t\tkept:     {n_kept_lit + n_kept_obs} (lit: {n_kept_lit}, obs: {n_kept_obs})")
-        debug_handler(debug_flag, debug_cb, 
-                        f"\t\tfiltered: {n_filt_lit + n_filt_obs} (lit: {n_filt_lit}, obs: {n_filt_obs})")
-    # drop annotations from DB
-    qry_del = """--beginsql
-        DELETE FROM Lipids WHERE lipid_id=?
-    --endsql"""
-    for lid in drop_lids:
-        cur.execute(qry_del, (lid,))
-    # update analysis log
+    in_scope = np.array(in_scope, dtype=np.bool_)
+    cur.executemany(update_qry, zip(*[results[k].filter(in_scope).to_list() 
+                                      for k in ["ccs_rel_err", "ccs_lit_trend", "ccs_pass"]], 
+                                    np.array(lids, dtype=np.int64)[in_scope].tolist()))
+    # update the summary tables and the analysis log
+    _update_summary_tables(cur, AnalysisStep.LIPID_ANN, dia_pre_ids=_scope_ids(cur, dia_pre_ids))
     update_analysis_log(
         cur, 
         AnalysisStep.LIPID_ANN,
@@ -754,46 +1300,115 @@ def filter_annotations_by_ccs_subclass_trend(results_db: ResultsDbPath,
     return n_kept_lit, n_filt_lit, n_kept_obs, n_filt_obs
 
 
-def _copy_lipid_entry_with_new_name_and_chains_flag(results_cur: ResultsDbCursor,
-                                                    lipid_id: int, 
-                                                    lipid_name: str,
-                                                    chains: str) -> int :
+def _chain_level_names(lipid_name: str, 
+                       supported_fas: List[str],
+                       frag_ids: List[int]
+                       ) -> Tuple[Optional[str], Dict[str, Dict[str, Any]]] :
     """
-    make a copy of an entry from the Lipids table with a different name and chains flag
-    return the lipid_id of the newly added entry
-    """
-    qd = list(results_cur.execute("SELECT * FROM Lipids WHERE lipid_id=?", (lipid_id,)).fetchone())
-    qd[0] = None
-    qd[3] = lipid_name
-    qd[-1] = chains
-    results_cur.execute("INSERT INTO Lipids VALUES (?,?,?,?,?,?,?,?,?)", qd)
-    # lastrowid can be None, but that should not happen because we run an insert
-    # query first. lastrowid should only be None if something goes wrong with the
-    # insert, so go ahead and get mad if that is the case
-    rowid = results_cur.lastrowid
-    assert type(rowid) is int
-    return rowid
+    Work out acyl chain level names for a lipid annotation from its annotated fragments that support
+    the presence of specific acyl chains
 
+    Parameters
+    ----------
+    lipid_name
+        sum composition level lipid name
+    supported_fas
+        acyl chain supported by each annotated fragment (e.g. "18:1")
+    frag_ids
+        identifier of each annotated fragment
 
-def _copy_lipid_frag_entries_with_new_lipid_id(results_cur: ResultsDbCursor,
-                                              dia_frag_ids: Iterable[int],
-                                              lipid_id: int
-                                              ) -> None :
-    """
-    make a copy of an entry from the LipidFragments table with a different lipid_id
+    Returns
+    -------
+    in_place_flag
+        chains flag to set on the annotation itself (keeping the same name), None if not updated
+    new_lipid_names
+        new lipid names generated for the annotation with the chains flag and the identifiers of the
+        fragments supporting them (``{"chains_flag": str, "frag_ids": set(int)}``), if any new names
+        are generated the annotation should be replaced by them
     """
-    # TODO: This results in a lot of duplicate entries, need to filter those down somehow
-    for dia_frag_id in dia_frag_ids:
-        # loop in case there are more than one?
-        for qd in results_cur.execute("SELECT * FROM LipidFragments WHERE dia_frag_id=?", (dia_frag_id,)).fetchall():
-            qd = list(qd)
-            qd[0] = lipid_id
-            results_cur.execute("INSERT INTO LipidFragments VALUES (?,?,?,?,?,?,?)", qd)
-
-
-# TODO: This function is too big, should break it up for ease of interpretation and maintenance.
-
-def _update_lipid_with_chain_info(results_cur: ResultsDbCursor
+    in_place_flag = None
+    # keep track of new lipid names for this entry, as well as the chains flag and any fragment IDs 
+    # that need to be remapped
+    # keys: new lipid name -> str
+    # values: {"chains_flag": str, "frag_ids": set(int)} 
+    new_lipid_names = {}
+    if (lipid := parse_lipid_name_info(lipid_name)) is None:
+        return in_place_flag, new_lipid_names
+    # unpack the FAs
+    # keys: FA -> tuple(n_carbons, n_unsaturations)
+    # values: fragment IDs -> set(int)
+    fas = {}
+    for fa, fid in zip([tuple(map(int, _.split(":"))) for _ in supported_fas], frag_ids):
+        if fa not in fas:
+            fas[fa] = {fid}
+        else:
+            fas[fa].add(fid)
+    match lipid.n_chains:
+        case 1:
+            # monoacyl
+            for (c, u) in fas.keys():
+                if c == lipid.fa_carbon and u == lipid.fa_unsat:
+                    # no need for a new name
+                    # update the lipid entry with "confirmed" chains flag in place
+                    in_place_flag = "confirmed"
+                    # no need to check more fragments
+                    # just move on to the next lipid annotation
+                    continue
+        case 2:
+            # diacyl 
+            for (c1, u1), fids in fas.items():
+                # calculate the remaining sum composition
+                c2_exp, u2_exp = lipid.fa_carbon - c1, lipid.fa_unsat - u1
+                if c2_exp > 0 and u2_exp >= 0:
+                    # we have found 1 valid chain, chains flag is "inferred"
+                    flag = "inferred"
+                    # see if we can match another chain
+                    for (c2, u2), fids2 in fas.items():
+                        if c2 == c2_exp and u2 == u2_exp:
+                            flag = "confirmed"
+                            fids |= fids2
+                    # generate the new lipid name 
+                    new_lipid_name = str(LipidWithChains(lipid.lmaps_id_prefix, [c1, c2_exp], [u1, u2_exp]))
+                    if new_lipid_name not in new_lipid_names:
+                        new_lipid_names[new_lipid_name] = {"chains_flag": flag, "frag_ids": fids}
+                    else:
+                        new_lipid_names[new_lipid_name]["chains_flag"] = flag
+                        new_lipid_names[new_lipid_name]["frag_ids"] |= fids
+        case 3:
+            # triacyl
+            for (c1, u1), fids in fas.items():
+                # calculate the remaining sum composition
+                c2_exp, u2_exp = lipid.fa_carbon - c1, lipid.fa_unsat - u1
+                if c2_exp > 0 and u2_exp >= 0:
+                    # we have found 1 valid chain, chains flag is "partial"
+                    flag = "partial"
+                    # see if we can match another chain
+                    for (c2, u2), fids2 in fas.items():
+                        # calculate the remaining sum composition
+                        c3_exp, u3_exp = c2_exp - c2, u2_exp - u2
+                        if c3_exp > 0 and u3_exp >= 0:
+                            # see if we can match the last chain
+                            for (c3, u3), fids3 in fas.items():
+                                if c3 == c3_exp and u3 == u3_exp:
+                                    flag = "confirmed"
+                                    # generate the new lipid name
+                                    new_lipid_name = str(LipidWithChains(lipid.lmaps_id_prefix, [c1, c2, c3], [u1, u2, u3]))
+                                    if new_lipid_name not in new_lipid_names:
+                                        new_lipid_names[new_lipid_name] = {"chains_flag": flag, "frag_ids": fids | fids2 | fids3}
+                                    else:
+                                        new_lipid_names[new_lipid_name]["chains_flag"] = flag
+                                        new_lipid_names[new_lipid_name]["frag_ids"] |= fids | fids2 | fids3
+                    # if flag is still partial go ahead an update the lipid annotation in place
+                    if flag == "partial":
+                        in_place_flag = flag
+        case 4:
+            # 4-acyl
+            assert False, "updating acyl chains for 4-acyl lipids not implemented yet"
+    return in_place_flag, new_lipid_names
+
+
+def _update_lipid_with_chain_info(results_cur: ResultsDbCursor,
+                                  scope: str = "1"
                                   ) -> None :
     """
     Update entries in Lipids based on annotated fragments supporting the presence
@@ -802,8 +1417,10 @@ def _update_lipid_with_chain_info(results_cur: ResultsDbCursor
     Parameters
     ----------
     results_cur
+    [scope]
+        condition restricting which Lipids entries to update (from ``_scope_condition``)
     """
-    qry_sel = """--beginsql
+    qry_sel = f"""--beginsql
         SELECT 
             lipid_id, 
             lipid, 
@@ -814,113 +1431,606 @@ def _update_lipid_with_chain_info(results_cur: ResultsDbCursor
             JOIN LipidFragments USING(lipid_id) 
         WHERE 
             supports_fa IS NOT NULL 
+            AND {scope}
         GROUP BY 
             lipid_id
     --endsql"""
     qry_updt_chains_flag = """--beginsql
         UPDATE Lipids SET chains=? WHERE lipid_id=?
     --endsql"""
+    # load the relevant Lipids entries and all LipidFragments entries at once, all of the updates 
+    # are made in memory then written back to the database in bulk at the end
+    qry_sel_lipids = f"""--beginsql
+        SELECT 
+            * 
+        FROM 
+            Lipids 
+        WHERE 
+            lipid_id IN (SELECT lipid_id FROM LipidFragments WHERE supports_fa IS NOT NULL)
+            AND {scope}
+    --endsql"""
+    lipid_rows = {row[0]: row for row in results_cur.execute(qry_sel_lipids).fetchall()}
+    qry_sel_frags = f"""--beginsql
+        SELECT 
+            * 
+        FROM 
+            LipidFragments 
+        WHERE 
+            lipid_id IN (SELECT lipid_id FROM Lipids WHERE {scope})
+    --endsql"""
+    # keys: (lipid_id, dia_frag_id) -> tuple(int, int)
+    # values: LipidFragments entries for that annotation and fragment (in table order) -> list(tuple(...))
+    frag_rows = {}
+    for row in results_cur.execute(qry_sel_frags).fetchall():
+        frag_rows.setdefault(row[:2], []).append(row)
+    # new lipid IDs are assigned sequentially after the current max
+    next_lipid_id = (results_cur.execute("SELECT MAX(lipid_id) FROM Lipids").fetchone()[0] or 0) + 1
+    # track chains flag updates (in place), new Lipids and LipidFragments entries, and Lipids entries
+    # to delete (replaced by entries with new names)
+    chains_flag_updates, new_lipid_rows, new_frag_rows, lipid_ids_to_delete = [], [], [], []
     # iterate through lipid annotations that also have annotated fragments supporting specific acyl chains
     for lipid_id, lipid_name, frag_ids, supported_fas in results_cur.execute(qry_sel).fetchall():
-        if (lipid := parse_lipid_name(lipid_name)) is not None:
-            # unpack the FAs
-            # keys: FA -> tuple(n_carbons, n_unsaturations)
-            # values: fragment IDs -> set(int)
-            fas = {}
-            for fa, fid in zip([tuple(map(int, _.split(":"))) for _ in supported_fas.split(",")], map(int, frag_ids.split(","))):
-                if fa not in fas:
-                    fas[fa] = {fid}
-                else:
-                    fas[fa].add(fid)
-            # keep track of new lipid names for this entry, as well as the chains flag and any fragment IDs 
-            # that need to be remapped
-            # keys: new lipid name -> str
-            # values: {"chains_flag": str, "frag_ids": set(int)} 
-            new_lipid_names = {}
-            match lipid.n_chains:
-                case 1:
-                    # monoacyl
-                    for (c, u) in fas.keys():
-                        if c == lipid.fa_carbon and u == lipid.fa_unsat:
-                            # no need for a new name
-                            # update the lipid entry with "confirmed" chains flag in place
-                            results_cur.execute(qry_updt_chains_flag, ("confirmed", lipid_id))
-                            # no need to check more fragments
-                            # just move on to the next lipid annotation
-                            continue
-                case 2:
-                    # diacyl 
-                    for (c1, u1), fids in fas.items():
-                        # calculate the remaining sum composition
-                        c2_exp, u2_exp = lipid.fa_carbon - c1, lipid.fa_unsat - u1
-                        if c2_exp > 0 and u2_exp >= 0:
-                            # we have found 1 valid chain, chains flag is "inferred"
-                            flag = "inferred"
-                            # see if we can match another chain
-                            for (c2, u2), fids2 in fas.items():
-                                if c2 == c2_exp and u2 == u2_exp:
-                                    flag = "confirmed"
-                                    fids |= fids2
-                            # generate the new lipid name 
-                            new_lipid_name = str(LipidWithChains(lipid.lmaps_id_prefix, [c1, c2_exp], [u1, u2_exp]))
-                            if new_lipid_name not in new_lipid_names:
-                                new_lipid_names[new_lipid_name] = {"chains_flag": flag, "frag_ids": fids}
-                            else:
-                                new_lipid_names[new_lipid_name]["chains_flag"] = flag
-                                new_lipid_names[new_lipid_name]["frag_ids"] |= fids
-                case 3:
-                    # triacyl
-                    for (c1, u1), fids in fas.items():
-                        # calculate the remaining sum composition
-                        c2_exp, u2_exp = lipid.fa_carbon - c1, lipid.fa_unsat - u1
-                        if c2_exp > 0 and u2_exp >= 0:
-                            # we have found 1 valid chain, chains flag is "partial"
-                            flag = "partial"
-                            # see if we can match another chain
-                            for (c2, u2), fids2 in fas.items():
-                                # calculate the remaining sum composition
-                                c3_exp, u3_exp = c2_exp - c2, u2_exp - u2
-                                if c3_exp > 0 and u3_exp >= 0:
-                                    # see if we can match the last chain
-                                    for (c3, u3), fids3 in fas.items():
-                                        if c3 == c3_exp and u3 == u3_exp:
-                                            flag = "confirmed"
-                                            # generate the new lipid name
-                                            new_lipid_name = str(LipidWithChains(lipid.lmaps_id_prefix, [c1, c2, c3], [u1, u2, u3]))
-                                            if new_lipid_name not in new_lipid_names:
-                                                new_lipid_names[new_lipid_name] = {"chains_flag": flag, "frag_ids": fids | fids2 | fids3}
-                                            else:
-                                                new_lipid_names[new_lipid_name]["chains_flag"] = flag
-                                                new_lipid_names[new_lipid_name]["frag_ids"] |= fids | fids2 | fids3
-                            # if flag is still partial go ahead an update the lipid annotation in place
-                            if flag == "partial":
-                                results_cur.execute(qry_updt_chains_flag, (flag, lipid_id))
-                case 4:
-                    # 4-acyl
-                    assert False, "updating acyl chains for 4-acyl lipids not implemented yet"
-            # if there were new names generated, update the database with them
-            if len(new_lipid_names) > 0:
-                # deal with all of the new lipid names
-                for new_lipid_name, v in new_lipid_names.items():
-                    chains_flag = v["chains_flag"]
-                    frag_ids = v["frag_ids"]
-                    # first make a copy of the Lipids entry
-                    new_lipid_id = _copy_lipid_entry_with_new_name_and_chains_flag(results_cur, lipid_id, new_lipid_name, chains_flag)
-                    # then make copies of the fragment annotations
-                    _copy_lipid_frag_entries_with_new_lipid_id(results_cur, frag_ids, new_lipid_id)
-                # delete the old lipid annotation
-                results_cur.execute("DELETE FROM Lipids WHERE lipid_id=?", (lipid_id,))
-
-
-# TODO: This function is too big, should break it up for ease of interpretation and maintenance.
+        in_place_flag, new_lipid_names = _chain_level_names(lipid_name, 
+                                                            supported_fas.split(","), 
+                                                            list(map(int, frag_ids.split(","))))
+        if in_place_flag is not None:
+            # update the lipid entry with the chains flag in place
+            chains_flag_updates.append((in_place_flag, lipid_id))
+        # if there were new names generated, replace the annotation with them
+        if len(new_lipid_names) > 0:
+            # deal with all of the new lipid names
+            for new_lipid_name, v in new_lipid_names.items():
+                chains_flag = v["chains_flag"]
+                frag_ids = v["frag_ids"]
+                # first make a copy of the Lipids entry with the new name and chains flag
+                new_lipid_id = next_lipid_id
+                next_lipid_id += 1
+                # (columns after chains are the filter flags, those are copied as well)
+                new_lipid_rows.append(
+                    (new_lipid_id, *lipid_rows[lipid_id][1:3], new_lipid_name, *lipid_rows[lipid_id][4:8], 
+                     chains_flag, *lipid_rows[lipid_id][9:])
+                )
+                # then make copies of the old annotation's own fragment annotations for the supporting 
+                # fragments (same as ``_chain_level_annotations``)
+                for dia_frag_id in sorted(frag_ids):
+                    new_frag_rows += [(new_lipid_id, *row[1:]) for row in frag_rows.get((lipid_id, dia_frag_id), [])]
+            # delete the old lipid annotation (and its fragment annotations)
+            lipid_ids_to_delete.append((lipid_id,))
+    # write all of the changes back to the database
+    results_cur.executemany(qry_updt_chains_flag, chains_flag_updates)
+    results_cur.executemany("INSERT INTO Lipids VALUES (?,?,?,?,?,?,?,?,?,?,?)", new_lipid_rows)
+    results_cur.executemany("INSERT INTO LipidFragments VALUES (?,?,?,?,?,?,?)", new_frag_rows)
+    results_cur.executemany("DELETE FROM Lipids WHERE lipid_id=?", lipid_ids_to_delete)
+    results_cur.executemany("DELETE FROM LipidFragments WHERE lipid_id=?", lipid_ids_to_delete)
+
+
+def _theoretical_fragments(rules: List[Any], 
+                           c_u_combos: List[Tuple[int, int]]
+                           ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.bool_], 
+                                      List[str], npt.NDArray[np.int64], List[Optional[str]]] :
+    """
+    Expand a set of fragmentation rules over all FA (c, u) combinations into flat arrays describing 
+    every theoretical fragment, in the same order that rules/combos would be iterated over one at a time
+    (rules in order, static rules once, dynamic rules once per combo in sorted order)
+
+    The fragment masses do not include the precursor m/z, neutral loss fragments are resolved to actual 
+    m/z values using ``_theoretical_fragment_mzs`` once the precursor m/z is known
+
+    Returns
+    -------
+    masses
+        fragment m/z (or neutral loss mass) for each theoretical fragment
+    neutral_loss
+        flags indicating which theoretical fragments are neutral losses
+    labels
+        fragment labels
+    diagnostic
+        flags (0 or 1) indicating which theoretical fragments are diagnostic
+    supports_fa
+        supported FA as "C:U" for fragments from dynamic rules, None for static rules
+    """
+    masses, neutral_loss, labels, diagnostic, supports_fa = [], [], [], [], []
+    for rule in rules:
+        if rule.static:
+            # with a precursor m/z of 0 neutral loss rules come out as the negative of the loss
+            mass = rule.mz(0.)
+            masses.append(-mass if rule.neutral_loss else mass)
+            labels.append(rule.label())
+            supports_fa.append(None)
+            neutral_loss.append(rule.neutral_loss)
+            diagnostic.append(int(rule.diagnostic))
+        else:
+            for c, u in sorted(c_u_combos):
+                mass = rule.mz(0., c, u)
+                masses.append(-mass if rule.neutral_loss else mass)
+                labels.append(rule.label(c, u))
+                supports_fa.append(f"{c}:{u}")
+                neutral_loss.append(rule.neutral_loss)
+                diagnostic.append(int(rule.diagnostic))
+    return (np.array(masses, dtype=np.float64), np.array(neutral_loss, dtype=np.bool_), 
+            labels, np.array(diagnostic, dtype=np.int64), supports_fa)
+
+
+def _theoretical_fragment_mzs(masses: npt.NDArray[np.float64], 
+                              neutral_loss: npt.NDArray[np.bool_], 
+                              pre_mz: float
+                              ) -> npt.NDArray[np.float64] :
+    """ resolve theoretical fragment masses into m/z values using the precursor m/z for neutral losses """
+    return np.where(neutral_loss, pre_mz - masses, masses)
+
+
+def _match_fragments(rule_mzs: npt.NDArray[np.float64], 
+                     frag_mzs: npt.NDArray[np.float64], 
+                     ppm: float
+                     ) -> Tuple[npt.NDArray[np.int64], npt.NDArray[np.int64], npt.NDArray[np.float64]] :
+    """
+    Match all theoretical fragment m/zs against all observed fragment m/zs at once
+
+    The observed m/zs are sorted and the window for each theoretical m/z is located with a binary 
+    search, then candidate pairs are checked using the exact ppm error (same as ``_ppm_error``)
+
+    Returns
+    -------
+    rule_idx
+    frag_idx
+        indices into ``rule_mzs`` and ``frag_mzs`` for each matched pair, ordered by rule index then
+        fragment index
+    ppms
+        ppm error of the observed fragment m/z relative to the theoretical m/z for each matched pair
+    """
+    if len(rule_mzs) == 0 or len(frag_mzs) == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([], dtype=np.float64)
+    order = np.argsort(frag_mzs, kind="stable")
+    sorted_mzs = frag_mzs[order]
+    # slightly widened windows, exact tolerance is enforced below
+    tol = np.abs(rule_mzs) * (ppm * 1.000001e-6)
+    lo = np.searchsorted(sorted_mzs, rule_mzs - tol, side="left")
+    hi = np.searchsorted(sorted_mzs, rule_mzs + tol, side="right")
+    counts = hi - lo
+    rule_idx = np.repeat(np.arange(len(rule_mzs)), counts)
+    # position of each candidate within the sorted observed m/zs
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    frag_idx = order[np.repeat(lo, counts) + offsets]
+    ppms = 1e6 * (frag_mzs[frag_idx] - rule_mzs[rule_idx]) / rule_mzs[rule_idx]
+    keep = np.abs(ppms) <= ppm
+    rule_idx, frag_idx, ppms = rule_idx[keep], frag_idx[keep], ppms[keep]
+    # restore the original (rule, fragment) ordering
+    srt = np.lexsort((frag_idx, rule_idx))
+    return rule_idx[srt], frag_idx[srt], ppms[srt]
+
+
+class FragmentLibrary():
+    """
+    Library of theoretical fragments (from fragmentation rules) for lipids at the level of sum 
+    composition, for a given ionization mode and FA composition limits
+
+    Theoretical fragments only depend upon the lipid class and sum composition, so they are generated 
+    once for each (lmid_prefix, n_chains, sum_c, sum_u) and stored as arrays (in the same order as from
+    ``_theoretical_fragments``) with fragment labels and supported FAs stored as indices into lookup 
+    tables. Fragment annotation then only requires resolving neutral losses using the precursor m/z and 
+    matching against observed fragments. 
+    
+    The library can be saved to disk (.npz) and loaded again as long as the ionization, FA composition 
+    limits, fragmentation rules and package version are the same.
+    """
+
+    def __init__(self, 
+                 ionization: str,
+                 fa_c_min: int,
+                 fa_c_max: int,
+                 fa_odd_c: bool
+                 ) -> None :
+        """
+        Initialize an empty library
+
+        Parameters
+        ----------
+        ionization
+            ionization mode ("POS" or "NEG")
+        fa_c_min
+        fa_c_max
+            min/max number of carbons in FA chains
+        fa_odd_c
+            whether to include odd-carbon FAs
+        """
+        self.ionization = ionization
+        self.fa_c_min = fa_c_min
+        self.fa_c_max = fa_c_max
+        self.fa_odd_c = fa_odd_c
+        # lookup tables for fragment labels and supported FAs 
+        self.labels: List[str] = []
+        self.fas: List[str] = []
+        self._label_idx: Dict[str, int] = {}
+        self._fa_idx: Dict[str, int] = {}
+        # keys: FragLibKey
+        # values: (masses, neutral_loss, label indices, diagnostic, FA indices (-1 for None))
+        self._entries: Dict[FragLibKey, Tuple[npt.NDArray[np.float64], npt.NDArray[np.bool_], 
+                                              npt.NDArray[np.int32], npt.NDArray[np.int8], 
+                                              npt.NDArray[np.int32]]] = {}
+        # rules are only loaded when fragments need to be generated
+        self._rules: Dict[str, List[Any]] = {}
+        # flag indicating whether entries were added since the library was created/loaded
+        self.modified = False
+
+    def __len__(self
+                ) -> int :
+        return len(self._entries)
+
+    def __contains__(self, 
+                     key: FragLibKey
+                     ) -> bool :
+        return key in self._entries
+
+    @staticmethod
+    def _rules_digest() -> str :
+        """ hash of the contents of all fragmentation rule files """
+        h = hashlib.sha256()
+        rules_dir = op.join(INCLUDE_DIR, "lipidlib/rules")
+        for fname in sorted(os.listdir(rules_dir)):
+            h.update(fname.encode())
+            with open(op.join(rules_dir, fname), "rb") as f:
+                h.update(f.read())
+        return h.hexdigest()
+
+    def _metadata(self
+                  ) -> str :
+        """ metadata identifying compatible libraries (as JSON) """
+        return json.dumps({
+            "version": __version__,
+            "ionization": self.ionization,
+            "fa_c_min": self.fa_c_min,
+            "fa_c_max": self.fa_c_max,
+            "fa_odd_c": bool(self.fa_odd_c),
+            "rules": self._rules_digest(),
+        }, sort_keys=True)
+
+    @staticmethod
+    def _lookup(value: str, 
+                table: List[str], 
+                index: Dict[str, int]
+                ) -> int :
+        """ get the index of a value in a lookup table, adding it if necessary """
+        if (i := index.get(value)) is None:
+            i = index[value] = len(table)
+            table.append(value)
+        return i
+
+    def add(self, 
+            key: FragLibKey
+            ) -> None :
+        """
+        Generate the theoretical fragments for a lipid (if they are not already in the library)
+
+        Parameters
+        ----------
+        key
+            (lmid_prefix, n_chains, sum_c, sum_u)
+        """
+        if key in self._entries:
+            return
+        lmid_prefix, n_chains, sum_c, sum_u = key
+        if lmid_prefix not in self._rules:
+            _, self._rules[lmid_prefix] = load_rules(lmid_prefix, self.ionization)
+        c_u_combos = list(get_c_u_combos(n_chains, 
+                                         sum_c, 
+                                         sum_u, 
+                                         self.fa_c_min, 
+                                         self.fa_c_max, 
+                                         self.fa_odd_c,
+                                         max_u=SumCompLipidDB.max_u))
+        masses, neutral_loss, labels, diagnostic, supports_fa = _theoretical_fragments(self._rules[lmid_prefix], 
+                                                                                       c_u_combos)
+        self._entries[key] = (
+            masses, 
+            neutral_loss, 
+            np.array([self._lookup(label, self.labels, self._label_idx) for label in labels], dtype=np.int32),
+            diagnostic.astype(np.int8),
+            np.array([-1 if fa is None else self._lookup(fa, self.fas, self._fa_idx) for fa in supports_fa], 
+                     dtype=np.int32)
+        )
+        self.modified = True
+
+    def add_sum_comp_lipids(self, 
+                            scdb: SumCompLipidDB
+                            ) -> None :
+        """
+        Generate the theoretical fragments for all of the lipids in a sum composition lipid DB
+        
+        Parameters
+        ----------
+        scdb
+            sum composition lipid DB
+        """
+        qry = "SELECT DISTINCT lmid_prefix, n_chains, sum_c, sum_u FROM SumCompLipids"
+        for key in scdb._cur.execute(qry).fetchall():
+            self.add(key)
+
+    def fragments(self, 
+                  key: FragLibKey
+                  ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.bool_], 
+                             npt.NDArray[np.int32], npt.NDArray[np.int8], npt.NDArray[np.int32]] :
+        """
+        Get the theoretical fragments for a lipid (generating them if necessary)
+
+        Parameters
+        ----------
+        key
+            (lmid_prefix, n_chains, sum_c, sum_u)
+
+        Returns
+        -------
+        masses
+            fragment m/z (or neutral loss mass) for each theoretical fragment
+        neutral_loss
+            flags indicating which theoretical fragments are neutral losses
+        label_idx
+            indices of fragment labels in ``FragmentLibrary.labels``
+        diagnostic
+            flags (0 or 1) indicating which theoretical fragments are diagnostic
+        fa_idx
+            indices of supported FAs in ``FragmentLibrary.fas``, -1 for fragments from static rules
+        """
+        self.add(key)
+        return self._entries[key]
+
+    def subset(self, 
+               keys: Iterable[FragLibKey]
+               ) -> "FragmentLibrary" :
+        """
+        Get a library with only the specified lipids (generating their fragments if necessary), which 
+        shares the lookup tables with this library (e.g. to send only the relevant parts of a large 
+        library to worker processes)
+        """
+        sub = FragmentLibrary(self.ionization, self.fa_c_min, self.fa_c_max, self.fa_odd_c)
+        sub.labels, sub.fas = self.labels, self.fas
+        sub._label_idx, sub._fa_idx = self._label_idx, self._fa_idx
+        sub._entries = {key: self.fragments(key) for key in keys}
+        return sub
+
+    def save(self, 
+             path: str
+             ) -> None :
+        """
+        Save the library to disk (.npz)
+
+        Parameters
+        ----------
+        path
+            path to save the library to
+        """
+        keys = list(self._entries.keys())
+        entries = [self._entries[key] for key in keys]
+        lengths = np.array([len(e[0]) for e in entries], dtype=np.int64)
+        def concat(i, dtype):
+            return np.concatenate([e[i] for e in entries]) if entries else np.array([], dtype=dtype)
+        # write to a temporary file first so an interrupted save does not leave a broken library
+        tmp = f"{path}.tmp.npz"
+        np.savez(
+            tmp,
+            metadata=np.array(self._metadata()),
+            key_prefixes=np.array([k[0] for k in keys], dtype=np.str_),
+            key_values=np.array([k[1:] for k in keys], dtype=np.int64).reshape(-1, 3),
+            offsets=np.concatenate([[0], np.cumsum(lengths)]),
+            masses=concat(0, np.float64),
+            neutral_loss=concat(1, np.bool_),
+            label_idx=concat(2, np.int32),
+            diagnostic=concat(3, np.int8),
+            fa_idx=concat(4, np.int32),
+            labels=np.array(self.labels, dtype=np.str_),
+            fas=np.array(self.fas, dtype=np.str_),
+        )
+        os.replace(tmp, path)
+        self.modified = False
+
+    @classmethod
+    def load(cls, 
+             path: str,
+             ionization: str,
+             fa_c_min: int,
+             fa_c_max: int,
+             fa_odd_c: bool
+             ) -> "FragmentLibrary" :
+        """
+        Load a library from disk (.npz), if the file does not exist or the library is not compatible 
+        (different ionization, FA composition limits, fragmentation rules or package version) an empty 
+        library is returned instead
+
+        Parameters
+        ----------
+        path
+            path to load the library from
+        ionization
+            ionization mode ("POS" or "NEG")
+        fa_c_min
+        fa_c_max
+            min/max number of carbons in FA chains
+        fa_odd_c
+            whether to include odd-carbon FAs
+
+        Returns
+        -------
+        library
+            fragment library
+        """
+        lib = cls(ionization, fa_c_min, fa_c_max, fa_odd_c)
+        if not op.isfile(path):
+            return lib
+        with np.load(path, allow_pickle=False) as npz:
+            if str(npz["metadata"]) != lib._metadata():
+                return lib
+            lib.labels = npz["labels"].tolist()
+            lib.fas = npz["fas"].tolist()
+            lib._label_idx = {label: i for i, label in enumerate(lib.labels)}
+            lib._fa_idx = {fa: i for i, fa in enumerate(lib.fas)}
+            offsets = npz["offsets"]
+            columns = [npz[k] for k in ["masses", "neutral_loss", "label_idx", "diagnostic", "fa_idx"]]
+            for i, (prefix, (n_chains, sum_c, sum_u)) in enumerate(zip(npz["key_prefixes"].tolist(), 
+                                                                       npz["key_values"].tolist())):
+                lib._entries[(prefix, n_chains, sum_c, sum_u)] = tuple(col[offsets[i]:offsets[i + 1]] 
+                                                                       for col in columns)
+        return lib
+
+
+def _match_frag_rules_partition(library: FragmentLibrary,
+                                mz_ppm: float,
+                                anns: List[Tuple[int, str, int, int, int, float, List[int], npt.NDArray[np.float64]]]
+                                ) -> List[Tuple[List[Tuple[int, int, str, float, float, int, Optional[str]]], bool]] :
+    """
+    Match theoretical fragments from a fragment library against observed DIA fragments for a set of 
+    lipid annotations. Each annotation is a tuple with an annotation identifier, lmid_prefix, sum 
+    composition carbons, unsaturations, and number of chains, precursor m/z, then fragment identifiers
+    and m/zs.
+
+    Returns a tuple for each annotation with the LipidFragments entries to add and a flag indicating
+    whether any fragments from dynamic rules (i.e., supporting specific acyl chains) were matched
+    """
+    results = []
+    for ann_id, lmid_prefix, sum_c, sum_u, n_chains, pmz, fids, fmzs in anns:
+        masses, neutral_loss, label_idx, diagnostic, fa_idx = library.fragments((lmid_prefix, n_chains, sum_c, sum_u))
+        rmzs = _theoretical_fragment_mzs(masses, neutral_loss, pmz)
+        # go through each rule and see if it matches any fragments
+        rule_idx, frag_idx, ppms = _match_fragments(rmzs, fmzs, mz_ppm)
+        results.append((
+            [
+                (ann_id, fids[j], library.labels[label_idx[i]], float(rmzs[i]), float(ppm), int(diagnostic[i]), 
+                 None if fa_idx[i] < 0 else library.fas[fa_idx[i]])
+                for i, j, ppm in zip(rule_idx, frag_idx, ppms)
+            ],
+            # annotations are updated if any fragments from dynamic rules were matched
+            bool((fa_idx[rule_idx] >= 0).any())
+        ))
+    return results
+
+
+def _load_fragment_library(params: AnnotationParams,
+                           frag_library: Optional[str],
+                           debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None
+                           ) -> FragmentLibrary :
+    """
+    load the fragment library from file (building it from the sum composition lipid DB if it does not
+    exist or is not compatible with the current parameters), or start an empty one if no file is given
+    """
+    assert params.ionization is not None, "ionization must be set (POS or NEG)"
+    lib_args = (params.ionization, 
+                params.frag_rules.fa_c.min, params.frag_rules.fa_c.max, params.frag_rules.fa_odd_c)
+    if frag_library is None:
+        return FragmentLibrary(*lib_args)
+    library = FragmentLibrary.load(frag_library, *lib_args)
+    if len(library) == 0:
+        debug_handler(debug_flag, debug_cb, f"building fragment library: {frag_library}")
+        scdb = _sum_comp_lipid_db(params)
+        library.add_sum_comp_lipids(scdb)
+        scdb.close()
+    return library
+
+
+def _match_frag_rules(anns: List[Tuple[int, str, int, int, int, float, List[int], npt.NDArray[np.float64]]],
+                      dfile_ids: List[int],
+                      params: AnnotationParams,
+                      library: FragmentLibrary,
+                      n_proc: int,
+                      frag_library: Optional[str] = None
+                      ) -> List[Tuple[List[Tuple[int, int, str, float, float, int, Optional[str]]], bool]] :
+    """
+    match fragmentation rules for a set of annotations (see ``_match_frag_rules_partition``), in 
+    parallel if n_proc > 1, saving the fragment library to file afterwards if it was modified
+    """
+    # theoretical fragments only depend upon lipid class and sum composition, get them from the 
+    # fragment library (only need to be generated once for each)
+    # only the lipids that are actually needed get sent to worker processes
+    shared = {
+        "library": library.subset(sorted({(_[1], _[4], _[2], _[3]) for _ in anns})),
+        "mz_ppm": params.frag_rules.mz_ppm,
+    }
+    if frag_library is not None and library.modified:
+        library.save(frag_library)
+    if n_proc > 1 and len(anns) > 1:
+        partitions = _partition_dia_features(np.array(dfile_ids), np.array([_[5] for _ in anns]), n_proc)
+        return _map_partitions(_match_frag_rules_partition, anns, partitions, shared, n_proc)
+    return _match_frag_rules_partition(shared["library"], shared["mz_ppm"], anns)
+
+
+def match_fragment_rules(annotations: pl.DataFrame,
+                         pre_mzs: npt.ArrayLike,
+                         frag_mzs: List[npt.ArrayLike],
+                         params: AnnotationParams,
+                         dfile_ids: Optional[npt.ArrayLike] = None,
+                         n_proc: int = 1,
+                         library: Optional[FragmentLibrary] = None
+                         ) -> Tuple[pl.DataFrame, npt.NDArray[np.bool_]] :
+    """
+    match theoretical fragments from fragmentation rules against observed fragments for a set of lipid 
+    annotations, entirely in memory (without a results database)
+
+    Parameters
+    ----------
+    annotations
+        lipid annotations (e.g. from ``annotate_sum_composition``), must have feature, lmid_prefix, 
+        sum_c, sum_u, and n_chains columns
+    pre_mzs
+        precursor m/z for each feature
+    frag_mzs
+        fragment m/zs for each feature
+    params
+        parameters for lipid annotation
+    [dfile_ids]
+        data file identifier for each feature, only used for partitioning annotations if n_proc > 1
+    [n_proc]
+        number of processes to use, set >1 to partition the annotations (by data file or m/z range) 
+        and match fragmentation rules in parallel
+    [library]
+        fragment library to get theoretical fragments from, None to only generate theoretical 
+        fragments for these annotations
+
+    Returns
+    -------
+    fragments
+        one row per matched fragment with columns: annotation (row index into ``annotations``), 
+        fragment (index into the feature's ``frag_mzs``), frag_rule, rule_mz, ppm, diagnostic, 
+        supports_fa
+    updated
+        flag for each annotation indicating whether any fragments from dynamic rules (i.e., supporting
+        specific acyl chains) were matched
+    """
+    pre_mzs = np.asarray(pre_mzs, dtype=np.float64)
+    if library is None:
+        library = _load_fragment_library(params, None)
+    features = annotations["feature"].to_list()
+    anns = [
+        (i, lmid_prefix, sum_c, sum_u, n_chains, float(pre_mzs[feature]), 
+         range(len(fmzs := np.asarray(frag_mzs[feature], dtype=np.float64))), fmzs)
+        for i, (feature, lmid_prefix, sum_c, sum_u, n_chains) in enumerate(zip(
+            features, *[annotations[k].to_list() for k in ["lmid_prefix", "sum_c", "sum_u", "n_chains"]]
+        ))
+    ]
+    dfile_ids = np.zeros(len(pre_mzs), dtype=np.int64) if dfile_ids is None else np.asarray(dfile_ids)
+    matches = _match_frag_rules(anns, dfile_ids[features].tolist(), params, library, n_proc)
+    return (
+        pl.DataFrame([row for ann_frag_rows, _ in matches for row in ann_frag_rows], 
+                     schema=FRAGMENT_SCHEMA, orient="row"),
+        np.array([updated for _, updated in matches], dtype=np.bool_)
+    )
+
 
 def update_lipid_ids_with_frag_rules(results_db: ResultsDbPath,
                                      params: AnnotationParams,
-                                     debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None
+                                     debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None,
+                                     n_proc: int = 1,
+                                     dia_pre_ids: Optional[Iterable[int]] = None,
+                                     frag_library: Optional[str] = None
                                      ) -> int :
     """
     update lipid annotations based on MS/MS spectra and fragmentation rules
 
+    For each annotation, all theoretical fragments (rules x FA combinations) are looked up from a 
+    ``FragmentLibrary`` and matched against all of the observed DIA fragments at once, matched 
+    fragments are then added to the ``LipidFragments`` table in bulk
+
+    Only annotations that passed filtering (those in the ``FilteredLipids`` view) and that do not 
+    already have annotated fragments are considered, so after re-filtering this only needs to 
+    process the annotations that newly passed
+
     Parameters
     ----------
     results_db
@@ -932,6 +2042,16 @@ def update_lipid_ids_with_frag_rules(results_db: ResultsDbPath,
     [debug_cb]
         callback function that takes the debugging message as an argument, can be None if
         debug_flag is not set to 'textcb' or 'textcb_pid'
+    [n_proc]
+        number of processes to use, set >1 to partition the annotations (by data file or m/z 
+        range) and match fragmentation rules in parallel
+    [dia_pre_ids]
+        only update annotations for this subset of DIA features (by dia_pre_id), None to update all
+    [frag_library]
+        path to a fragment library file (.npz) to use, if it does not exist yet (or is not compatible 
+        with the current parameters) a library with all of the lipids from the sum composition lipid 
+        DB is built and saved there, None to only generate theoretical fragments for the annotations 
+        that are being updated (without saving them)
     
     Returns 
     -------
@@ -945,14 +2065,16 @@ def update_lipid_ids_with_frag_rules(results_db: ResultsDbPath,
                                 results_db)
     debug_handler(debug_flag, debug_cb, 'UPDATING LIPID ANNOTATIONS USING FRAGMENTATION RULES ...')
     # connect to  results database
-    con = connect(results_db) 
+    con = connect_results_db(results_db) 
     cur = con.cursor()
     # check that initial lipid annotations have already been added
     check_analysis_log(cur, AnalysisStep.LIPID_ANN)
-    n_anns = cur.execute('SELECT COUNT(*) FROM Lipids;').fetchall()[0][0]
+    _upgrade_results_db_schema(cur)
+    n_anns = cur.execute('SELECT COUNT(*) FROM FilteredLipids;').fetchall()[0][0]
+    scope = _scope_condition(cur, dia_pre_ids)
     # iterate through annotations, see if there are annotatable fragments
-    # only select out the annotations that have NULL fragments
-    qry_sel1 = """--beginsql
+    # only select out the annotations that passed filtering and do not have annotated fragments yet
+    qry_sel1 = f"""--beginsql
         SELECT 
             lipid_id, 
             lmid_prefix, 
@@ -961,64 +2083,44 @@ def update_lipid_ids_with_frag_rules(results_db: ResultsDbPath,
             n_chains, 
             mz, 
             GROUP_CONCAT(dia_frag_id) AS frag_ids,
-            GROUP_CONCAT(fmz)
+            GROUP_CONCAT(fmz),
+            dfile_id
         FROM 
-            Lipids 
+            FilteredLipids 
             JOIN LipidSumComp USING(lipid_id)
             JOIN DIAPrecursors USING(dia_pre_id) 
             LEFT JOIN DIAFragments USING(dia_pre_id)
+        WHERE
+            {scope}
+            AND lipid_id NOT IN (SELECT lipid_id FROM LipidFragments)
         GROUP BY 
             lipid_id
         HAVING
             frag_ids IS NOT NULL
     --endsql"""
     # track number of lipids that are updated
-    n_diagnostic = 0
     n_update_chains = 0
     qry_add_frag = """--beginsql
         INSERT INTO LipidFragments VALUES (?,?,?,?,?,?,?)
     --endsql"""
-    assert params.ionization is not None, "ionization must be set (POS or NEG)"
-    for lipid_id, lmid_prefix, sum_c, sum_u, n_chains, pmz, fids, fmzs in cur.execute(qry_sel1).fetchall():
-        update = False
+    anns, ann_dfile_ids = [], []
+    for *ann, fids, fmzs, dfile_id in cur.execute(qry_sel1).fetchall():
         if fmzs is not None:
-            # load fragmentation rules
-            c_u_combos = list(get_c_u_combos(n_chains, 
-                                             sum_c, 
-                                             sum_u, 
-                                             params.frag_rules.fa_c.min, 
-                                             params.frag_rules.fa_c.max, 
-                                             params.frag_rules.fa_odd_c,
-                                             max_u=SumCompLipidDB.max_u))
-            ffmzs = list(map(float, fmzs.split(",")))
-            ifids = list(map(int, fids.split(",")))
-            _, rules = load_rules(lmid_prefix, params.ionization)
-            diag_flag = 0
-            # go through each rule and see if it matches any fragments
-            for rule in rules:
-                diag_flag = int(rule.diagnostic)
-                if rule.static:
-                    rmz = rule.mz(pmz)  # type: ignore
-                    for ffmz, ifid in zip(ffmzs, ifids):
-                        ppm = _ppm_error(rmz, ffmz)
-                        if abs(ppm) <= params.frag_rules.mz_ppm:
-                            cur.execute(qry_add_frag, (lipid_id, ifid, rule.label(), rmz, ppm, diag_flag, None))  # type: ignore
-                else:
-                    for c, u in sorted(c_u_combos):
-                        rmz = rule.mz(pmz, c, u) # type: ignore
-                        for ffmz, ifid in zip(ffmzs, ifids):
-                            ppm = _ppm_error(rmz, ffmz)
-                            if abs(ppm) <= params.frag_rules.mz_ppm:
-                                cur.execute(qry_add_frag, (lipid_id, ifid, rule.label(c, u), rmz, ppm, diag_flag, f"{c}:{u}"))  # type: ignore
-                                update = True
-            # update counters
-            if update:
-                n_update_chains += 1
-            n_diagnostic += diag_flag
+            anns.append((*ann, list(map(int, fids.split(","))), np.array(fmzs.split(","), dtype=np.float64)))
+            ann_dfile_ids.append(dfile_id)
+    library = _load_fragment_library(params, frag_library, debug_flag=debug_flag, debug_cb=debug_cb)
+    matches = _match_frag_rules(anns, ann_dfile_ids, params, library, n_proc, frag_library=frag_library)
+    # accumulate LipidFragments rows and add them all at once
+    frag_rows = []
+    for ann_frag_rows, updated in matches:
+        frag_rows += ann_frag_rows
+        n_update_chains += int(updated)
+    cur.executemany(qry_add_frag, frag_rows)
     # go through annotated fragments and update lipid annotations if there is evidence for 
-    # presence of specific acyl chains
-    _update_lipid_with_chain_info(cur)
-    # update analysis log
+    # presence of specific acyl chains (only the annotations that were just considered)
+    _update_lipid_with_chain_info(cur, _scope_condition(cur, [_[0] for _ in anns], column="lipid_id"))
+    # update the summary tables and the analysis log
+    _update_summary_tables(cur, AnalysisStep.LIPID_ANN, dia_pre_ids=_scope_ids(cur, dia_pre_ids))
     update_analysis_log(
         cur,
         AnalysisStep.LIPID_ANN,
@@ -1034,10 +2136,212 @@ def update_lipid_ids_with_frag_rules(results_db: ResultsDbPath,
     return n_update_chains
 
 
+def _chain_level_annotations(annotations: pl.DataFrame,
+                             fragments: pl.DataFrame
+                             ) -> Tuple[pl.DataFrame, pl.DataFrame] :
+    """
+    in-memory counterpart of ``_update_lipid_with_chain_info``, annotations with fragments supporting
+    specific acyl chains get their chains flag updated or are replaced by new annotations with acyl
+    chain level names (appended at the end, with copies of the supporting fragments)
+    """
+    n_anns = annotations.height
+    lipids, chains = annotations["lipid"].to_list(), annotations["chains"].to_list()
+    keep = np.ones(n_anns, dtype=np.bool_)
+    # original annotation index, new name, and chains flag for each new annotation
+    new_idx, new_names, new_flags = [], [], []
+    # original annotation index, fragment index, new annotation index for each fragment to copy
+    copies = {"annotation": [], "fragment": [], "new_annotation": []}
+    supporting = (
+        fragments
+        .filter(pl.col("supports_fa").is_not_null())
+        .group_by("annotation", maintain_order=True)
+        .agg("fragment", "supports_fa")
+    )
+    for i, frag_idx, supported_fas in supporting.iter_rows():
+        in_place_flag, new_lipid_names = _chain_level_names(lipids[i], supported_fas, frag_idx)
+        if in_place_flag is not None:
+            chains[i] = in_place_flag
+        if len(new_lipid_names) > 0:
+            keep[i] = False
+            for new_lipid_name, v in new_lipid_names.items():
+                for j in sorted(v["frag_ids"]):
+                    copies["annotation"].append(i)
+                    copies["fragment"].append(j)
+                    copies["new_annotation"].append(n_anns + len(new_idx))
+                new_idx.append(i)
+                new_names.append(new_lipid_name)
+                new_flags.append(v["chains_flag"])
+    annotations = annotations.with_columns(pl.Series("chains", chains, dtype=pl.String))
+    annotations = pl.concat([
+        annotations, 
+        annotations[new_idx].with_columns(pl.Series("lipid", new_names, dtype=pl.String), 
+                                          pl.Series("chains", new_flags, dtype=pl.String))
+    ])
+    fragments = pl.concat([
+        fragments,
+        fragments
+        .join(pl.DataFrame(copies, schema={k: pl.Int64 for k in copies}), on=["annotation", "fragment"])
+        .with_columns(pl.col("new_annotation").alias("annotation"))
+        .drop("new_annotation")
+    ])
+    # drop the replaced annotations (and their fragments) and re-index the rest
+    keep = np.concatenate([keep, np.ones(len(new_idx), dtype=np.bool_)])
+    new_index = np.cumsum(keep) - 1
+    fragments = fragments.filter(pl.Series(keep[fragments["annotation"].to_numpy()]))
+    fragments = fragments.with_columns(pl.Series("annotation", new_index[fragments["annotation"].to_numpy()], 
+                                                 dtype=pl.Int64))
+    return annotations.filter(pl.Series(keep)), fragments
+
+
+def annotate_features(pre_mzs: npt.ArrayLike,
+                      rts: npt.ArrayLike,
+                      ccss: npt.ArrayLike,
+                      frag_mzs: List[Optional[npt.ArrayLike]],
+                      params: AnnotationParams,
+                      dfile_ids: Optional[npt.ArrayLike] = None,
+                      debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None,
+                      n_proc: int = 1,
+                      scdb: Optional[SumCompLipidDB] = None,
+                      frag_library: Optional[str] = None
+                      ) -> Tuple[pl.DataFrame, pl.DataFrame] :
+    """
+    Perform all lipid annotation steps for a set of features entirely in memory (without a results 
+    database), the same steps as ``annotate_lipids``: 
+    
+    * annotate features at the level of sum composition
+    * check annotations against expected RT ranges
+    * check annotations against CCS subclass trends
+    * match fragmentation rules for annotations that passed, updating annotations with acyl chain
+      level names where fragments support specific acyl chains
+
+    As in the results database, annotations that did not pass filtering are kept but flagged 
+    (``rt_pass`` or ``ccs_pass`` = 0). Annotations replaced by acyl chain level annotations are removed
+    and the new annotations are appended at the end, with copies of the fragments supporting them.
+
+    Parameters
+    ----------
+    pre_mzs
+    rts
+    ccss
+        precursor m/z, retention time, and CCS for each feature (CCS can be NaN if not available)
+    frag_mzs
+        fragment m/zs for each feature (None or empty if there are no fragments)
+    params
+        parameters for lipid annotation
+    [dfile_ids]
+        data file identifier for each feature, only used for partitioning features if n_proc > 1
+    [debug_flag]
+        specifies how to dispatch debugging messages, None to do nothing
+    [debug_cb]
+        callback function that takes the debugging message as an argument, can be None if
+        debug_flag is not set to 'textcb' or 'textcb_pid'
+    [n_proc]
+        number of processes to use for the annotation steps that can be run in parallel
+    [scdb]
+        sum composition lipid DB to use, None to generate one using ``params``
+    [frag_library]
+        path to a fragment library file (.npz) to use (see ``update_lipid_ids_with_frag_rules``), 
+        None to only generate theoretical fragments for the annotations that need them
+
+    Returns
+    -------
+    annotations
+        one row per annotation, with columns described by ``ANNOTATION_SCHEMA``
+    fragments
+        one row per annotated fragment, with columns described by ``FRAGMENT_SCHEMA``
+    """
+    pre_mzs = np.asarray(pre_mzs, dtype=np.float64)
+    rts = np.asarray(rts, dtype=np.float64)
+    ccss = np.asarray(ccss, dtype=np.float64)
+    # sum composition
+    anns = annotate_sum_composition(pre_mzs, params, dfile_ids=dfile_ids, n_proc=n_proc, scdb=scdb)
+    features = anns["feature"].to_numpy()
+    debug_handler(debug_flag, debug_cb, 
+                  f"ANNOTATED: {len(np.unique(features))} / {len(pre_mzs)} features ({anns.height} annotations total)")
+    # RT ranges
+    rt_pass = rt_range_pass(anns["lmid_prefix"].to_numpy(), rts[features], _load_rt_ranges(params))
+    # CCS subclass trends
+    ccs_results, _ = ccs_trend_filter(features, 
+                                      anns["lmid_prefix"].str.slice(2, 6).to_numpy(), 
+                                      anns["adduct"].to_numpy(), 
+                                      pre_mzs[features], 
+                                      ccss[features], 
+                                      params, 
+                                      rt_pass=rt_pass, 
+                                      debug_flag=debug_flag, debug_cb=debug_cb, 
+                                      n_proc=n_proc)
+    anns = anns.with_columns(pl.Series("rt_pass", rt_pass.astype(np.int64)), *ccs_results)
+    # fragmentation rules, only for annotations that passed filtering and have fragments
+    has_frags = np.array([fmzs is not None and len(fmzs) > 0 for fmzs in frag_mzs], dtype=np.bool_)
+    to_match = np.flatnonzero(rt_pass & anns["ccs_pass"].fill_null(1).cast(pl.Boolean).to_numpy() 
+                              & has_frags[features])
+    library = _load_fragment_library(params, frag_library, debug_flag=debug_flag, debug_cb=debug_cb)
+    fragments, updated = match_fragment_rules(anns[to_match], pre_mzs, frag_mzs, params, 
+                                              dfile_ids=dfile_ids, n_proc=n_proc, library=library)
+    if frag_library is not None and library.modified:
+        library.save(frag_library)
+    debug_handler(debug_flag, debug_cb, 
+                  f"UPDATED: {updated.sum()} / {len(to_match)} annotations using fragmentation rules")
+    fragments = fragments.with_columns(pl.Series("annotation", to_match[fragments["annotation"].to_numpy()], 
+                                                 dtype=pl.Int64))
+    anns, fragments = _chain_level_annotations(anns, fragments)
+    return anns.select(list(ANNOTATION_SCHEMA)), fragments
+
+
+def _features_to_annotate(results_db: ResultsDbPath, 
+                          params_hash: str
+                          ) -> Optional[List[int]] :
+    """
+    Determine which DIA features need to be annotated in incremental mode: if all previously annotated
+    features were annotated with the same parameters (``params_hash``), returns the IDs of any DIA 
+    features that have not been annotated yet, otherwise returns None (everything needs to be annotated)
+    """
+    con = connect_results_db(results_db)
+    cur = con.cursor()
+    _upgrade_results_db_schema(cur)
+    prev_hashes = {h for h, in cur.execute("SELECT DISTINCT params_hash FROM LipidAnnotatedFeatures").fetchall()}
+    dia_pre_ids = None
+    if prev_hashes == {params_hash}:
+        qry = """--beginsql
+            SELECT 
+                dia_pre_id 
+            FROM 
+                DIAPrecursors 
+            WHERE 
+                dia_pre_id NOT IN (SELECT dia_pre_id FROM LipidAnnotatedFeatures)
+        --endsql"""
+        dia_pre_ids = [dia_pre_id for dia_pre_id, in cur.execute(qry).fetchall()]
+    con.commit()
+    con.close()
+    return dia_pre_ids
+
+
+def _record_annotated_features(results_db: ResultsDbPath, 
+                               params_hash: str, 
+                               dia_pre_ids: Optional[List[int]]
+                               ) -> None :
+    """ record that DIA features (all features if ``dia_pre_ids`` is None) were annotated using ``params_hash`` """
+    con = connect_results_db(results_db)
+    cur = con.cursor()
+    _upgrade_results_db_schema(cur)
+    qry = f"""--beginsql
+        INSERT OR REPLACE INTO LipidAnnotatedFeatures 
+        SELECT dia_pre_id, ? FROM DIAPrecursors WHERE {_scope_condition(cur, dia_pre_ids)}
+    --endsql"""
+    cur.execute(qry, (params_hash,))
+    con.commit()
+    # annotation is the last of the steps that bulk load data, index everything
+    _create_results_db_indexes(cur)
+    con.close()
+
+
 def annotate_lipids(results_db: ResultsDbPath,
                     params: AnnotationParams,
                     debug_flag: Optional[str] = None, 
-                    debug_cb: Optional[Callable] = None
+                    debug_cb: Optional[Callable] = None,
+                    n_proc: int = 1,
+                    incremental: bool = False,
+                    frag_library: Optional[str] = None
                     ) -> Dict[str, Any] :
     """
     Perform the full lipid annotation workflow:
@@ -1046,7 +2350,22 @@ def annotate_lipids(results_db: ResultsDbPath,
     - populate the LipidMAPS ontology info (from lipidlib)
     - generate initial lipid annotation at the level of sum composition
     - filter annotations based on retention time ranges
+    - filter annotations based on CCS subclass trends
     - update lipid annotations using fragmentation rules
+
+    Filtering does not remove annotations, it only flags them (see ``refilter_lipid_annotations``),
+    annotations that passed filtering are in the ``FilteredLipids`` view.
+
+    The DIA features that were annotated are recorded along with a hash of the annotation parameters
+    (see ``annotation_params_hash``) in the ``LipidAnnotatedFeatures`` table. In incremental mode, 
+    existing annotations are kept and only DIA features that have not been annotated yet get annotated, 
+    unless the annotation parameters have changed in which case everything gets re-annotated.
+
+    .. note::
+
+        In incremental mode, observed CCS trends (for subclasses without literature trends) are fit 
+        using the new annotations along with the existing annotations, so results can differ 
+        slightly from annotating everything at once
     
     Parameters
     ----------
@@ -1059,26 +2378,118 @@ def annotate_lipids(results_db: ResultsDbPath,
     [debug_cb]
         callback function that takes the debugging message as an argument, can be None if
         debug_flag is not set to 'textcb' or 'textcb_pid'
+    [n_proc]
+        number of processes to use for the parallelized annotation steps
+    [incremental]
+        only annotate DIA features that have not already been annotated with the same parameters
+    [frag_library]
+        path to a fragment library file (.npz) to use for updating annotations using fragmentation 
+        rules, built and saved if it does not exist yet (see ``update_lipid_ids_with_frag_rules``)
 
     Returns 
     -------
     results
 
     """
-    remove_lipid_annotations(results_db)
+    # ensure results database file exists
+    if not os.path.isfile(results_db):
+        raise FileNotFoundError(errno.ENOENT, 
+                                os.strerror(errno.ENOENT), 
+                                results_db)
+    params_hash = annotation_params_hash(params)
+    # DIA features to annotate, None for all
+    dia_pre_ids = _features_to_annotate(results_db, params_hash) if incremental else None
+    if dia_pre_ids is None:
+        remove_lipid_annotations(results_db)
+    else:
+        debug_handler(debug_flag, debug_cb, 
+                      f"INCREMENTAL ANNOTATION: {len(dia_pre_ids)} new DIA features to annotate")
     add_lmaps_ont(results_db)
     # track results from each step
     results = {}
     results["sum_comp"] = annotate_lipids_sum_composition(results_db,
                                                           params, 
-                                                          debug_flag=debug_flag, debug_cb=debug_cb)
+                                                          debug_flag=debug_flag, debug_cb=debug_cb,
+                                                          n_proc=n_proc, 
+                                                          dia_pre_ids=dia_pre_ids)
+    results["rt_filter"] = filter_annotations_by_rt_range(results_db, 
+                                                          params, 
+                                                          debug_flag=debug_flag, debug_cb=debug_cb,
+                                                          dia_pre_ids=dia_pre_ids)
+    results["ccs_filter"] = filter_annotations_by_ccs_subclass_trend(results_db,
+                                                                     params,
+                                                                     debug_flag=debug_flag, debug_cb=debug_cb,
+                                                                     n_proc=n_proc, 
+                                                                     dia_pre_ids=dia_pre_ids)
+    results["frag_rule"] = update_lipid_ids_with_frag_rules(results_db, 
+                                                            params,
+                                                            debug_flag=debug_flag, debug_cb=debug_cb,
+                                                            n_proc=n_proc, 
+                                                            dia_pre_ids=dia_pre_ids,
+                                                            frag_library=frag_library)
+    _record_annotated_features(results_db, params_hash, dia_pre_ids)
+    return results
+
+
+def refilter_lipid_annotations(results_db: ResultsDbPath,
+                               params: AnnotationParams,
+                               debug_flag: Optional[str] = None, 
+                               debug_cb: Optional[Callable] = None,
+                               n_proc: int = 1,
+                               frag_library: Optional[str] = None
+                               ) -> Dict[str, Any] :
+    """
+    Re-apply the annotation filters to existing lipid annotations (e.g. using a different RT range 
+    config or ``ccs_trends.percent``) without re-annotating everything:
+
+    - filter annotations based on retention time ranges
+    - filter annotations based on CCS subclass trends
+    - update lipid annotations that newly passed filtering using fragmentation rules
+
+    Only the parameters for filtering should be different from those that were used for the 
+    original annotation, the DIA features that were annotated are recorded as having been annotated 
+    with ``params``.
+
+    Parameters
+    ----------
+    results_db
+        path to LipidIMEA analysis results database
+    params
+        parameters for lipid annotation
+    [debug_flag]
+        specifies how to dispatch debugging messages, None to do nothing
+    [debug_cb]
+        callback function that takes the debugging message as an argument, can be None if
+        debug_flag is not set to 'textcb' or 'textcb_pid'
+    [n_proc]
+        number of processes to use for the parallelized annotation steps
+    [frag_library]
+        path to a fragment library file (.npz) to use for updating annotations using fragmentation 
+        rules, built and saved if it does not exist yet (see ``update_lipid_ids_with_frag_rules``)
+
+    Returns 
+    -------
+    results
+
+    """
+    # track results from each step
+    results = {}
     results["rt_filter"] = filter_annotations_by_rt_range(results_db, 
                                                           params, 
                                                           debug_flag=debug_flag, debug_cb=debug_cb)
     results["ccs_filter"] = filter_annotations_by_ccs_subclass_trend(results_db,
                                                                      params,
-                                                                     debug_flag=debug_flag, debug_cb=debug_cb)
+                                                                     debug_flag=debug_flag, debug_cb=debug_cb,
+                                                                     n_proc=n_proc)
     results["frag_rule"] = update_lipid_ids_with_frag_rules(results_db, 
                                                             params,
-                                                            debug_flag=debug_flag, debug_cb=debug_cb)
-    return results
\ No newline at end of file
+                                                            debug_flag=debug_flag, debug_cb=debug_cb,
+                                                            n_proc=n_proc,
+                                                            frag_library=frag_library)
+    # annotated features are now annotated with the new parameters
+    con = connect_results_db(results_db)
+    cur = con.cursor()
+    cur.execute("UPDATE LipidAnnotatedFeatures SET params_hash=?", (annotation_params_hash(params),))
+    con.commit()
+    con.close()
+    return results
@@ -0,0 +1,484 @@
+"""
+lipidimea/library_search.py
+Dylan Ross (dylan.ross@pnnl.gov)
+
+    module for searching DDA/DIA MS/MS spectra against a spectral library
+"""
+
+
+import os
+import errno
+from typing import (
+    List, Optional, Callable, Tuple, Dict, Iterable, Union, Any
+)
+
+import numpy as np
+import numpy.typing as npt
+import polars as pl
+from scipy import sparse
+
+from lipidimea.typing import ResultsDbPath, ResultsDbCursor
+from lipidimea.util import (
+    debug_handler, AnalysisStep, update_analysis_log, check_analysis_log,
+    connect_results_db, _upgrade_results_db_schema, _create_results_db_indexes
+)
+
+
+# similarity metrics that can be used for library searching
+SIMILARITY_METRICS: List[str] = ["cosine", "entropy"]
+
+
+# columns (and types) of the library search hit tables produced by ``search_spectra``
+LIBRARY_HIT_SCHEMA: Dict[str, Any] = {
+    "query": pl.Int64,
+    "hit_rank": pl.Int64,
+    "lib_idx": pl.Int64,
+    "score": pl.Float64,
+    "n_matched": pl.Int64,
+}
+
+
+# for each source of MS/MS spectra: the extraction analysis step, the precursor identifier, and the
+# queries to select precursor m/zs and fragments
+_SOURCES: Dict[str, Tuple[AnalysisStep, str, str, str]] = {
+    "DDA": (
+        AnalysisStep.DDA_EXT,
+        "dda_pre_id",
+        "SELECT dda_pre_id, mz FROM DDAPrecursors",
+        "SELECT dda_pre_id, fmz, fint FROM DDAFragments",
+    ),
+    "DIA": (
+        AnalysisStep.DIA_EXT,
+        "dia_pre_id",
+        "SELECT dia_pre_id, mz FROM DIAPrecursors",
+        "SELECT dia_pre_id, fmz, fint FROM DIAFragments",
+    ),
+}
+
+
+#------------------------------------------------------------------------------
+# spectral library
+
+
+class SpectralLibrary():
+    """
+    Collection of reference MS/MS spectra (e.g. loaded from an MSP file). Peaks from all of the
+    spectra are stored in flat arrays, with ``indptr`` marking where the peaks for each spectrum
+    start and end (like the rows of a CSR matrix)
+    """
+
+    def __init__(self,
+                 names: List[str],
+                 pre_mzs: npt.ArrayLike,
+                 adducts: List[Optional[str]],
+                 indptr: npt.ArrayLike,
+                 mzs: npt.ArrayLike,
+                 ints: npt.ArrayLike
+                 ) -> None :
+        """
+        Initialize the library
+
+        Parameters
+        ----------
+        names
+            name of each library spectrum
+        pre_mzs
+            precursor m/z of each library spectrum (NaN if not known)
+        adducts
+            adduct (precursor type) of each library spectrum (None if not known)
+        indptr
+            peaks for spectrum i are mzs[indptr[i]:indptr[i + 1]] and ints[indptr[i]:indptr[i + 1]]
+        mzs
+        ints
+            m/z and intensity of the peaks from all of the spectra
+        """
+        self.names = list(names)
+        self.pre_mzs = np.asarray(pre_mzs, dtype=np.float64)
+        self.adducts = list(adducts)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.mzs = np.asarray(mzs, dtype=np.float64)
+        self.ints = np.asarray(ints, dtype=np.float64)
+
+    def __len__(self
+                ) -> int :
+        return len(self.names)
+
+    @property
+    def spec_idx(self
+                 ) -> npt.NDArray[np.int64] :
+        """ library spectrum index for each of the peaks """
+        return np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.indptr))
+
+    @staticmethod
+    def _parse_peaks(line: str
+                     ) -> List[Tuple[float, float]] :
+        """
+        parse a line of peaks from an MSP entry, there can be multiple peaks per line separated by
+        ";" and anything after the m/z and intensity (like a quoted peak annotation) is ignored
+        """
+        peaks = []
+        for peak in line.split(";"):
+            if len(fields := peak.replace(",", " ").split()) >= 2:
+                peaks.append((float(fields[0]), float(fields[1])))
+        return peaks
+
+    @classmethod
+    def from_msp(cls,
+                 msp_file: str
+                 ) -> "SpectralLibrary" :
+        """
+        Load a spectral library from an MSP file. Each entry starts with a "Name:" field and the peaks
+        follow the "Num Peaks:" field. The precursor m/z is taken from the "PrecursorMZ:" (or
+        "Precursor_MZ:") field and the adduct from the "Precursor_type:" (or "PrecursorType:" or
+        "Adduct:") field, if present. Entries without any peaks are skipped.
+
+        Parameters
+        ----------
+        msp_file
+            path to the MSP file
+
+        Returns
+        -------
+        library
+            spectral library
+        """
+        names, pre_mzs, adducts, indptr, mzs, ints = [], [], [], [0], [], []
+        # metadata and peaks for the current entry
+        meta, peaks, in_peaks = {}, [], False
+
+        def finish_entry():
+            if "name" in meta and len(peaks) > 0:
+                names.append(meta["name"])
+                pre_mz = meta.get("precursormz", meta.get("precursor_mz"))
+                pre_mzs.append(float(pre_mz) if pre_mz else np.nan)
+                adducts.append(meta.get("precursor_type", meta.get("precursortype", meta.get("adduct"))))
+                for mz, i in peaks:
+                    mzs.append(mz)
+                    ints.append(i)
+                indptr.append(len(mzs))
+
+        with open(msp_file, "r") as f:
+            for line in f:
+                line = line.strip()
+                if line == "" or line.lower().startswith("name:"):
+                    # blank lines or a new "Name:" field separate the entries
+                    finish_entry()
+                    meta, peaks, in_peaks = {}, [], False
+                    if line == "":
+                        continue
+                if in_peaks:
+                    peaks += cls._parse_peaks(line)
+                elif ":" in line:
+                    key, value = line.split(":", 1)
+                    meta[key.strip().lower()] = value.strip()
+                    in_peaks = key.strip().lower() == "num peaks"
+        finish_entry()
+        return cls(names, pre_mzs, adducts, indptr, mzs, ints)
+
+
+#------------------------------------------------------------------------------
+# library searching
+
+
+def _binned_spectra(spec_idx: npt.NDArray[np.int64],
+                    mzs: npt.NDArray[np.float64],
+                    ints: npt.NDArray[np.float64],
+                    n_spectra: int,
+                    bin_width: float,
+                    n_bins: int,
+                    similarity: str
+                    ) -> sparse.csr_matrix :
+    """
+    Bin spectra into a sparse (n_spectra x n_bins) CSR matrix, intensities of peaks falling into
+    the same bin are summed. For cosine similarity the intensities are square root transformed and
+    each spectrum is scaled to unit length, for entropy similarity each spectrum is scaled to sum
+    to 1.
+    """
+    bins = (mzs / bin_width).astype(np.int64)
+    keep = (ints > 0) & (bins >= 0) & (bins < n_bins)
+    spectra = sparse.csr_matrix((ints[keep], (spec_idx[keep], bins[keep])), shape=(n_spectra, n_bins))
+    spectra.sum_duplicates()
+    if similarity == "cosine":
+        spectra.data = np.sqrt(spectra.data)
+        norms = np.sqrt(np.asarray(spectra.multiply(spectra).sum(axis=1)).ravel())
+    else:
+        norms = np.asarray(spectra.sum(axis=1)).ravel()
+    spectra.data /= np.repeat(norms, np.diff(spectra.indptr))
+    return spectra
+
+
+def _cosine_scores(queries: sparse.csr_matrix,
+                   library: sparse.csr_matrix
+                   ) -> Tuple[sparse.csr_matrix, sparse.csr_matrix] :
+    """
+    cosine similarity scores (dot products of the unit length spectra) and the number of matched bins
+    for all pairs of query and library spectra that share at least one bin
+    """
+    scores = (queries @ library.T).tocsr()
+    # binary spectra give the number of matched bins, since all intensities are positive the result
+    # has the same sparsity structure as the scores
+    n_matched = (queries.astype(np.bool_).astype(np.int64) @ library.astype(np.bool_).astype(np.int64).T).tocsr()
+    scores.sort_indices()
+    n_matched.sort_indices()
+    return scores, n_matched
+
+
+def _entropy_scores(queries: sparse.csr_matrix,
+                    library: sparse.csr_matrix
+                    ) -> Tuple[sparse.csr_matrix, sparse.csr_matrix] :
+    """
+    entropy similarity scores and the number of matched bins for all pairs of query and library
+    spectra that share at least one bin
+
+    The (unweighted) entropy similarity, 1 - (2 * S_AB - S_A - S_B) / ln(4), reduces to a sum over only
+    the shared bins of ((a + b) * ln(a + b) - a * ln(a) - b * ln(b)) / ln(4) for spectra scaled to
+    sum to 1, so it can be computed the same way as a sparse matrix product: every query peak gets
+    paired with every library peak in the same bin and the terms are summed for each pair of spectra
+    """
+    # bins x library spectra, rows give the library peaks in each bin
+    by_bin = library.T.tocsr()
+    q = queries.tocoo()
+    starts = by_bin.indptr[q.col]
+    counts = by_bin.indptr[q.col + 1] - starts
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    pos = np.repeat(starts, counts) + offsets
+    rows, cols = np.repeat(q.row, counts), by_bin.indices[pos]
+    a, b = np.repeat(q.data, counts), by_bin.data[pos]
+    terms = ((a + b) * np.log(a + b) - a * np.log(a) - b * np.log(b)) / np.log(4)
+    shape = (queries.shape[0], library.shape[0])
+    scores = sparse.csr_matrix((terms, (rows, cols)), shape=shape)
+    n_matched = sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)), shape=shape)
+    scores.sum_duplicates()
+    n_matched.sum_duplicates()
+    return scores, n_matched
+
+
+def _top_hits(rows: npt.NDArray[np.int64],
+              cols: npt.NDArray[np.int64],
+              scores: npt.NDArray[np.float64],
+              n_matched: npt.NDArray[np.int64],
+              top_k: int
+              ) -> Tuple[npt.NDArray[np.int64], ...] :
+    """ select the top k hits (by score) for each query, returns rows, ranks, cols, scores, n_matched """
+    # sort by query then score (descending), ties broken by library index
+    order = np.lexsort((cols, -scores, rows))
+    rows, cols, scores, n_matched = rows[order], cols[order], scores[order], n_matched[order]
+    ranks = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = ranks < top_k
+    return rows[keep], ranks[keep] + 1, cols[keep], scores[keep], n_matched[keep]
+
+
+def search_spectra(pre_mzs: npt.ArrayLike,
+                   spec_idx: npt.ArrayLike,
+                   frag_mzs: npt.ArrayLike,
+                   frag_ints: npt.ArrayLike,
+                   library: SpectralLibrary,
+                   similarity: str = "cosine",
+                   bin_width: float = 0.02,
+                   mz_ppm: Optional[float] = None,
+                   top_k: int = 5,
+                   min_score: float = 0.5,
+                   min_matched: int = 1,
+                   chunk_size: int = 10000
+                   ) -> pl.DataFrame :
+    """
+    Search query MS/MS spectra against a spectral library, entirely in memory. Query and library
+    spectra are binned into sparse matrices and all query spectra are scored against all library
+    spectra at once (in chunks of queries), only pairs of spectra that share at least one bin are
+    considered.
+
+    Parameters
+    ----------
+    pre_mzs
+        precursor m/z for each query spectrum
+    spec_idx
+        query spectrum index (into ``pre_mzs``) for each fragment
+    frag_mzs
+    frag_ints
+        m/z and intensity for each fragment
+    library
+        spectral library to search against
+    [similarity]
+        similarity metric, "cosine" (square root transformed intensities) or "entropy" (unweighted
+        spectral entropy similarity)
+    [bin_width]
+        width of m/z bins (Da)
+    [mz_ppm]
+        if set, library spectra are only considered hits if their precursor m/z is within this
+        tolerance (ppm) of the query precursor m/z, None to consider all library spectra
+    [top_k]
+        max number of hits to keep for each query
+    [min_score]
+        minimum similarity score for a hit
+    [min_matched]
+        minimum number of matched bins for a hit
+    [chunk_size]
+        number of query spectra to score at once, limits memory usage
+
+    Returns
+    -------
+    hits
+        one row per hit with columns: query (index into ``pre_mzs``), hit_rank (starting at 1 for the
+        best hit), lib_idx (index into ``library``), score, n_matched
+    """
+    if similarity not in SIMILARITY_METRICS:
+        raise ValueError(f"similarity must be one of {SIMILARITY_METRICS}, got: {similarity}")
+    pre_mzs = np.asarray(pre_mzs, dtype=np.float64)
+    spec_idx = np.asarray(spec_idx, dtype=np.int64)
+    frag_mzs = np.asarray(frag_mzs, dtype=np.float64)
+    frag_ints = np.asarray(frag_ints, dtype=np.float64)
+    max_mz = max([np.max(frag_mzs, initial=0.), np.max(library.mzs, initial=0.)])
+    n_bins = int(max_mz / bin_width) + 1
+    lib_spectra = _binned_spectra(library.spec_idx, library.mzs, library.ints, len(library),
+                                  bin_width, n_bins, similarity)
+    score_func = _cosine_scores if similarity == "cosine" else _entropy_scores
+    hits = {k: [] for k in LIBRARY_HIT_SCHEMA}
+    # fragments get sorted by query so that each chunk of queries is a contiguous slice
+    order = np.argsort(spec_idx, kind="stable")
+    spec_idx, frag_mzs, frag_ints = spec_idx[order], frag_mzs[order], frag_ints[order]
+    for start in range(0, len(pre_mzs), chunk_size):
+        stop = min(start + chunk_size, len(pre_mzs))
+        i0, i1 = np.searchsorted(spec_idx, [start, stop])
+        queries = _binned_spectra(spec_idx[i0:i1] - start, frag_mzs[i0:i1], frag_ints[i0:i1], stop - start,
+                                  bin_width, n_bins, similarity)
+        scores, n_matched = score_func(queries, lib_spectra)
+        rows = np.repeat(np.arange(stop - start), np.diff(scores.indptr))
+        cols, vals, n_matched = scores.indices.astype(np.int64), scores.data, n_matched.data
+        keep = (vals >= min_score) & (n_matched >= min_matched)
+        if mz_ppm is not None:
+            q_mzs = pre_mzs[start:stop][rows]
+            # comparisons with NaN (library spectra without precursor m/z) are always False
+            keep &= np.abs(library.pre_mzs[cols] - q_mzs) <= q_mzs * mz_ppm / 1e6
+        for k, v in zip(hits, _top_hits(rows[keep] + start, cols[keep], vals[keep], n_matched[keep], top_k)):
+            hits[k].append(v)
+    return pl.DataFrame({k: np.concatenate(v) if v else [] for k, v in hits.items()},
+                        schema=LIBRARY_HIT_SCHEMA)
+
+
+def search_library(results_db: ResultsDbPath,
+                   library: Union[str, SpectralLibrary],
+                   sources: Optional[Iterable[str]] = None,
+                   similarity: str = "cosine",
+                   bin_width: float = 0.02,
+                   mz_ppm: Optional[float] = None,
+                   top_k: int = 5,
+                   min_score: float = 0.5,
+                   min_matched: int = 1,
+                   debug_flag: Optional[str] = None, debug_cb: Optional[Callable] = None
+                   ) -> Dict[str, Tuple[int, int]] :
+    """
+    Search DDA and/or DIA MS/MS spectra (from the DDAFragments and DIAFragments tables) against a
+    spectral library (see ``search_spectra``) and store the top hits for each precursor in the
+    LibraryHits table. Any existing hits for the same source are replaced.
+
+    Parameters
+    ----------
+    results_db
+        path to LipidIMEA analysis results database
+    library
+        spectral library to search against, or path to a spectral library file (.msp)
+    [sources]
+        sources of MS/MS spectra to search, "DDA" and/or "DIA", None to search all sources whose
+        features have been extracted (according to the analysis log)
+    [similarity]
+        similarity metric, "cosine" or "entropy"
+    [bin_width]
+        width of m/z bins (Da)
+    [mz_ppm]
+        if set, library spectra are only considered hits if their precursor m/z is within this
+        tolerance (ppm) of the query precursor m/z, None to consider all library spectra
+    [top_k]
+        max number of hits to keep for each precursor
+    [min_score]
+        minimum similarity score for a hit
+    [min_matched]
+        minimum number of matched bins for a hit
+    [debug_flag]
+        specifies how to dispatch debugging messages, None to do nothing
+    [debug_cb]
+        callback function that takes the debugging message as an argument, can be None if
+        debug_flag is not set to 'textcb' or 'textcb_pid'
+
+    Returns
+    -------
+    n_hits
+        for each source: number of precursors with hits, total number of hits
+    """
+    # ensure results database file exists
+    if not os.path.isfile(results_db):
+        raise FileNotFoundError(errno.ENOENT,
+                                os.strerror(errno.ENOENT),
+                                results_db)
+    for source in sources or []:
+        if source not in _SOURCES:
+            raise ValueError(f"sources must be from {list(_SOURCES)}, got: {source}")
+    if isinstance(library, str):
+        debug_handler(debug_flag, debug_cb, f"loading spectral library: {library}")
+        library = SpectralLibrary.from_msp(library)
+    debug_handler(debug_flag, debug_cb,
+                  f"SEARCHING MS/MS SPECTRA AGAINST SPECTRAL LIBRARY ({len(library)} spectra) ...")
+    con = connect_results_db(results_db)
+    cur = con.cursor()
+    _upgrade_results_db_schema(cur)
+    if sources is None:
+        # default to the sources with extracted features
+        qry_steps = """--beginsql
+            SELECT DISTINCT step FROM AnalysisLog
+        --endsql"""
+        logged_steps = {step for step, in cur.execute(qry_steps).fetchall()}
+        sources = [source for source, (step, *_) in _SOURCES.items() if step.value in logged_steps]
+        if not sources:
+            con.close()
+            raise RuntimeError("no DDA or DIA feature extraction found in results database")
+    qry_del = """--beginsql
+        DELETE FROM LibraryHits WHERE pre_id_type=?
+    --endsql"""
+    qry_ins = """--beginsql
+        INSERT INTO LibraryHits VALUES (?,?,?,?,?,?,?,?,?)
+    --endsql"""
+    n_hits = {}
+    for source in sources:
+        step, pre_id_type, qry_pre, qry_frag = _SOURCES[source]
+        # make sure the features have been extracted
+        check_analysis_log(cur, step)
+        pre_ids, pre_mzs = zip(*rows) if (rows := cur.execute(qry_pre).fetchall()) else ([], [])
+        frag_pre_ids, frag_mzs, frag_ints = zip(*rows) if (rows := cur.execute(qry_frag).fetchall()) else ([], [], [])
+        # map precursor identifiers to query indices
+        pre_ids = np.array(pre_ids, dtype=np.int64)
+        order = np.argsort(pre_ids)
+        spec_idx = order[np.searchsorted(pre_ids, frag_pre_ids, sorter=order)]
+        hits = search_spectra(pre_mzs, spec_idx, frag_mzs, frag_ints, library,
+                              similarity=similarity, bin_width=bin_width, mz_ppm=mz_ppm,
+                              top_k=top_k, min_score=min_score, min_matched=min_matched)
+        lib_idx = hits["lib_idx"].to_list()
+        cur.execute(qry_del, (pre_id_type,))
+        cur.executemany(qry_ins, zip(
+            [pre_id_type] * hits.height,
+            pre_ids[hits["query"].to_numpy()].tolist(),
+            hits["hit_rank"].to_list(),
+            [library.names[i] for i in lib_idx],
+            [library.adducts[i] for i in lib_idx],
+            [None if np.isnan(mz := library.pre_mzs[i]) else float(mz) for i in lib_idx],
+            [similarity] * hits.height,
+            hits["score"].to_list(),
+            hits["n_matched"].to_list(),
+        ))
+        n_hits[source] = (hits["query"].n_unique(), hits.height)
+        debug_handler(debug_flag, debug_cb,
+                      f"{source}: {n_hits[source][0]} / {len(pre_ids)} precursors with hits ({n_hits[source][1]} hits total)")
+    # update analysis log
+    update_analysis_log(
+        cur,
+        AnalysisStep.LIB_SEARCH,
+        {
+            "similarity": similarity,
+            "library spectra": len(library),
+            **{f"{source} precursors with hits": n_pre for source, (n_pre, _) in n_hits.items()},
+        }
+    )
+    con.commit()
+    # index the hits after loading them
+    _create_results_db_indexes(cur, ["LibraryHits"])
+    # clean up
+    con.close()
+    return n_hits
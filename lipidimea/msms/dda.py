@@ -9,7 +9,6 @@ Dylan Ross (dylan.ross@pnnl.gov)
 
 
 from typing import List, Any, Set, Callable, Optional, Dict, Tuple, Union
-import sqlite3
 from time import time
 from itertools import repeat
 import multiprocessing
@@ -28,7 +27,8 @@ from lipidimea.msms._util import (
     apply_args_and_kwargs, ppm_from_delta_mz, tol_from_ppm
 )
 from lipidimea.util import (
-    add_data_file_to_db, debug_handler, AnalysisStep, update_analysis_log, check_analysis_log
+    add_data_file_to_db, debug_handler, AnalysisStep, update_analysis_log, check_analysis_log,
+    connect_results_db, _update_summary_tables, _delete_stale_raw_downsampled
 )
 from lipidimea.params import (
     DdaParams
@@ -333,7 +333,7 @@ def extract_dda_features(dda_data_file: Union[MzaFilePath, MzaFileId],
         case str():
             # initialize a connection to results database
             # increase timeout to avoid errors from database locked by another process
-            con: ResultsDbConnection = sqlite3.connect(results_db, timeout=60)  
+            con: ResultsDbConnection = connect_results_db(results_db, timeout=60)  
             cur: ResultsDbCursor = con.cursor()
             # add the MZA data file to the database and get a file identifier for it
             dda_file_id: int = add_data_file_to_db(cur, "LC-MS/MS (DDA)", dda_data_file)
@@ -383,17 +383,25 @@ def extract_dda_features(dda_data_file: Union[MzaFilePath, MzaFileId],
     rdr.close()
     # initialize connection to DDA ids database
     # increase timeout to avoid errors from database locked by another process
-    con: ResultsDbConnection = sqlite3.connect(results_db, timeout=60)  
+    con: ResultsDbConnection = connect_results_db(results_db, timeout=60)  
     cur: ResultsDbCursor = con.cursor()
+    # raw data added from here on gets identifiers past the current max one, drop any downsampled 
+    # raw data left over for those identifiers
+    max_raw_id, = cur.execute("""--beginsql
+        SELECT COALESCE(MAX(raw_id), 0) FROM Raw
+    --endsql""").fetchone()
+    _delete_stale_raw_downsampled(cur, max_raw_id)
     # add precursors and MS/MS spectra to database
     _add_precursors_and_fragments_to_db(cur, precursors, spectra, debug_flag, debug_cb)
-    # update the analysis log
+    # update the summary tables and the analysis log
+    _update_summary_tables(cur, AnalysisStep.DDA_EXT, dfile_ids=[dda_file_id])
     update_analysis_log(
         cur, 
         AnalysisStep.DDA_EXT,
         {
             "DDA file ID": dda_file_id,
-            "precursors": n_precursors
+            "precursors": n_precursors,
+            "database lock wait (s)": round(con.lock_wait_time, 3)
         }
     )
     # close database connection
@@ -489,7 +497,7 @@ def consolidate_dda_features(results_db: ResultsDbPath,
                                 results_db)
     # no need to get the PID, this should only ever be run in the main process
     # connect to the database
-    con: ResultsDbConnection = sqlite3.connect(results_db)
+    con: ResultsDbConnection = connect_results_db(results_db)
     cur: ResultsDbCursor = con.cursor()
     # check that DDA feature extraction has been completed first
     check_analysis_log(cur, AnalysisStep.DDA_EXT)
@@ -571,7 +579,8 @@ def consolidate_dda_features(results_db: ResultsDbPath,
     --endsql"""
     for fid in drop_fids:
         cur.execute(qry_drop, (fid,))
-    # update the analysis log
+    # update the summary tables and the analysis log
+    _update_summary_tables(cur, AnalysisStep.DDA_CONS)
     update_analysis_log(
         cur, 
         AnalysisStep.DDA_CONS,
@@ -7,7 +7,6 @@ Dylan Ross (dylan.ross@pnnl.gov)
 
 
 from typing import List, Tuple, Union, Optional, Callable, Dict
-import sqlite3
 import os
 import errno
 from itertools import repeat
@@ -21,7 +20,9 @@ from mzapy.peaks import find_peaks_1d_gauss, find_peaks_1d_localmax, calc_gauss_
 
 from lipidimea.msms._util import apply_args_and_kwargs, tol_from_ppm
 from lipidimea.util import (
-    debug_handler, add_data_file_to_db, AnalysisStep, update_analysis_log, check_analysis_log
+    debug_handler, add_data_file_to_db, AnalysisStep, update_analysis_log, check_analysis_log,
+    connect_results_db, _create_results_db_indexes, _connect_results_db_shard, merge_results_db_shards,
+    _update_summary_tables, _delete_stale_raw_downsampled, _delete_stale_annotated_features
 )
 from lipidimea.params import (
     DiaParams
@@ -472,11 +473,19 @@ def extract_dia_features(dia_data_file: MzaFilePath,
                          debug_flag: Optional[str] = None, 
                          debug_cb: Optional[Callable] = None,
                          mza_io_threads: int = 4,
+                         shard_db: Optional[ResultsDbPath] = None,
+                         create_indexes: bool = True
                          ) -> int :
     """
     Extract features from a raw DIA data file, store them in a database 
     (initialized using ``lipidimea.util.create_results_db`` function)
 
+    If ``shard_db`` is set, the DDA features are read from the results database but the DIA 
+    features (and the data file and analysis log entries) are written into a separate shard
+    database instead, which gets created (or overwritten) at that path. This way nothing gets
+    written to the results database, and the shards can be merged into it afterwards using 
+    ``lipidimea.util.merge_results_db_shards``.
+
     Parameters
     ----------
     dia_data_file
@@ -492,6 +501,13 @@ def extract_dia_features(dia_data_file: MzaFilePath,
         debug_flag is not set to 'textcb' or 'textcb_pid'
     [mza_io_threads]
         number of I/O threads to specify for the MZA reader object
+    [shard_db]
+        path to a shard database to write the DIA features into, None to write them into the
+        results database
+    [create_indexes]
+        index the DDA features in the results database first (if they are not indexed yet), can be
+        turned off if this has already been done, e.g. before processing multiple data files in
+        parallel
 
     Returns
     -------
@@ -508,11 +524,28 @@ def extract_dia_features(dia_data_file: MzaFilePath,
     debug_handler(debug_flag, debug_cb, f"file: {dia_data_file}", pid)
     # initialize connection to the database
     # increase timeout to avoid errors from database locked by another process
-    con = sqlite3.connect(results_db, timeout=300)  
+    con = connect_results_db(results_db, timeout=300)  
     cur = con.cursor()
     # check that DDA feature extraction and consolidation have been completed first
     check_analysis_log(cur, AnalysisStep.DDA_EXT)
     check_analysis_log(cur, AnalysisStep.DDA_CONS)
+    # index the DDA features (already loaded), they get looked up for each DIA target
+    if create_indexes:
+        _create_results_db_indexes(cur, ["DDAPrecursors", "DDAFragments"])
+    if shard_db is not None:
+        # write into the shard, reading the DDA features from the attached results database
+        con.close()
+        con = _connect_results_db_shard(results_db, shard_db, timeout=300)
+        cur = con.cursor()
+    # the DIA features (and raw data) from this data file get identifiers past the current max ones
+    max_pre_id, max_frag_id, max_raw_id = cur.execute("""--beginsql
+        SELECT 
+            (SELECT COALESCE(MAX(dia_pre_id), 0) FROM DIAPrecursors), 
+            (SELECT COALESCE(MAX(dia_frag_id), 0) FROM DIAFragments),
+            (SELECT COALESCE(MAX(raw_id), 0) FROM Raw)
+    --endsql""").fetchone()
+    _delete_stale_raw_downsampled(cur, max_raw_id)
+    _delete_stale_annotated_features(cur, max_pre_id)
     # check if the dia_data_file is a path (str) or file ID from the results database (int)
     match dia_data_file:
         case int():
@@ -558,13 +591,15 @@ def extract_dia_features(dia_data_file: MzaFilePath,
         con.commit()
     # commit DB changes at the end of the analysis? No.
     #con.commit()
-    # update the analysis log
+    # update the summary tables (only for the features that were just added) and the analysis log
+    _update_summary_tables(cur, AnalysisStep.DIA_EXT, dfile_ids=[dia_file_id], after_ids=(max_pre_id, max_frag_id))
     update_analysis_log(
         cur, 
         AnalysisStep.DIA_EXT,
         {
             "DIA file ID": dia_file_id,
             "precursors": n_dia_features,
+            "database lock wait (s)": round(con.lock_wait_time, 3),
         }
     )
     con.commit()
@@ -590,11 +625,18 @@ def extract_dia_features_multiproc(dia_data_files: List[MzaFilePath],
                                    n_proc: int, 
                                    debug_flag: Optional[str] = None, 
                                    debug_cb: Optional[Callable] = None,
-                                   mza_io_threads: int = 4
+                                   mza_io_threads: int = 4,
+                                   shards: bool = False
                                    ) -> Dict[str, int] :
     """
     extracts dda features from multiple DDA files in parallel
 
+    If ``shards`` is set, each data file gets processed into its own shard database (next to
+    the results database) instead of all of the processes writing into the results database, 
+    then the shards are merged into the results database (in the same order as the data files)
+    and removed. This avoids the processes having to wait on each other for the results database 
+    to be unlocked.
+
     Parameters
     ----------
     dia_data_files
@@ -612,6 +654,9 @@ def extract_dia_features_multiproc(dia_data_files: List[MzaFilePath],
         debug_flag is not set to 'textcb' or 'textcb_pid'
     [mza_io_threads]
         number of I/O threads to specify for the MZA reader objects
+    [shards]
+        write the DIA features from each data file into a separate shard database and merge them
+        into the results database at the end
 
     Returns
     -------
@@ -619,12 +664,26 @@ def extract_dia_features_multiproc(dia_data_files: List[MzaFilePath],
         dictionary with the number of DIA features mapped to input DIA data files
     """
     n_proc = min(n_proc, len(dia_data_files))  # no need to use more processes than the number of inputs
+    kwargs = [{'debug_flag': debug_flag, 'debug_cb': debug_cb, 'mza_io_threads': mza_io_threads,
+               'create_indexes': False} 
+              for _ in dia_data_files]
+    if os.path.isfile(results_db):
+        # index the DDA features up front, once, instead of each of the processes trying to index 
+        # them at the same time (with shards, the processes then only need to read from the results 
+        # database)
+        con = connect_results_db(results_db)
+        _create_results_db_indexes(con.cursor(), ["DDAPrecursors", "DDAFragments"])
+        con.close()
+    if shards:
+        shard_dbs = [f"{results_db}.shard{i}" for i in range(len(dia_data_files))]
+        for kw, shard_db in zip(kwargs, shard_dbs):
+            kw["shard_db"] = shard_db
     args = [(dia_data_file, results_db, params) for dia_data_file in dia_data_files]
-    args_for_starmap = zip(repeat(extract_dia_features), args, repeat({'debug_flag': debug_flag, 
-                                                                       'debug_cb': debug_cb, 
-                                                                       'mza_io_threads': mza_io_threads}))
+    args_for_starmap = zip(repeat(extract_dia_features), args, kwargs)
     with multiprocessing.Pool(processes=n_proc) as p:
         feat_counts = p.starmap(apply_args_and_kwargs, args_for_starmap)
+    if shards:
+        _ = merge_results_db_shards(results_db, shard_dbs, remove_shards=True)
     return {k: v for k, v in zip(dia_data_files, feat_counts)}
 
 
@@ -668,7 +727,7 @@ def add_calibrated_ccs_to_dia_features(results_db: ResultsDbPath,
         # buffer gas is N2 -> 28.00615 in reduced mass calculation
         return (dt + t_fix) / (beta * np.sqrt(mz / (mz + 28.00615)))
     # connect to the database
-    con = sqlite3.connect(results_db) 
+    con = connect_results_db(results_db) 
     cur1, cur2 = con.cursor(), con.cursor()  # one cursor to select data, another to update the db with ccs
     # check that DIA feature extraction has been completed first
     check_analysis_log(cur1, AnalysisStep.DIA_EXT)
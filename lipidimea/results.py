@@ -0,0 +1,757 @@
+"""
+lipidimea/results.py
+Dylan Ross (dylan.ross@pnnl.gov)
+
+    module for reading analysis results from the results database into polars DataFrames and
+    numpy arrays
+"""
+
+
+import os
+import errno
+import json
+from typing import (
+    List, Optional, Tuple, Dict, Iterable, Any, Literal, Generator
+)
+
+import numpy as np
+import numpy.typing as npt
+import polars as pl
+
+from lipidimea.typing import ResultsDbPath
+from lipidimea.util import connect_results_db, _upgrade_results_db_schema
+
+
+# polars data types for the column types used in the results database schema
+_SQLITE_TO_POLARS: Dict[str, Any] = {
+    "INTEGER": pl.Int64,
+    "INT": pl.Int64,
+    "REAL": pl.Float64,
+    "TEXT": pl.String,
+    "BLOB": pl.Binary,
+}
+
+
+# for each source of features: the precursors table, the fragments table, and the precursor identifier
+_SOURCES: Dict[str, Tuple[str, str, str]] = {
+    "DDA": ("DDAPrecursors", "DDAFragments", "dda_pre_id"),
+    "DIA": ("DIAPrecursors", "DIAFragments", "dia_pre_id"),
+}
+
+
+class ResultsReader():
+    """
+    Read access to the results database, with the contents of the tables returned as polars
+    DataFrames (and raw data as numpy arrays) instead of row by row. Rows are fetched from the
+    database in batches and the columns get built up a batch at a time, and selections by
+    identifier are passed to the database as a single parameter (a JSON array), so there is no
+    limit on the number of identifiers. Can be used as a context manager, which closes the
+    connection to the database on exit.
+
+    .. code-block:: python3
+
+        with ResultsReader("results.db") as rdr:
+            pre = rdr.precursors(dfile_ids=[1, 2], mz_range=(700., 800.))
+            frags = rdr.fragments(pre_ids=pre["dia_pre_id"])
+            xics = rdr.raw_arrays(pre["dia_pre_id"], raw_types=["DIA_PRE_XIC"])
+    """
+
+    def __init__(self,
+                 results_db: ResultsDbPath,
+                 batch_size: int = 100000
+                 ) -> None :
+        """
+        Open a (read-only usage) connection to the results database
+
+        Parameters
+        ----------
+        results_db
+            path to LipidIMEA analysis results database
+        [batch_size]
+            number of rows to fetch from the database at a time
+        """
+        # ensure results database file exists
+        if not os.path.isfile(results_db):
+            raise FileNotFoundError(errno.ENOENT,
+                                    os.strerror(errno.ENOENT),
+                                    results_db)
+        self.batch_size = batch_size
+        self._con = connect_results_db(results_db, profile="read")
+
+    def close(self
+              ) -> None :
+        """ close the connection to the results database """
+        self._con.close()
+
+    def __enter__(self
+                  ) -> "ResultsReader" :
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback
+                 ) -> None :
+        self.close()
+
+    def _schema(self,
+                table: str
+                ) -> Dict[str, Any] :
+        """ column names and polars data types for a table (or view) in the results database """
+        return {
+            name: _SQLITE_TO_POLARS.get(col_type.upper(), pl.Object)
+            for _, name, col_type, *_ in self._con.execute(f"PRAGMA table_info({table})")
+        }
+
+    def _fetch_batches(self,
+                       table: str,
+                       columns: List[str],
+                       conditions: List[Tuple[str, Any]],
+                       order_by: str
+                       ) -> Generator[List[Tuple[Any, ...]], Any, None] :
+        """
+        select rows from a table with conditions (as SQL expressions with a single parameter,
+        combined with AND), yields batches of up to ``batch_size`` rows
+        """
+        qry = f"SELECT {', '.join(columns)} FROM {table}"
+        if conditions:
+            qry += " WHERE " + " AND ".join(expr for expr, _ in conditions)
+        qry += f" ORDER BY {order_by}"
+        cur = self._con.execute(qry, [param for _, param in conditions])
+        while rows := cur.fetchmany(self.batch_size):
+            yield rows
+        cur.close()
+
+    def _select(self,
+                table: str,
+                conditions: List[Tuple[str, Any]],
+                order_by: str,
+                columns: Optional[List[str]] = None
+                ) -> pl.DataFrame :
+        """ select rows from a table (see ``_fetch_batches``) into a DataFrame, a batch at a time """
+        schema = self._schema(table)
+        if columns is not None:
+            schema = {column: schema[column] for column in columns}
+        batches = [
+            pl.DataFrame(rows, schema=schema, orient="row")
+            for rows in self._fetch_batches(table, list(schema), conditions, order_by)
+        ]
+        return pl.concat(batches) if batches else pl.DataFrame(schema=schema)
+
+    def _has_table(self,
+                   table: str
+                   ) -> bool :
+        """ 
+        check if a table (or view) exists in the results database (e.g. tables added in newer schema 
+        versions) 
+        """
+        qry = "SELECT COUNT(*) FROM sqlite_master WHERE type IN ('table', 'view') AND name=?"
+        return self._con.execute(qry, (table,)).fetchone()[0] > 0
+
+    @staticmethod
+    def _ids_condition(column: str,
+                       ids: Iterable[int]
+                       ) -> Tuple[str, str] :
+        """ condition selecting rows with any of the identifiers in a column """
+        return f"{column} IN (SELECT value FROM json_each(?))", json.dumps([int(i) for i in ids])
+
+    @staticmethod
+    def _source(source: str
+                ) -> Tuple[str, str, str] :
+        if source not in _SOURCES:
+            raise ValueError(f"source must be one of {list(_SOURCES)}, got: {source}")
+        return _SOURCES[source]
+
+    def data_files(self
+                   ) -> pl.DataFrame :
+        """ all of the data files (DataFiles table) """
+        return self._select("DataFiles", [], "dfile_id")
+
+    def precursors(self,
+                   dfile_ids: Optional[Iterable[int]] = None,
+                   pre_ids: Optional[Iterable[int]] = None,
+                   mz_range: Optional[Tuple[float, float]] = None,
+                   source: Literal["DDA", "DIA"] = "DIA",
+                   columns: Optional[List[str]] = None
+                   ) -> pl.DataFrame :
+        """
+        Select precursors (DIAPrecursors or DDAPrecursors table), ordered by precursor identifier
+
+        Parameters
+        ----------
+        [dfile_ids]
+            only select precursors from these data files
+        [pre_ids]
+            only select precursors with these identifiers
+        [mz_range]
+            only select precursors with m/z in this range (min, max)
+        [source]
+            "DIA" or "DDA" precursors
+        [columns]
+            only select these columns, None to select all of them
+
+        Returns
+        -------
+        precursors
+            DataFrame with the selected precursors, with the same columns as the table
+        """
+        pre_table, _, pre_id = self._source(source)
+        conditions = []
+        if dfile_ids is not None:
+            conditions.append(self._ids_condition("dfile_id", dfile_ids))
+        if pre_ids is not None:
+            conditions.append(self._ids_condition(pre_id, pre_ids))
+        if mz_range is not None:
+            conditions += [("mz >= ?", float(mz_range[0])), ("mz <= ?", float(mz_range[1]))]
+        return self._select(pre_table, conditions, pre_id, columns=columns)
+
+    def fragments(self,
+                  pre_ids: Optional[Iterable[int]] = None,
+                  source: Literal["DDA", "DIA"] = "DIA",
+                  columns: Optional[List[str]] = None
+                  ) -> pl.DataFrame :
+        """
+        Select fragments (DIAFragments or DDAFragments table), ordered by precursor identifier
+        then fragment m/z
+
+        Parameters
+        ----------
+        [pre_ids]
+            only select fragments from precursors with these identifiers
+        [source]
+            "DIA" or "DDA" fragments
+        [columns]
+            only select these columns, None to select all of them
+
+        Returns
+        -------
+        fragments
+            DataFrame with the selected fragments, with the same columns as the table
+        """
+        _, frag_table, pre_id = self._source(source)
+        conditions = []
+        if pre_ids is not None:
+            conditions.append(self._ids_condition(pre_id, pre_ids))
+        return self._select(frag_table, conditions, f"{pre_id}, fmz", columns=columns)
+
+    def annotations(self,
+                    pre_ids: Optional[Iterable[int]] = None,
+                    filtered: bool = True,
+                    columns: Optional[List[str]] = None
+                    ) -> pl.DataFrame :
+        """
+        Select lipid annotations of DIA precursors, ordered by precursor identifier then lipid
+        annotation identifier
+
+        Parameters
+        ----------
+        [pre_ids]
+            only select annotations of DIA precursors with these identifiers
+        [filtered]
+            only select the annotations that were not filtered out (FilteredLipids view),
+            set to False to select all of them (Lipids table). Results databases from before 
+            the FilteredLipids view was added (not upgraded) have the annotations that were 
+            filtered out removed from the Lipids table, so it is selected from either way.
+        [columns]
+            only select these columns, None to select all of them
+
+        Returns
+        -------
+        annotations
+            DataFrame with the selected annotations, with the same columns as the Lipids table
+        """
+        conditions = []
+        if pre_ids is not None:
+            conditions.append(self._ids_condition("dia_pre_id", pre_ids))
+        table = "FilteredLipids" if filtered and self._has_table("FilteredLipids") else "Lipids"
+        return self._select(table, conditions, "dia_pre_id, lipid_id", columns=columns)
+
+    def _require_table(self,
+                       table: str
+                       ) -> None :
+        """
+        raise a RuntimeError if a table is not in the results database (summary and alignment tables
+        are only in results databases with schema version 4 or newer)
+        """
+        if not self._has_table(table):
+            raise RuntimeError(f"results database does not have the {table} table, it needs to be upgraded "
+                               "(see upgrade_results_db)")
+
+    def _summary(self,
+                 table: str,
+                 dfile_ids: Optional[Iterable[int]],
+                 pre_ids: Optional[Iterable[int]],
+                 columns: Optional[List[str]]
+                 ) -> pl.DataFrame :
+        """ select rows from one of the DIA feature summary tables """
+        self._require_table(table)
+        conditions = []
+        if dfile_ids is not None:
+            conditions.append(self._ids_condition("dfile_id", dfile_ids))
+        if pre_ids is not None:
+            conditions.append(self._ids_condition("dia_pre_id", pre_ids))
+        return self._select(table, conditions, "dia_pre_id", columns=columns)
+
+    def file_summary(self
+                     ) -> pl.DataFrame :
+        """ feature counts for each data file (DataFileSummary table) """
+        self._require_table("DataFileSummary")
+        return self._select("DataFileSummary", [], "dfile_id")
+
+    def fragment_summary(self,
+                         dfile_ids: Optional[Iterable[int]] = None,
+                         pre_ids: Optional[Iterable[int]] = None,
+                         columns: Optional[List[str]] = None
+                         ) -> pl.DataFrame :
+        """
+        Select fragment statistics of DIA precursors (DIAFragmentSummary table), ordered by 
+        precursor identifier
+
+        Parameters
+        ----------
+        [dfile_ids]
+            only select DIA precursors from these data files
+        [pre_ids]
+            only select DIA precursors with these identifiers
+        [columns]
+            only select these columns, None to select all of them
+
+        Returns
+        -------
+        summary
+            DataFrame with the selected fragment statistics, with the same columns as the table
+        """
+        return self._summary("DIAFragmentSummary", dfile_ids, pre_ids, columns)
+
+    def annotation_summary(self,
+                           dfile_ids: Optional[Iterable[int]] = None,
+                           pre_ids: Optional[Iterable[int]] = None,
+                           columns: Optional[List[str]] = None
+                           ) -> pl.DataFrame :
+        """
+        Select annotation summaries of annotated DIA precursors (DIAAnnotationSummary table), 
+        ordered by precursor identifier
+
+        Parameters
+        ----------
+        [dfile_ids]
+            only select DIA precursors from these data files
+        [pre_ids]
+            only select DIA precursors with these identifiers
+        [columns]
+            only select these columns, None to select all of them
+
+        Returns
+        -------
+        summary
+            DataFrame with the selected annotation summaries, with the same columns as the table
+        """
+        return self._summary("DIAAnnotationSummary", dfile_ids, pre_ids, columns)
+
+    def alignments(self
+                   ) -> pl.DataFrame :
+        """ all of the stored alignments of DIA features across data files (Alignments table) """
+        self._require_table("Alignments")
+        return self._select("Alignments", [], "align_id")
+
+    def aligned_features(self,
+                         align_id: int,
+                         afeat_ids: Optional[Iterable[int]] = None,
+                         columns: Optional[List[str]] = None
+                         ) -> pl.DataFrame :
+        """
+        Select aligned features from a stored alignment (AlignedFeatures table, see 
+        ``align_dia_features``), ordered by aligned feature identifier
+
+        Parameters
+        ----------
+        align_id
+            alignment identifier
+        [afeat_ids]
+            only select aligned features with these identifiers
+        [columns]
+            only select these columns, None to select all of them
+
+        Returns
+        -------
+        features
+            DataFrame with the selected aligned features, with the same columns as the table
+        """
+        self._require_table("AlignedFeatures")
+        conditions = [("align_id = ?", int(align_id))]
+        if afeat_ids is not None:
+            conditions.append(self._ids_condition("afeat_id", afeat_ids))
+        return self._select("AlignedFeatures", conditions, "afeat_id", columns=columns)
+
+    def aligned_members(self,
+                        align_id: int,
+                        afeat_ids: Optional[Iterable[int]] = None,
+                        columns: Optional[List[str]] = None
+                        ) -> pl.DataFrame :
+        """
+        Select the DIA precursors in the aligned features from a stored alignment 
+        (AlignedFeatureMembers table, see ``align_dia_features``), in the order they were aligned
+
+        Parameters
+        ----------
+        align_id
+            alignment identifier
+        [afeat_ids]
+            only select the DIA precursors in aligned features with these identifiers
+        [columns]
+            only select these columns, None to select all of them
+
+        Returns
+        -------
+        members
+            DataFrame with the selected DIA precursors, with the same columns as the table
+        """
+        self._require_table("AlignedFeatureMembers")
+        conditions = [("align_id = ?", int(align_id))]
+        if afeat_ids is not None:
+            conditions.append(self._ids_condition("afeat_id", afeat_ids))
+        return self._select("AlignedFeatureMembers", conditions, "member_n", columns=columns)
+
+    def raw_arrays(self,
+                   feat_ids: Optional[Iterable[int]] = None,
+                   feat_id_type: str = "dia_pre_id",
+                   raw_types: Optional[Iterable[str]] = None,
+                   max_points: Optional[int] = None,
+                   method: str = "minmax"
+                   ) -> "RawArrays" :
+        """
+        Select raw data (Raw table) associated with features, ordered by feature identifier then
+        raw data identifier. All of the selected raw data are loaded in one query into a single
+        contiguous buffer (see ``RawArrays``).
+
+        With ``max_points`` set (e.g. for plotting), raw data with more points than that are 
+        replaced by the largest downsampled version that fits (from the RawDownsampled table, see
+        ``build_raw_downsampled``) or, if there is not one, downsampled when loaded (see 
+        ``downsample_trace``).
+
+        Parameters
+        ----------
+        [feat_ids]
+            only select raw data associated with features with these identifiers
+        [feat_id_type]
+            type of feature identifier, e.g. "dia_pre_id" or "dia_frag_id"
+        [raw_types]
+            only select raw data of these types, e.g. "DIA_PRE_XIC" or "DIA_FRAG_ATD"
+        [max_points]
+            max number of points for each array, None to load the full raw data
+        [method]
+            method for downsampling raw data that does not have a stored downsampled version
+            that fits within ``max_points``, "minmax" or "lttb"
+
+        Returns
+        -------
+        raw
+            selected raw data, with the arrays in the same order as the rows of ``raw.info`` (where
+            raw_n is the number of points that were loaded)
+        """
+        conditions = [("feat_id_type = ?", feat_id_type)]
+        if feat_ids is not None:
+            conditions.append(self._ids_condition("feat_id", feat_ids))
+        if raw_types is not None:
+            conditions.append(("raw_type IN (SELECT value FROM json_each(?))", json.dumps(list(raw_types))))
+        schema = self._schema("Raw")
+        # the BLOBs get copied straight into the buffer instead of going through the DataFrame
+        del schema["raw_data"]
+        table = "Raw"
+        if max_points is not None:
+            if method not in DOWNSAMPLE_METHODS:
+                raise ValueError(f"method must be one of {DOWNSAMPLE_METHODS}, got: {method}")
+            if self._has_table("RawDownsampled"):
+                # swap in the largest downsampled version that fits, if the raw data does not fit
+                table = f"""(
+                    SELECT 
+                        {", ".join(f"Raw.{column}" for column in schema if column != "raw_n")},
+                        COALESCE(RawDownsampled.raw_n, Raw.raw_n) AS raw_n,
+                        COALESCE(RawDownsampled.raw_data, Raw.raw_data) AS raw_data
+                    FROM 
+                        Raw
+                        LEFT JOIN RawDownsampled ON Raw.raw_n > {int(max_points)}
+                            AND RawDownsampled.raw_id = Raw.raw_id 
+                            AND RawDownsampled.raw_n = (
+                                SELECT MAX(raw_n) FROM RawDownsampled AS rd
+                                WHERE rd.raw_id = Raw.raw_id AND rd.raw_n <= {int(max_points)}
+                            )
+                )"""
+        batches = []
+        buf = bytearray()
+        offsets = [0]
+        i_n = list(schema).index("raw_n")
+        for rows in self._fetch_batches(table, [*schema, "raw_data"], conditions, "feat_id, raw_id"):
+            info = []
+            for *row, blob in rows:
+                if max_points is not None and row[i_n] > max_points:
+                    trace = downsample_trace(np.frombuffer(blob, dtype=np.float64).reshape((2, row[i_n])),
+                                             max_points, method=method)
+                    row[i_n] = trace.shape[1]
+                    blob = np.ascontiguousarray(trace).tobytes()
+                info.append(row)
+                buf += blob
+                offsets.append(len(buf))
+            batches.append(pl.DataFrame(info, schema=schema, orient="row"))
+        info = pl.concat(batches) if batches else pl.DataFrame(schema=schema)
+        # frombuffer on the bytearray does not copy it
+        data = np.frombuffer(buf, dtype=np.float64)
+        indptr = np.array(offsets, dtype=np.int64) // data.itemsize
+        return RawArrays(info, data, indptr)
+
+
+class RawArrays():
+    """
+    Raw data arrays (from the Raw table) for many features in a ragged layout. Each raw data array
+    has shape (2, N) and is stored as the N values of the first row followed by the N values of the
+    second row, the arrays are all concatenated into a single contiguous buffer (``data``) and 
+    ``indptr`` marks where each array starts and ends (like the rows of a CSR matrix). Indexing or 
+    iterating gives (2, N) views into the buffer, without copying.
+    """
+
+    def __init__(self,
+                 info: pl.DataFrame,
+                 data: npt.NDArray[np.float64],
+                 indptr: npt.NDArray[np.int64]
+                 ) -> None :
+        """
+        Initialize the raw data arrays
+
+        Parameters
+        ----------
+        info
+            Raw table columns (except raw_data) for each array
+        data
+            all of the arrays concatenated
+        indptr
+            array i is data[indptr[i]:indptr[i + 1]].reshape((2, -1))
+        """
+        self.info = info
+        self.data = data
+        self.indptr = indptr
+        self._index: Optional[Dict[Tuple[int, str], int]] = None
+
+    def __len__(self
+                ) -> int :
+        return len(self.indptr) - 1
+
+    def __getitem__(self,
+                    i: int
+                    ) -> npt.NDArray[np.float64] :
+        if not -len(self) <= i < len(self):
+            raise IndexError(f"raw data array index {i} out of range ({len(self)} arrays)")
+        i %= len(self)
+        return self.data[self.indptr[i]:self.indptr[i + 1]].reshape((2, -1))
+
+    def __iter__(self
+                 ) -> Generator[npt.NDArray[np.float64], Any, None] :
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def lengths(self
+                ) -> npt.NDArray[np.int64] :
+        """ number of points (N) in each array """
+        return np.diff(self.indptr) // 2
+
+    def get(self,
+            feat_id: int,
+            raw_type: str
+            ) -> Optional[npt.NDArray[np.float64]] :
+        """
+        Get the array with a given type of raw data (e.g. "DIA_PRE_XIC") for a feature, returns None 
+        if there is not one (if there are several, returns the first one)
+        """
+        if self._index is None:
+            self._index = {}
+            for i, key in enumerate(self.info.select("feat_id", "raw_type").iter_rows()):
+                self._index.setdefault(key, i)
+        i = self._index.get((feat_id, raw_type))
+        return None if i is None else self[i]
+
+
+#------------------------------------------------------------------------------
+# downsampled raw data
+
+
+# methods for downsampling raw data (see ``downsample_trace``)
+DOWNSAMPLE_METHODS: List[str] = ["minmax", "lttb"]
+
+
+# point budgets for the downsampled versions of the raw data stored in the RawDownsampled table,
+# each piece of raw data gets a downsampled version for every budget smaller than its number of points
+RAW_DOWNSAMPLE_LEVELS: List[int] = [4096, 1024, 256]
+
+
+def _minmax_indices(y: npt.NDArray[np.float64],
+                    n_out: int
+                    ) -> npt.NDArray[np.int64] :
+    """
+    indices of the points to keep with min/max decimation: the first and last points plus the 
+    points with the min and max y values in each of (n_out - 2) / 2 equal-size buckets
+    """
+    n = len(y)
+    n_buckets = (n_out - 2) // 2
+    # buckets of the points between the first and last points
+    edges = np.linspace(1, n - 1, n_buckets + 1).astype(np.int64)
+    bucket = np.repeat(np.arange(n_buckets), np.diff(edges))
+    inner = y[1:n - 1]
+    keep = [np.array([0, n - 1])]
+    for reduce in [np.fmin, np.fmax]:
+        extreme = reduce.reduceat(inner, edges[:-1] - 1)
+        hits = np.flatnonzero(inner == extreme[bucket])
+        # first matching point in each bucket
+        _, first = np.unique(bucket[hits], return_index=True)
+        keep.append(hits[first] + 1)
+    return np.unique(np.concatenate(keep))
+
+
+def _lttb_indices(x: npt.NDArray[np.float64], 
+                  y: npt.NDArray[np.float64],
+                  n_out: int
+                  ) -> npt.NDArray[np.int64] :
+    """
+    indices of the points to keep with Largest-Triangle-Three-Buckets: the first and last points 
+    plus one point from each of (n_out - 2) equal-size buckets, the one that makes the largest
+    triangle with the point kept from the previous bucket and the average of the next bucket
+    """
+    n = len(y)
+    n_buckets = n_out - 2
+    edges = np.linspace(1, n - 1, n_buckets + 1).astype(np.int64)
+    keep = np.empty(n_buckets + 2, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(n_buckets):
+        lo, hi = edges[i], edges[i + 1]
+        # average of the next bucket (the last point for the last bucket)
+        nlo, nhi = (edges[i + 1], edges[i + 2]) if i + 2 <= n_buckets else (n - 1, n)
+        cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+
+def downsample_trace(trace: npt.NDArray[np.float64],
+                     n_out: int,
+                     method: str = "minmax"
+                     ) -> npt.NDArray[np.float64] :
+    """
+    Downsample a trace (XIC, ATD, or spectrum, as an array with shape (2, N) like the raw data) to 
+    at most ``n_out`` points, keeping a subset of the original points that preserves the shape of 
+    the trace (peaks are not flattened like with averaging). The trace is returned as-is if it 
+    does not have more than ``n_out`` points.
+
+    Parameters
+    ----------
+    trace
+        x and y values of the trace, shape (2, N)
+    n_out
+        max number of points to keep (at least 4)
+    [method]
+        "minmax" keeps the min and max points in equal-size buckets (fast, keeps all local extremes
+        of the buckets) or "lttb" to use Largest-Triangle-Three-Buckets (better visual fidelity
+        per point kept, but slower)
+
+    Returns
+    -------
+    downsampled
+        x and y values of the downsampled trace, shape (2, M) with M <= n_out
+    """
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(f"method must be one of {DOWNSAMPLE_METHODS}, got: {method}")
+    if n_out < 4:
+        raise ValueError(f"n_out must be at least 4, got: {n_out}")
+    if trace.shape[1] <= n_out:
+        return trace
+    if method == "minmax":
+        idx = _minmax_indices(trace[1], n_out)
+    else:
+        idx = _lttb_indices(trace[0], trace[1], n_out)
+    return trace[:, idx]
+
+
+def build_raw_downsampled(results_db: ResultsDbPath,
+                          levels: Iterable[int] = RAW_DOWNSAMPLE_LEVELS,
+                          method: str = "minmax",
+                          raw_types: Optional[Iterable[str]] = None,
+                          overwrite: bool = False,
+                          batch_size: int = 10000
+                          ) -> int :
+    """
+    Store downsampled versions of the raw data (see ``downsample_trace``) at multiple resolutions 
+    in the RawDownsampled table, so that plotting does not need to load all of the raw data (see
+    the ``max_points`` option of ``ResultsReader.raw_arrays``). Raw data that already has
+    downsampled versions is skipped, unless ``overwrite`` is set.
+
+    Parameters
+    ----------
+    results_db
+        path to LipidIMEA analysis results database
+    [levels]
+        point budgets for the downsampled versions, each piece of raw data gets a downsampled
+        version for every budget smaller than its number of points
+    [method]
+        downsampling method, "minmax" or "lttb"
+    [raw_types]
+        only downsample raw data of these types, e.g. "DIA_PRE_XIC" or "DIA_FRAG_ATD"
+    [overwrite]
+        replace any existing downsampled versions of the raw data
+    [batch_size]
+        number of rows of raw data to process at a time
+
+    Returns
+    -------
+    n_downsampled
+        number of pieces of raw data that got downsampled versions
+    """
+    # ensure results database file exists
+    if not os.path.isfile(results_db):
+        raise FileNotFoundError(errno.ENOENT,
+                                os.strerror(errno.ENOENT),
+                                results_db)
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(f"method must be one of {DOWNSAMPLE_METHODS}, got: {method}")
+    levels = sorted(set(levels), reverse=True)
+    con = connect_results_db(results_db)
+    cur = con.cursor()
+    _upgrade_results_db_schema(cur)
+    raw_types_cond, qdata = "", [min(levels)]
+    if raw_types is not None:
+        raw_types_cond = "AND raw_type IN (SELECT value FROM json_each(?))"
+        qdata.append(json.dumps(list(raw_types)))
+    if overwrite:
+        cur.execute(f"""--beginsql
+            DELETE FROM RawDownsampled WHERE raw_id IN (
+                SELECT raw_id FROM Raw WHERE TRUE {raw_types_cond}
+            )
+        --endsql""", qdata[1:])
+    qry_sel = f"""--beginsql
+        SELECT 
+            raw_id, raw_n, raw_data 
+        FROM 
+            Raw 
+        WHERE 
+            raw_n > ? 
+            {raw_types_cond} 
+            AND raw_id NOT IN (SELECT raw_id FROM RawDownsampled)
+    --endsql"""
+    qry_ins = """--beginsql
+        INSERT INTO RawDownsampled VALUES (?,?,?)
+    --endsql"""
+    n_downsampled = 0
+    # separate cursor for selecting, so it does not get reset by the inserts
+    sel = con.cursor()
+    sel.execute(qry_sel, qdata)
+    while rows := sel.fetchmany(batch_size):
+        qdata_ins = []
+        for raw_id, raw_n, raw_data in rows:
+            trace = np.frombuffer(raw_data, dtype=np.float64).reshape((2, raw_n))
+            # each level is downsampled from the next larger one, which is much faster and 
+            # keeps the points in the smaller levels consistent with the larger ones
+            for level in levels:
+                if trace.shape[1] > level:
+                    trace = downsample_trace(trace, level, method=method)
+                    qdata_ins.append((raw_id, trace.shape[1], np.ascontiguousarray(trace).tobytes()))
+        cur.executemany(qry_ins, qdata_ins)
+        n_downsampled += len(rows)
+    con.commit()
+    con.close()
+    return n_downsampled
@@ -9,16 +9,22 @@ Dylan Ross (dylan.ross@pnnl.gov)
 import unittest
 
 from lipidimea.test.annotation import AllTestsAnnotation
+from lipidimea.test.library_search import AllTestsLibrarySearch
 from lipidimea.test.params import AllTestsParams
+from lipidimea.test.results import AllTestsResults
 from lipidimea.test.util import AllTestsUtil
 from lipidimea.test.msms.__all_tests import AllTests as AllTestsMsms
+from lipidimea.test._lipidlib.parser import AllTestsParser
 
 
 # collect tests
 AllTests = unittest.TestSuite()
 AllTests.addTests([
     AllTestsAnnotation,
+    AllTestsLibrarySearch,
     AllTestsParams,
+    AllTestsResults,
     AllTestsUtil,
-    AllTestsMsms
+    AllTestsMsms,
+    AllTestsParser
 ])
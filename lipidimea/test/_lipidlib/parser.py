@@ -1,21 +1,52 @@
 """
-lipidlib/test/parser.py
+lipidimea/test/_lipidlib/parser.py
 
 Dylan Ross (dylan.ross@pnnl.gov)
 
-    tests for lipidlib/parser.py module
+    tests for lipidimea/_lipidlib/parser.py module
 """
 
 
+import unittest
 from unittest import TestCase, main as utmain
 
 
-from lipidlib.parser import (
+from lipidimea._lipidlib.parser import (
     _suffixes_combinable, _combine_o_variants, _combined_oxy_suffix_from_oxy_suffix_chains, 
-    _get_lmid_prefix, parse_lipid_name
+    _get_lmid_prefix, _fast_tokenize, _parse_lipid_name_fast, _parse_lipid_name_regex, 
+    ParsedLipidName, parse_lipid_name_info, parse_lipid_name
 )
 
 
+# names with the simple shapes handled by the fast path
+_SIMPLE_NAMES = [
+    "PC 34:1", "PE 36:4", "LPC 18:1", "TG 52:3", "PS 36:2", "PC 18:1_16:0", "PE 18:0_20:4", 
+    "LPC 18:1_0:0", "LPC 0:0_18:1", "PG 16:0_18:1", "DG 16:0_18:1",
+]
+
+# names that need the full regex
+_COMPLEX_NAMES = [
+    "PC O-34:1", "PC P-34:1", "LPC O-18:1", "SM 34:1;O2", "PC O-18:1_16:0", "PC P-18:1/16:0", 
+    "PC 18:1/16:0", "LPC 0:0/18:1", "SM 18:1;O2_16:0", "SM 18:1;O2/16:0", "Cer 18:1;O2/16:0", 
+    "TG 16:0_18:1_18:2", "TG 16:0/18:1/18:2",
+]
+
+# names that are not able to be parsed
+_BAD_NAMES = [
+    "", "not a lipid", "PC(34:1)", "PC 34", "PC 34:1 ", "PC 34:1_A", "XYZ 34:1", "PE 16:0_0:0", 
+    "PC 18:1_16:0_14:0", "PC 18:1(9Z)_16:0", "PC 34:1_A;PC 34:1_B",
+]
+
+
+def _lipid_info(lpd):
+    """ comparable information from a parsed lipid (or None) """
+    if lpd is None:
+        return None
+    return (str(lpd), lpd.lmaps_id_prefix, lpd.fa_carbon, lpd.fa_unsat, 
+            getattr(lpd, "fa_carbon_chains", None), getattr(lpd, "fa_unsat_chains", None),
+            getattr(lpd, "sn_pos_is_known", None), getattr(lpd, "oxy_suffix_chains", None))
+
+
 class Test_SuffixesCombinable(TestCase):
     """ tests for the _suffixes_combinable function """
 
@@ -320,6 +351,81 @@ class TestParseLipidName(TestCase):
                               msg="should have gotten None from parse_lipid, " + fail_reason)
 
 
+
+class Test_FastTokenize(TestCase):
+    """ tests for the _fast_tokenize function """
+
+    def test_simple_and_complex_names(self):
+        """ only names with the simple shapes get tokenized """
+        self.assertEqual(_fast_tokenize("PC 34:1"), ("PC", [34], [1]))
+        self.assertEqual(_fast_tokenize("PC 18:1_16:0"), ("PC", [18, 16], [1, 0]))
+        for name in _COMPLEX_NAMES + ["PC 34", "PC 34:1 ", "PC 18:1_16:0_14:0", "PC ３4:1", "PC(34:1)"]:
+            self.assertIsNone(_fast_tokenize(name), msg=name)
+
+
+class TestParseLipidNameInfo(TestCase):
+    """ tests for the parse_lipid_name_info function (and the fast/regex parsing paths) """
+
+    def test_fast_path_same_as_regex(self):
+        """ the fast path gives the same lipids as the full regex, complex names skip the fast path """
+        for name in _SIMPLE_NAMES + ["PE 16:0_0:0", "XYZ 34:1"]:
+            handled, lpd = _parse_lipid_name_fast(name)
+            self.assertTrue(handled, msg=name)
+            self.assertEqual(_lipid_info(lpd), _lipid_info(_parse_lipid_name_regex(name)), msg=name)
+        for name in _COMPLEX_NAMES:
+            self.assertEqual(_parse_lipid_name_fast(name), (False, None), msg=name)
+
+    def test_same_as_regex(self):
+        """ parsed info (and lipids from parse_lipid_name) are the same as parsing with the full regex """
+        for name in _SIMPLE_NAMES + _COMPLEX_NAMES:
+            expected = _parse_lipid_name_regex(name)
+            info = parse_lipid_name_info(name)
+            self.assertIsInstance(info, ParsedLipidName)
+            self.assertEqual(info.with_chains, hasattr(expected, "fa_carbon_chains"), msg=name)
+            self.assertEqual((info.lmaps_id_prefix, info.fa_carbon, info.fa_unsat, info.n_chains, info.n_chains_full),
+                             (expected.lmaps_id_prefix, expected.fa_carbon, expected.fa_unsat, 
+                              expected.n_chains, expected.n_chains_full), 
+                             msg=name)
+            self.assertEqual(_lipid_info(parse_lipid_name(name)), _lipid_info(expected), msg=name)
+
+    def test_bad_names(self):
+        """ names that are not able to be parsed give None """
+        for name in _BAD_NAMES:
+            self.assertIsNone(parse_lipid_name_info(name), msg=name)
+            self.assertIsNone(parse_lipid_name(name), msg=name)
+
+    def test_cached_results_immutable(self):
+        """ cached results are immutable and lipids built from them are new instances each time """
+        info = parse_lipid_name_info("PC 18:1_16:0")
+        self.assertIs(parse_lipid_name_info("PC 18:1_16:0"), info)
+        self.assertIsInstance(info.fa_carbon_chains, tuple)
+        self.assertIsInstance(info.oxy_suffix_chains, tuple)
+        with self.assertRaises(AttributeError):
+            info.fa_carbon = 36  # type: ignore
+        with self.assertRaises(TypeError):
+            info.fa_carbon_chains[0] = 20  # type: ignore
+        # modifying a returned lipid does not affect the cached info or the next lipid
+        lpd = parse_lipid_name("PC 18:1_16:0")
+        lpd.fa_carbon_chains[0] = 20
+        self.assertIsNot(parse_lipid_name("PC 18:1_16:0"), lpd)
+        self.assertEqual(parse_lipid_name("PC 18:1_16:0").fa_carbon_chains, [18, 16])
+        self.assertEqual(parse_lipid_name_info("PC 18:1_16:0").fa_carbon_chains, (18, 16))
+
+
+# group all of the tests from this module into a TestSuite
+_loader = unittest.TestLoader()
+AllTestsParser = unittest.TestSuite()
+AllTestsParser.addTests([
+    _loader.loadTestsFromTestCase(Test_SuffixesCombinable),
+    _loader.loadTestsFromTestCase(Test_CombineOVariants),
+    _loader.loadTestsFromTestCase(Test_CombinedOxySuffixFromOxySuffixChains),
+    _loader.loadTestsFromTestCase(Test_GetLmidPrefix),
+    _loader.loadTestsFromTestCase(TestParseLipidName),
+    _loader.loadTestsFromTestCase(Test_FastTokenize),
+    _loader.loadTestsFromTestCase(TestParseLipidNameInfo),
+])
+
+
 if __name__ == '__main__':
     # run all defined TestCases for only this module if invoked directly
     utmain(verbosity=2)
\ No newline at end of file
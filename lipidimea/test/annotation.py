@@ -11,20 +11,44 @@ import unittest
 import tempfile
 import sqlite3
 
-from lipidimea.util import create_results_db
+import numpy as np
+import polars as pl
+from mzapy.isotopes import ms_adduct_mz
+
+from lipidimea.util import create_results_db, AnalysisStep
 from lipidimea.params import AnnotationParams
 from lipidimea.annotation import (
     DEFAULT_SCDB_CONFIG, 
     DEFAULT_RP_RT_RANGE_CONFIG,
     DEFAULT_LITERATURE_CCS_TREND_PARAMS,
     SumCompLipidDB,
+    FragmentLibrary,
     remove_lipid_annotations, 
     annotate_lipids_sum_composition, 
     filter_annotations_by_rt_range, 
     filter_annotations_by_ccs_subclass_trend,
     update_lipid_ids_with_frag_rules,
-    annotate_lipids
+    annotate_lipids,
+    annotation_params_hash,
+    annotate_sum_composition,
+    rt_range_pass,
+    annotate_features,
+    _features_to_annotate,
+    _record_annotated_features,
+    _sum_comp_library_arrays,
+    _match_sum_comp_partition,
+    _partition_dia_features,
+    _update_lipid_with_chain_info,
+    _chain_level_annotations,
+    FRAGMENT_SCHEMA,
+    _fpow,
+    _fit_observed_trend,
+    _theoretical_fragments,
+    _theoretical_fragment_mzs,
+    _match_fragments
 )
+from lipidimea._lipidlib._fragmentation_rules import load_rules
+from lipidimea._lipidlib.lipids import Lipid, get_c_u_combos
 
 
 # Use the default annotation params for tests
@@ -167,6 +191,48 @@ class TestSumCompLipidDB(unittest.TestCase):
         # there should be 1 ID for this m/z at 40 ppm 
         self.assertEqual(len(lipids), 1)
 
+    def test_fill_db_same_as_individual_lipids(self):
+        """ names and m/zs in the database should be the same as computing them one lipid at a time """
+        scdb = SumCompLipidDB()
+        scdb.fill_db_from_config(DEFAULT_SCDB_CONFIG["POS"], 12, 24, True)
+        scdb.fill_db_from_config(DEFAULT_SCDB_CONFIG["NEG"], 12, 24, True)
+        qry = "SELECT lmid_prefix, sum_c, sum_u, name, adduct, mz FROM SumCompLipids"
+        for lmid_prefix, sum_c, sum_u, name, adduct, mz in scdb._cur.execute(qry).fetchall():
+            lpd = Lipid(lmid_prefix, sum_c, sum_u)
+            self.assertEqual(name, str(lpd))
+            self.assertEqual(mz, ms_adduct_mz(lpd.formula, adduct))
+
+    def test_match_sum_comp_partition(self):
+        """ matching against the library arrays should give the same results as querying the database """
+        scdb = SumCompLipidDB()
+        scdb.fill_db_from_config(DEFAULT_SCDB_CONFIG["POS"], 12, 24, False)
+        library = _sum_comp_library_arrays(scdb)
+        mzs = np.linspace(400., 1000., 301).tolist()
+        for mz, matches in zip(mzs, _match_sum_comp_partition(library, 20., mzs)):
+            self.assertListEqual([_[0] for _ in matches], scdb.get_sum_comp_lipid_ids(mz, 20.))
+        scdb.close()
+
+
+class Test_PartitionDiaFeatures(unittest.TestCase):
+    """ tests for the _partition_dia_features function """
+
+    def test_partition_by_data_file(self):
+        """ enough data files, partition by data file """
+        dfile_ids = np.array([1, 2, 1, 3, 2, 3])
+        mzs = np.array([600., 500., 700., 800., 900., 400.])
+        parts = _partition_dia_features(dfile_ids, mzs, 3)
+        self.assertEqual([_.tolist() for _ in parts], [[0, 2], [1, 4], [3, 5]])
+
+    def test_partition_by_mz_range(self):
+        """ not enough data files, partition by m/z range """
+        dfile_ids = np.array([1, 1, 1, 1, 2, 2])
+        mzs = np.array([600., 500., 700., 800., 900., 400.])
+        parts = _partition_dia_features(dfile_ids, mzs, 3)
+        self.assertEqual([_.tolist() for _ in parts], [[1, 5], [0, 2], [3, 4]])
+        # every feature ends up in exactly one partition
+        self.assertEqual(sorted(np.concatenate(_partition_dia_features(dfile_ids, mzs, 4)).tolist()), 
+                         list(range(6)))
+
 
 class TestRemoveLipidAnnotations(unittest.TestCase):
     """ tests for the remove_lipid_annotations function """
@@ -198,13 +264,13 @@ class TestRemoveLipidAnnotations(unittest.TestCase):
             cur = con.cursor()
             # fill the db with the features
             for qdata in [
-                (None, 1, "LMID prefix", "lipid", "adduct", 20., None, None, None),
-                (None, 2, "LMID prefix", "lipid", "adduct", 20., None, None, None),
-                (None, 3, "LMID prefix", "lipid", "adduct", 20., None, None, None),
-                (None, 4, "LMID prefix", "lipid", "adduct", 20., None, None, None),
-                (None, 5, "LMID prefix", "lipid", "adduct", 20., None, None, None),
+                (None, 1, "LMID prefix", "lipid", "adduct", 20., None, None, None, None, None),
+                (None, 2, "LMID prefix", "lipid", "adduct", 20., None, None, None, None, None),
+                (None, 3, "LMID prefix", "lipid", "adduct", 20., None, None, None, None, None),
+                (None, 4, "LMID prefix", "lipid", "adduct", 20., None, None, None, None, None),
+                (None, 5, "LMID prefix", "lipid", "adduct", 20., None, None, None, None, None),
             ]:
-                cur.execute("INSERT INTO Lipids VALUES (?,?,?,?,?,?,?,?,?)", qdata) 
+                cur.execute("INSERT INTO Lipids VALUES (?,?,?,?,?,?,?,?,?,?,?)", qdata) 
             con.commit()
             # test the function
             # entries are in the Lipids table before removing
@@ -245,6 +311,34 @@ class TestAnnotateLipidsSumComposition(unittest.TestCase):
             # there should be more than 1 annotation in the Lipid table of the database
             self.assertGreater(len(cur.execute("SELECT * FROM Lipids").fetchall()), 1)
 
+    def test_mock_features_serial_and_parallel(self):
+        """ annotate mocked DIA features from multiple data files, with and without multiprocessing """
+        results = []
+        # n_proc = 3 partitions by data file, n_proc = 4 partitions by m/z range
+        for n_proc in [1, 3, 4]:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                dbf = os.path.join(tmp_dir, "results.db")
+                create_results_db(dbf)
+                con = sqlite3.connect(dbf)
+                cur = con.cursor()
+                cur.executemany(
+                    f"INSERT INTO DIAPrecursors VALUES ({("?," * 14).rstrip(",")});",
+                    [(None, None, dfile_id, mz, 15., 0.1, 1e5, 20., 35., 2.5, 1e5, 10., None, 0)
+                     for dfile_id in [1, 2, 3] for mz in np.linspace(650., 950., 40)]
+                )
+                cur.execute("INSERT INTO AnalysisLog VALUES (?,?,?)", (None, AnalysisStep.DIA_EXT.value, None))
+                con.commit()
+                counts = annotate_lipids_sum_composition(dbf, _ANNOTATION_PARAMS, n_proc=n_proc)
+                results.append((
+                    counts,
+                    cur.execute("SELECT * FROM Lipids").fetchall(),
+                    cur.execute("SELECT * FROM LipidSumComp").fetchall(),
+                ))
+                con.close()
+        self.assertGreater(results[0][0][1], 0)
+        for result in results[1:]:
+            self.assertEqual(result, results[0])
+
     def test_results_db_file_does_not_exist(self):
         """ should raise an error if the results database file does not exist """
         with self.assertRaises(FileNotFoundError, 
@@ -299,8 +393,53 @@ class TestFilterAnnotationsByRtRange(unittest.TestCase):
             # there should have been at least one annotation filtered out
             self.assertGreater(n_filtered, 0)
             # there should be fewer annotations after filtering than there were 
-            # after initial annotation
-            self.assertLess(len(cur.execute("SELECT * FROM Lipids").fetchall()), n_ann)
+            # after initial annotation, but filtered annotations are only flagged
+            self.assertLess(len(cur.execute("SELECT * FROM FilteredLipids").fetchall()), n_ann)
+            self.assertEqual(len(cur.execute("SELECT * FROM Lipids").fetchall()), n_ann)
+
+    def test_custom_rt_range_config_edge_cases(self):
+        """ filter annotations with a custom RT range config, check the bounds and undefined classes """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)
+            rtcf = os.path.join(tmp_dir, "rt_ranges.yaml")
+            with open(rtcf, "w") as yf:
+                yf.write("LMGP0101: [10.0, 20.0]\n")
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            cur.executemany(
+                f"INSERT INTO DIAPrecursors VALUES ({("?," * 14).rstrip(",")});",
+                [(i, None, -1, 766.5, rt, 0.1, 1e5, 20., 35., 2.5, 1e5, 10., None, 0)
+                 for i, rt in enumerate([9.0, 10.0, 15.0, 20.0, 21.0], start=1)]
+            )
+            # PC annotations for every precursor, PE (no RT range defined) for the one inside the range,
+            # and a PC annotation that does not correspond to any precursor
+            cur.executemany(
+                "INSERT INTO Lipids VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                [(None, i, "LMGP0101", "PC 34:1", "[M+H]+", 0., None, None, None, None, None) for i in range(1, 6)]
+                + [(None, 3, "LMGP0201", "PE 37:1", "[M+H]+", 0., None, None, None, None, None),
+                   (None, 99, "LMGP0101", "PC 34:1", "[M+H]+", 0., None, None, None, None, None)]
+            )
+            cur.execute("INSERT INTO AnalysisLog VALUES (?,?,?)", (None, AnalysisStep.LIPID_ANN.value, None))
+            con.commit()
+            params = AnnotationParams.load_default()
+            params.config_file["rt_range_config"] = rtcf
+            n_kept, n_filtered = filter_annotations_by_rt_range(dbf, params)
+            # only the PC annotation strictly inside of the RT range is kept
+            self.assertEqual(n_kept, 1)
+            self.assertEqual(n_filtered, 5)
+            self.assertEqual(sorted(cur.execute("SELECT dia_pre_id FROM FilteredLipids").fetchall()),
+                             [(3,), (99,)])
+            # annotations without a corresponding precursor are not flagged
+            self.assertEqual(cur.execute("SELECT dia_pre_id, rt_pass FROM Lipids ORDER BY lipid_id").fetchall(),
+                             [(1, 0), (2, 0), (3, 1), (4, 0), (5, 0), (3, 0), (99, None)])
+            # re-filtering with a wider RT range
+            with open(rtcf, "w") as yf:
+                yf.write("LMGP0101: [5.0, 25.0]\n")
+            self.assertEqual(filter_annotations_by_rt_range(dbf, params), (5, 1))
+            self.assertEqual(sorted(cur.execute("SELECT dia_pre_id FROM FilteredLipids").fetchall()),
+                             [(1,), (2,), (3,), (4,), (5,), (99,)])
+            con.close()
     
     def test_results_db_file_does_not_exist(self):
         """ should raise an error if the results database file does not exist """
@@ -310,6 +449,19 @@ class TestFilterAnnotationsByRtRange(unittest.TestCase):
                                                _ANNOTATION_PARAMS)
 
 
+class TestRtRangePass(unittest.TestCase):
+    """ tests for the rt_range_pass function """
+
+    def test_edge_cases(self):
+        """ RT ranges are exclusive and classes without a defined range do not pass """
+        rt_ranges = {"LMGP0101": (10., 20.)}
+        self.assertListEqual(
+            rt_range_pass(["LMGP0101"] * 5 + ["LMGP0201"], [9., 10., 15., 20., 21., 15.], rt_ranges).tolist(),
+            [False, False, True, False, False, False]
+        )
+        self.assertEqual(len(rt_range_pass([], [], rt_ranges)), 0)
+
+
 class TestFilterAnnotationsByCcsSubclassTrend(unittest.TestCase):
     """ tests for the filter_annotations_by_ccs_subclass_trend function """
     
@@ -318,7 +470,379 @@ class TestFilterAnnotationsByCcsSubclassTrend(unittest.TestCase):
         with self.assertRaises(FileNotFoundError, 
                                msg="expect a FileNotFoundError from nonexistent database file"):
             filter_annotations_by_ccs_subclass_trend("results db file doesnt exist", _ANNOTATION_PARAMS)
-        
+
+    def _setup_mock_db(self, dbf):
+        """ set up a results database with annotations for literature and observed subclass trends """
+        create_results_db(dbf)
+        con = sqlite3.connect(dbf)
+        cur = con.cursor()
+        lit_params = (0.6, 0.8, 100.)  # matches the literature trend for [GP0101, [M+H]+] below
+        obs_params = [(2., 0.6, 50.), (1., 0.7, 80.)]
+        mzs = np.linspace(600., 900., 8)
+        precursors, lipids = [], []
+        # literature trend: 8 points on the trend and 2 outliers (+/- 10 %)
+        ccss = [_ for _ in lit_params[0] * mzs ** lit_params[1] + lit_params[2]] + [300., 250.]
+        for mz, ccs in zip(list(mzs) + [700., 800.], ccss):
+            precursors.append((mz, ccs))
+            lipids.append("LMGP0101")
+        # observed trends: 8 points on each trend and 1 outlier (+10 %) each
+        for lmid_prefix, (a, b, c) in zip(["LMXX0101", "LMXX0201"], obs_params):
+            ccss = a * mzs ** b + c
+            ccss[3] *= 1.1
+            for mz, ccs in zip(mzs, ccss):
+                precursors.append((mz, ccs))
+                lipids.append(lmid_prefix)
+        # too few points to fit an observed trend
+        for mz in mzs[:3]:
+            precursors.append((mz, 300.))
+            lipids.append("LMXX0301")
+        cur.executemany(
+            f"INSERT INTO DIAPrecursors VALUES ({("?," * 14).rstrip(",")});",
+            [(None, None, -1, mz, 15., 0.1, 1e5, 20., 35., 2.5, 1e5, 10., ccs, 0) for mz, ccs in precursors]
+        )
+        cur.executemany(
+            "INSERT INTO Lipids VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+            [(None, i, lmid_prefix, "lipid", "[M+H]+", 0., None, None, None, None, None)
+             for i, lmid_prefix in enumerate(lipids, start=1)]
+        )
+        for step in [AnalysisStep.CCS_CAL, AnalysisStep.LIPID_ANN]:
+            cur.execute("INSERT INTO AnalysisLog VALUES (?,?,?)", (None, step.value, None))
+        con.commit()
+        con.close()
+        trends = os.path.join(os.path.dirname(dbf), "ccs_trends.yaml")
+        with open(trends, "w") as yf:
+            yf.write(f"GP0101:\n  '[M+H]+': [{", ".join(map(str, lit_params))}]\n")
+        return trends
+
+    def test_mock_data_serial_and_parallel(self):
+        """ filter annotations using literature and observed trends, with and without multiprocessing """
+        results = []
+        for n_proc in [1, 2]:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                dbf = os.path.join(tmp_dir, "results.db")
+                params = AnnotationParams.load_default()
+                params.ccs_trends.config = self._setup_mock_db(dbf)
+                params.ccs_trends.percent = 3.
+                counts = filter_annotations_by_ccs_subclass_trend(dbf, params, n_proc=n_proc)
+                self.assertEqual(counts, (8, 2, 14, 2))
+                con = sqlite3.connect(dbf)
+                results.append(con.execute("SELECT * FROM Lipids ORDER BY lipid_id").fetchall())
+                con.close()
+        # annotations with too few points to fit an observed trend are not touched
+        self.assertEqual([_ for _ in results[0] if _[2] == "LMXX0301" and _[6] is None and _[7] is None],
+                         [_ for _ in results[0] if _[2] == "LMXX0301"])
+        self.assertEqual(len([_ for _ in results[0] if _[2] == "LMXX0301"]), 3)
+        # literature trend flag is set appropriately
+        self.assertTrue(all(_[7] == (1 if _[2] == "LMGP0101" else 0) for _ in results[0] if _[6] is not None))
+        # filtered annotations are flagged (and have trend errors) but are not removed
+        self.assertEqual(len(results[0]), 29)
+        self.assertEqual(len([_ for _ in results[0] if _[10] == 0]), 4)
+        self.assertTrue(all(abs(_[6]) > 3. for _ in results[0] if _[10] == 0 and _[6] is not None))
+        # serial and parallel results are the same
+        self.assertListEqual(results[0], results[1])
+
+    def test_refilter_mock_data(self):
+        """ re-filter annotations with a different percent tolerance without re-annotating """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            params = AnnotationParams.load_default()
+            params.ccs_trends.config = self._setup_mock_db(dbf)
+            params.ccs_trends.percent = 3.
+            self.assertEqual(filter_annotations_by_ccs_subclass_trend(dbf, params), (8, 2, 14, 2))
+            con = sqlite3.connect(dbf)
+            self.assertEqual(con.execute("SELECT COUNT(*) FROM FilteredLipids").fetchone(), (25,))
+            # everything is within 50 % of the trends
+            params.ccs_trends.percent = 50.
+            self.assertEqual(filter_annotations_by_ccs_subclass_trend(dbf, params), (10, 0, 16, 0))
+            self.assertEqual(con.execute("SELECT COUNT(*) FROM FilteredLipids").fetchone(), (29,))
+            # annotations that were filtered out by RT range are not used for fitting or counted
+            con.execute("UPDATE Lipids SET rt_pass = (dia_pre_id > 10)")
+            con.commit()
+            self.assertEqual(filter_annotations_by_ccs_subclass_trend(dbf, params), (0, 0, 16, 0))
+            self.assertEqual(con.execute("SELECT COUNT(*) FROM FilteredLipids").fetchone(), (19,))
+            con.close()
+
+
+class Test_UpdateLipidWithChainInfo(unittest.TestCase):
+    """ tests for the _update_lipid_with_chain_info function """
+
+    def test_mock_annotations(self):
+        """ update mock annotations with fragments supporting specific acyl chains """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            cur.executemany(
+                "INSERT INTO Lipids VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                [
+                    (1, 1, "LMGP0101", "PC 34:1", "[M+H]+", 1., None, None, None, None, None),
+                    (2, 2, "LMGP0105", "LPC 18:1", "[M+H]+", 1., None, None, "inferred", None, None),
+                    (3, 3, "LMGP0101", "PC 36:2", "[M+H]+", 1., None, None, None, None, None),
+                ]
+            )
+            cur.executemany(
+                "INSERT INTO LipidFragments VALUES (?,?,?,?,?,?,?)",
+                [
+                    # PC 34:1 -> PC 18:1_16:0 (confirmed)
+                    (1, 11, "FA", 255.2, 1., 0, "16:0"),
+                    (1, 12, "FA", 281.2, 1., 0, "18:1"),
+                    (1, 13, "static", 184.1, 1., 1, None),
+                    # LPC 18:1 (confirmed)
+                    (2, 21, "FA", 281.2, 1., 0, "18:1"),
+                    # PC 36:2 -> PC 18:2_18:0 (inferred)
+                    (3, 31, "FA", 283.2, 1., 0, "18:0"),
+                ]
+            )
+            _update_lipid_with_chain_info(cur)
+            self.assertListEqual(
+                cur.execute("SELECT lipid_id, dia_pre_id, lipid, chains FROM Lipids ORDER BY lipid_id").fetchall(),
+                [
+                    (2, 2, "LPC 18:1", "confirmed"),
+                    (4, 1, "PC 18:1_16:0", "confirmed"),
+                    (5, 3, "PC 18:2_18:0", "inferred"),
+                ]
+            )
+            # supporting fragment annotations are copied to the new lipid IDs
+            self.assertListEqual(
+                cur.execute("SELECT lipid_id, dia_frag_id FROM LipidFragments WHERE lipid_id > 3 ORDER BY lipid_id, dia_frag_id").fetchall(),
+                [(4, 11), (4, 12), (5, 31)]
+            )
+            con.close()
+
+
+class Test_ChainLevelAnnotations(unittest.TestCase):
+    """ tests for the _chain_level_annotations function """
+
+    def test_mock_annotations(self):
+        """ same mock annotations as the _update_lipid_with_chain_info test, but in memory """
+        annotations = pl.DataFrame(
+            {
+                "feature": [0, 1, 2],
+                "lipid": ["PC 34:1", "LPC 18:1", "PC 36:2"],
+                "chains": [None, "inferred", None],
+            },
+            schema={"feature": pl.Int64, "lipid": pl.String, "chains": pl.String}
+        )
+        fragments = pl.DataFrame(
+            [
+                (0, 0, "FA", 255.2, 1., 0, "16:0"),
+                (0, 1, "FA", 281.2, 1., 0, "18:1"),
+                (0, 2, "static", 184.1, 1., 1, None),
+                (1, 0, "FA", 281.2, 1., 0, "18:1"),
+                (2, 0, "FA", 283.2, 1., 0, "18:0"),
+            ],
+            schema=["annotation", "fragment", "frag_rule", "rule_mz", "ppm", "diagnostic", "supports_fa"],
+            orient="row"
+        )
+        annotations, fragments = _chain_level_annotations(annotations, fragments)
+        self.assertListEqual(
+            list(annotations.iter_rows()), 
+            [(1, "LPC 18:1", "confirmed"), (0, "PC 18:1_16:0", "confirmed"), (2, "PC 18:2_18:0", "inferred")]
+        )
+        # fragments of replaced annotations are dropped, supporting fragments are copied to the new 
+        # annotations (and annotation indices are updated)
+        self.assertListEqual(
+            sorted(fragments.select("annotation", "fragment").iter_rows()),
+            [(0, 0), (1, 0), (1, 1), (2, 0)]
+        )
+
+
+    def test_same_as_results_db(self):
+        """ same annotations and fragment annotations as _update_lipid_with_chain_info """
+        # (feature, lipid, chains) for each annotation
+        anns = [
+            (0, "PC 34:1", None),
+            (0, "PE 37:1", None),
+            (1, "LPC 18:1", "inferred"),
+            (2, "TG 52:3", None),
+            (3, "PC 36:2", None),
+        ]
+        # (annotation, fragment, frag_rule, rule_mz, ppm, diagnostic, supports_fa), fragments are shared 
+        # between annotations of the same feature and can be matched by more than one rule
+        frags = [
+            (0, 0, "FA", 255.2, 1., 0, "16:0"),
+            (0, 1, "FA", 281.2, 1., 0, "18:1"),
+            (0, 2, "static", 184.1, 1., 1, None),
+            (1, 0, "FA", 255.2, 2., 0, "16:0"),
+            (1, 2, "static", 141.0, 2., 1, None),
+            (2, 0, "FA", 281.2, 1., 0, "18:1"),
+            (3, 0, "FA", 255.2, 1., 0, "16:0"),
+            (3, 1, "FA", 281.2, 1., 0, "18:1"),
+            (3, 2, "FA", 279.2, 1., 0, "18:2"),
+            (4, 0, "FA", 283.2, 1., 0, "18:0"),
+            (4, 0, "FA NL", 502.3, 1.5, 0, "18:0"),
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            # lipid_id = annotation + 1, dia_pre_id = feature + 1, dia_frag_id = 10 * dia_pre_id + fragment
+            cur.executemany("INSERT INTO Lipids VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                            [(i + 1, f + 1, "", lipid, "[M+H]+", 1., None, None, chains, None, None)
+                             for i, (f, lipid, chains) in enumerate(anns)])
+            cur.executemany("INSERT INTO LipidFragments VALUES (?,?,?,?,?,?,?)",
+                            [(i + 1, 10 * (anns[i][0] + 1) + j, *rest) for i, j, *rest in frags])
+            _update_lipid_with_chain_info(cur)
+            expected_anns = sorted(cur.execute("SELECT dia_pre_id - 1, lipid, chains FROM Lipids").fetchall())
+            expected_frags = sorted(cur.execute("""
+                SELECT dia_pre_id - 1, lipid, dia_frag_id - 10 * dia_pre_id, frag_rule, rule_mz, ppm, diagnostic, supports_fa 
+                FROM LipidFragments JOIN Lipids USING(lipid_id)
+            """).fetchall())
+            # fragment annotations of the replaced annotations are removed as well
+            self.assertEqual(cur.execute("SELECT COUNT(*) FROM LipidFragments").fetchone()[0], len(expected_frags))
+            con.close()
+        annotations, fragments = _chain_level_annotations(
+            pl.DataFrame(anns, schema={"feature": pl.Int64, "lipid": pl.String, "chains": pl.String}, orient="row"),
+            pl.DataFrame(frags, schema=list(FRAGMENT_SCHEMA), orient="row")
+        )
+        self.assertListEqual(sorted(annotations.iter_rows()), expected_anns)
+        features, lipids = annotations["feature"].to_list(), annotations["lipid"].to_list()
+        self.assertListEqual(
+            sorted((features[i], lipids[i], *rest) for i, *rest in fragments.iter_rows()),
+            expected_frags
+        )
+        # supporting fragment annotations are only copied from the annotation that was replaced
+        self.assertEqual(len([_ for _ in expected_frags if _[1] == "PC 18:1_16:0"]), 2)
+
+
+class Test_FitObservedTrend(unittest.TestCase):
+    """ tests for the _fit_observed_trend function """
+
+    def test_recover_trend_params(self):
+        """ fit points generated from known trends, with and without a starting exponent """
+        mzs = np.linspace(500., 1000., 20)
+        for trend_params in [(0.6, 0.8, 100.), (2., 0.6, 50.), (12.2, 0.46, 10.8)]:
+            ccss = _fpow(mzs, *trend_params)
+            for b0 in [None, 0.5]:
+                fit_params, err = _fit_observed_trend(mzs, ccss, b0)
+                self.assertIsNone(err)
+                # the fit trend should reproduce the points
+                self.assertTrue(np.allclose(_fpow(mzs, *fit_params), ccss, rtol=1e-6))
+                # and the exponent should be within bounds
+                self.assertGreaterEqual(fit_params[1], 0.)
+                self.assertLessEqual(fit_params[1], 1.)
+
+    def test_bad_data(self):
+        """ fitting should fail and return the exception with too few or non-finite points """
+        for mzs, ccss in [([500., 600.], [200., 210.]), 
+                          ([500., 600., 700., 800.], [200., np.nan, 220., 230.])]:
+            fit_params, err = _fit_observed_trend(mzs, ccss)
+            self.assertIsNone(fit_params)
+            self.assertIsInstance(err, ValueError)
+
+
+class Test_TheoreticalFragments(unittest.TestCase):
+    """ tests for the _theoretical_fragments and _theoretical_fragment_mzs functions """
+
+    def test_matches_individual_rules(self):
+        """ theoretical fragment m/zs should be the same as computing them one rule at a time """
+        _, rules = load_rules("LMGP0101", "POS")
+        c_u_combos = [(18, 1), (16, 0)]
+        pre_mz = 760.5851
+        masses, neutral_loss, labels, diagnostic, supports_fa = _theoretical_fragments(rules, c_u_combos)
+        mzs = _theoretical_fragment_mzs(masses, neutral_loss, pre_mz)
+        i = 0
+        for rule in rules:
+            if rule.static:
+                self.assertAlmostEqual(mzs[i], rule.mz(pre_mz))
+                self.assertEqual(labels[i], rule.label())
+                self.assertIsNone(supports_fa[i])
+                i += 1
+            else:
+                for c, u in sorted(c_u_combos):
+                    self.assertAlmostEqual(mzs[i], rule.mz(pre_mz, c, u))
+                    self.assertEqual(labels[i], rule.label(c, u))
+                    self.assertEqual(supports_fa[i], f"{c}:{u}")
+                    self.assertEqual(diagnostic[i], int(rule.diagnostic))
+                    i += 1
+        self.assertEqual(i, len(mzs))
+
+
+class TestFragmentLibrary(unittest.TestCase):
+    """ tests for the FragmentLibrary class """
+
+    def _check_fragments(self, lib, key, c_u_combos):
+        """ fragments from the library should be the same as from _theoretical_fragments """
+        _, rules = load_rules(key[0], lib.ionization)
+        masses, neutral_loss, labels, diagnostic, supports_fa = _theoretical_fragments(rules, c_u_combos)
+        lmasses, lneutral_loss, label_idx, ldiagnostic, fa_idx = lib.fragments(key)
+        self.assertTrue(np.array_equal(masses, lmasses))
+        self.assertTrue(np.array_equal(neutral_loss, lneutral_loss))
+        self.assertListEqual(labels, [lib.labels[i] for i in label_idx])
+        self.assertTrue(np.array_equal(diagnostic, ldiagnostic))
+        self.assertListEqual(supports_fa, [None if i < 0 else lib.fas[i] for i in fa_idx])
+
+    def test_fragments_and_save_load(self):
+        """ generate fragments for a couple lipids, save and load the library """
+        lib = FragmentLibrary("POS", 12, 24, True)
+        self.assertEqual(len(lib), 0)
+        # PC 34:1 (2 chains) and LPC 18:1 (1 chain)
+        keys = [("LMGP0101", 2, 34, 1), ("LMGP0105", 1, 18, 1)]
+        combos = [
+            list(get_c_u_combos(2, 34, 1, 12, 24, True, max_u=SumCompLipidDB.max_u)),
+            [(18, 1)]
+        ]
+        for key, c_u_combos in zip(keys, combos):
+            self._check_fragments(lib, key, c_u_combos)
+        self.assertEqual(len(lib), 2)
+        self.assertTrue(lib.modified)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            libf = os.path.join(tmp_dir, "fraglib.npz")
+            lib.save(libf)
+            self.assertFalse(lib.modified)
+            loaded = FragmentLibrary.load(libf, "POS", 12, 24, True)
+            self.assertEqual(len(loaded), 2)
+            self.assertFalse(loaded.modified)
+            for key, c_u_combos in zip(keys, combos):
+                self.assertIn(key, loaded)
+                self._check_fragments(loaded, key, c_u_combos)
+            # a library with different parameters is not compatible
+            self.assertEqual(len(FragmentLibrary.load(libf, "POS", 14, 24, True)), 0)
+            self.assertEqual(len(FragmentLibrary.load(libf, "NEG", 12, 24, True)), 0)
+            # nonexistent file
+            self.assertEqual(len(FragmentLibrary.load(os.path.join(tmp_dir, "nope.npz"), "POS", 12, 24, True)), 0)
+
+    def test_subset(self):
+        """ a subset of the library only has the requested lipids and shares the lookup tables """
+        lib = FragmentLibrary("POS", 12, 24, True)
+        lib.fragments(("LMGP0101", 2, 34, 1))
+        sub = lib.subset([("LMGP0105", 1, 18, 1)])
+        self.assertEqual(len(sub), 1)
+        self.assertIn(("LMGP0105", 1, 18, 1), sub)
+        self.assertIn(("LMGP0105", 1, 18, 1), lib)
+        self.assertIs(sub.labels, lib.labels)
+
+
+class Test_MatchFragments(unittest.TestCase):
+    """ tests for the _match_fragments function """
+
+    def test_same_as_brute_force(self):
+        """ matches should be the same as comparing every pair of m/zs """
+        rng = np.random.default_rng(420)
+        rule_mzs = rng.uniform(100, 800, 200)
+        # some observed m/zs near the theoretical ones, plus some random ones
+        frag_mzs = np.concatenate([rule_mzs[:50] * (1 + rng.normal(0, 5e-5, 50)), rng.uniform(100, 800, 50)])
+        rng.shuffle(frag_mzs)
+        ppm = 40.
+        expected = [
+            (i, j) 
+            for i, rmz in enumerate(rule_mzs) 
+            for j, fmz in enumerate(frag_mzs) 
+            if abs(1e6 * (fmz - rmz) / rmz) <= ppm
+        ]
+        rule_idx, frag_idx, ppms = _match_fragments(rule_mzs, frag_mzs, ppm)
+        self.assertListEqual(list(zip(rule_idx.tolist(), frag_idx.tolist())), expected)
+        self.assertTrue(np.all(np.abs(ppms) <= ppm))
+
+    def test_no_fragments(self):
+        """ no observed fragments should give no matches """
+        rule_idx, frag_idx, ppms = _match_fragments(np.array([123.4, 234.5]), np.array([]), 40.)
+        self.assertEqual(len(rule_idx), 0)
+        self.assertEqual(len(frag_idx), 0)
+        self.assertEqual(len(ppms), 0)
+
 
 class TestUpdateLipidIDsWithFragRules(unittest.TestCase):
     """ tests for the update_lipid_ids_with_frag_rules function """
@@ -330,6 +854,51 @@ class TestUpdateLipidIDsWithFragRules(unittest.TestCase):
             update_lipid_ids_with_frag_rules("results db file doesnt exist", _ANNOTATION_PARAMS)
         
 
+class TestAnnotateFeatures(unittest.TestCase):
+    """ tests for the annotate_features function """
+
+    def test_same_as_results_db(self):
+        """ in-memory annotation of mock features gives the same annotations as the results DB steps """
+        mzs = np.tile(np.linspace(650., 950., 40), 3)
+        rts = np.repeat([5., 15., 25.], 40)
+        dfile_ids = np.repeat([1, 2, 3], 40)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            cur.executemany(
+                f"INSERT INTO DIAPrecursors VALUES ({("?," * 14).rstrip(",")});",
+                [(i, None, int(dfile_id), float(mz), float(rt), 0.1, 1e5, 20., 35., 2.5, 1e5, 10., None, 0)
+                 for i, (dfile_id, mz, rt) in enumerate(zip(dfile_ids, mzs, rts))]
+            )
+            cur.execute("INSERT INTO AnalysisLog VALUES (?,?,?)", (None, AnalysisStep.DIA_EXT.value, None))
+            con.commit()
+            annotate_lipids_sum_composition(dbf, _ANNOTATION_PARAMS)
+            filter_annotations_by_rt_range(dbf, _ANNOTATION_PARAMS)
+            expected = cur.execute(
+                "SELECT dia_pre_id, lipid, adduct, mz_ppm_err, chains, rt_pass FROM Lipids ORDER BY lipid_id"
+            ).fetchall()
+            con.close()
+        # no CCS or fragments, so only sum composition annotation and RT range filtering apply
+        for n_proc in [1, 4]:
+            annotations, fragments = annotate_features(mzs, rts, np.full(len(mzs), np.nan), [None] * len(mzs),
+                                                       _ANNOTATION_PARAMS, dfile_ids=dfile_ids, n_proc=n_proc)
+            self.assertListEqual(
+                list(annotations.select("feature", "lipid", "adduct", "mz_ppm_err", "chains", "rt_pass").iter_rows()),
+                expected
+            )
+            self.assertTrue(annotations["ccs_pass"].is_null().all())
+            self.assertEqual(fragments.height, 0)
+        # sum composition annotations are the first step
+        self.assertTrue(
+            annotate_sum_composition(mzs, _ANNOTATION_PARAMS).drop("chains").equals(
+                annotations.select("feature", "lmid_prefix", "lipid", "adduct", "mz_ppm_err", 
+                                   "sum_c", "sum_u", "n_chains")
+            )
+        )
+
+
 class TestAnnotateLipids(unittest.TestCase):
     """ tests for the annotate_lipids function """
 
@@ -339,6 +908,43 @@ class TestAnnotateLipids(unittest.TestCase):
                                msg="expect a FileNotFoundError from nonexistent database file"):
             annotate_lipids("results db file doesnt exist", _ANNOTATION_PARAMS)
 
+    def test_annotation_params_hash(self):
+        """ the params hash should ignore display_name but change with any other parameter """
+        params = AnnotationParams.load_default()
+        params.ionization = "POS"
+        h = annotation_params_hash(params)
+        self.assertEqual(annotation_params_hash(params), h)
+        params.display_name = "something else"
+        self.assertEqual(annotation_params_hash(params), h)
+        params.sum_comp.mz_ppm = params.sum_comp.mz_ppm + 1
+        self.assertNotEqual(annotation_params_hash(params), h)
+
+    def test_features_to_annotate(self):
+        """ incremental mode should only select new features, unless the params hash changed """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            qry = f"INSERT INTO DIAPrecursors VALUES ({("?," * 14).rstrip(",")});"
+            cur.executemany(qry, [(None, None, -1, 700., 15., 0.1, 1e5, 20., 35., 2.5, 1e5, 10., 250., 0)] * 3)
+            con.commit()
+            # nothing annotated yet -> everything gets annotated
+            self.assertIsNone(_features_to_annotate(dbf, "hash1"))
+            _record_annotated_features(dbf, "hash1", None)
+            self.assertEqual(_features_to_annotate(dbf, "hash1"), [])
+            cur.executemany(qry, [(None, None, -1, 800., 15., 0.1, 1e5, 20., 35., 2.5, 1e5, 10., 275., 0)] * 2)
+            con.commit()
+            self.assertEqual(_features_to_annotate(dbf, "hash1"), [4, 5])
+            _record_annotated_features(dbf, "hash1", [4])
+            self.assertEqual(_features_to_annotate(dbf, "hash1"), [5])
+            # different params -> everything gets annotated
+            self.assertIsNone(_features_to_annotate(dbf, "hash2"))
+            # removing annotations also clears the record of annotated features
+            remove_lipid_annotations(dbf)
+            self.assertEqual(cur.execute("SELECT COUNT(*) FROM LipidAnnotatedFeatures").fetchone(), (0,))
+            con.close()
+
 
 # group all of the tests from this module into a TestSuite
 _loader = unittest.TestLoader()
@@ -346,10 +952,19 @@ AllTestsAnnotation = unittest.TestSuite()
 AllTestsAnnotation.addTests([
     _loader.loadTestsFromTestCase(TestDefaultConfigs),
     _loader.loadTestsFromTestCase(TestSumCompLipidDB),
+    _loader.loadTestsFromTestCase(Test_PartitionDiaFeatures),
     _loader.loadTestsFromTestCase(TestRemoveLipidAnnotations),
     _loader.loadTestsFromTestCase(TestAnnotateLipidsSumComposition),
     _loader.loadTestsFromTestCase(TestFilterAnnotationsByRtRange),
+    _loader.loadTestsFromTestCase(TestRtRangePass),
     _loader.loadTestsFromTestCase(TestFilterAnnotationsByCcsSubclassTrend),
+    _loader.loadTestsFromTestCase(Test_UpdateLipidWithChainInfo),
+    _loader.loadTestsFromTestCase(Test_ChainLevelAnnotations),
+    _loader.loadTestsFromTestCase(Test_FitObservedTrend),
+    _loader.loadTestsFromTestCase(Test_TheoreticalFragments),
+    _loader.loadTestsFromTestCase(TestFragmentLibrary),
+    _loader.loadTestsFromTestCase(Test_MatchFragments),
+    _loader.loadTestsFromTestCase(TestAnnotateFeatures),
     _loader.loadTestsFromTestCase(TestAnnotateLipids)
 ])
 
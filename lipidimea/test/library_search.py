@@ -0,0 +1,272 @@
+"""
+lipidimea/test/library_search.py
+Dylan Ross (dylan.ross@pnnl.gov)
+
+    tests for the lipidimea/library_search.py module
+"""
+
+
+import os
+import unittest
+import tempfile
+import sqlite3
+
+import numpy as np
+
+from lipidimea.util import create_results_db, AnalysisStep
+from lipidimea.library_search import (
+    SpectralLibrary,
+    search_spectra,
+    search_library,
+    _binned_spectra,
+    _top_hits,
+)
+
+
+# small MSP library, with a few different formatting quirks
+_MSP = """\
+Name: PC 16:0_18:1
+PrecursorMZ: 760.5851
+Precursor_type: [M+H]+
+Num Peaks: 3
+184.0733 999
+496.3398 120
+522.3554 80
+
+NAME: PE 16:0_18:1
+PRECURSORMZ: 718.5381
+Num Peaks: 3
+577.5190 999; 255.2330 50;
+281.2486 40 "FA 18:1"
+Name: no peaks
+PrecursorMZ: 100.0
+Num Peaks: 0
+
+Name: no precursor m/z
+Num Peaks: 2
+100.0 10
+200.0 20
+"""
+
+
+def _mock_library():
+    """ mock library with 3 spectra, the first two share a peak """
+    return SpectralLibrary(
+        ["A", "B", "C"],
+        [500., 600., np.nan],
+        ["[M+H]+", "[M+H]+", None],
+        [0, 3, 5, 7],
+        [100., 200., 300., 100., 250., 400., 450.],
+        [10., 5., 1., 10., 10., 1., 1.]
+    )
+
+
+def _brute_force_scores(q_mzs, q_ints, lib, bin_width, similarity):
+    """ compute scores against each library spectrum one at a time with dense vectors """
+    n_bins = int(max(np.max(q_mzs), np.max(lib.mzs)) / bin_width) + 1
+    def dense(mzs, ints):
+        v = np.zeros(n_bins)
+        np.add.at(v, (np.asarray(mzs) / bin_width).astype(int), ints)
+        return np.sqrt(v) / np.linalg.norm(np.sqrt(v)) if similarity == "cosine" else v / v.sum()
+    def entropy(p):
+        p = p[p > 0]
+        return -np.sum(p * np.log(p))
+    q = dense(q_mzs, q_ints)
+    scores = []
+    for i in range(len(lib)):
+        s = dense(lib.mzs[lib.indptr[i]:lib.indptr[i + 1]], lib.ints[lib.indptr[i]:lib.indptr[i + 1]])
+        if similarity == "cosine":
+            scores.append(np.dot(q, s))
+        else:
+            scores.append(1 - (2 * entropy((q + s) / 2) - entropy(q) - entropy(s)) / np.log(4))
+    return np.array(scores)
+
+
+class TestSpectralLibrary(unittest.TestCase):
+    """ tests for the SpectralLibrary class """
+
+    def test_from_msp(self):
+        """ load a small MSP library """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mspf = os.path.join(tmp_dir, "lib.msp")
+            with open(mspf, "w") as f:
+                f.write(_MSP)
+            lib = SpectralLibrary.from_msp(mspf)
+        # entries without peaks are skipped
+        self.assertEqual(len(lib), 3)
+        self.assertListEqual(lib.names, ["PC 16:0_18:1", "PE 16:0_18:1", "no precursor m/z"])
+        self.assertListEqual(lib.adducts, ["[M+H]+", None, None])
+        self.assertTrue(np.allclose(lib.pre_mzs[:2], [760.5851, 718.5381]))
+        self.assertTrue(np.isnan(lib.pre_mzs[2]))
+        self.assertListEqual(lib.indptr.tolist(), [0, 3, 6, 8])
+        self.assertListEqual(lib.mzs[3:6].tolist(), [577.5190, 255.2330, 281.2486])
+        self.assertListEqual(lib.ints[3:6].tolist(), [999., 50., 40.])
+        self.assertListEqual(lib.spec_idx.tolist(), [0, 0, 0, 1, 1, 1, 2, 2])
+
+
+class Test_BinnedSpectra(unittest.TestCase):
+    """ tests for the _binned_spectra function """
+
+    def test_normalization(self):
+        """ peaks in the same bin are summed and spectra are normalized for each similarity metric """
+        spec_idx = np.array([0, 0, 0, 1])
+        mzs = np.array([100.001, 100.002, 200., 150.])
+        ints = np.array([1., 3., 4., 2.])
+        cos = _binned_spectra(spec_idx, mzs, ints, 3, 0.01, 30000, "cosine")
+        self.assertEqual(cos.shape, (3, 30000))
+        self.assertEqual(cos[0].nnz, 2)
+        self.assertAlmostEqual(cos[0].multiply(cos[0]).sum(), 1.)
+        self.assertAlmostEqual(cos[0, 10000], cos[0, 20000])
+        ent = _binned_spectra(spec_idx, mzs, ints, 3, 0.01, 30000, "entropy")
+        self.assertAlmostEqual(ent[0].sum(), 1.)
+        self.assertAlmostEqual(ent[1, 15000], 1.)
+        # spectra without peaks are empty
+        self.assertEqual(ent[2].nnz, 0)
+
+
+class Test_TopHits(unittest.TestCase):
+    """ tests for the _top_hits function """
+
+    def test_ranks(self):
+        """ hits are ranked by score within each query """
+        rows = np.array([1, 0, 1, 1, 0])
+        cols = np.array([0, 1, 1, 2, 2])
+        scores = np.array([0.5, 0.9, 0.8, 0.7, 0.95])
+        n_matched = np.array([1, 2, 3, 4, 5])
+        rows, ranks, cols, scores, n_matched = _top_hits(rows, cols, scores, n_matched, 2)
+        self.assertListEqual(rows.tolist(), [0, 0, 1, 1])
+        self.assertListEqual(ranks.tolist(), [1, 2, 1, 2])
+        self.assertListEqual(cols.tolist(), [2, 1, 1, 2])
+        self.assertListEqual(n_matched.tolist(), [5, 2, 3, 4])
+
+
+class TestSearchSpectra(unittest.TestCase):
+    """ tests for the search_spectra function """
+
+    def test_same_as_brute_force(self):
+        """ scores for all query/library pairs are the same as scoring one pair at a time """
+        lib = _mock_library()
+        q_mzs = np.array([100.001, 200.002, 250., 333.])
+        q_ints = np.array([8., 6., 2., 1.])
+        for similarity in ["cosine", "entropy"]:
+            hits = search_spectra([550.], np.zeros(4), q_mzs, q_ints, lib, similarity=similarity,
+                                  bin_width=0.01, min_score=0., top_k=10)
+            expected = _brute_force_scores(q_mzs, q_ints, lib, 0.01, similarity)
+            # only library spectra sharing at least one bin are hits
+            self.assertListEqual(sorted(hits["lib_idx"].to_list()), [0, 1])
+            for lib_idx, score in hits.select("lib_idx", "score").iter_rows():
+                self.assertAlmostEqual(score, expected[lib_idx])
+            self.assertListEqual(hits["hit_rank"].to_list(), [1, 2])
+
+    def test_identical_spectra_and_filters(self):
+        """ library spectra searched against themselves, with top k, precursor m/z and chunking """
+        lib = _mock_library()
+        for similarity in ["cosine", "entropy"]:
+            for chunk_size in [1, 2, 10]:
+                hits = search_spectra(lib.pre_mzs, lib.spec_idx, lib.mzs, lib.ints, lib,
+                                      similarity=similarity, top_k=1, min_score=0., chunk_size=chunk_size)
+                self.assertListEqual(hits["query"].to_list(), [0, 1, 2])
+                self.assertListEqual(hits["lib_idx"].to_list(), [0, 1, 2])
+                self.assertTrue(np.allclose(hits["score"].to_numpy(), 1.))
+                self.assertListEqual(hits["n_matched"].to_list(), [3, 2, 2])
+            # precursor m/z tolerance excludes library spectra without precursor m/z
+            hits = search_spectra(lib.pre_mzs, lib.spec_idx, lib.mzs, lib.ints, lib,
+                                  similarity=similarity, mz_ppm=20., min_score=0.)
+            self.assertListEqual(list(hits.select("query", "lib_idx").iter_rows()), [(0, 0), (1, 1)])
+            # minimum number of matched bins
+            hits = search_spectra(lib.pre_mzs, lib.spec_idx, lib.mzs, lib.ints, lib,
+                                  similarity=similarity, min_matched=3, min_score=0.)
+            self.assertListEqual(list(hits.select("query", "lib_idx").iter_rows()), [(0, 0)])
+
+    def test_bad_similarity(self):
+        """ unrecognized similarity metric should raise a ValueError """
+        with self.assertRaises(ValueError):
+            _ = search_spectra([], [], [], [], _mock_library(), similarity="dot")
+
+
+class TestSearchLibrary(unittest.TestCase):
+    """ tests for the search_library function """
+
+    def test_results_db_file_does_not_exist(self):
+        """ should raise an error if the results database file does not exist """
+        with self.assertRaises(FileNotFoundError):
+            _ = search_library("results db file doesnt exist", _mock_library())
+
+    def test_mock_features(self):
+        """ search mock DDA and DIA features, repeated searches replace the hits """
+        lib = _mock_library()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            cur.executemany("INSERT INTO DDAPrecursors VALUES (?,?,?,?,?,?,?,?,?)",
+                            [(11, 1, 500., 10., 0.1, 1e5, 10., None, None),
+                             (12, 1, 700., 10., 0.1, 1e5, 10., None, None)])
+            cur.executemany("INSERT INTO DDAFragments VALUES (?,?,?,?)",
+                            [(None, 11, 100., 10.), (None, 11, 200., 5.), (None, 11, 300., 1.),
+                             (None, 12, 900., 1.)])
+            cur.executemany("INSERT INTO DIAPrecursors VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                            [(21, 11, 2, 600., 10., 0.1, 1e5, 10., 20., 1., 1e5, 10., None, None)])
+            cur.executemany("INSERT INTO DIAFragments VALUES (?,?,?,?,?,?,?)",
+                            [(None, 21, 100., 10., 0, None, None), (None, 21, 250., 10., 0, None, None)])
+            cur.executemany("INSERT INTO AnalysisLog VALUES (?,?,?)",
+                            [(None, AnalysisStep.DDA_EXT.value, None), (None, AnalysisStep.DIA_EXT.value, None)])
+            con.commit()
+            for _ in range(2):
+                self.assertDictEqual(search_library(dbf, lib, top_k=1), {"DDA": (1, 1), "DIA": (1, 1)})
+                self.assertListEqual(
+                    cur.execute("SELECT pre_id_type, pre_id, hit_rank, lib_name, lib_adduct, lib_mz, similarity "
+                                "FROM LibraryHits ORDER BY pre_id").fetchall(),
+                    [("dda_pre_id", 11, 1, "A", "[M+H]+", 500., "cosine"),
+                     ("dia_pre_id", 21, 1, "B", "[M+H]+", 600., "cosine")]
+                )
+            # only search DIA spectra
+            self.assertDictEqual(search_library(dbf, lib, sources=["DIA"], similarity="entropy", top_k=5),
+                                 {"DIA": (1, 2)})
+            self.assertListEqual(
+                cur.execute("SELECT pre_id_type, lib_name, similarity FROM LibraryHits "
+                            "ORDER BY pre_id_type, hit_rank").fetchall(),
+                [("dda_pre_id", "A", "cosine"), ("dia_pre_id", "B", "entropy"), ("dia_pre_id", "A", "entropy")]
+            )
+            con.close()
+
+    def test_dia_only(self):
+        """ by default only the sources with extracted features are searched """
+        lib = _mock_library()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)
+            # no features extracted yet
+            with self.assertRaises(RuntimeError):
+                _ = search_library(dbf, lib)
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            cur.executemany("INSERT INTO DIAPrecursors VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                            [(21, None, 2, 600., 10., 0.1, 1e5, 10., 20., 1., 1e5, 10., None, None)])
+            cur.executemany("INSERT INTO DIAFragments VALUES (?,?,?,?,?,?,?)",
+                            [(None, 21, 100., 10., 0, None, None), (None, 21, 250., 10., 0, None, None)])
+            cur.execute("INSERT INTO AnalysisLog VALUES (?,?,?)", (None, AnalysisStep.DIA_EXT.value, None))
+            con.commit()
+            con.close()
+            self.assertDictEqual(search_library(dbf, lib, top_k=1), {"DIA": (1, 1)})
+            # explicitly requesting DDA spectra still requires DDA extraction
+            with self.assertRaises(RuntimeError):
+                _ = search_library(dbf, lib, sources=["DDA"])
+
+
+# collect all of the tests from this module
+_loader = unittest.TestLoader()
+AllTestsLibrarySearch = unittest.TestSuite()
+AllTestsLibrarySearch.addTests([
+    _loader.loadTestsFromTestCase(TestSpectralLibrary),
+    _loader.loadTestsFromTestCase(Test_BinnedSpectra),
+    _loader.loadTestsFromTestCase(Test_TopHits),
+    _loader.loadTestsFromTestCase(TestSearchSpectra),
+    _loader.loadTestsFromTestCase(TestSearchLibrary),
+])
+
+
+if __name__ == "__main__":
+    # run all defined TestCases
+    unittest.TextTestRunner(verbosity=2).run(AllTestsLibrarySearch)
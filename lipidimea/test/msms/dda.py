@@ -377,6 +377,28 @@ class TestExtractDdaFeatures(unittest.TestCase):
             self.assertEqual(n, 2,
                              msg="should have gotten 2 for number of features extracted")
 
+    def test_stale_raw_downsampled(self):
+        """ downsampled raw data left over from deleted raw data gets dropped """
+        with TemporaryDirectory() as tmp_dir, patch('lipidimea.msms.dda.MsmsReaderDda') as MockReader:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)  # STRICT!
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            # raw data 2 was deleted (e.g. using the GUI) but its downsampled version was not
+            cur.execute("INSERT INTO Raw VALUES (?,?,?,?,?,?)", 
+                        (1, "DIA_PRE_XIC", "dia_pre_id", 1, 2, np.zeros(4).tobytes()))
+            cur.executemany("INSERT INTO RawDownsampled VALUES (?,?,?)", 
+                            [(1, 1, np.zeros(2).tobytes()), (2, 1, np.zeros(2).tobytes())])
+            con.commit()
+            # mock a reader without any precursors
+            rdr = MockReader.return_value
+            type(rdr).f = PropertyMock(return_value="data.file")
+            rdr.get_pre_mzs.return_value = set()
+            n = extract_dda_features("data.file", dbf, _DDA_PARAMS, cache_ms1=False)
+            self.assertEqual(n, 0)
+            self.assertListEqual(cur.execute("SELECT raw_id FROM RawDownsampled").fetchall(), [(1,)])
+            con.close()
+
 
 # NOTE (Dylan Ross): removed the unit test for extract_dda_features_multiproc as mocking does 
 #                    not work well with multiprocessing. The actual business logic function is 
@@ -0,0 +1,246 @@
+"""
+lipidimea/test/results.py
+Dylan Ross (dylan.ross@pnnl.gov)
+
+    tests for the lipidimea/results.py module
+"""
+
+
+import os
+import unittest
+import tempfile
+import sqlite3
+
+import numpy as np
+import polars as pl
+
+from lipidimea.util import create_results_db, refresh_summary_tables, align_dia_features
+from lipidimea.results import ResultsReader, downsample_trace, build_raw_downsampled
+
+
+def _mock_results_db(dbf):
+    """ results database with a few DIA features, annotations, and raw data """
+    create_results_db(dbf)
+    con = sqlite3.connect(dbf)
+    cur = con.cursor()
+    cur.executemany("INSERT INTO DataFiles VALUES (?,?,?,?,?)",
+                    [(None, "DIA", "a.mza", None, None), (None, "DIA", "b.mza", None, None)])
+    cur.executemany("INSERT INTO DIAPrecursors VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                    [(i, None, 1 + i % 2, 500. + 100 * i, 10., 0.1, 1e5, 10., 20., 1., 1e5, 10., None, 2)
+                     for i in range(1, 5)])
+    cur.executemany("INSERT INTO DIAFragments VALUES (?,?,?,?,?,?,?)",
+                    [(None, i, fmz, 10., 0, None, None) for i in range(1, 5) for fmz in [300., 100.]])
+    cur.executemany("INSERT INTO Lipids (dia_pre_id, lmid_prefix, lipid, adduct, mz_ppm_err, rt_pass) "
+                    "VALUES (?,?,?,?,?,?)",
+                    [(2, "LMGP0101", "PC 34:1", "[M+H]+", 1., 1), (2, "LMGP0201", "PE 37:1", "[M+H]+", 2., 0)])
+    for i in range(1, 5):
+        for raw_type, n in [("DIA_PRE_XIC", i + 2), ("DIA_PRE_ATD", 3)]:
+            arr = np.arange(2 * n, dtype=np.float64).reshape((2, n)) * i
+            cur.execute("INSERT INTO Raw VALUES (?,?,?,?,?,?)", (None, raw_type, "dia_pre_id", i, n, arr.tobytes()))
+    con.commit()
+    con.close()
+
+
+class TestResultsReader(unittest.TestCase):
+    """ tests for the ResultsReader class """
+
+    def test_results_db_file_does_not_exist(self):
+        """ should raise an error if the results database file does not exist """
+        with self.assertRaises(FileNotFoundError):
+            _ = ResultsReader("results db file doesnt exist")
+
+    def test_mock_results(self):
+        """ select features, annotations, and raw data from a mock results database """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            _mock_results_db(dbf)
+            # small batches, to make sure they get put together
+            with ResultsReader(dbf, batch_size=3) as rdr:
+                self.assertListEqual(rdr.data_files()["dfile_name"].to_list(), ["a.mza", "b.mza"])
+                pre = rdr.precursors()
+                self.assertEqual(pre.shape, (4, 14))
+                self.assertEqual(pre.schema["dda_pre_id"], pl.Int64)
+                self.assertEqual(pre.schema["ccs"], pl.Float64)
+                pre = rdr.precursors(dfile_ids=[2], mz_range=(0., 800.), columns=["dia_pre_id", "mz"])
+                self.assertListEqual(pre.rows(), [(1, 600.), (3, 800.)])
+                self.assertListEqual(rdr.precursors(pre_ids=np.array([4, 2]))["dia_pre_id"].to_list(), [2, 4])
+                frags = rdr.fragments(pre_ids=pre["dia_pre_id"], columns=["dia_pre_id", "fmz"])
+                self.assertListEqual(frags.rows(), [(1, 100.), (1, 300.), (3, 100.), (3, 300.)])
+                self.assertEqual(rdr.fragments(source="DDA").shape, (0, 4))
+                self.assertListEqual(rdr.annotations()["lipid"].to_list(), ["PC 34:1"])
+                self.assertListEqual(rdr.annotations(pre_ids=[2], filtered=False)["lipid"].to_list(),
+                                     ["PC 34:1", "PE 37:1"])
+                self.assertEqual(rdr.annotations(pre_ids=[]).shape[0], 0)
+                raw = rdr.raw_arrays([3, 1], raw_types=["DIA_PRE_XIC"])
+                self.assertListEqual(raw.info.columns, ["raw_id", "raw_type", "feat_id_type", "feat_id", "raw_n"])
+                self.assertListEqual(raw.info["feat_id"].to_list(), [1, 3])
+                for i, arr in zip([1, 3], raw):
+                    self.assertTrue(np.array_equal(arr, np.arange(2 * (i + 2)).reshape((2, i + 2)) * i))
+                raw = rdr.raw_arrays()
+                self.assertEqual(len(raw), 8)
+                self.assertListEqual(raw.lengths.tolist(), raw.info["raw_n"].to_list())
+                self.assertEqual(rdr.raw_arrays(feat_id_type="dia_frag_id").data.size, 0)
+
+    def test_annotations_without_filtered_view(self):
+        """ results databases from before the FilteredLipids view was added have only the filtered annotations """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            _mock_results_db(dbf)
+            con = sqlite3.connect(dbf)
+            con.execute("DROP VIEW FilteredLipids")
+            con.execute("DELETE FROM Lipids WHERE rt_pass=0")
+            con.commit()
+            con.close()
+            with ResultsReader(dbf) as rdr:
+                self.assertListEqual(rdr.annotations()["lipid"].to_list(), ["PC 34:1"])
+                self.assertListEqual(rdr.annotations(filtered=False)["lipid"].to_list(), ["PC 34:1"])
+
+    def test_summaries(self):
+        """ select from the summary tables """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            _mock_results_db(dbf)
+            refresh_summary_tables(dbf)
+            with ResultsReader(dbf) as rdr:
+                self.assertListEqual(rdr.file_summary().rows(), [(1, 0, 2, 4, 0, 1, 1), (2, 0, 2, 4, 0, 0, 0)])
+                frags = rdr.fragment_summary(dfile_ids=[2], columns=["dia_pre_id", "n_fragments", "max_fint"])
+                self.assertListEqual(frags.rows(), [(1, 2, 10.), (3, 2, 10.)])
+                anns = rdr.annotation_summary(pre_ids=[1, 2])
+                self.assertListEqual(anns.rows(), [(2, 1, 2, 1, "PC 34:1@[M+H]+")])
+                self.assertEqual(rdr.annotation_summary(dfile_ids=[2]).shape[0], 0)
+            # results database from before the summary tables were added
+            con = sqlite3.connect(dbf)
+            con.execute("DROP TABLE DataFileSummary")
+            con.close()
+            with ResultsReader(dbf) as rdr, self.assertRaises(RuntimeError):
+                _ = rdr.file_summary()
+
+    def test_alignments(self):
+        """ select from a stored alignment """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            _mock_results_db(dbf)
+            align_id = align_dia_features(dbf, (0.025, 0.25, 2.5))
+            with ResultsReader(dbf) as rdr:
+                self.assertListEqual(rdr.alignments().select("align_id", "n_precursors", "n_features").rows(),
+                                     [(align_id, 1, 1)])
+                feats = rdr.aligned_features(align_id, columns=["afeat_id", "n_members", "mz"])
+                self.assertListEqual(feats.rows(), [(0, 1, 700.)])
+                members = rdr.aligned_members(align_id, afeat_ids=[0], columns=["afeat_id", "dia_pre_id"])
+                self.assertListEqual(members.rows(), [(0, 2)])
+                self.assertEqual(rdr.aligned_members(align_id, afeat_ids=[1]).shape[0], 0)
+
+
+class TestRawArrays(unittest.TestCase):
+    """ tests for the RawArrays class """
+
+    def test_views(self):
+        """ arrays are views into the contiguous buffer and can be looked up by feature """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            _mock_results_db(dbf)
+            with ResultsReader(dbf, batch_size=3) as rdr:
+                raw = rdr.raw_arrays()
+        self.assertEqual(raw.data.size, 2 * sum(i + 2 + 3 for i in range(1, 5)))
+        for i, arr in enumerate(raw):
+            self.assertTrue(np.shares_memory(arr, raw.data))
+            self.assertEqual(arr.shape, (2, raw.info["raw_n"][i]))
+        self.assertTrue(np.array_equal(raw[-1], raw[len(raw) - 1]))
+        with self.assertRaises(IndexError):
+            _ = raw[len(raw)]
+        self.assertTrue(np.array_equal(raw.get(2, "DIA_PRE_ATD"), np.arange(6).reshape((2, 3)) * 2))
+        self.assertIsNone(raw.get(2, "DIA_FRAG_XIC"))
+
+    def test_bad_source(self):
+        """ unrecognized source should raise a ValueError """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)
+            with ResultsReader(dbf) as rdr, self.assertRaises(ValueError):
+                _ = rdr.precursors(source="MS1")
+
+
+class TestDownsampleTrace(unittest.TestCase):
+    """ tests for the downsample_trace function """
+
+    def _trace(self, n):
+        """ noisy trace with a couple of peaks """
+        x = np.linspace(0, 10, n)
+        y = np.exp(-(x - 3) ** 2 / 0.01) * 1e5 + np.exp(-(x - 7) ** 2) * 1e4 
+        y += np.random.default_rng(420).random(n) * 100
+        return np.array([x, y])
+
+    def test_point_budget(self):
+        """ downsampled traces are a subset of the points, with at most n_out points """
+        trace = self._trace(10001)
+        for method in ["minmax", "lttb"]:
+            for n_out in [4, 5, 100, 1001]:
+                ds = downsample_trace(trace, n_out, method=method)
+                self.assertLessEqual(ds.shape[1], n_out)
+                self.assertGreater(ds.shape[1], n_out // 2)
+                # points in order, first and last points are kept
+                idx = np.searchsorted(trace[0], ds[0])
+                self.assertTrue(np.all(np.diff(idx) > 0))
+                self.assertTrue(np.array_equal(trace[:, idx], ds))
+                self.assertListEqual(idx[[0, -1]].tolist(), [0, 10000])
+            # short traces are returned as-is
+            short = trace[:, :50]
+            self.assertIs(downsample_trace(short, 100, method=method), short)
+
+    def test_minmax_keeps_extremes(self):
+        """ min/max decimation keeps the max and min values """
+        trace = self._trace(10000)
+        ds = downsample_trace(trace, 64)
+        self.assertEqual(ds[1].max(), trace[1].max())
+        self.assertEqual(ds[1].min(), trace[1].min())
+
+    def test_bad_params(self):
+        """ unrecognized method or too small n_out should raise a ValueError """
+        with self.assertRaises(ValueError):
+            _ = downsample_trace(self._trace(100), 10, method="mean")
+        with self.assertRaises(ValueError):
+            _ = downsample_trace(self._trace(100), 3)
+
+
+class TestBuildRawDownsampled(unittest.TestCase):
+    """ tests for the build_raw_downsampled function and loading downsampled raw data """
+
+    def test_mock_results(self):
+        """ store downsampled raw data and load raw data with a point budget """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            _mock_results_db(dbf)
+            # raw data has 3 to 6 points
+            self.assertEqual(build_raw_downsampled(dbf, levels=[4, 5], raw_types=["DIA_PRE_XIC"]), 2)
+            self.assertEqual(build_raw_downsampled(dbf, levels=[4, 5], raw_types=["DIA_PRE_XIC"]), 0)
+            con = sqlite3.connect(dbf)
+            self.assertListEqual(
+                con.execute("SELECT raw_id, raw_n FROM RawDownsampled ORDER BY raw_id, raw_n").fetchall(),
+                [(5, 4), (7, 4)]
+            )
+            con.close()
+            self.assertEqual(build_raw_downsampled(dbf, levels=[4], overwrite=True), 2)
+            with ResultsReader(dbf) as rdr:
+                full = rdr.raw_arrays(raw_types=["DIA_PRE_XIC"])
+                for max_points, lengths in [(100, [3, 4, 5, 6]), (5, [3, 4, 5, 4]), (4, [3, 4, 4, 4])]:
+                    raw = rdr.raw_arrays(raw_types=["DIA_PRE_XIC"], max_points=max_points)
+                    self.assertListEqual(raw.lengths.tolist(), lengths)
+                    self.assertListEqual(raw.info["raw_n"].to_list(), lengths)
+                    for arr, full_arr in zip(raw, full):
+                        self.assertTrue(np.isin(arr[0], full_arr[0]).all())
+
+
+# collect all of the tests from this module
+_loader = unittest.TestLoader()
+AllTestsResults = unittest.TestSuite()
+AllTestsResults.addTests([
+    _loader.loadTestsFromTestCase(TestResultsReader),
+    _loader.loadTestsFromTestCase(TestRawArrays),
+    _loader.loadTestsFromTestCase(TestDownsampleTrace),
+    _loader.loadTestsFromTestCase(TestBuildRawDownsampled),
+])
+
+
+if __name__ == "__main__":
+    # run all defined TestCases
+    unittest.TextTestRunner(verbosity=2).run(AllTestsResults)
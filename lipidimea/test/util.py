@@ -12,11 +12,40 @@ import os
 import io
 import contextlib
 import sqlite3
+import threading
+import time
+from unittest import mock
+
+import numpy as np
+import polars as pl
 
 from lipidimea.util import (
     _RESULTS_DB_SCHEMA,
     create_results_db,
-    debug_handler
+    RESULTS_DB_PRAGMAS,
+    connect_results_db,
+    results_db_lock_stats,
+    RESULTS_DB_SCHEMA_VERSION,
+    RESULTS_DB_INDEXES,
+    _create_results_db_indexes,
+    _upgrade_results_db_schema,
+    upgrade_results_db,
+    _update_summary_tables,
+    refresh_summary_tables,
+    _connect_results_db_shard,
+    merge_results_db_shards,
+    AnalysisStep,
+    update_analysis_log,
+    debug_handler,
+    _precursor_match,
+    _align_precursors,
+    _fetch_dia_precursors,
+    _stored_alignment,
+    _results_table_schema,
+    ResultsTableWriter,
+    read_results_table,
+    align_dia_features,
+    export_results_table
 )
 
 
@@ -95,6 +124,453 @@ class TestCreateResultsDb(unittest.TestCase):
             con.execute("INSERT INTO DDAFragments VALUES (?,?,?,?);", (None, "are", "bad", "types"))
                 
 
+class TestConnectResultsDb(unittest.TestCase):
+    """ tests for the connect_results_db function """
+
+    def test_profiles(self):
+        """ PRAGMA settings from each profile, with overrides """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)
+            for profile in ["read", "write"]:
+                con = connect_results_db(dbf, profile=profile, pragmas={"cache_size": -1000})  # type: ignore
+                self.assertEqual(con.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+                self.assertEqual(con.execute("PRAGMA mmap_size").fetchone()[0], 
+                                 RESULTS_DB_PRAGMAS[profile]["mmap_size"])
+                self.assertEqual(con.execute("PRAGMA cache_size").fetchone()[0], -1000)
+                con.close()
+            with self.assertRaises(ValueError):
+                _ = connect_results_db(dbf, profile="append")  # type: ignore
+
+    def test_read_profile_journal_mode(self):
+        """ read connections do not change the journal mode of the database """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            other = sqlite3.connect(dbf)
+            other.execute("CREATE TABLE T (x INTEGER)")
+            other.close()
+            con = connect_results_db(dbf, profile="read")
+            self.assertEqual(con.execute("SELECT COUNT(*) FROM T").fetchone()[0], 0)
+            self.assertEqual(con.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+            con.close()
+            self.assertListEqual(os.listdir(tmp_dir), ["results.db"])
+
+    def test_lock_wait(self):
+        """ wait while another connection has the database locked, and time out """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)
+            locked = threading.Event()
+            def hold_lock(seconds):
+                other = sqlite3.connect(dbf)
+                other.execute("BEGIN IMMEDIATE")
+                locked.set()
+                time.sleep(seconds)
+                other.commit()
+                other.close()
+            results_db_lock_stats(reset=True)
+            con = connect_results_db(dbf, timeout=0.5)
+            thread = threading.Thread(target=hold_lock, args=(0.2,))
+            thread.start()
+            locked.wait()
+            con.execute("INSERT INTO AnalysisLog VALUES (?,?,?)", (None, "step", None))
+            con.commit()
+            thread.join()
+            self.assertEqual(con.lock_waits, 1)
+            self.assertGreater(con.lock_wait_time, 0.1)
+            locked.clear()
+            thread = threading.Thread(target=hold_lock, args=(1.,))
+            thread.start()
+            locked.wait()
+            with self.assertRaises(sqlite3.OperationalError):
+                con.executemany("INSERT INTO AnalysisLog VALUES (?,?,?)", ((None, "step", None) for _ in range(2)))
+            thread.join()
+            stats = results_db_lock_stats(reset=True)
+            self.assertEqual((stats["waits"], stats["timeouts"]), (2, 1))
+            self.assertEqual(results_db_lock_stats()["waits"], 0)
+            con.close()
+
+    def test_lock_not_cleared_by_waiting(self):
+        """ do not wait on locks that cannot clear, like writing from a stale read transaction """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)
+            results_db_lock_stats(reset=True)
+            con = connect_results_db(dbf, timeout=5.)
+            con.execute("BEGIN")
+            _ = con.execute("SELECT COUNT(*) FROM AnalysisLog").fetchone()
+            other = sqlite3.connect(dbf)
+            other.execute("INSERT INTO AnalysisLog VALUES (?,?,?)", (None, "other", None))
+            other.commit()
+            other.close()
+            start = time.perf_counter()
+            with self.assertRaises(sqlite3.OperationalError):
+                con.execute("INSERT INTO AnalysisLog VALUES (?,?,?)", (None, "step", None))
+            self.assertLess(time.perf_counter() - start, 1.)
+            stats = results_db_lock_stats(reset=True)
+            self.assertEqual((stats["waits"], stats["timeouts"]), (1, 0))
+            con.rollback()
+            # the busy timeout only applies while waiting on a lock
+            self.assertEqual(con.execute("PRAGMA busy_timeout").fetchone()[0], 0)
+            con.close()
+
+    def test_executemany_batches(self):
+        """ parameters from a generator are inserted in batches, retrying while the database is locked """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)
+            locked = threading.Event()
+            def hold_lock():
+                other = sqlite3.connect(dbf)
+                other.execute("BEGIN IMMEDIATE")
+                locked.set()
+                time.sleep(0.2)
+                other.commit()
+                other.close()
+            con = connect_results_db(dbf, timeout=5.)
+            thread = threading.Thread(target=hold_lock)
+            thread.start()
+            locked.wait()
+            with mock.patch("lipidimea.util._EXECUTEMANY_BATCH_SIZE", 3):
+                con.executemany("INSERT INTO AnalysisLog VALUES (?,?,?)", 
+                                ((None, f"step{i}", None) for i in range(10)))
+            con.commit()
+            thread.join()
+            self.assertEqual(con.lock_waits, 1)
+            self.assertListEqual([_ for _, in con.execute("SELECT step FROM AnalysisLog ORDER BY n")], 
+                                 [f"step{i}" for i in range(10)])
+            con.close()
+
+
+class TestUpgradeResultsDb(unittest.TestCase):
+    """ tests for the upgrade_results_db function """
+
+    def _downgrade(self, dbf):
+        """ remove the parts of the schema added after the schema was versioned """
+        con = sqlite3.connect(dbf)
+        con.executescript("""
+            DROP VIEW FilteredLipids;
+            DROP TABLE LipidAnnotatedFeatures;
+            DROP TABLE LibraryHits;
+            DROP TABLE RawDownsampled;
+            DROP TABLE DataFileSummary;
+            DROP TABLE DIAFragmentSummary;
+            DROP TABLE DIAAnnotationSummary;
+            DROP TABLE Alignments;
+            DROP TABLE AlignedFeatures;
+            DROP TABLE AlignedFeatureMembers;
+            ALTER TABLE Lipids DROP COLUMN rt_pass;
+            ALTER TABLE Lipids DROP COLUMN ccs_pass;
+            PRAGMA user_version = 0;
+        """)
+        con.close()
+
+    def _schema(self, dbf):
+        """ names of tables, views, and indexes and the columns of the Lipids table """
+        con = sqlite3.connect(dbf)
+        names = {name for name, in con.execute("SELECT name FROM sqlite_master")}
+        lipids_cols = [row[1] for row in con.execute("PRAGMA table_info(Lipids)")]
+        version, = con.execute("PRAGMA user_version").fetchone()
+        con.close()
+        return names, lipids_cols, version
+
+    def test_results_db_file_does_not_exist(self):
+        """ should raise an error if the results database file does not exist """
+        with self.assertRaises(FileNotFoundError):
+            _ = upgrade_results_db("results db file doesnt exist")
+
+    def test_upgrade_old_db(self):
+        """ upgrading an old results database gives the same schema as a new one, plus indexes """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)
+            names, lipids_cols, version = self._schema(dbf)
+            self.assertEqual(version, RESULTS_DB_SCHEMA_VERSION)
+            # no indexes in a new database
+            self.assertTrue(names.isdisjoint(RESULTS_DB_INDEXES))
+            self._downgrade(dbf)
+            self.assertEqual(upgrade_results_db(dbf, create_indexes=False), (0, RESULTS_DB_SCHEMA_VERSION))
+            self.assertEqual(self._schema(dbf), (names, lipids_cols, version))
+            # upgrading again does nothing, but creates the indexes
+            self.assertEqual(upgrade_results_db(dbf), (RESULTS_DB_SCHEMA_VERSION, RESULTS_DB_SCHEMA_VERSION))
+            self.assertTrue(set(RESULTS_DB_INDEXES).issubset(self._schema(dbf)[0]))
+
+    def test_partially_upgraded_db(self):
+        """ migrations can be applied to databases that already include some of the changes """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)
+            expected = self._schema(dbf)
+            con = sqlite3.connect(dbf)
+            con.execute("PRAGMA user_version = 0")
+            con.close()
+            self.assertEqual(upgrade_results_db(dbf, create_indexes=False), (0, RESULTS_DB_SCHEMA_VERSION))
+            self.assertEqual(self._schema(dbf), expected)
+
+    def test_newer_db(self):
+        """ should raise an error if the results database has a newer schema version """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)
+            con = sqlite3.connect(dbf)
+            con.execute(f"PRAGMA user_version = {RESULTS_DB_SCHEMA_VERSION + 1}")
+            with self.assertRaises(RuntimeError):
+                _ = _upgrade_results_db_schema(con.cursor())
+            # the connection belongs to the caller, it does not get closed
+            self.assertEqual(con.execute("PRAGMA user_version").fetchone()[0], RESULTS_DB_SCHEMA_VERSION + 1)
+            con.close()
+            with self.assertRaises(RuntimeError):
+                _ = upgrade_results_db(dbf)
+
+    def test_create_indexes_for_tables(self):
+        """ only create indexes on the specified tables, and only once """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            create_results_db(dbf)
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            self.assertListEqual(_create_results_db_indexes(cur, ["DIAFragments"]), ["DIAFragments_dia_pre_id_idx"])
+            self.assertListEqual(_create_results_db_indexes(cur, ["DIAFragments"]), [])
+            self.assertEqual(len(_create_results_db_indexes(cur)), len(RESULTS_DB_INDEXES) - 1)
+            plan = cur.execute("EXPLAIN QUERY PLAN SELECT fmz, fint FROM DIAFragments WHERE dia_pre_id=1").fetchall()
+            self.assertIn("COVERING INDEX DIAFragments_dia_pre_id_idx", plan[0][-1])
+            con.close()
+
+
+class TestSummaryTables(unittest.TestCase):
+    """ tests for the _update_summary_tables and refresh_summary_tables functions """
+
+    def _mock_results_db(self, dbf):
+        """ 
+        mock results database with DDA precursors and DIA precursors from 2 data files, with 
+        fragments and annotations (the first DIA precursor has no fragments or annotations)
+        """
+        create_results_db(dbf)
+        con = sqlite3.connect(dbf)
+        cur = con.cursor()
+        cur.executemany("INSERT INTO DataFiles VALUES (?,?,?,?,?)",
+                        [(None, "DIA", f"{name}.mza", None, None) for name in "ab"])
+        cur.executemany("INSERT INTO DDAPrecursors VALUES (?,?,?,?,?,?,?,?,?)",
+                        [(None, 1, 500., 10., 0.1, 1e5, 10., None, None) for _ in range(3)])
+        self._add_dia_precursors(cur, [1, 1, 2])
+        # the third annotation is filtered out
+        cur.executemany("INSERT INTO Lipids VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                        [(None, dia_pre_id, "LMGP0101", lipid, "[M+H]+", 1., None, None, None, rt_pass, None)
+                         for dia_pre_id, lipid, rt_pass in [(2, "PC 34:1", 1), (2, "PC 33:1", None), 
+                                                            (3, "PE 36:2", 0)]])
+        con.commit()
+        return con
+
+    def _add_dia_precursors(self, cur, dfile_ids):
+        """ add mock DIA precursors with fragments, all except the first one get 2 fragments """
+        for i, dfile_id in enumerate(dfile_ids):
+            cur.execute("INSERT INTO DIAPrecursors VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                        (None, None, dfile_id, 500., 10., 0.1, 1e5, 10., 20., 1., 1e5, 10., None, None))
+            if i > 0:
+                cur.executemany("INSERT INTO DIAFragments VALUES (?,?,?,?,?,?,?)",
+                                [(None, cur.lastrowid, 100., 10., 0, None, None),
+                                 (None, cur.lastrowid, 200., 20., 1, None, None)])
+
+    def _summaries(self, cur):
+        return [cur.execute(f"SELECT * FROM {table} ORDER BY 1").fetchall()
+                for table in ["DataFileSummary", "DIAFragmentSummary", "DIAAnnotationSummary"]]
+
+    def test_summaries(self):
+        """ summary tables have the same counts as aggregating the full tables """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            con = self._mock_results_db(dbf)
+            cur = con.cursor()
+            _update_summary_tables(cur, AnalysisStep.DIA_EXT)
+            _update_summary_tables(cur, AnalysisStep.LIPID_ANN)
+            files, frags, anns = self._summaries(cur)
+            self.assertListEqual(files, [(1, 3, 2, 2, 1, 1, 2), (2, 0, 1, 2, 1, 0, 0)])
+            self.assertListEqual(frags, [(1, 1, 0, 0, None), (2, 1, 2, 1, 20.), (3, 2, 2, 1, 20.)])
+            self.assertListEqual(anns, [(2, 1, 2, 2, "PC 34:1@[M+H]+|PC 33:1@[M+H]+"), (3, 2, 1, 0, None)])
+            # rebuilding them from scratch gives the same summaries
+            con.close()
+            refresh_summary_tables(dbf)
+            con = sqlite3.connect(dbf)
+            self.assertListEqual(self._summaries(con.cursor()), [files, frags, anns])
+            con.close()
+
+    def test_new_dia_features_only(self):
+        """ after DIA extraction only the new DIA features from the data file get summarized """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            con = self._mock_results_db(dbf)
+            cur = con.cursor()
+            _update_summary_tables(cur, AnalysisStep.DIA_EXT)
+            # existing entries do not get refreshed
+            cur.execute("UPDATE DIAFragmentSummary SET n_fragments = 5 WHERE dia_pre_id = 2")
+            after_ids = cur.execute("SELECT MAX(dia_pre_id), MAX(dia_frag_id) FROM DIAFragments").fetchone()
+            self._add_dia_precursors(cur, [2, 2, 1])
+            _update_summary_tables(cur, AnalysisStep.DIA_EXT, dfile_ids=[2], after_ids=after_ids)
+            files, frags, _ = self._summaries(cur)
+            self.assertListEqual([row[:3] for row in frags], [(1, 1, 0), (2, 1, 5), (3, 2, 2), (4, 2, 0), (5, 2, 2)])
+            # the new DIA feature from the other data file does not get summarized
+            self.assertListEqual(files, [(1, 3, 2, 2, 1, 0, 0), (2, 0, 3, 4, 2, 0, 0)])
+            con.close()
+
+    def test_old_schema_version(self):
+        """ summary tables are not updated in results databases with an older schema version """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            con = self._mock_results_db(dbf)
+            con.execute("PRAGMA user_version = 3")
+            _update_summary_tables(con.cursor(), AnalysisStep.DIA_EXT)
+            self.assertListEqual(self._summaries(con.cursor()), [[], [], []])
+            con.close()
+            # upgrading fills them in
+            upgrade_results_db(dbf)
+            con = sqlite3.connect(dbf)
+            self.assertEqual(len(self._summaries(con.cursor())[1]), 3)
+            con.close()
+        with self.assertRaises(FileNotFoundError):
+            refresh_summary_tables("results db file doesnt exist")
+
+
+class TestMergeResultsDbShards(unittest.TestCase):
+    """ tests for the _connect_results_db_shard and merge_results_db_shards functions """
+
+    def _add_dia_features(self, cur, dfile_id, n_pre):
+        """ add mock DIA precursors, each with two fragments and raw data for precursor and fragments """
+        for _ in range(n_pre):
+            cur.execute("INSERT INTO DIAPrecursors VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                        (None, 11, dfile_id, 500., 10., 0.1, 1e5, 10., 20., 1., 1e5, 10., None, None))
+            dia_pre_id = cur.lastrowid
+            cur.execute("INSERT INTO Raw VALUES (?,?,?,?,?,?)", (None, "XIC", "dia_pre_id", dia_pre_id, 0, b""))
+            for fmz in [100., 200.]:
+                cur.execute("INSERT INTO DIAFragments VALUES (?,?,?,?,?,?,?)", 
+                            (None, dia_pre_id, fmz, 10., 0, None, None))
+                cur.execute("INSERT INTO Raw VALUES (?,?,?,?,?,?)", 
+                            (None, "ATD", "dia_frag_id", cur.lastrowid, 0, b""))
+        update_analysis_log(cur, AnalysisStep.DIA_EXT, {"DIA file ID": dfile_id, "precursors": n_pre})
+        cur.connection.commit()
+
+    def _dia_features(self, dbf):
+        """ DIA precursors with their data file names, fragments, and raw data """
+        con = sqlite3.connect(dbf)
+        pres = con.execute("SELECT dia_pre_id, dfile_name FROM DIAPrecursors JOIN DataFiles USING(dfile_id) "
+                           "ORDER BY dia_pre_id").fetchall()
+        frags = con.execute("SELECT dia_frag_id, dia_pre_id, fmz FROM DIAFragments ORDER BY dia_frag_id").fetchall()
+        raw = con.execute("SELECT raw_type, feat_id_type, feat_id FROM Raw ORDER BY raw_id").fetchall()
+        log = con.execute("SELECT step, json_extract(notes, '$.\"DIA file ID\"') FROM AnalysisLog ORDER BY n").fetchall()
+        con.close()
+        return pres, frags, raw, log
+
+    def test_shard_connection(self):
+        """ shard connection reads DDA features from the results database and writes into the shard """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            shard = os.path.join(tmp_dir, "results.db.shard0")
+            create_results_db(dbf)
+            con = sqlite3.connect(dbf)
+            con.execute("INSERT INTO DDAFragments VALUES (?,?,?,?)", (None, 11, 100., 10.))
+            con.commit()
+            shard_con = _connect_results_db_shard(dbf, shard)
+            self.assertListEqual(shard_con.execute("SELECT dda_pre_id, fmz FROM DDAFragments").fetchall(), [(11, 100.)])
+            self._add_dia_features(shard_con.cursor(), 1, 1)
+            shard_con.close()
+            self.assertEqual(con.execute("SELECT COUNT(*) FROM DIAPrecursors").fetchone()[0], 0)
+            con.close()
+            self.assertEqual(len(self._dia_features(shard)[0]), 0)  # no DataFiles entry in the shard yet
+            con = sqlite3.connect(shard)
+            self.assertEqual(con.execute("SELECT COUNT(*) FROM DIAPrecursors").fetchone()[0], 1)
+            self.assertEqual(con.execute("SELECT COUNT(*) FROM DDAFragments").fetchone()[0], 0)
+            con.close()
+
+    def test_merge_shards(self):
+        """ identifiers from the shards are offset past the ones already in the results database """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            shards = [os.path.join(tmp_dir, f"results.db.shard{i}") for i in range(2)]
+            # the same features in one results database, for comparison
+            expected_dbf = os.path.join(tmp_dir, "expected.db")
+            for dbfi in [dbf, expected_dbf]:
+                create_results_db(dbfi)
+                con = sqlite3.connect(dbfi)
+                cur = con.cursor()
+                cur.execute("INSERT INTO DataFiles VALUES (?,?,?,?,?)", (None, "DIA", "a.mza", None, None))
+                self._add_dia_features(cur, 1, 2)
+                if dbfi == expected_dbf:
+                    # a new data file, and features for the data file that was already there
+                    cur.execute("INSERT INTO DataFiles VALUES (?,?,?,?,?)", (None, "DIA", "b.mza", None, None))
+                    self._add_dia_features(cur, 2, 3)
+                    self._add_dia_features(cur, 1, 1)
+                con.close()
+            for shard, (dfile_name, dfile_id, n_pre) in zip(shards, [("b.mza", 1, 3), (None, 1, 1)]):
+                create_results_db(shard)
+                con = sqlite3.connect(shard)
+                cur = con.cursor()
+                if dfile_name is not None:
+                    cur.execute("INSERT INTO DataFiles VALUES (?,?,?,?,?)", (None, "DIA", dfile_name, None, None))
+                self._add_dia_features(cur, dfile_id, n_pre)
+                con.close()
+            self.assertEqual(merge_results_db_shards(dbf, shards, remove_shards=True), 4)
+            self.assertEqual(self._dia_features(dbf), self._dia_features(expected_dbf))
+            self.assertFalse(any(os.path.exists(shard) for shard in shards))
+
+    def test_stale_raw_downsampled(self):
+        """ downsampled raw data left over from deleted raw data do not get picked up by merged raw data """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            shard = os.path.join(tmp_dir, "results.db.shard0")
+            for dbfi in [dbf, shard]:
+                create_results_db(dbfi)
+                con = sqlite3.connect(dbfi)
+                cur = con.cursor()
+                cur.execute("INSERT INTO DataFiles VALUES (?,?,?,?,?)", (None, "DIA", "a.mza", None, None))
+                self._add_dia_features(cur, 1, 1)
+                con.close()
+            con = sqlite3.connect(dbf)
+            con.executemany("INSERT INTO RawDownsampled VALUES (?,?,?)", [(2, 0, b""), (3, 0, b"")])
+            # raw data with the highest identifier deleted, without its downsampled version
+            con.execute("DELETE FROM Raw WHERE raw_id=3")
+            con.commit()
+            _ = merge_results_db_shards(dbf, [shard])
+            self.assertListEqual(con.execute("SELECT raw_id FROM RawDownsampled").fetchall(), [(2,)])
+            self.assertEqual(con.execute("SELECT MAX(raw_id) FROM Raw").fetchone()[0], 5)
+            con.close()
+
+    def test_stale_annotated_features(self):
+        """ records of deleted annotated DIA features do not mark merged DIA features as annotated """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            shard = os.path.join(tmp_dir, "results.db.shard0")
+            for dbfi in [dbf, shard]:
+                create_results_db(dbfi)
+                con = sqlite3.connect(dbfi)
+                cur = con.cursor()
+                cur.execute("INSERT INTO DataFiles VALUES (?,?,?,?,?)", (None, "DIA", "a.mza", None, None))
+                self._add_dia_features(cur, 1, 2)
+                con.close()
+            con = sqlite3.connect(dbf)
+            con.executemany("INSERT INTO LipidAnnotatedFeatures VALUES (?,?)", [(1, "hash"), (2, "hash")])
+            # DIA feature with the highest identifier deleted, the record of it being annotated is left over
+            con.execute("DELETE FROM DIAPrecursors WHERE dia_pre_id=2")
+            con.commit()
+            _ = merge_results_db_shards(dbf, [shard])
+            self.assertListEqual(con.execute("SELECT dia_pre_id FROM LipidAnnotatedFeatures").fetchall(), [(1,)])
+            self.assertListEqual(con.execute("SELECT dia_pre_id FROM DIAPrecursors").fetchall(), [(1,), (2,), (3,)])
+            con.close()
+
+    def test_shard_schema_version(self):
+        """ should raise an error if a shard has a different schema version """
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            shard = os.path.join(tmp_dir, "results.db.shard0")
+            create_results_db(dbf)
+            create_results_db(shard)
+            con = sqlite3.connect(shard)
+            con.execute("PRAGMA user_version = 0")
+            con.close()
+            with self.assertRaises(ValueError):
+                _ = merge_results_db_shards(dbf, [shard])
+            with self.assertRaises(FileNotFoundError):
+                _ = merge_results_db_shards(dbf, ["shard file doesnt exist"])
+
+
 class TestDebugHandler(unittest.TestCase):
     """ tests for the debug_handler function """
 
@@ -160,13 +636,256 @@ class TestDebugHandler(unittest.TestCase):
                              msg="incorrect outputs produced")
 
 
+class Test_AlignPrecursors(unittest.TestCase):
+    """ tests for the _align_precursors function """
+
+    def _first_match_brute_force(self, points, tolerances):
+        """ the original grouping, comparing each precursor against every existing group in order """
+        firsts, groups = [], []
+        for point in points.tolist():
+            for g, first in enumerate(firsts):
+                if _precursor_match(first, point, tolerances):
+                    groups.append(g)
+                    break
+            else:
+                groups.append(len(firsts))
+                firsts.append(point)
+        return groups
+
+    def test_first_match_same_as_brute_force(self):
+        """ first match grouping is the same as comparing against every group """
+        rng = np.random.default_rng(420)
+        # features shared across data files (with some noise), values rounded to get some pairs 
+        # that are exactly at the tolerances
+        features = np.column_stack([rng.uniform(700., 702., 50), rng.uniform(10., 12., 50), rng.uniform(20., 30., 50)])
+        points = np.round(np.repeat(features, 10, axis=0) + rng.normal(0., [0.005, 0.05, 0.5], (500, 3)), 2)
+        points = points[rng.permutation(500)]
+        for tolerances in [(0.02, 0.2, 2.), (0.1, 1., 5.), (0., 0., 0.)]:
+            self.assertListEqual(_align_precursors(points, tolerances, "first_match").tolist(), 
+                                 self._first_match_brute_force(points, tolerances))
+
+    def test_first_match_vs_connected_components(self):
+        """ a chain of features is split by first match grouping but not by connected components """
+        points = np.array([[700., 10., 20.], [700.02, 10., 20.], [700.04, 10., 20.], [800., 10., 20.]])
+        tolerances = (0.025, 0.25, 2.5)
+        self.assertListEqual(_align_precursors(points, tolerances, "first_match").tolist(), [0, 0, 1, 2])
+        self.assertListEqual(_align_precursors(points, tolerances, "connected_components").tolist(), [0, 0, 0, 1])
+        # groups are numbered in order of their first member
+        self.assertListEqual(_align_precursors(points[::-1], tolerances, "connected_components").tolist(), 
+                             [0, 1, 1, 1])
+        with self.assertRaises(ValueError):
+            _ = _align_precursors(points, tolerances, "nearest")
+
+
+class TestResultsTableWriter(unittest.TestCase):
+    """ tests for the ResultsTableWriter class and read_results_table function """
+
+    def _chunks(self):
+        """ a few chunks of a mock results table """
+        schema = _results_table_schema({1: "a.mza", 2: "b.mza"}, [1, 2])
+        rows = [
+            ["1", 700., 10., 20., 150., "PC 32:0@[M+H]+", 1000, None],
+            ["2|3", 750., 11., 21., 155., None, None, None],
+            ["4", 800., 12., 22., 160., "PC 34:1@[M+H]+", None, 2000],
+        ]
+        return [pl.DataFrame(rows[i:i + 2], schema=schema, orient="row") for i in range(0, 3, 2)]
+
+    def test_roundtrip(self):
+        """ write a table in chunks and read it back in each format """
+        chunks = self._chunks()
+        expected = pl.concat(chunks)
+        with TemporaryDirectory() as tmp_dir:
+            for ext in [".csv", ".parquet", ".arrow"]:
+                out = os.path.join(tmp_dir, "results" + ext)
+                with ResultsTableWriter(out) as writer:
+                    for chunk in chunks:
+                        writer.write(chunk)
+                self.assertEqual(writer.n_rows, 3)
+                # temporary part files are cleaned up
+                self.assertListEqual(os.listdir(tmp_dir), [os.path.basename(out)])
+                self.assertTrue(read_results_table(out).equals(expected))
+                self.assertTrue(read_results_table(out, columns=["m/z"]).equals(expected.select("m/z")))
+                self.assertTrue(read_results_table(out, lazy=True).collect().equals(expected))
+                os.remove(out)
+
+    def test_error_while_writing(self):
+        """ no output file if there is an error while writing """
+        with TemporaryDirectory() as tmp_dir:
+            for ext in [".csv", ".parquet"]:
+                out = os.path.join(tmp_dir, "results" + ext)
+                with self.assertRaises(ValueError):
+                    with ResultsTableWriter(out) as writer:
+                        writer.write(self._chunks()[0])
+                        # mismatched schema
+                        writer.write(pl.DataFrame({"m/z": [1.]}))
+                self.assertListEqual(os.listdir(tmp_dir), [])
+
+    def test_bad_format(self):
+        """ unrecognized file extension or format should raise a ValueError """
+        with self.assertRaises(ValueError):
+            _ = ResultsTableWriter("results.xlsx")
+        with self.assertRaises(ValueError):
+            _ = ResultsTableWriter("results.csv", fmt="xlsx")
+
+
+class TestExportResultsTable(unittest.TestCase):
+    """ tests for the export_results_table function """
+
+    def _mock_results_db(self, dbf):
+        """ results database with clusters of DIA features from a few data files, with annotations """
+        create_results_db(dbf)
+        rng = np.random.default_rng(420)
+        n = 300
+        cluster = rng.integers(0, 60, n)
+        mzs = 700. + cluster * 0.03 + rng.normal(0, 0.005, n)
+        rts = 10. + (cluster % 3) + rng.normal(0, 0.05, n)
+        dts = 20. + rng.normal(0, 0.5, n)
+        con = sqlite3.connect(dbf)
+        cur = con.cursor()
+        cur.executemany("INSERT INTO DataFiles VALUES (?,?,?,?,?)", 
+                        [(i, "LC-IMS-MS/MS (DIA)", f"file{i}.mza", None, None) for i in range(1, 4)])
+        cur.executemany("INSERT INTO DIAPrecursors VALUES (?,NULL,?,?,?,0.1,1e5,10.,?,0.3,?,10.,150.,0)",
+                        zip(range(1, n + 1), (1 + np.arange(n) % 3).tolist(), mzs.tolist(), rts.tolist(), 
+                            dts.tolist(), rng.uniform(1e3, 1e5, n).tolist()))
+        cur.executemany("INSERT INTO Lipids VALUES (NULL,?,'LMGP0101',?,'[M+H]+',0.,NULL,NULL,NULL,1,1)",
+                        [(i, f"PC {32 + j}:{i % 3}") for i in range(1, n + 1) for j in range(i % 3)])
+        con.commit()
+        con.close()
+
+    def test_db_chunk_size(self):
+        """ chunked export does not depend on the chunk size and gives the same connected components """
+        tolerances = (0.025, 0.25, 2.5)
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            self._mock_results_db(dbf)
+            out = os.path.join(tmp_dir, "results.csv")
+            for alignment in ["first_match", "connected_components"]:
+                for strategy in ["union", "intersection"]:
+                    tables = []
+                    for db_chunk_size in [None, 1000, 37, 5]:
+                        n_rows = export_results_table(dbf, out, tolerances, alignment=alignment,  # type: ignore
+                                                      annotation_combine_strategy=strategy,  # type: ignore
+                                                      chunk_size=7, db_chunk_size=db_chunk_size)
+                        tables.append(read_results_table(out))
+                        self.assertEqual(tables[-1].height, n_rows)
+                    for table in tables[2:]:
+                        self.assertTrue(table.equals(tables[1]))
+                    if alignment == "connected_components":
+                        # same groups, with the same annotations and abundances
+                        def groups(table):
+                            return sorted(
+                                (sorted(pids.split("|")), sorted(anns.split("|")), abuns)
+                                for pids, anns, *abuns in table.drop("m/z", "RT (min)", "arrival time (ms)", 
+                                                                     "CCS (Ang^2)").iter_rows()
+                            )
+                        self.assertListEqual(groups(tables[0]), groups(tables[1]))
+
+    def test_out_csv_deprecated(self):
+        """ the old name of the output file parameter still works but gives a DeprecationWarning """
+        tolerances = (0.025, 0.25, 2.5)
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            self._mock_results_db(dbf)
+            out = os.path.join(tmp_dir, "results.csv")
+            n_rows = export_results_table(dbf, out, tolerances)
+            expected = read_results_table(out)
+            os.remove(out)
+            with self.assertWarns(DeprecationWarning):
+                self.assertEqual(export_results_table(dbf, out_csv=out, tolerances=tolerances), n_rows)
+            self.assertTrue(read_results_table(out).equals(expected))
+            with self.assertRaises(TypeError):
+                _ = export_results_table(dbf, out, tolerances, out_csv=out)
+
+    def test_stored_alignment_not_committed(self):
+        """ storing an alignment is left for the caller to commit """
+        tolerances = (0.025, 0.25, 2.5)
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            self._mock_results_db(dbf)
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            rows = list(_fetch_dia_precursors(cur, False, [1, 2, 3], 40.))
+            _ = _stored_alignment(cur, rows, "key", tolerances, "first_match")
+            self.assertEqual(cur.execute("SELECT COUNT(*) FROM Alignments").fetchone()[0], 1)
+            con.rollback()
+            self.assertEqual(cur.execute("SELECT COUNT(*) FROM Alignments").fetchone()[0], 0)
+            con.close()
+
+    def test_stored_alignment(self):
+        """ alignments are stored, reused by export, and replaced when the DIA features change """
+        tolerances = (0.025, 0.25, 2.5)
+        with TemporaryDirectory() as tmp_dir:
+            dbf = os.path.join(tmp_dir, "results.db")
+            self._mock_results_db(dbf)
+            out = os.path.join(tmp_dir, "results.csv")
+            export_results_table(dbf, out, tolerances)
+            expected = read_results_table(out)
+            con = sqlite3.connect(dbf)
+            cur = con.cursor()
+            # export only stores alignments if asked to
+            self.assertEqual(cur.execute("SELECT COUNT(*) FROM Alignments").fetchone()[0], 0)
+            align_id = align_dia_features(dbf, tolerances)
+            self.assertEqual(align_dia_features(dbf, tolerances), align_id)
+            n_pre, n_feat = cur.execute("SELECT n_precursors, n_features FROM Alignments "
+                                        "WHERE align_id=?", (align_id,)).fetchone()
+            self.assertEqual(n_feat, expected.height)
+            self.assertEqual(cur.execute("SELECT COUNT(*) FROM AlignedFeatureMembers").fetchone()[0], n_pre)
+            # consensus values are the means of the aligned DIA features
+            for mz, mean_mz, n_members, count in cur.execute("""
+                SELECT af.mz, AVG(p.mz), af.n_members, COUNT(*)
+                FROM AlignedFeatures AS af
+                    JOIN AlignedFeatureMembers AS m USING(align_id, afeat_id)
+                    JOIN DIAPrecursors AS p USING(dia_pre_id)
+                GROUP BY af.afeat_id
+            """).fetchall():
+                self.assertAlmostEqual(mz, mean_mz)
+                self.assertEqual(n_members, count)
+            # export with the stored alignment gives the same results table
+            export_results_table(dbf, out, tolerances, reuse_alignment=True)
+            self.assertTrue(read_results_table(out).equals(expected))
+            # different parameters get a separate alignment
+            self.assertNotEqual(align_dia_features(dbf, tolerances, select_data_files=[1, 2]), align_id)
+            self.assertEqual(cur.execute("SELECT COUNT(*) FROM Alignments").fetchone()[0], 2)
+            # changing the DIA features replaces the stored alignment
+            cur.execute("DELETE FROM DIAPrecursors WHERE dia_pre_id=1")
+            con.commit()
+            export_results_table(dbf, out, tolerances)
+            expected = read_results_table(out)
+            align_id = align_dia_features(dbf, tolerances)
+            self.assertEqual(cur.execute("SELECT COUNT(*) FROM Alignments").fetchone()[0], 2)
+            self.assertEqual(cur.execute("SELECT COUNT(*) FROM AlignedFeatureMembers "
+                                         "WHERE align_id=? AND dia_pre_id=1", (align_id,)).fetchone()[0], 0)
+            export_results_table(dbf, out, tolerances, reuse_alignment=True)
+            self.assertTrue(read_results_table(out).equals(expected))
+            self.assertEqual(align_dia_features(dbf, tolerances), align_id)
+            # only the most recently stored alignments are kept
+            with mock.patch("lipidimea.util.MAX_STORED_ALIGNMENTS", 2):
+                newest = align_dia_features(dbf, (0.03, 0.25, 2.5))
+            self.assertListEqual(cur.execute("SELECT align_id FROM Alignments ORDER BY align_id").fetchall(),
+                                 [(align_id,), (newest,)])
+            self.assertEqual(cur.execute("SELECT COUNT(DISTINCT align_id) FROM AlignedFeatureMembers").fetchone()[0], 2)
+            con.close()
+
+    def test_align_results_db_file_does_not_exist(self):
+        """ should raise an error if the results database file does not exist """
+        with self.assertRaises(FileNotFoundError):
+            _ = align_dia_features("results db file doesnt exist", (0.025, 0.25, 2.5))
+
+
 # group all of the tests from this module into a TestSuite
 _loader = unittest.TestLoader()
 AllTestsUtil = unittest.TestSuite()
 AllTestsUtil.addTests([
     _loader.loadTestsFromTestCase(Test_ResultsDbSchemaPath),
     _loader.loadTestsFromTestCase(TestCreateResultsDb),
+    _loader.loadTestsFromTestCase(TestConnectResultsDb),
+    _loader.loadTestsFromTestCase(TestUpgradeResultsDb),
+    _loader.loadTestsFromTestCase(TestSummaryTables),
+    _loader.loadTestsFromTestCase(TestMergeResultsDbShards),
     _loader.loadTestsFromTestCase(TestDebugHandler),
+    _loader.loadTestsFromTestCase(Test_AlignPrecursors),
+    _loader.loadTestsFromTestCase(TestResultsTableWriter),
+    _loader.loadTestsFromTestCase(TestExportResultsTable),
 ])
 
 
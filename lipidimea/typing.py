@@ -46,3 +46,6 @@ type DiaDeconFragment = Tuple[float, Xic, float, Atd, float]
 
 # (LMID_prefix, lipid_name, sum_c, sum_u, n_chains, adduct, mz)
 type ScdbLipidId = Tuple[str, str, int, int, int, str, float]
+
+# (LMID_prefix, n_chains, sum_c, sum_u)
+type FragLibKey = Tuple[str, int, int, int]
@@ -8,17 +8,28 @@ Dylan Ross (dylan.ross@pnnl.gov)
 
 import os
 import errno
+import shutil
+import tempfile
 from typing import (
     Optional, Callable, Dict, Union, Tuple, List, Generator, Any, Literal
 )
 import sqlite3
 import enum
 import json
+import time
+import hashlib
+import warnings
+import functools
+from itertools import product, islice, repeat
 
+import numpy as np
+import numpy.typing as npt
 import polars as pl
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
 
 from lipidimea.typing import (
-    ResultsDbPath, ResultsDbCursor, MzaFilePath, MzaFileId
+    ResultsDbPath, ResultsDbConnection, ResultsDbCursor, MzaFilePath, MzaFileId
 )
 
 
@@ -33,6 +44,173 @@ INCLUDE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_include
 _RESULTS_DB_SCHEMA = os.path.join(INCLUDE_DIR, 'results.sql3')
 
 
+# PRAGMA settings for connections to the results database, for read-heavy and write-heavy usage.
+# Write connections (including the one from create_results_db) put the database in WAL mode, which 
+# lets readers continue while another process is writing, with synchronous=NORMAL (which is safe 
+# from corruption in WAL mode). The journal mode is stored in the database file, so read connections 
+# leave it alone and opening a database only to read from it does not change it. The read profile 
+# uses a bigger page cache and memory map, the write profile keeps temporary storage (e.g. sorting 
+# for index creation) in files so it does not grow the memory usage.
+RESULTS_DB_PRAGMAS: Dict[str, Dict[str, Union[str, int]]] = {
+    "read": {
+        "synchronous": "NORMAL",
+        "cache_size": -131072,  # 128 MiB
+        "mmap_size": 1073741824,  # 1 GiB
+        "temp_store": "MEMORY",
+    },
+    "write": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,  # 64 MiB
+        "mmap_size": 268435456,  # 256 MiB
+        "temp_store": "FILE",
+    },
+}
+
+
+# number of parameter sets that executemany buffers at a time (so that they can be replayed if the
+# statement gets retried) when they are not already in a list or tuple
+_EXECUTEMANY_BATCH_SIZE: int = 65536
+
+
+# time spent waiting on the results database being locked, for all connections in this process
+_LOCK_STATS: Dict[str, Union[int, float]] = {"waits": 0, "wait_time": 0., "timeouts": 0}
+
+
+def _retry_if_locked(con: "_LockTimedConnection", 
+                     fn: Callable, 
+                     *args: Any
+                     ) -> Any :
+    """ 
+    call fn, if the results database is locked call it again letting the SQLite busy handler wait 
+    on the lock (up to the connection timeout), keeping track of the time spent waiting. Lock errors 
+    that waiting cannot clear (e.g. a read transaction that cannot be upgraded to a write transaction) 
+    are raised right away by SQLite instead of being waited on.
+    """
+    try:
+        return fn(*args)
+    except sqlite3.OperationalError as e:
+        if "database is locked" not in str(e):
+            raise
+    # the statement did not run, so it can be run again
+    start = time.perf_counter()
+    sqlite3.Connection.execute(con, f"PRAGMA busy_timeout = {int(con.timeout * 1000)}")
+    try:
+        result = fn(*args)
+    except sqlite3.OperationalError as e:
+        waited = time.perf_counter() - start
+        con._record_lock_wait(waited, "database is locked" in str(e) and waited >= con.timeout)
+        raise
+    finally:
+        sqlite3.Connection.execute(con, "PRAGMA busy_timeout = 0")
+    con._record_lock_wait(time.perf_counter() - start, False)
+    return result
+
+
+class _LockTimedCursor(sqlite3.Cursor):
+    """ cursor that retries statements while the database is locked (see ``connect_results_db``) """
+
+    def execute(self, sql, parameters=(), /):
+        return _retry_if_locked(self.connection, super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        # the parameters need to be reusable if the statement gets retried, other iterables (e.g.
+        # generators) are buffered in bounded batches rather than copied all at once
+        if isinstance(seq_of_parameters, (list, tuple)):
+            return _retry_if_locked(self.connection, super().executemany, sql, seq_of_parameters)
+        parameters = iter(seq_of_parameters)
+        while batch := list(islice(parameters, _EXECUTEMANY_BATCH_SIZE)):
+            _retry_if_locked(self.connection, super().executemany, sql, batch)
+        return self
+
+
+class _LockTimedConnection(sqlite3.Connection):
+    """ 
+    connection that only lets the SQLite busy handler wait on locks when a statement or commit runs 
+    into one, so that the time spent waiting can be measured (see ``connect_results_db``)
+    """
+
+    def __init__(self, *args, timeout: float = 5., **kwargs):
+        # SQLite only waits on locks (up to the timeout) when a statement gets run again after 
+        # running into a lock, see _retry_if_locked
+        super().__init__(*args, timeout=0., **kwargs)
+        self.timeout = timeout
+        self.lock_waits = 0
+        self.lock_wait_time = 0.
+
+    def _record_lock_wait(self, wait_time: float, timed_out: bool):
+        self.lock_waits += 1
+        self.lock_wait_time += wait_time
+        _LOCK_STATS["waits"] += 1
+        _LOCK_STATS["wait_time"] += wait_time
+        _LOCK_STATS["timeouts"] += int(timed_out)
+
+    def cursor(self, factory=_LockTimedCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=(), /):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters, /):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        return _retry_if_locked(self, super().commit)
+
+
+def connect_results_db(results_db: ResultsDbPath,
+                       profile: Literal["read", "write"] = "write",
+                       timeout: float = 60.,
+                       pragmas: Optional[Dict[str, Union[str, int]]] = None
+                       ) -> ResultsDbConnection :
+    """
+    Open a connection to the results database with PRAGMA settings for read-heavy or write-heavy 
+    usage (see ``RESULTS_DB_PRAGMAS``). 
+    
+    Statements and commits that fail because the database is locked (e.g. by another process 
+    writing to it) are run again with SQLite waiting on the lock (up to the timeout), and the time 
+    spent waiting is tracked, per connection in its ``lock_waits`` and ``lock_wait_time`` attributes
+    and for all connections in this process by ``results_db_lock_stats``.
+
+    Parameters
+    ----------
+    results_db
+        path to LipidIMEA analysis results database
+    [profile]
+        "read" or "write", selects PRAGMA settings for read-heavy or write-heavy usage
+    [timeout]
+        how long to wait when the database is locked (in seconds)
+    [pragmas]
+        override (or add to) the PRAGMA settings from the profile
+
+    Returns
+    -------
+    con
+        connection to the results database
+    """
+    if profile not in RESULTS_DB_PRAGMAS:
+        raise ValueError(f"profile must be 'read' or 'write', got: {profile}")
+    con = sqlite3.connect(results_db, timeout=timeout, factory=_LockTimedConnection)
+    for pragma, value in (RESULTS_DB_PRAGMAS[profile] | (pragmas or {})).items():
+        con.execute(f"PRAGMA {pragma} = {value}")
+    return con
+
+
+def results_db_lock_stats(reset: bool = False
+                          ) -> Dict[str, Union[int, float]] :
+    """
+    Get the number of times connections (from ``connect_results_db``) in this process had to wait
+    because the results database was locked ("waits"), the total time spent waiting in seconds 
+    ("wait_time"), and the number of waits that ran into the timeout ("timeouts"), optionally
+    resetting the counts
+    """
+    stats = dict(_LOCK_STATS)
+    if reset:
+        _LOCK_STATS.update(waits=0, wait_time=0., timeouts=0)
+    return stats
+
+
+
 def create_results_db(results_file: ResultsDbPath,
                       overwrite: bool = False,
                       strict: bool = True
@@ -58,11 +236,15 @@ def create_results_db(results_file: ResultsDbPath,
     if os.path.exists(results_file):
         if overwrite:
             os.remove(results_file)
+            # WAL files left over from the old database must not get applied to the new one
+            for ext in ["-wal", "-shm"]:
+                if os.path.exists(results_file + ext):
+                    os.remove(results_file + ext)
         else:
             msg = f"create_results_db: results database file ({results_file}) already exists"
             raise RuntimeError(msg)
     # initial connection creates the DB
-    con = sqlite3.connect(results_file)
+    con = connect_results_db(results_file)
     cur = con.cursor()
     # execute SQL script to set up the database
     with open(_RESULTS_DB_SCHEMA, 'r') as sql_f:
@@ -71,6 +253,8 @@ def create_results_db(results_file: ResultsDbPath,
         if not strict:
             content = content.replace("STRICT", "")
         cur.executescript(content)
+    # mark the schema version
+    cur.execute(f"PRAGMA user_version = {RESULTS_DB_SCHEMA_VERSION}")
     # save and close the database
     con.commit()
     con.close()
@@ -102,6 +286,7 @@ class AnalysisStep(enum.Enum):
     DIA_EXT = "DIA feature extraction"
     CCS_CAL = "CCS calibration"
     LIPID_ANN = "lipid annotation"
+    LIB_SEARCH = "spectral library search"
 
 
 def check_analysis_log(cur: ResultsDbCursor,
@@ -137,6 +322,633 @@ def update_analysis_log(cur: ResultsDbCursor,
     _ = cur.execute(qry, qdata)
 
 
+#------------------------------------------------------------------------------
+# results database schema versions and indexes
+
+
+# version of the results database schema, stored in the database file as PRAGMA user_version
+# (results databases created before the schema was versioned have version 0)
+RESULTS_DB_SCHEMA_VERSION: int = 5
+
+
+def _migrate_annotation_filter_flags(cur: ResultsDbCursor
+                                     ) -> None :
+    """ 
+    add the filter flag columns to the Lipids table, the FilteredLipids view, and the 
+    LipidAnnotatedFeatures table 
+    """
+    cur.execute("""--beginsql
+        CREATE TABLE IF NOT EXISTS LipidAnnotatedFeatures (
+            dia_pre_id INTEGER PRIMARY KEY,
+            params_hash TEXT NOT NULL
+        ) STRICT
+    --endsql""")
+    lipids_cols = {row[1] for row in cur.execute("PRAGMA table_info(Lipids)").fetchall()}
+    for col in ["rt_pass", "ccs_pass"]:
+        if col not in lipids_cols:
+            cur.execute(f"ALTER TABLE Lipids ADD COLUMN {col} INT")
+    cur.execute("""--beginsql
+        CREATE VIEW IF NOT EXISTS 
+            FilteredLipids
+        AS SELECT 
+            * 
+        FROM 
+            Lipids 
+        WHERE 
+            rt_pass IS NOT 0 
+            AND ccs_pass IS NOT 0
+    --endsql""")
+
+
+def _migrate_library_hits(cur: ResultsDbCursor
+                          ) -> None :
+    """ add the LibraryHits table """
+    cur.execute("""--beginsql
+        CREATE TABLE IF NOT EXISTS LibraryHits (
+            pre_id_type TEXT NOT NULL,
+            pre_id INT NOT NULL,
+            hit_rank INT NOT NULL,
+            lib_name TEXT NOT NULL,
+            lib_adduct TEXT,
+            lib_mz REAL,
+            similarity TEXT NOT NULL,
+            score REAL NOT NULL,
+            n_matched INT NOT NULL
+        ) STRICT
+    --endsql""")
+
+
+def _migrate_raw_downsampled(cur: ResultsDbCursor
+                             ) -> None :
+    """ add the RawDownsampled table """
+    cur.execute("""--beginsql
+        CREATE TABLE IF NOT EXISTS RawDownsampled (
+            raw_id INT NOT NULL,
+            raw_n INT NOT NULL,
+            raw_data BLOB NOT NULL,
+            PRIMARY KEY (raw_id, raw_n)
+        ) STRICT
+    --endsql""")
+
+
+def _migrate_summary_tables(cur: ResultsDbCursor
+                            ) -> None :
+    """ add the summary tables (DataFileSummary, DIAFragmentSummary, DIAAnnotationSummary) and fill them in """
+    cur.execute("""--beginsql
+        CREATE TABLE IF NOT EXISTS DataFileSummary (
+            dfile_id INTEGER PRIMARY KEY,
+            n_dda_precursors INT NOT NULL,
+            n_dia_precursors INT NOT NULL,
+            n_dia_fragments INT NOT NULL,
+            n_dia_decon_fragments INT NOT NULL,
+            n_dia_annotated INT NOT NULL,
+            n_dia_annotations INT NOT NULL
+        ) STRICT
+    --endsql""")
+    cur.execute("""--beginsql
+        CREATE TABLE IF NOT EXISTS DIAFragmentSummary (
+            dia_pre_id INTEGER PRIMARY KEY,
+            dfile_id INT,
+            n_fragments INT NOT NULL,
+            n_decon_fragments INT NOT NULL,
+            max_fint REAL
+        ) STRICT
+    --endsql""")
+    cur.execute("""--beginsql
+        CREATE TABLE IF NOT EXISTS DIAAnnotationSummary (
+            dia_pre_id INTEGER PRIMARY KEY,
+            dfile_id INT,
+            n_annotations INT NOT NULL,
+            n_filtered_annotations INT NOT NULL,
+            annotations TEXT
+        ) STRICT
+    --endsql""")
+    _refresh_dia_fragment_summary(cur)
+    _refresh_dia_annotation_summary(cur)
+    _refresh_data_file_summary(cur)
+
+
+def _migrate_alignments(cur: ResultsDbCursor
+                        ) -> None :
+    """ add the Alignments, AlignedFeatures, and AlignedFeatureMembers tables """
+    cur.execute("""--beginsql
+        CREATE TABLE IF NOT EXISTS Alignments (
+            align_id INTEGER PRIMARY KEY,
+            align_key TEXT NOT NULL UNIQUE,
+            members_hash TEXT NOT NULL,
+            n_precursors INT NOT NULL,
+            n_features INT NOT NULL
+        ) STRICT
+    --endsql""")
+    cur.execute("""--beginsql
+        CREATE TABLE IF NOT EXISTS AlignedFeatures (
+            align_id INT NOT NULL,
+            afeat_id INT NOT NULL,
+            n_members INT NOT NULL,
+            mz REAL NOT NULL,
+            rt REAL NOT NULL,
+            dt REAL NOT NULL,
+            ccs REAL,
+            PRIMARY KEY (align_id, afeat_id)
+        ) STRICT
+    --endsql""")
+    cur.execute("""--beginsql
+        CREATE TABLE IF NOT EXISTS AlignedFeatureMembers (
+            align_id INT NOT NULL,
+            member_n INT NOT NULL,
+            afeat_id INT NOT NULL,
+            dia_pre_id INT NOT NULL,
+            PRIMARY KEY (align_id, member_n)
+        ) STRICT
+    --endsql""")
+
+
+# migrations for upgrading results databases created with older versions of the schema, 
+# as (schema version after the migration, migration function), in order. Migrations must be
+# safe to run more than once, since databases created before the schema was versioned can 
+# already include some of the changes.
+_RESULTS_DB_MIGRATIONS: List[Tuple[int, Callable[[ResultsDbCursor], None]]] = [
+    (1, _migrate_annotation_filter_flags),
+    (2, _migrate_library_hits),
+    (3, _migrate_raw_downsampled),
+    (4, _migrate_summary_tables),
+    (5, _migrate_alignments),
+]
+
+
+def _upgrade_results_db_schema(cur: ResultsDbCursor
+                               ) -> Tuple[int, int] :
+    """
+    Upgrade the schema of an open results database to the current version in place (only runs the
+    migrations that have not been applied yet), returns the schema versions before and after.
+    Raises a RuntimeError if the database has a newer schema version than this version of LipidIMEA.
+    Does not commit, the caller owns the connection and commits the upgrade along with its own changes.
+    """
+    version, = cur.execute("PRAGMA user_version").fetchone()
+    if version > RESULTS_DB_SCHEMA_VERSION:
+        msg = (f"results database schema version ({version}) is newer than the schema version supported "
+               f"by this version of LipidIMEA ({RESULTS_DB_SCHEMA_VERSION})")
+        raise RuntimeError(msg)
+    if version == RESULTS_DB_SCHEMA_VERSION:
+        return version, version
+    for to_version, migration in _RESULTS_DB_MIGRATIONS:
+        if to_version > version:
+            migration(cur)
+    cur.execute(f"PRAGMA user_version = {RESULTS_DB_SCHEMA_VERSION}")
+    return version, RESULTS_DB_SCHEMA_VERSION
+
+
+# secondary indexes for the results database, as index name: (table, indexed columns), these
+# cover the frequent lookups of fragments, annotations and raw data by feature and the selection
+# of precursors by data file and m/z (from analysis steps and from the GUI)
+RESULTS_DB_INDEXES: Dict[str, Tuple[str, str]] = {
+    "DDAPrecursors_mz_idx": ("DDAPrecursors", "mz"),
+    "DDAFragments_dda_pre_id_idx": ("DDAFragments", "dda_pre_id, fmz, fint"),
+    "DIAPrecursors_dfile_id_mz_idx": ("DIAPrecursors", "dfile_id, mz"),
+    "DIAFragments_dia_pre_id_idx": ("DIAFragments", "dia_pre_id, fmz, fint"),
+    "Raw_feat_id_idx": ("Raw", "feat_id_type, feat_id, raw_type"),
+    "Lipids_dia_pre_id_idx": ("Lipids", "dia_pre_id"),
+    "LipidSumComp_lipid_id_idx": ("LipidSumComp", "lipid_id"),
+    "LipidFragments_lipid_id_idx": ("LipidFragments", "lipid_id"),
+    "LibraryHits_pre_id_idx": ("LibraryHits", "pre_id_type, pre_id"),
+    "DIAFragmentSummary_dfile_id_idx": ("DIAFragmentSummary", "dfile_id"),
+    "DIAAnnotationSummary_dfile_id_idx": ("DIAAnnotationSummary", "dfile_id"),
+    "AlignedFeatureMembers_dia_pre_id_idx": ("AlignedFeatureMembers", "dia_pre_id"),
+}
+
+
+def _create_results_db_indexes(cur: ResultsDbCursor,
+                               tables: Optional[List[str]] = None
+                               ) -> List[str] :
+    """
+    Create any of the secondary indexes (``RESULTS_DB_INDEXES``) that do not exist yet, only on the
+    specified tables if ``tables`` is not None, then ANALYZE the tables that got new indexes so the 
+    query planner has statistics for them. The indexes are not part of a newly created results 
+    database, since it is faster to bulk load the data first and index it afterwards, so this gets 
+    called after the analysis steps that bulk load the indexed tables. Returns the names of the 
+    indexes that were created.
+    """
+    existing = {name for name, in cur.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+    created = []
+    for name, (table, columns) in RESULTS_DB_INDEXES.items():
+        if name not in existing and (tables is None or table in tables):
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+            created.append(name)
+    for table in dict.fromkeys(RESULTS_DB_INDEXES[name][0] for name in created):
+        cur.execute(f"ANALYZE {table}")
+    cur.connection.commit()
+    return created
+
+
+def upgrade_results_db(results_db: ResultsDbPath,
+                       create_indexes: bool = True
+                       ) -> Tuple[int, int] :
+    """
+    Upgrade a results database created with an older version of LipidIMEA to the current schema
+    version (``RESULTS_DB_SCHEMA_VERSION``) in place, optionally creating the secondary indexes 
+    (``RESULTS_DB_INDEXES``) and updating the query planner statistics.
+
+    Parameters
+    ----------
+    results_db
+        path to LipidIMEA analysis results database
+    [create_indexes]
+        also create any secondary indexes that do not exist yet and run ANALYZE on the database
+
+    Returns
+    -------
+    old_version
+        schema version of the database before upgrading
+    new_version
+        schema version of the database after upgrading
+    """
+    # ensure results database file exists
+    if not os.path.isfile(results_db):
+        raise FileNotFoundError(errno.ENOENT,
+                                os.strerror(errno.ENOENT),
+                                results_db)
+    con = connect_results_db(results_db)
+    cur = con.cursor()
+    try:
+        versions = _upgrade_results_db_schema(cur)
+        if create_indexes:
+            _create_results_db_indexes(cur)
+            # refresh the statistics for all tables, not only newly indexed ones
+            cur.execute("ANALYZE")
+        con.commit()
+    finally:
+        con.close()
+    return versions
+
+
+#------------------------------------------------------------------------------
+# results database summary tables
+
+
+def _refresh_dia_fragment_summary(cur: ResultsDbCursor,
+                                  dfile_ids: Optional[List[int]] = None,
+                                  after_ids: Tuple[int, int] = (0, 0)
+                                  ) -> None :
+    """
+    Refresh the DIAFragmentSummary entries for DIA precursors from the specified data files (all 
+    data files if ``dfile_ids`` is None). If ``after_ids`` is set to the max DIA precursor and DIA 
+    fragment identifiers from before new DIA features were added, only the new DIA features get 
+    summarized, which only needs to look at the fragments that were added since then.
+    """
+    dfile_cond = "1" if dfile_ids is None else f"dfile_id IN ({','.join(map(str, dfile_ids))})"
+    qdata = dict(zip(["pre", "frag"], after_ids))
+    # with a range of new fragments, grouping by +dia_pre_id keeps the query planner from scanning
+    # all of the fragments through the index on dia_pre_id instead of only the new ones by rowid
+    group_by = "+dia_pre_id" if after_ids[1] > 0 else "dia_pre_id"
+    cur.execute(f"""--beginsql
+        DELETE FROM DIAFragmentSummary WHERE dia_pre_id > :pre AND {dfile_cond}
+    --endsql""", qdata)
+    cur.execute(f"""--beginsql
+        INSERT INTO DIAFragmentSummary
+        SELECT
+            dia_pre_id,
+            dfile_id,
+            COALESCE(n_fragments, 0),
+            COALESCE(n_decon_fragments, 0),
+            max_fint
+        FROM
+            DIAPrecursors
+            LEFT JOIN (
+                SELECT 
+                    dia_pre_id, 
+                    COUNT(*) AS n_fragments, 
+                    SUM(deconvoluted) AS n_decon_fragments, 
+                    MAX(fint) AS max_fint
+                FROM 
+                    DIAFragments
+                WHERE
+                    dia_frag_id > :frag
+                GROUP BY 
+                    {group_by}
+            ) USING(dia_pre_id)
+        WHERE
+            dia_pre_id > :pre
+            AND {dfile_cond}
+    --endsql""", qdata)
+
+
+def _refresh_dia_annotation_summary(cur: ResultsDbCursor,
+                                    dia_pre_ids: Optional[List[int]] = None
+                                    ) -> None :
+    """
+    Refresh the DIAAnnotationSummary entries for the specified DIA precursors (all DIA precursors 
+    if ``dia_pre_ids`` is None), the annotations of each DIA precursor are listed in the same 
+    format as in exported results tables
+    """
+    scope_cond = "1" if dia_pre_ids is None else "dia_pre_id IN (SELECT value FROM json_each(:ids))"
+    qdata = {"ids": json.dumps([int(_) for _ in dia_pre_ids]) if dia_pre_ids is not None else None}
+    cur.execute(f"""--beginsql
+        DELETE FROM DIAAnnotationSummary WHERE {scope_cond}
+    --endsql""", qdata)
+    cur.execute(f"""--beginsql
+        INSERT INTO DIAAnnotationSummary
+        SELECT
+            dia_pre_id,
+            dfile_id,
+            COUNT(*),
+            SUM(rt_pass IS NOT 0 AND ccs_pass IS NOT 0),
+            GROUP_CONCAT(CASE WHEN rt_pass IS NOT 0 AND ccs_pass IS NOT 0 THEN lipid || "@" || adduct END, "|")
+        FROM
+            Lipids
+            JOIN DIAPrecursors USING(dia_pre_id)
+        WHERE
+            {scope_cond}
+        GROUP BY
+            dia_pre_id
+    --endsql""", qdata)
+
+
+def _refresh_data_file_summary(cur: ResultsDbCursor,
+                               dfile_ids: Optional[List[int]] = None
+                               ) -> None :
+    """
+    Refresh the DataFileSummary entries for the specified data files (all data files if 
+    ``dfile_ids`` is None), the DIA counts come from the DIA feature summary tables so those 
+    need to be refreshed first
+    """
+    dfile_cond = "1" if dfile_ids is None else f"dfile_id IN ({','.join(map(str, dfile_ids))})"
+    cur.execute(f"""--beginsql
+        DELETE FROM DataFileSummary WHERE {dfile_cond}
+    --endsql""")
+    cur.execute(f"""--beginsql
+        INSERT INTO DataFileSummary
+        SELECT
+            dfile_id,
+            COALESCE(dda.n_precursors, 0),
+            COALESCE(dia.n_precursors, 0),
+            COALESCE(dia.n_fragments, 0),
+            COALESCE(dia.n_decon_fragments, 0),
+            COALESCE(ann.n_annotated, 0),
+            COALESCE(ann.n_annotations, 0)
+        FROM
+            DataFiles
+            LEFT JOIN (
+                SELECT dfile_id, COUNT(*) AS n_precursors
+                FROM DDAPrecursors WHERE {dfile_cond} GROUP BY dfile_id
+            ) AS dda USING(dfile_id)
+            LEFT JOIN (
+                SELECT 
+                    dfile_id, 
+                    COUNT(*) AS n_precursors, 
+                    SUM(n_fragments) AS n_fragments, 
+                    SUM(n_decon_fragments) AS n_decon_fragments
+                FROM DIAFragmentSummary WHERE {dfile_cond} GROUP BY dfile_id
+            ) AS dia USING(dfile_id)
+            LEFT JOIN (
+                SELECT 
+                    dfile_id, 
+                    SUM(n_filtered_annotations > 0) AS n_annotated, 
+                    SUM(n_filtered_annotations) AS n_annotations
+                FROM DIAAnnotationSummary WHERE {dfile_cond} GROUP BY dfile_id
+            ) AS ann USING(dfile_id)
+        WHERE
+            {dfile_cond}
+    --endsql""")
+
+
+def _update_summary_tables(cur: ResultsDbCursor,
+                           step: AnalysisStep,
+                           dfile_ids: Optional[List[int]] = None,
+                           dia_pre_ids: Optional[List[int]] = None,
+                           after_ids: Tuple[int, int] = (0, 0)
+                           ) -> None :
+    """
+    Refresh the summary tables affected by an analysis step, called at the end of the step (in 
+    the same transaction). The refresh can be restricted to the data files (``dfile_ids``) or DIA 
+    precursors (``dia_pre_ids``) the step worked on, and to the DIA features added by the step
+    (``after_ids``, see ``_refresh_dia_fragment_summary``). Results databases with an older 
+    schema version do not have the summary tables yet, they get filled in when the database is 
+    upgraded.
+    """
+    # the summary tables were added in schema version 4
+    version, = cur.execute("PRAGMA user_version").fetchone()
+    if version < 4:
+        return
+    match step:
+        case AnalysisStep.DDA_EXT | AnalysisStep.DDA_CONS:
+            _refresh_data_file_summary(cur, dfile_ids)
+        case AnalysisStep.DIA_EXT:
+            _refresh_dia_fragment_summary(cur, dfile_ids, after_ids)
+            _refresh_data_file_summary(cur, dfile_ids)
+        case AnalysisStep.LIPID_ANN:
+            _refresh_dia_annotation_summary(cur, dia_pre_ids)
+            _refresh_data_file_summary(cur)
+
+
+def refresh_summary_tables(results_db: ResultsDbPath
+                           ) -> None :
+    """
+    Rebuild all of the summary tables (DataFileSummary, DIAFragmentSummary, DIAAnnotationSummary)
+    from scratch. These are kept up to date at the end of each analysis step, so this is only 
+    needed if the results database was modified in some other way (e.g. features deleted using 
+    the GUI).
+
+    Parameters
+    ----------
+    results_db
+        path to LipidIMEA analysis results database
+    """
+    # ensure results database file exists
+    if not os.path.isfile(results_db):
+        raise FileNotFoundError(errno.ENOENT,
+                                os.strerror(errno.ENOENT),
+                                results_db)
+    con = connect_results_db(results_db)
+    cur = con.cursor()
+    _upgrade_results_db_schema(cur)
+    _refresh_dia_fragment_summary(cur)
+    _refresh_dia_annotation_summary(cur)
+    _refresh_data_file_summary(cur)
+    con.commit()
+    con.close()
+
+
+def _delete_stale_raw_downsampled(cur: ResultsDbCursor,
+                                  after_raw_id: int
+                                  ) -> None :
+    """
+    Delete downsampled raw data (RawDownsampled table) past the current max raw data identifier 
+    (``after_raw_id``) before new raw data get added. Raw data identifiers get reused if the raw 
+    data with the highest identifiers were deleted (e.g. using the GUI), so any downsampled versions 
+    left over from those would otherwise be picked up by the new raw data. Results databases with 
+    an older schema version do not have the RawDownsampled table.
+    """
+    # the RawDownsampled table was added in schema version 3
+    version, = cur.execute("PRAGMA user_version").fetchone()
+    if version >= 3:
+        cur.execute("DELETE FROM RawDownsampled WHERE raw_id > ?", (after_raw_id,))
+
+
+def _delete_stale_annotated_features(cur: ResultsDbCursor,
+                                     after_pre_id: int
+                                     ) -> None :
+    """
+    Delete records of annotated DIA features (LipidAnnotatedFeatures table) past the current max 
+    DIA precursor identifier (``after_pre_id``) before new DIA features get added. DIA precursor 
+    identifiers get reused if the DIA features with the highest identifiers were deleted (e.g. using 
+    the GUI), and records left over from those would make incremental annotation skip the new DIA
+    features. Results databases with an older schema version do not have the LipidAnnotatedFeatures
+    table.
+    """
+    # the LipidAnnotatedFeatures table was added in schema version 1
+    version, = cur.execute("PRAGMA user_version").fetchone()
+    if version >= 1:
+        cur.execute("DELETE FROM LipidAnnotatedFeatures WHERE dia_pre_id > ?", (after_pre_id,))
+
+
+#------------------------------------------------------------------------------
+# results database shards
+
+
+# tables that DIA feature extraction reads from the main results database when writing into a
+# shard, these are shadowed in the shard connection by TEMP views of the attached main database
+_SHARD_READ_TABLES: List[str] = ["DDAPrecursors", "DDAFragments"]
+
+
+# tables copied from a shard into the main results database, in order, with the expressions for
+# the identifier columns that need to be offset so they do not collide with the identifiers that
+# are already in the main results database (all other columns get copied as-is), the offsets are
+# the maximum identifiers in the main results database (:dfile, :pre, :frag, :raw) and shard data
+# file identifiers are only offset if the data file was added to the shard (features extracted
+# from a data file that was already in the main results database keep its identifier)
+_SHARD_DFILE_ID = "CASE WHEN {0} IN (SELECT dfile_id FROM shard.DataFiles) THEN {0} + :dfile ELSE {0} END"
+_SHARD_TABLE_REMAPS: List[Tuple[str, Dict[str, str]]] = [
+    ("DataFiles", {
+        "dfile_id": "dfile_id + :dfile",
+    }),
+    ("DIAPrecursors", {
+        "dia_pre_id": "dia_pre_id + :pre",
+        "dfile_id": _SHARD_DFILE_ID.format("dfile_id"),
+    }),
+    ("DIAFragments", {
+        "dia_frag_id": "dia_frag_id + :frag",
+        "dia_pre_id": "dia_pre_id + :pre",
+    }),
+    ("Raw", {
+        "raw_id": "raw_id + :raw",
+        "feat_id": "feat_id + CASE feat_id_type WHEN 'dia_pre_id' THEN :pre WHEN 'dia_frag_id' THEN :frag ELSE 0 END",
+    }),
+    ("RawDownsampled", {
+        "raw_id": "raw_id + :raw",
+    }),
+    ("DIAFragmentSummary", {
+        "dia_pre_id": "dia_pre_id + :pre",
+        "dfile_id": _SHARD_DFILE_ID.format("dfile_id"),
+    }),
+    ("AnalysisLog", {
+        # n gets autoincremented, shard analysis steps are logged after those in the main database
+        "n": "NULL",
+        "notes": ("CASE WHEN json_valid(notes) "
+                  "AND json_extract(notes, '$.\"DIA file ID\"') IN (SELECT dfile_id FROM shard.DataFiles) "
+                  "THEN json_replace(notes, '$.\"DIA file ID\"', json_extract(notes, '$.\"DIA file ID\"') + :dfile) "
+                  "ELSE notes END"),
+    }),
+]
+
+
+def _connect_results_db_shard(results_db: ResultsDbPath,
+                              shard_db: ResultsDbPath,
+                              timeout: float = 60.
+                              ) -> ResultsDbConnection :
+    """
+    Create a new (empty) shard database and return a connection to it, with the main results
+    database attached (as ``results``) for reading. The tables in ``_SHARD_READ_TABLES`` are
+    shadowed by TEMP views of the same tables in the main results database (TEMP objects take
+    precedence over the main database for unqualified table names) so queries that read from
+    them get the data from the main results database, while everything else gets written into
+    the shard. The shard can then be merged into the main results database using
+    ``merge_results_db_shards``.
+    """
+    create_results_db(shard_db, overwrite=True)
+    con = connect_results_db(shard_db, timeout=timeout)
+    con.execute("ATTACH DATABASE ? AS results", (results_db,))
+    for table in _SHARD_READ_TABLES:
+        con.execute(f"CREATE TEMP VIEW {table} AS SELECT * FROM results.{table}")
+    return con
+
+
+def merge_results_db_shards(results_db: ResultsDbPath,
+                            shard_dbs: List[ResultsDbPath],
+                            remove_shards: bool = False
+                            ) -> int :
+    """
+    Merge shard databases with DIA features (e.g. from ``extract_dia_features`` with the
+    ``shard_db`` option, from separate processes or separate compute nodes) into the main results
+    database. Shards are merged in the order they are given, the data files, DIA precursors, DIA
+    fragments, raw data, DIA fragment summaries, and analysis log entries from each shard are 
+    copied into the main results database in bulk with their identifiers offset past the ones 
+    already in the main results database.
+
+    Parameters
+    ----------
+    results_db
+        path to LipidIMEA analysis results database
+    shard_dbs
+        paths to shard databases to merge into the results database
+    [remove_shards]
+        delete the shard database files after they are merged
+
+    Returns
+    -------
+    n_dia_features
+        number of DIA features merged into the results database
+    """
+    # ensure results database and shard files exist
+    for dbf in [results_db, *shard_dbs]:
+        if not os.path.isfile(dbf):
+            raise FileNotFoundError(errno.ENOENT,
+                                    os.strerror(errno.ENOENT),
+                                    dbf)
+    con = connect_results_db(results_db)
+    cur = con.cursor()
+    _, version = _upgrade_results_db_schema(cur)
+    offsets_qry = """--beginsql
+        SELECT
+            (SELECT COALESCE(MAX(dfile_id), 0) FROM main.DataFiles),
+            (SELECT COALESCE(MAX(dia_pre_id), 0) FROM main.DIAPrecursors),
+            (SELECT COALESCE(MAX(dia_frag_id), 0) FROM main.DIAFragments),
+            (SELECT COALESCE(MAX(raw_id), 0) FROM main.Raw)
+    --endsql"""
+    n_dia_features = 0
+    for shard_db in shard_dbs:
+        cur.execute("ATTACH DATABASE ? AS shard", (shard_db,))
+        shard_version, = cur.execute("PRAGMA shard.user_version").fetchone()
+        if shard_version != version:
+            cur.execute("DETACH DATABASE shard")
+            con.close()
+            msg = (f"merge_results_db_shards: shard database ({shard_db}) schema version ({shard_version}) "
+                   f"does not match results database schema version ({version})")
+            raise ValueError(msg)
+        offsets = dict(zip(["dfile", "pre", "frag", "raw"], cur.execute(offsets_qry).fetchone()))
+        _delete_stale_raw_downsampled(cur, offsets["raw"])
+        _delete_stale_annotated_features(cur, offsets["pre"])
+        for table, remap in _SHARD_TABLE_REMAPS:
+            columns = [row[1] for row in cur.execute(f"PRAGMA main.table_info({table})")]
+            qry = (f"INSERT INTO main.{table} ({', '.join(columns)}) "
+                   f"SELECT {', '.join(remap.get(c, c) for c in columns)} FROM shard.{table} "
+                   f"ORDER BY rowid")
+            cur.execute(qry, offsets)
+        n_dia_features += cur.execute("SELECT COUNT(*) FROM shard.DIAPrecursors").fetchone()[0]
+        # all of the tables from one shard get copied in a single transaction
+        con.commit()
+        cur.execute("DETACH DATABASE shard")
+    # the per data file counts also include the features that were already in the results database
+    _refresh_data_file_summary(cur)
+    con.commit()
+    con.close()
+    if remove_shards:
+        for shard_db in shard_dbs:
+            for ext in ["", "-wal", "-shm"]:
+                if os.path.exists(shard_db + ext):
+                    os.remove(shard_db + ext)
+    return n_dia_features
+
+
 #------------------------------------------------------------------------------
 # debug handler
 
@@ -229,10 +1041,11 @@ def _fetch_dia_precursors(cur: ResultsDbCursor,
                           include_unknowns: bool,
                           include_dfile_ids: List[int],
                           limit_precursor_mz_ppm: float,
+                          order_by_mz: bool = False
                           ) -> Generator[Any, Any, Any] : 
     """ 
     construct a query and fetch the DIA precursors from the database, 
-    yields results one row at a time 
+    yields results one row at a time, ordered by annotations or by m/z
     """
     # collect/aggregate the DIA precursors
     qry_sel_precursors = """--beginsql
@@ -248,18 +1061,19 @@ def _fetch_dia_precursors(cur: ResultsDbCursor,
         GROUP_CONCAT(lipid || "@" || adduct, "|") AS annotations
     FROM
         DIAPrecursors
-        {incl_unk} JOIN Lipids USING(dia_pre_id)
+        {incl_unk} JOIN FilteredLipids USING(dia_pre_id)
     WHERE
         dfile_id IN ({dfids})
         AND ABS(mz_ppm_err) <= {ppmlim}
     GROUP BY
         dia_pre_id
     ORDER BY
-        annotations
+        {order}
     --endsql""".format(
         incl_unk="LEFT" if include_unknowns else "",
         dfids=",".join(map(str, include_dfile_ids)),
-        ppmlim=limit_precursor_mz_ppm
+        ppmlim=limit_precursor_mz_ppm,
+        order="mz, dia_pre_id" if order_by_mz else "annotations"
     )
     for row in cur.execute(qry_sel_precursors):
         yield row
@@ -281,6 +1095,183 @@ def _precursor_match(one: Union[Tuple[float, float, float], List[float]],
     )
 
 
+def _first_match_groups(points: npt.NDArray[np.float64],
+                        tolerances: Tuple[float, float, float]
+                        ) -> npt.NDArray[np.int64] :
+    """
+    Group precursors one at a time (in order), each precursor joins the first group (in order of 
+    creation) with a first member that matches it within tolerances (see ``_precursor_match``) or
+    starts a new group. Group first members are kept in a grid with cells slightly larger than the 
+    tolerances, so only the 27 neighboring cells need to be checked for each precursor.
+    """
+    tols = np.array(tolerances, dtype=np.float64)
+    cell = np.where(tols > 0, tols * (1 + 1e-6), 1.)
+    keys = np.floor(points / cell).astype(np.int64).tolist()
+    # keys: grid cell -> tuple(int, int, int)
+    # values: indices of groups with first members in that cell (in order of creation) -> list(int)
+    cells = {}
+    firsts = []
+    groups = np.empty(len(points), dtype=np.int64)
+    neighbors = list(product((-1, 0, 1), repeat=3))
+    for i, ((kx, ky, kz), point) in enumerate(zip(keys, points.tolist())):
+        best = -1
+        for dx, dy, dz in neighbors:
+            for g in cells.get((kx + dx, ky + dy, kz + dz), ()):
+                if best >= 0 and g >= best:
+                    break
+                if _precursor_match(firsts[g], point, tolerances):
+                    best = g
+                    break
+        if best < 0:
+            best = len(firsts)
+            firsts.append(point)
+            cells.setdefault((kx, ky, kz), []).append(best)
+        groups[i] = best
+    return groups
+
+
+def _connected_component_groups(points: npt.NDArray[np.float64],
+                                tolerances: Tuple[float, float, float],
+                                chunk_size: int = 100000
+                                ) -> npt.NDArray[np.int64] :
+    """
+    Group precursors as connected components of the graph linking all pairs of precursors that match 
+    within tolerances (see ``_precursor_match``). Candidate pairs are found by sorting the precursors 
+    by m/z and sweeping over them with a window of the m/z tolerance (in chunks, to limit memory usage).
+    Groups are numbered in order of their first member.
+    """
+    n = len(points)
+    tol_mz, tol_rt, tol_dt = tolerances
+    order = np.argsort(points[:, 0], kind="stable")
+    sorted_points = points[order]
+    # end of the m/z window for each precursor (slightly wider, exact check below)
+    ends = np.searchsorted(sorted_points[:, 0], sorted_points[:, 0] + tol_mz * (1 + 1e-6), side="right")
+    edges_i, edges_j = [], []
+    for start in range(0, n, chunk_size):
+        idx = np.arange(start, min(start + chunk_size, n))
+        counts = ends[idx] - idx - 1
+        i = np.repeat(idx, counts)
+        j = i + 1 + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        # check one dimension at a time, dropping the pairs that do not match as we go
+        for dim, tol in [(1, tol_rt), (2, tol_dt), (0, tol_mz)]:
+            keep = np.abs(sorted_points[i, dim] - sorted_points[j, dim]) <= tol
+            i, j = i[keep], j[keep]
+        edges_i.append(order[i])
+        edges_j.append(order[j])
+    edges_i = np.concatenate(edges_i) if edges_i else np.array([], dtype=np.int64)
+    edges_j = np.concatenate(edges_j) if edges_j else np.array([], dtype=np.int64)
+    graph = sparse.coo_matrix((np.ones(len(edges_i), dtype=np.int8), (edges_i, edges_j)), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    # renumber the components in order of their first member
+    _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    renumber = np.empty(len(first), dtype=np.int64)
+    renumber[np.argsort(first)] = np.arange(len(first))
+    return renumber[inverse]
+
+
+def _align_precursors(points: npt.NDArray[np.float64],
+                      tolerances: Tuple[float, float, float],
+                      alignment: Literal["first_match", "connected_components"]
+                      ) -> npt.NDArray[np.int64] :
+    """
+    Align precursors (rows of m/z, RT, DT) into groups using the specified alignment strategy, 
+    returns the group index for each precursor with groups numbered in order of their first member
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    match alignment:
+        case "first_match":
+            return _first_match_groups(points, tolerances)
+        case "connected_components":
+            return _connected_component_groups(points, tolerances)
+        case _:
+            raise ValueError(f"alignment must be 'first_match' or 'connected_components', got: {alignment}")
+
+
+def _alignment_key(include_dfile_ids: List[int],
+                   tolerances: Tuple[float, float, float],
+                   include_unknowns: bool,
+                   limit_precursor_mz_ppm: float,
+                   alignment: Literal["first_match", "connected_components"]
+                   ) -> str :
+    """ 
+    alignment parameters, including the ones that select which DIA precursors get aligned, as JSON 
+    (identifies alignments stored in the results database)
+    """
+    return json.dumps({
+        "tolerances": [float(_) for _ in tolerances],
+        "alignment": alignment,
+        "data files": sorted(int(_) for _ in include_dfile_ids),
+        "include unknowns": bool(include_unknowns),
+        "limit precursor m/z ppm": float(limit_precursor_mz_ppm),
+    }, sort_keys=True)
+
+
+# maximum number of alignments kept in the results database (Alignments table), the oldest ones 
+# are removed when storing a new alignment would go past this
+MAX_STORED_ALIGNMENTS: int = 8
+
+
+def _stored_alignment(cur: ResultsDbCursor,
+                      rows: List[Any],
+                      align_key: str,
+                      tolerances: Tuple[float, float, float],
+                      alignment: Literal["first_match", "connected_components"]
+                      ) -> Tuple[int, npt.NDArray[np.int64]] :
+    """
+    Align DIA precursors (rows from ``_fetch_dia_precursors``) like ``_align_precursors``, reusing the 
+    alignment stored in the results database with the same parameters (``align_key``) if it has the
+    same DIA precursors (same identifiers, m/z, RT, arrival time, and CCS, in the same order). 
+    Otherwise the precursors are aligned and the alignment is stored, replacing any alignment with 
+    the same parameters and removing the oldest alignments past ``MAX_STORED_ALIGNMENTS``. Returns 
+    the alignment identifier and the group index for each precursor. Does not commit, that is left 
+    to the caller.
+    """
+    pre_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    # m/z, RT, DT, CCS (NULL CCS -> NaN)
+    values = np.array([row[2:6] for row in rows], dtype=np.float64).reshape(-1, 4)
+    members_hash = hashlib.sha256(pre_ids.tobytes() + values.tobytes()).hexdigest()
+    qry_sel = """--beginsql
+        SELECT align_id, members_hash FROM Alignments WHERE align_key=?
+    --endsql"""
+    stored = cur.execute(qry_sel, (align_key,)).fetchone()
+    if stored is not None and stored[1] == members_hash:
+        qry_members = """--beginsql
+            SELECT afeat_id FROM AlignedFeatureMembers WHERE align_id=? ORDER BY member_n
+        --endsql"""
+        groups = np.array([_ for _, in cur.execute(qry_members, (stored[0],))], dtype=np.int64)
+        return stored[0], groups
+    groups = _align_precursors(values[:, :3], tolerances, alignment)
+    if stored is not None:
+        for table in ["AlignedFeatureMembers", "AlignedFeatures", "Alignments"]:
+            cur.execute(f"DELETE FROM {table} WHERE align_id=?", (stored[0],))
+    # consensus values are the means over the members of each group (CCS only from members that have it)
+    n_groups = int(groups.max()) + 1 if groups.size > 0 else 0
+    n_members = np.bincount(groups, minlength=n_groups)
+    means = [np.bincount(groups, weights=values[:, i], minlength=n_groups) / n_members for i in range(3)]
+    has_ccs = ~np.isnan(values[:, 3])
+    n_ccs = np.bincount(groups[has_ccs], minlength=n_groups)
+    sum_ccs = np.bincount(groups[has_ccs], weights=values[has_ccs, 3], minlength=n_groups)
+    ccs = [float(c) / n if n > 0 else None for c, n in zip(sum_ccs, n_ccs)]
+    cur.execute("INSERT INTO Alignments VALUES (?,?,?,?,?)", 
+                (None, align_key, members_hash, len(pre_ids), n_groups))
+    align_id = cur.lastrowid
+    # lastrowid should only be None if something went wrong with the insert
+    assert type(align_id) is int
+    cur.executemany("INSERT INTO AlignedFeatures VALUES (?,?,?,?,?,?,?)", 
+                    zip(repeat(align_id), range(n_groups), n_members.tolist(), 
+                        *[mean.tolist() for mean in means], ccs))
+    cur.executemany("INSERT INTO AlignedFeatureMembers VALUES (?,?,?,?)", 
+                    zip(repeat(align_id), range(len(pre_ids)), groups.tolist(), pre_ids.tolist()))
+    # only keep the most recently stored alignments
+    qry_old = """--beginsql
+        SELECT align_id FROM Alignments ORDER BY align_id DESC LIMIT -1 OFFSET ?
+    --endsql"""
+    old_align_ids = cur.execute(qry_old, (MAX_STORED_ALIGNMENTS,)).fetchall()
+    for table in ["AlignedFeatureMembers", "AlignedFeatures", "Alignments"]:
+        cur.executemany(f"DELETE FROM {table} WHERE align_id=?", old_align_ids)
+    return align_id, groups
+
+
 # TODO: This is a pretty well-defined data structure, maybe it would be
 #       worth it to just implement an internal dataclass or something like
 #       that? It would make it unecessary to have this type alias and could
@@ -316,7 +1307,9 @@ def _extract_intermediate_data(cur: ResultsDbCursor,
                                abundance_value: Literal["dt_area", "dt_height"],
                                include_unknowns: bool,
                                limit_precursor_mz_ppm: float,
-                               annotation_combine_strategy: Literal["union", "intersection"]
+                               annotation_combine_strategy: Literal["union", "intersection"],
+                               alignment: Literal["first_match", "connected_components"] = "first_match",
+                               reuse_alignment: bool = False
                                ) -> _GroupedResults :
     """
     Performs all the steps for extracting and aggregating data from the results database 
@@ -325,7 +1318,8 @@ def _extract_intermediate_data(cur: ResultsDbCursor,
     format and exported. It is useful to have this part of the process in a separate 
     function so that various selection and filtering parameters can be tested out and 
     this intermediate data structure can be inspected instead of the results always being 
-    written all the way into a .csv file.
+    written all the way into a .csv file. With ``reuse_alignment`` set, the alignment is stored in 
+    the results database and reused (see ``_stored_alignment``).
     """
     # group the precursors based on m/z, RT, and DT
     grouped = [
@@ -345,31 +1339,19 @@ def _extract_intermediate_data(cur: ResultsDbCursor,
         # }, 
         # ...
     ]
+    rows = list(_fetch_dia_precursors(cur, include_unknowns, include_dfile_ids, limit_precursor_mz_ppm))
+    # align the DIA precursors, groups are numbered in order of their first member
+    if reuse_alignment:
+        align_key = _alignment_key(include_dfile_ids, tolerances, include_unknowns, limit_precursor_mz_ppm, 
+                                   alignment)
+        _, groups = _stored_alignment(cur, rows, align_key, tolerances, alignment)
+    else:
+        groups = _align_precursors([row[2:5] for row in rows], tolerances, alignment)
     # iterate through the DIA precursors and group them
-    for dia_pre_id, dfile_id, *mz_rt_dt, ccs, dt_pkht, dt_area, annotations in _fetch_dia_precursors(
-        cur, include_unknowns, include_dfile_ids, limit_precursor_mz_ppm
-    ):
-        # flag indicating if this entry was matched with an entry in the grouped list
-        matched = False
+    for group_idx, (dia_pre_id, dfile_id, *mz_rt_dt, ccs, dt_pkht, dt_area, annotations) in zip(groups.tolist(), rows):
         abundance = {"dt_area": dt_area, "dt_height": dt_pkht}[abundance_value]
         anns = set(annotations.split("|"))
-        # NOTE: This is a slow way to do this O(N^2), but probably OK for now
-        for group in grouped:
-            if _precursor_match(group["mz_rt_dt"], mz_rt_dt, tolerances):
-                matched = True
-                group["dia_pre_ids"].append(dia_pre_id)
-                # take the intersection or union of all possible annotations
-                match annotation_combine_strategy:
-                    case "intersection":
-                        group["annotations"] &= anns
-                    case "union":
-                        group["annotations"] |= anns
-                if dfile_id in group["abundance"]:
-                    group["abundance"][dfile_id] += abundance
-                else:
-                    group["abundance"][dfile_id] = abundance
-                break
-        if not matched:
+        if group_idx == len(grouped):
             grouped.append({
                 "dia_pre_ids": [dia_pre_id],
                 "mz_rt_dt": mz_rt_dt,
@@ -377,6 +1359,19 @@ def _extract_intermediate_data(cur: ResultsDbCursor,
                 "annotations": anns,
                 "abundance": {dfile_id: abundance}
             })
+        else:
+            group = grouped[group_idx]
+            group["dia_pre_ids"].append(dia_pre_id)
+            # take the intersection or union of all possible annotations
+            match annotation_combine_strategy:
+                case "intersection":
+                    group["annotations"] &= anns
+                case "union":
+                    group["annotations"] |= anns
+            if dfile_id in group["abundance"]:
+                group["abundance"][dfile_id] += abundance
+            else:
+                group["abundance"][dfile_id] = abundance
     return grouped
 
 
@@ -408,62 +1403,494 @@ def _setup_alias_mapping(cur: ResultsDbCursor,
     return out_aliases
     
 
+def _results_table_schema(alias_mapping: Dict[int, str],
+                          include_dfile_ids: List[int]
+                          ) -> Dict[str, Any] :
+    """ column names and types for the exported results table """
+    return {
+        "precursor IDs": pl.String, 
+        "m/z": pl.Float64, 
+        "RT (min)": pl.Float64, 
+        "arrival time (ms)": pl.Float64, 
+        "CCS (Ang^2)": pl.Float64, 
+        "Lipid@Adduct": pl.String,
+    } | {
+        alias: pl.Int64
+        for dfid, alias in alias_mapping.items() 
+        if dfid in include_dfile_ids
+    }
+
+
 def _unpack_intermediate_results(grouped: _GroupedResults,
                                  alias_mapping: Dict[int, str],
                                  include_unknowns: bool,
                                  include_dfile_ids: List[int],
-                                 ) -> pl.DataFrame :
+                                 chunk_size: Optional[int] = None
+                                 ) -> Generator[pl.DataFrame, Any, None] :
     """
     unpack all of the info from the intermediate grouped results data structure into
-    tabular format and return it in a polars dataframe
-    """
-    # data dictionary
-    # column name: column data
-    data = {
-        "precursor IDs": [], 
-        "m/z": [], 
-        "RT (min)": [], 
-        "arrival time (ms)": [], 
-        "CCS (Ang^2)": [], 
-        "Lipid@Adduct": [] 
-    } | {
-        alias: []
-        for dfid, alias in alias_mapping.items() 
-        if dfid in include_dfile_ids
-    }
-    # fill the data dictionary
-    for entry in grouped:
-        if include_unknowns or len(entry["annotations"]) > 0:
+    tabular format, sorted by annotations, RT, and arrival time, and yield it in polars 
+    dataframes of up to chunk_size rows (all rows at once if chunk_size is None)
+    """
+    schema = _results_table_schema(alias_mapping, include_dfile_ids)
+    # sort the entries first so the chunks are in order
+    entries = [
+        ("|".join(entry["annotations"]), entry) 
+        for entry in grouped 
+        if include_unknowns or len(entry["annotations"]) > 0
+    ]
+    entries.sort(key=lambda x: (x[0], x[1]["mz_rt_dt"][1], x[1]["mz_rt_dt"][2]))
+    chunk_size = max(len(entries), 1) if chunk_size is None else chunk_size
+    for start in range(0, max(len(entries), 1), chunk_size):
+        # data dictionary
+        # column name: column data
+        data = {col: [] for col in schema}
+        # fill the data dictionary
+        for annotations, entry in entries[start:start + chunk_size]:
             data["precursor IDs"].append("|".join(map(str, entry["dia_pre_ids"])))
             emz, ert, edt = entry["mz_rt_dt"]
             data["m/z"].append(emz)
             data["RT (min)"].append(ert)
             data["arrival time (ms)"].append(edt)
             data["CCS (Ang^2)"].append(entry["ccs"])
-            data["Lipid@Adduct"].append("|".join(entry["annotations"]))
-            for dfid, abun in entry["abundance"].items():
-                if dfid in include_dfile_ids:
-                    # fetch abundances, cast to ints 
-                    data[alias_mapping[dfid]].append(int(abun))
+            data["Lipid@Adduct"].append(annotations)
             for dfid, alias in alias_mapping.items():
                 if dfid in include_dfile_ids:
-                    if dfid not in entry["abundance"].keys():
-                        data[alias].append(None)
-    return pl.DataFrame(data).sort("Lipid@Adduct", "RT (min)", "arrival time (ms)")
+                    # fetch abundances, cast to ints 
+                    abun = entry["abundance"].get(dfid)
+                    data[alias].append(None if abun is None else int(abun))
+        yield pl.DataFrame(data, schema=schema)
+
+
+#------------------------------------------------------------------------------
+# chunked export, for results databases that are too large to hold in memory
+
+
+# column names and types for DIA precursors fetched from the results database 
+# (see _fetch_dia_precursors)
+_DIA_PRECURSOR_SCHEMA: Dict[str, Any] = {
+    "dia_pre_id": pl.Int64,
+    "dfile_id": pl.Int64,
+    "mz": pl.Float64,
+    "rt": pl.Float64,
+    "dt": pl.Float64,
+    "ccs": pl.Float64,
+    "dt_height": pl.Float64,
+    "dt_area": pl.Float64,
+    "annotations": pl.String,
+}
+
+
+def _fetch_dia_precursor_chunks(cur: ResultsDbCursor,
+                                include_unknowns: bool,
+                                include_dfile_ids: List[int],
+                                limit_precursor_mz_ppm: float,
+                                chunk_size: int
+                                ) -> Generator[pl.DataFrame, Any, None] :
+    """ fetch the DIA precursors from the database in order of m/z, yields chunks of up to chunk_size rows """
+    rows = _fetch_dia_precursors(cur, include_unknowns, include_dfile_ids, limit_precursor_mz_ppm, 
+                                 order_by_mz=True)
+    while len(chunk := list(islice(rows, chunk_size))) > 0:
+        yield pl.DataFrame(chunk, schema=_DIA_PRECURSOR_SCHEMA, orient="row")
+
 
+def _aggregate_groups(precursors: pl.DataFrame,
+                      groups: npt.NDArray[np.int64],
+                      abundance_value: Literal["dt_area", "dt_height"],
+                      include_unknowns: bool,
+                      annotation_combine_strategy: Literal["union", "intersection"],
+                      alias_mapping: Dict[int, str],
+                      include_dfile_ids: List[int]
+                      ) -> pl.DataFrame :
+    """
+    Aggregate aligned DIA precursors into rows of the results table (see ``_results_table_schema``), 
+    this is the columnar equivalent of ``_extract_intermediate_data`` followed by 
+    ``_unpack_intermediate_results``. Each group takes m/z, RT, arrival time, and CCS from its first 
+    member, annotations are kept in the order they are first seen, and rows are in order of groups.
+    """
+    precursors = precursors.with_columns(
+        group=pl.Series(groups, dtype=pl.Int64), 
+        row=pl.int_range(pl.len(), dtype=pl.Int64)
+    )
+    # abundances are summed within each group for each data file, then cast to ints 
+    abundances = [
+        pl.when((pl.col("dfile_id") == dfid).any())
+        .then(pl.col(abundance_value).filter(pl.col("dfile_id") == dfid).sum())
+        .cast(pl.Int64)
+        .alias(alias)
+        for dfid, alias in alias_mapping.items()
+        if dfid in include_dfile_ids
+    ]
+    table = precursors.group_by("group", maintain_order=True).agg(
+        pl.col("dia_pre_id").cast(pl.String).str.join("|").alias("precursor IDs"),
+        pl.col("mz").first().alias("m/z"),
+        pl.col("rt").first().alias("RT (min)"),
+        pl.col("dt").first().alias("arrival time (ms)"),
+        pl.col("ccs").first().alias("CCS (Ang^2)"),
+        pl.len().alias("n_pre"),
+        *abundances
+    )
+    # one row per (precursor, annotation)
+    anns = (
+        precursors.select("group", "row", pl.col("annotations").str.split("|"))
+        .explode("annotations")
+        .drop_nulls("annotations")
+        .unique(["row", "annotations"], keep="first", maintain_order=True)
+    )
+    # take the intersection or union of all possible annotations
+    anns = anns.group_by("group", "annotations", maintain_order=True).agg(pl.len().alias("n_ann"))
+    if annotation_combine_strategy == "intersection":
+        anns = (
+            anns.join(table.select("group", "n_pre"), on="group", maintain_order="left")
+            .filter(pl.col("n_ann") == pl.col("n_pre"))
+        )
+    anns = anns.group_by("group", maintain_order=True).agg(
+        pl.col("annotations").str.join("|").alias("Lipid@Adduct")
+    )
+    table = (
+        table.join(anns, on="group", how="left", maintain_order="left")
+        .with_columns(pl.col("Lipid@Adduct").fill_null(""))
+    )
+    if not include_unknowns:
+        table = table.filter(pl.col("Lipid@Adduct") != "")
+    return table.select(_results_table_schema(alias_mapping, include_dfile_ids).keys())
+
+
+def _extract_results_chunks(cur: ResultsDbCursor,
+                            include_dfile_ids: List[int],
+                            tolerances: Tuple[float, float, float],
+                            abundance_value: Literal["dt_area", "dt_height"],
+                            include_unknowns: bool,
+                            limit_precursor_mz_ppm: float,
+                            annotation_combine_strategy: Literal["union", "intersection"],
+                            alignment: Literal["first_match", "connected_components"],
+                            alias_mapping: Dict[int, str],
+                            db_chunk_size: int,
+                            chunk_size: int
+                            ) -> Generator[pl.DataFrame, Any, None] :
+    """
+    Fetch DIA precursors from the results database in order of m/z, db_chunk_size at a time, align 
+    them and yield the completed rows of the results table in polars dataframes of up to chunk_size 
+    rows (always at least one, possibly empty, chunk). Precursors are aligned in order of m/z, so with first_match alignment the groups can 
+    differ from ``_extract_intermediate_data``, which aligns them in order of their annotations.
+
+    Groups with any member within the m/z tolerance of the last precursor in a chunk could still 
+    pick up precursors from the next chunk, so their members are carried over and aligned again 
+    along with it. Re-aligning whole groups (in their original order) gives the same result, so the 
+    output does not depend on the chunk size.
+    """
+    schema = _results_table_schema(alias_mapping, include_dfile_ids)
+    yielded = False
+    carry = None
+    chunks = _fetch_dia_precursor_chunks(cur, include_unknowns, include_dfile_ids, 
+                                         limit_precursor_mz_ppm, db_chunk_size)
+    for chunk in chunks:
+        precursors = chunk if carry is None else pl.concat([carry, chunk])
+        groups = _align_precursors(precursors.select("mz", "rt", "dt").to_numpy(), tolerances, alignment)
+        # a group is done once its largest m/z is out of reach of precursors in later chunks (which 
+        # all have m/z >= the last one in this chunk), groups are numbered in order of their first 
+        # member (lowest m/z) so all groups from the first one that is not done onward are carried 
+        # over to keep the rows in order
+        boundary = chunk["mz"][-1] - tolerances[0] * (1 + 1e-6)
+        group_max_mz = np.full(groups.max() + 1, -np.inf)
+        np.maximum.at(group_max_mz, groups, precursors["mz"].to_numpy())
+        is_open = groups >= np.argmax(group_max_mz >= boundary)
+        carry = precursors.filter(pl.Series(is_open))
+        done = ~is_open
+        table = _aggregate_groups(precursors.filter(pl.Series(done)), groups[done], abundance_value, 
+                                  include_unknowns, annotation_combine_strategy, alias_mapping, 
+                                  include_dfile_ids)
+        if table.height > 0:
+            yielded = True
+            yield from table.iter_slices(chunk_size)
+    # whatever is left over after the last chunk is done
+    if carry is not None and carry.height > 0:
+        groups = _align_precursors(carry.select("mz", "rt", "dt").to_numpy(), tolerances, alignment)
+        table = _aggregate_groups(carry, groups, abundance_value, include_unknowns, 
+                                  annotation_combine_strategy, alias_mapping, include_dfile_ids)
+        if table.height > 0:
+            yielded = True
+            yield from table.iter_slices(chunk_size)
+    if not yielded:
+        yield pl.DataFrame(schema=schema)
+
+
+#------------------------------------------------------------------------------
+# results table files
 
+
+# file formats for exported results tables, by file extension
+RESULTS_TABLE_FORMATS: Dict[str, str] = {
+    ".csv": "csv",
+    ".parquet": "parquet",
+    ".arrow": "ipc",
+    ".ipc": "ipc",
+    ".feather": "ipc",
+}
+
+
+def _results_table_format(path: str,
+                          fmt: Optional[Literal["csv", "parquet", "ipc"]]
+                          ) -> str :
+    """ get the results table file format, from the file extension if not specified """
+    if fmt is None:
+        ext = os.path.splitext(path)[1].lower()
+        if ext not in RESULTS_TABLE_FORMATS:
+            raise ValueError(f"unable to determine results table format from file extension: {ext}, "
+                             f"expected one of {list(RESULTS_TABLE_FORMATS)}")
+        fmt = RESULTS_TABLE_FORMATS[ext]  # type: ignore
+    if fmt not in ["csv", "parquet", "ipc"]:
+        raise ValueError(f"results table format must be 'csv', 'parquet', or 'ipc', got: {fmt}")
+    return fmt  # type: ignore
+
+
+class ResultsTableWriter():
+    """
+    Write a results table to file (CSV, Parquet, or Arrow IPC) one chunk of rows at a time, so that 
+    the whole table never needs to be held in memory. 
+    
+    CSV chunks are appended directly to the output file. Parquet and Arrow IPC chunks are written to 
+    temporary part files, which are combined into the output file with a streaming scan/sink when the 
+    writer is closed. Use as a context manager, if an exception is raised the output file is not written.
+    """
+
+    def __init__(self, 
+                 path: str,
+                 fmt: Optional[Literal["csv", "parquet", "ipc"]] = None,
+                 compression: Optional[str] = None
+                 ) -> None :
+        """
+        Initialize the writer
+
+        Parameters
+        ----------
+        path
+            output file
+        [fmt]
+            file format ("csv", "parquet", or "ipc" for Arrow IPC), None to determine from the file 
+            extension (see ``RESULTS_TABLE_FORMATS``)
+        [compression]
+            compression for Parquet ("zstd" by default) or Arrow IPC ("uncompressed" by default, which 
+            allows the file to be memory-mapped when reading it back) output, ignored for CSV
+        """
+        self.path = path
+        self.fmt = _results_table_format(path, fmt)
+        self.compression = (
+            compression if compression is not None 
+            else {"csv": None, "parquet": "zstd", "ipc": "uncompressed"}[self.fmt]
+        )
+        self.n_rows = 0
+        self._schema = None
+        self._parts = []
+        self._tmp_dir = None
+        self._csv = None
+        if self.fmt == "csv":
+            self._csv = open(path, "wb")
+        else:
+            # part files go next to the output file, so combining them does not cross file systems
+            self._tmp_dir = tempfile.mkdtemp(prefix=".parts_", dir=os.path.dirname(os.path.abspath(path)))
+
+    def write(self, 
+              df: pl.DataFrame
+              ) -> None :
+        """ write a chunk of rows, all chunks must have the same schema """
+        if self._schema is None:
+            self._schema = df.schema
+        elif df.schema != self._schema:
+            raise ValueError("all chunks written to a results table must have the same schema")
+        if self._csv is not None:
+            # only the first chunk gets the header
+            df.write_csv(self._csv, include_header=(len(self._parts) == 0))
+            self._parts.append(None)
+        else:
+            part = os.path.join(self._tmp_dir, f"{len(self._parts):06d}.{self.fmt}")  # type: ignore
+            if self.fmt == "parquet":
+                df.write_parquet(part, compression="lz4")
+            else:
+                df.write_ipc(part, compression="lz4")
+            self._parts.append(part)
+        self.n_rows += df.height
+
+    def close(self
+              ) -> None :
+        """ finish writing the output file and clean up """
+        if self._csv is not None:
+            self._csv.close()
+            self._csv = None
+        elif self._tmp_dir is not None:
+            if len(self._parts) == 0:
+                # nothing was written, still produce an (empty) output file
+                self.write(pl.DataFrame())
+            if self.fmt == "parquet":
+                pl.scan_parquet(self._parts).sink_parquet(self.path, compression=self.compression)
+            else:
+                pl.scan_ipc(self._parts).sink_ipc(self.path, compression=self.compression)
+            self._discard_parts()
+
+    def _discard_parts(self
+                       ) -> None :
+        """ remove the temporary part files """
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+    def __enter__(self
+                  ) -> "ResultsTableWriter" :
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback
+                 ) -> None :
+        if exc_type is None:
+            self.close()
+        else:
+            if self._csv is not None:
+                self._csv.close()
+                self._csv = None
+                os.remove(self.path)
+            self._discard_parts()
+
+
+def read_results_table(path: str,
+                       fmt: Optional[Literal["csv", "parquet", "ipc"]] = None,
+                       columns: Optional[List[str]] = None,
+                       lazy: bool = False
+                       ) -> Union[pl.DataFrame, pl.LazyFrame] :
+    """
+    Read an exported results table (from ``export_results_table``) back in. Uncompressed Arrow IPC 
+    files are memory-mapped, so the data is not copied when it is loaded. 
+
+    Parameters
+    ----------
+    path
+        results table file
+    [fmt]
+        file format ("csv", "parquet", or "ipc" for Arrow IPC), None to determine from the file 
+        extension (see ``RESULTS_TABLE_FORMATS``)
+    [columns]
+        only load these columns, None to load all of them
+    [lazy]
+        return a LazyFrame that scans the file instead of loading it
+
+    Returns
+    -------
+    table
+        results table
+    """
+    fmt = _results_table_format(path, fmt)
+    match fmt:
+        case "csv":
+            # the precursor IDs are strings, even if a column only contains single IDs
+            lf = pl.scan_csv(path, schema_overrides={"precursor IDs": pl.String})
+        case "parquet":
+            lf = pl.scan_parquet(path)
+        case "ipc":
+            lf = pl.scan_ipc(path)
+    if columns is not None:
+        lf = lf.select(columns)
+    if lazy:
+        return lf
+    if fmt == "ipc" and columns is None:
+        return pl.read_ipc(path)
+    return lf.collect()
+
+
+def align_dia_features(results_db: ResultsDbPath,
+                       tolerances: Tuple[float, float, float],
+                       select_data_files: Optional[Union[List[int], List[str]]] = None,
+                       include_unknowns: bool = False,
+                       limit_precursor_mz_ppm: float = 40.,
+                       alignment: Literal["first_match", "connected_components"] = "first_match"
+                       ) -> int :
+    """
+    Align DIA features across samples (data files) the same way as ``export_results_table`` and 
+    store the alignment in the results database: the aligned features with their consensus m/z, RT, 
+    arrival time, and CCS (AlignedFeatures table) and the DIA features in each of them 
+    (AlignedFeatureMembers table). There is one stored alignment for each set of parameters 
+    (Alignments table), it gets reused (by this function and by ``export_results_table`` with 
+    ``reuse_alignment`` set) as long as the DIA features that get aligned have not changed, otherwise 
+    it is replaced. Only the ``MAX_STORED_ALIGNMENTS`` most recently stored alignments are kept.
+    Stored alignments can be read back with ``lipidimea.results.ResultsReader``, the GUI does not 
+    use them.
+
+    Parameters
+    ----------
+    results_db
+        results database with annotated DIA features
+    tolerances
+        tuple of tolerances (m/z, RT, arrival time) for combining DIA precursors
+    [select_data_files]
+        If provided, restrict the alignment to only include the specified list of data files, by data 
+        file name if list of str or by data file ID if list of int
+    [include_unknowns]
+        flag indicating whether to include DIA features that do not have any associated annotations
+    [limit_precursor_mz_ppm]
+        limit the absolute m/z ppm error when selecting lipid annotations 
+    [alignment]
+        strategy for aligning features across data files, "first_match" or "connected_components" 
+        (see ``export_results_table``)
+
+    Returns
+    -------
+    align_id
+        identifier of the stored alignment
+    """
+    # ensure results database file exists
+    if not os.path.isfile(results_db):
+        raise FileNotFoundError(errno.ENOENT,
+                                os.strerror(errno.ENOENT),
+                                results_db)
+    con = connect_results_db(results_db)
+    cur = con.cursor()
+    _upgrade_results_db_schema(cur)
+    include_dfile_ids = _get_included_dfile_ids(select_data_files, cur)
+    rows = list(_fetch_dia_precursors(cur, include_unknowns, include_dfile_ids, limit_precursor_mz_ppm))
+    align_key = _alignment_key(include_dfile_ids, tolerances, include_unknowns, limit_precursor_mz_ppm, alignment)
+    align_id, _ = _stored_alignment(cur, rows, align_key, tolerances, alignment)
+    con.commit()
+    con.close()
+    return align_id
+
+
+def _renamed_kwarg(old: str, new: str
+                   ) -> Callable :
+    """
+    Decorator that accepts the old name of a renamed keyword argument (with a DeprecationWarning) 
+    and passes its value on under the new name
+    """
+    def decorator(func: Callable) -> Callable :
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any :
+            if old in kwargs:
+                if new in kwargs:
+                    raise TypeError(f"{func.__name__}() got values for both {old!r} and {new!r}")
+                warnings.warn(f"{func.__name__}(): {old!r} is deprecated, use {new!r} instead", 
+                              DeprecationWarning, stacklevel=2)
+                kwargs[new] = kwargs.pop(old)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@_renamed_kwarg("out_csv", "out_file")
 def export_results_table(results_db: ResultsDbPath,
-                         out_csv: str,
+                         out_file: str,
                          tolerances: Tuple[float, float, float],
                          select_data_files: Optional[Union[List[int], List[str]]] = None,
                          abundance_value: Literal["dt_area", "dt_height"] = "dt_area",
                          include_unknowns: bool = False,
                          limit_precursor_mz_ppm: float = 40.,
                          data_file_aliases: Optional[Dict[Union[int, str], str]] = None,
-                         annotation_combine_strategy: Literal["union", "intersection"] = "union"
+                         annotation_combine_strategy: Literal["union", "intersection"] = "union",
+                         alignment: Literal["first_match", "connected_components"] = "first_match",
+                         out_format: Optional[Literal["csv", "parquet", "ipc"]] = None,
+                         compression: Optional[str] = None,
+                         chunk_size: int = 100000,
+                         db_chunk_size: Optional[int] = None,
+                         reuse_alignment: bool = False
                          ) -> int :
     """
-    Aggregate the results (DIA) from the database and output in a tabular format (.csv).
+    Aggregate the results (DIA) from the database and output in a tabular format (.csv, .parquet, or 
+    Arrow IPC).
 
     Aligns features across samples (data files) based on m/z, RT, and arrival time using specified
     tolerances. If more than one feature from a single data file falls within the specified tolerances,
@@ -478,8 +1905,10 @@ def export_results_table(results_db: ResultsDbPath,
     ----------
     results_db
         results database with annotated DIA features
-    out_csv
-        output results file (.csv)
+    out_file
+        output results file, the format is determined from the file extension (.csv, .parquet, or 
+        .arrow/.ipc/.feather for Arrow IPC) unless ``out_format`` is set (this parameter used to be 
+        called ``out_csv``, which is still accepted as a keyword argument but deprecated)
     tolerances
         tuple of tolerances (m/z, RT, arrival time) for combining DIA precursors
     [select_data_files]
@@ -500,6 +1929,34 @@ def export_results_table(results_db: ResultsDbPath,
         the strategy for what annotations to keep. "union" to keep all possible annotations and
         "intersection" to only keep annotations that are common among all features that get combined into
         a group. The latter is much more stringent. 
+    [alignment]
+        strategy for aligning features across data files. "first_match" to process features one at a 
+        time, adding each to the first group with a first feature that matches it within tolerances (or 
+        starting a new group), or "connected_components" to group all features that are linked by any
+        chain of matches within tolerances. The latter is not sensitive to the order in which the 
+        features are processed but can merge larger groups. 
+    [out_format]
+        output file format ("csv", "parquet", or "ipc"), None to determine from the file extension
+    [compression]
+        compression for Parquet ("zstd" by default) or Arrow IPC ("uncompressed" by default) output, 
+        see ``ResultsTableWriter``
+    [chunk_size]
+        number of rows to write to the output file at a time
+    [db_chunk_size]
+        If provided, fetch DIA features from the database in order of m/z, this many at a time, and 
+        align them and write out the completed groups before fetching the next chunk. This keeps memory 
+        use bounded for very large results databases. Features are aligned in order of m/z instead of 
+        in order of their annotations (this can change "first_match" groups, "connected_components" 
+        groups are the same) and rows are written in order of m/z instead of sorted by annotations.
+    [reuse_alignment]
+        reuse the alignment of the DIA features stored in the results database (Alignments, 
+        AlignedFeatures, and AlignedFeatureMembers tables) for the same tolerances, alignment 
+        strategy, and selection of DIA features (data files, ``include_unknowns``, and 
+        ``limit_precursor_mz_ppm``), as long as the DIA features have not changed since (see
+        ``align_dia_features``). NOTE: this writes into the results database, if there is no 
+        matching stored alignment the new alignment gets stored (only the ``MAX_STORED_ALIGNMENTS`` 
+        most recent alignments are kept). Only applies if ``db_chunk_size`` is not set, in chunked 
+        mode the DIA features are always aligned on the fly.
     
     Returns
     -------
@@ -511,28 +1968,58 @@ def export_results_table(results_db: ResultsDbPath,
         raise FileNotFoundError(errno.ENOENT,
                                 os.strerror(errno.ENOENT),
                                 results_db)
-    # connect to results database
-    con = sqlite3.connect(results_db)
+    # check the output format before doing any of the work
+    out_format = _results_table_format(out_file, out_format)  # type: ignore
+    # connect to results database, this writes to it (schema upgrade and stored alignments) so it
+    # uses the write profile, which also keeps sorting the DIA precursors by m/z in chunked mode 
+    # out of memory
+    con = connect_results_db(results_db)
     cur = con.cursor()
+    # results databases created with older versions of the schema may not have the FilteredLipids view
+    _upgrade_results_db_schema(cur)
+    con.commit()
     # determine the set of data files to include
     include_dfile_ids = _get_included_dfile_ids(select_data_files, cur)
-    # perform the first half of the process to get the _GroupedResults
-    # intermediate data structure
-    grouped = _extract_intermediate_data(cur,
+    # set up the mapping between data file aliases and data file names/IDs
+    alias_mapping = _setup_alias_mapping(cur, data_file_aliases)
+    if db_chunk_size is None:
+        # perform the first half of the process to get the _GroupedResults
+        # intermediate data structure
+        grouped = _extract_intermediate_data(cur,
+                                             include_dfile_ids,
+                                             tolerances, 
+                                             abundance_value, 
+                                             include_unknowns, 
+                                             limit_precursor_mz_ppm,
+                                             annotation_combine_strategy,
+                                             alignment,
+                                             reuse_alignment=reuse_alignment)
+        # commit the stored alignment (if any)
+        con.commit()
+        # upack the intermediate data structure into tabular format (as polars dataframes)
+        chunks = _unpack_intermediate_results(grouped, 
+                                              alias_mapping, 
+                                              include_unknowns,
+                                              include_dfile_ids,
+                                              chunk_size=chunk_size)
+    else:
+        # fetch, align, and aggregate the DIA precursors in chunks 
+        chunks = _extract_results_chunks(cur,
                                          include_dfile_ids,
                                          tolerances, 
                                          abundance_value, 
                                          include_unknowns, 
                                          limit_precursor_mz_ppm,
-                                         annotation_combine_strategy)
-    # set up the mapping between data file aliases and data file names/IDs
-    alias_mapping = _setup_alias_mapping(cur, data_file_aliases)
-    # upack the intermediate data structure into tabular format (as a polars dataframe)
-    df = _unpack_intermediate_results(grouped, 
-                                      alias_mapping, 
-                                      include_unknowns,
-                                      include_dfile_ids)  
+                                         annotation_combine_strategy,
+                                         alignment,
+                                         alias_mapping,
+                                         db_chunk_size,
+                                         chunk_size)
+    # write the results to the output file in chunks
     # TODO: (filter dataframe? replace NAs?)
-    df.write_csv(out_csv)
-    return df.shape[0]
+    with ResultsTableWriter(out_file, fmt=out_format, compression=compression) as writer:
+        for df in chunks:
+            writer.write(df)
+    con.close()
+    return writer.n_rows
 